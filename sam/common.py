@@ -5,6 +5,7 @@ import logging
 import web
 import smtplib
 from sam import constants
+from sam import iputil
 logger = logging.getLogger(__name__)
 
 
@@ -110,11 +111,7 @@ def IPtoString(ip_number):
     Returns: The IP address as a dotted-decimal string.
 
     """
-    return "{0}.{1}.{2}.{3}".format(
-        (ip_number & 0xFF000000) >> 24,
-        (ip_number & 0xFF0000) >> 16,
-        (ip_number & 0xFF00) >> 8,
-        ip_number & 0xFF)
+    return iputil.decode(ip_number)
 
 
 def IPtoInt(a, b, c, d):
@@ -129,7 +126,7 @@ def IPtoInt(a, b, c, d):
     Returns: The IP address as a simple 32-bit unsigned integer
 
     """
-    return (int(a) << 24) + (int(b) << 16) + (int(c) << 8) + int(d)
+    return iputil.ip_to_int(a, b, c, d)
 
 
 def IPStringtoInt(ip):
@@ -141,17 +138,7 @@ def IPStringtoInt(ip):
     Returns: The IP address as a simple 32-bit unsigned integer
 
     """
-    address_mask = ip.split("/")
-    parts = address_mask[0].split(".")
-    ip_int = 0
-    for i in range(4):
-        ip_int <<= 8
-        if len(parts) > i:
-            try:
-                ip_int += int(parts[i])
-            except:
-                pass
-    return ip_int
+    return iputil.encode_partial(ip)
 
 
 def determine_range(ip8=-1, ip16=-1, ip24=-1, ip32=-1):
@@ -219,13 +206,8 @@ def get_domain(path):
 
 
 def sqlite_udf(db):
-    db._db_cursor().connection.create_function("decodeIP", 1,
-                                               lambda ip: "{}.{}.{}.{}".format(ip >> 24,
-                                                                               ip >> 16 & 0xff,
-                                                                               ip >> 8 & 0xff,
-                                                                               ip & 0xff))
-    db._db_cursor().connection.create_function("encodeIP", 4,
-                                               lambda a, b, c, d: a << 24 | b << 16 | c << 8 | d)
+    db._db_cursor().connection.create_function("decodeIP", 1, iputil.make_cached_decoder())
+    db._db_cursor().connection.create_function("encodeIP", 4, iputil.ip_to_int)
 
 
 def sendmail(to_address, subject, body, from_address=constants.smtp['from'], headers=None, **kw):
@@ -293,6 +275,24 @@ def get_db(config):
     return db, db_quiet
 
 
+def get_infile_db(config):
+    """
+    Connect to a MySQL database with LOAD DATA LOCAL INFILE allowed, for bulk loading Syslog rows
+    (see importers/bulk_load.py). The given config is not modified.
+
+    :param config: database connection settings, as given to get_db
+     :type config: dict
+    :return: a quiet database connection
+     :rtype: web.db.DB
+    """
+    config = dict(config, local_infile=1)
+    old = web.config.debug
+    web.config.debug = False
+    db = web.database(**config)
+    web.config.debug = old
+    return db
+
+
 def db_concat(db, *args):
     if not args:
         raise ValueError("Must supply arguments to concatenate")
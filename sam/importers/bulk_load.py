@@ -0,0 +1,144 @@
+"""
+Bulk loading of translated rows into a datasource's Syslog table.
+
+MySQL loads rows with LOAD DATA LOCAL INFILE from a temporary tab-separated file, if the
+connection was made with local_infile set (see common.get_infile_db). Otherwise, or once the
+server refuses LOCAL INFILE, the loader falls back to executemany. Other errors are raised as usual.
+SQLite loads rows with a prepared executemany inside a single transaction.
+"""
+import os
+import logging
+import tempfile
+from datetime import datetime
+logger = logging.getLogger(__name__)
+# MySQL error codes for LOAD DATA LOCAL INFILE being disabled by the server (1148, 3948) or the client library (2068)
+INFILE_REFUSED = (1148, 2068, 3948)
+
+
+def tsv_value(value):
+    """
+    Format a value for a MySQL LOAD DATA file with default escaping. Unicode is encoded as UTF-8.
+
+    :param value: a column value
+    :return: the value as it should appear in the file
+     :rtype: str
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if isinstance(value, str):
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+    return str(value)
+
+
+def infile_refused(error):
+    """
+    :param error: an exception raised by LOAD DATA LOCAL INFILE
+     :type error: Exception
+    :return: True if it means LOCAL INFILE is not allowed on this connection, as opposed to a failure of this load
+     :rtype: bool
+    """
+    args = getattr(error, 'args', ())
+    return bool(args) and args[0] in INFILE_REFUSED
+
+
+def executemany(db, query, rows):
+    """
+    Run a query once per row with the DB-API cursor's executemany, inside a transaction.
+    web.py has no public executemany, so this uses web.DB internals (ctx.transactions and _db_cursor)
+    as found in web.py 0.38 and 0.39. Check them when upgrading web.py.
+
+    :param db: database connection
+     :type db: web.DB
+    :param query: a query with one parameter marker per value, in the connection's paramstyle
+     :type query: str
+    :param rows: the parameter tuples
+     :type rows: list[tuple]
+    """
+    if db.ctx.transactions:
+        # already inside the caller's transaction
+        db._db_cursor().executemany(query, rows)
+        return
+    transaction = db.transaction()
+    try:
+        db._db_cursor().executemany(query, rows)
+    except:
+        transaction.rollback()
+        raise
+    else:
+        transaction.commit()
+
+
+class SyslogLoader(object):
+    def __init__(self, db, table, columns, ignore_duplicates=False):
+        """
+        :param db: database connection
+         :type db: web.DB
+        :param table: name of the table to load into, e.g. s1_ds1_Syslog
+         :type table: str
+        :param columns: column names, in the order values appear in each row
+         :type columns: list[str]
+        :param ignore_duplicates: skip rows whose primary key is already in the table, instead of failing
+         :type ignore_duplicates: bool
+        """
+        self.db = db
+        self.table = table
+        self.columns = list(columns)
+        self.use_infile = db.dbname == 'mysql' and bool(getattr(db, 'keywords', {}).get('local_infile'))
+        if db.paramstyle == 'qmark':
+            marker = '?'
+        else:
+            marker = '%s'
+        if not ignore_duplicates:
+            self.ignore = ''
+        elif db.dbname == 'mysql':
+            self.ignore = 'IGNORE '
+        else:
+            self.ignore = 'OR IGNORE '
+        self.insert_query = "INSERT {ignore}INTO {table} ({columns}) VALUES ({markers})".format(
+            ignore=self.ignore,
+            table=self.table,
+            columns=', '.join(self.columns),
+            markers=', '.join([marker] * len(self.columns)))
+
+    def load(self, rows):
+        """
+        Insert many rows at once.
+
+        :param rows: row tuples, with values in the same order as self.columns
+         :type rows: list[tuple]
+        :return: number of rows loaded
+         :rtype: int
+        """
+        if not rows:
+            return 0
+        if self.use_infile:
+            try:
+                return self.load_infile(rows)
+            except Exception as e:
+                if not infile_refused(e):
+                    raise
+                logger.warning("LOAD DATA LOCAL INFILE refused ({0}). Using executemany instead.".format(e))
+                self.use_infile = False
+        return self.load_executemany(rows)
+
+    def load_executemany(self, rows):
+        executemany(self.db, self.insert_query, rows)
+        return len(rows)
+
+    def load_infile(self, rows):
+        handle, path = tempfile.mkstemp(suffix='.tsv', prefix='sam_syslog_')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                for row in rows:
+                    f.write('\t'.join(map(tsv_value, row)))
+                    f.write('\n')
+            query = "LOAD DATA LOCAL INFILE $path {ignore}INTO TABLE {table} CHARACTER SET utf8 ({columns})".format(
+                ignore=self.ignore, table=self.table, columns=', '.join(self.columns))
+            self.db.query(query, vars={'path': path})
+        finally:
+            os.remove(path)
+        return len(rows)
@@ -0,0 +1,181 @@
+"""
+Pre-aggregation of translated rows before they are written to a datasource's Syslog table.
+
+Rows are merged in memory using the grouping Preprocessor.syslog_to_staging_links applies in SQL:
+(src, dst, dstport, protocol, 5-minute bucket). Each merged row carries the number of rows it stands for
+in its `links` column, so the preprocessing step produces the same links, bytes, packets and durations
+whether or not the rows were aggregated first.
+
+Buckets are written out once the input has moved `late_buckets` buckets past them, or, oldest first,
+whenever more than `max_flows` flows are held in memory. Rows that arrive for a bucket that was already
+written out simply start a new merged row for it.
+
+LinkAccumulator goes one step further for the aggregator's direct mode: it sums rows into exactly the
+StagingLinks rows preprocessing would make of them, so they never pass through the Syslog table.
+"""
+import itertools
+from sam.importers.timestamps import format_epoch
+
+BUCKET_SECONDS = 300  # the 5-minute buckets of the Links tables
+MAX_FLOWS = 100000  # merged rows held in memory before the oldest buckets are written early
+
+# indexes into a merged row:
+# src, srcport, dst, dstport, timestamp, protocol, bytes_sent, bytes_received, packets_sent, packets_received,
+# total duration, links
+TIMESTAMP = 4
+DURATION = 10
+LINKS = 11
+
+
+def add_counts(a, b):
+    # NULL counts are skipped, the same as SUM() does
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a + b
+
+
+class FlowAggregator(object):
+    def __init__(self, max_flows=MAX_FLOWS, late_buckets=1):
+        """
+        :param max_flows: merged rows to hold in memory before writing out the oldest buckets
+         :type max_flows: int
+        :param late_buckets: how many buckets behind the newest one may still receive rows
+         :type late_buckets: int
+        """
+        self.max_flows = max_flows
+        self.late_buckets = late_buckets
+        self.buckets = {}  # bucket start => {(src, dst, dstport, protocol): merged row}
+        self.flows = 0  # merged rows currently held
+        self.newest = None  # start of the newest bucket seen
+        self.rows_in = 0
+        self.rows_out = 0
+
+    def __len__(self):
+        return self.flows
+
+    def add_batch(self, batch):
+        """
+        Merge a batch of translated rows.
+
+        :param batch: translated rows, with columns in BaseImporter.keys order
+         :type batch: ColumnBatch
+        :return: merged rows from buckets that closed, ready to insert.
+            Values are in BaseImporter.keys order followed by links, with timestamps formatted for the database.
+         :rtype: list[tuple]
+        """
+        buckets = self.buckets
+        newest = self.newest
+        for src, srcport, dst, dstport, timestamp, protocol, bytes_sent, bytes_received, packets_sent, \
+                packets_received, duration in itertools.izip(*batch.columns):
+            bucket = timestamp - timestamp % BUCKET_SECONDS
+            flows = buckets.get(bucket)
+            if flows is None:
+                flows = buckets[bucket] = {}
+                if newest is None or bucket > newest:
+                    newest = bucket
+            key = (src, dst, dstport, protocol)
+            flow = flows.get(key)
+            if flow is None:
+                flows[key] = [src, srcport, dst, dstport, timestamp, protocol, bytes_sent, bytes_received,
+                              packets_sent, packets_received, duration, 1]
+                self.flows += 1
+                continue
+            if timestamp < flow[TIMESTAMP]:
+                flow[TIMESTAMP] = timestamp
+            flow[6] = add_counts(flow[6], bytes_sent)
+            flow[7] = add_counts(flow[7], bytes_received)
+            flow[8] = add_counts(flow[8], packets_sent)
+            flow[9] = add_counts(flow[9], packets_received)
+            flow[DURATION] += duration
+            flow[LINKS] += 1
+        self.rows_in += len(batch)
+        self.newest = newest
+
+        rows = []
+        if newest is not None:
+            closed = newest - self.late_buckets * BUCKET_SECONDS
+            for bucket in sorted(b for b in buckets if b < closed):
+                self.emit(bucket, rows)
+        for bucket in sorted(buckets):
+            if self.flows <= self.max_flows:
+                break
+            self.emit(bucket, rows)
+        return rows
+
+    def flush(self):
+        """
+        :return: all remaining merged rows, as returned by add_batch
+         :rtype: list[tuple]
+        """
+        rows = []
+        for bucket in sorted(self.buckets):
+            self.emit(bucket, rows)
+        self.newest = None
+        return rows
+
+    def emit(self, bucket, rows):
+        flows = self.buckets.pop(bucket)
+        self.flows -= len(flows)
+        self.rows_out += len(flows)
+        stamps = {}
+        for flow in flows.itervalues():
+            epoch = flow[TIMESTAMP]
+            stamp = stamps.get(epoch)
+            if stamp is None:
+                stamp = stamps[epoch] = format_epoch(epoch)
+            flow[TIMESTAMP] = stamp
+            # the average duration; preprocessing weights it by links
+            flow[DURATION] = int(round(flow[DURATION] / float(flow[LINKS])))
+            rows.append(tuple(flow))
+
+
+class LinkAccumulator(object):
+    """
+    Sums translated rows into links, grouped as Preprocessor.syslog_to_staging_links groups Syslog rows:
+    (src, dst, dstport, protocol, 5-minute bucket).
+    Preprocessor.links_to_staging_links writes the result to StagingLinks.
+    """
+    def __init__(self):
+        # (src, dst, port, protocol, bucket start) =>
+        #   [links, bytes_sent, bytes_received, packets_sent, packets_received, total duration]
+        self.links = {}
+        self.rows = 0  # rows summed into self.links
+
+    def __len__(self):
+        return len(self.links)
+
+    def add_batch(self, batch):
+        """
+        :param batch: translated rows, with columns in BaseImporter.keys order
+         :type batch: ColumnBatch
+        :return: the number of rows added
+         :rtype: int
+        """
+        links = self.links
+        for src, srcport, dst, dstport, timestamp, protocol, bytes_sent, bytes_received, packets_sent, \
+                packets_received, duration in itertools.izip(*batch.columns):
+            key = (src, dst, dstport, protocol, timestamp - timestamp % BUCKET_SECONDS)
+            link = links.get(key)
+            if link is None:
+                links[key] = [1, bytes_sent, bytes_received, packets_sent, packets_received, duration]
+                continue
+            link[0] += 1
+            link[1] = add_counts(link[1], bytes_sent)
+            link[2] = add_counts(link[2], bytes_received)
+            link[3] = add_counts(link[3], packets_sent)
+            link[4] = add_counts(link[4], packets_received)
+            link[5] = add_counts(link[5], duration)
+        self.rows += len(batch)
+        return len(batch)
+
+    def pop_all(self):
+        """
+        :return: the accumulated links, as described in __init__. The accumulator is emptied.
+         :rtype: dict[tuple, list]
+        """
+        links = self.links
+        self.links = {}
+        self.rows = 0
+        return links
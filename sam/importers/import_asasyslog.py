@@ -1,6 +1,7 @@
 import sys
 import re
-from sam.importers.import_base import BaseImporter
+from sam.importers.import_base import BaseImporter, ColumnBatch
+from sam import iputil
 import datetime
 import time
 import traceback
@@ -38,30 +39,91 @@ class ASASyslogImporter(BaseImporter):
         '302015', '302016', '302017', '302018', '302020',
         '302021', '313001', '313008', '710003'
     }
-    ACCEPTED_CODES = {302014, 302016, 302018, 302021}
-
-    message_regex = re.compile(r"^[<>:%\w\-]+-(\d+):\s+(.+)$")
-    tcp_regex = re.compile(r"^Teardown TCP connection (?P<connection>\d+) for (?P<dst_interface>\w+)\s*:(?P<dst>[\d\.]+)\s*\/(?P<dstport>\d+) (?:\(\w+\)\s)?to (?P<src_interface>\w+)\s*:(?P<src>[\d\.]+)\s*\/(?P<srcport>\d+) (?:\(\w+\)\s)?duration (?P<duration>[\d:\s]+) bytes (?P<bytes>\d+).*$")
-    udp_regex = re.compile(r"^Teardown UDP connection (?P<connection>\d+) for (?P<dst_interface>\w+)\s*:(?P<dst>[\d\.]+)\s*\/(?P<dstport>\d+) (?:\(\w+\)\s)?to (?P<src_interface>\w+)\s*:(?P<src>[\d\.]+)\s*\/(?P<srcport>\d+) (?:\(\w+\)\s)?duration (?P<duration>[\d:\s]+) bytes (?P<bytes>\d+).*$")
-    icmp_regex = re.compile(r"^Teardown ICMP connection for faddr (?P<faddr>[\d.]+)\s*\/(?P<faddrport>\d+) (?P<idw_user1>\(\w+\)\s)?gaddr (?P<gaddr>[\d.]+)\s*\/(?P<gaddrport>\d+) laddr (?P<laddr>[\d.]+)\s*\/(?P<laddrport>\d+)(?P<idw_user2>\s?\(\w+\)\s)?.*$")
-    gre_regex = re.compile(r"^Teardown GRE connection (?P<connection>\d+) from (?P<src_iface>\w+):(?P<src>[\d.]+)\s*\/(?P<srcport>\d+) \([\d./]*\) (?P<idw_user1>\(\w+\)\s)?to (?P<dst_iface>\w+):(?P<dst>[\d.]+)\s*\/(?P<dstport>\d+) \([\d./]*\) (?P<idw_user2>\(\w+\)\s)?duration (?P<duration>[\d:\s]+) bytes (?P<bytes>\d+).*$")
-
-    def get_message_id(self, line):
+    # teardown message ids, as they appear in the line, and the protocol each one reports
+    TEARDOWN_PROTOCOLS = {
+        '302014': 'TCP',
+        '302016': 'UDP',
+        '302018': 'GRE',
+        '302021': 'ICMP',
+    }
+    DURATION_CACHE_SIZE = 10000
+
+    # All four teardown messages in one pattern. Groups are read by position:
+    #   TCP/UDP: 1 protocol, 2 dst, 3 dstport, 4 src, 5 srcport, 6 duration, 7 bytes
+    #   GRE:     8 protocol, 9 src, 10 srcport, 11 dst, 12 dstport, 13 duration, 14 bytes
+    #   ICMP:    15 protocol, 16 faddr, 17 faddrport, 18 laddr, 19 laddrport
+    teardown_regex = re.compile(
+        r"^Teardown (?:"
+        r"(TCP|UDP) connection \d+ for \w+\s*:([\d.]+)\s*\/(\d+) (?:\(\w+\)\s)?to \w+\s*:([\d.]+)\s*\/(\d+) (?:\(\w+\)\s)?duration ([\d:\s]+) bytes (\d+)"
+        r"|(GRE) connection \d+ from \w+:([\d.]+)\s*\/(\d+) \([\d./]*\) (?:\(\w+\)\s)?to \w+:([\d.]+)\s*\/(\d+) \([\d./]*\) (?:\(\w+\)\s)?duration ([\d:\s]+) bytes (\d+)"
+        r"|(ICMP) connection for faddr ([\d.]+)\s*\/(\d+) (?:\(\w+\)\s)?gaddr [\d.]+\s*\/\d+ laddr ([\d.]+)\s*\/(\d+)"
+        r")")
+
+    def __init__(self):
+        BaseImporter.__init__(self)
+        self.duration_cache = {}
+
+    @staticmethod
+    def scan_message_id(line):
         """
+        Find the message id with plain string operations instead of a regex,
+        so that uninteresting lines can be rejected cheaply.
+
         :param line: syslog line
         :type line: str
-        :return: the message id and the rest of the syslog line
-        :rtype: tuple [ int, str ]
+        :return: the 6-digit message id and the rest of the syslog line, or (None, line)
+        :rtype: tuple [ str, str ]
         """
-        # line may start:
+        # the id is the 6 digits between the last '-' of the prefix and the first ': '
         #    <166>:%ASA-session-6-302015: ...
-        #       or
-        #    <166>%ASA-6-302015: ...
-        match = ASASyslogImporter.message_regex.match(line)
-        if match:
-            return int(match.group(1)), match.group(2)
-        else:
+        end = line.find(': ')
+        if end < 7 or line[end - 7] != '-':
+            return None, line
+        message_id = line[end - 6:end]
+        if not message_id.isdigit():
             return None, line
+        return message_id, line[end + 2:].strip()
+
+    def parse_duration(self, ts):
+        """
+        timestring_to_seconds, remembering recent results. Durations repeat often in a log.
+
+        :param ts: duration as hh:mm:ss
+        :type ts: str
+        :rtype: int
+        """
+        seconds = self.duration_cache.get(ts)
+        if seconds is None:
+            if len(self.duration_cache) >= self.DURATION_CACHE_SIZE:
+                self.duration_cache.clear()
+            seconds = self.duration_cache[ts] = self.timestring_to_seconds(ts)
+        return seconds
+
+    def decode_teardown(self, message_id, msg):
+        """
+        Decode any accepted teardown message with the combined teardown_regex.
+
+        :param message_id: message id from scan_message_id
+        :type message_id: str
+        :param msg: the message, after the message id
+        :type msg: str
+        :return: protocol, src, srcport, dst, dstport, bytes_received, duration; or None if the message can't be decoded
+        :rtype: tuple or None
+        """
+        match = ASASyslogImporter.teardown_regex.match(msg)
+        if match is None:
+            return None
+        g = match.groups()
+        if g[0]:
+            decoded = (g[0], g[3], g[4], g[1], g[2], g[6], self.parse_duration(g[5]))
+        elif g[7]:
+            decoded = ('GRE', g[8], g[9], g[10], g[11], g[13], self.parse_duration(g[12]))
+        else:
+            decoded = ('ICMP', g[17], g[18], g[15], g[16], '1', 1)
+        # the message must describe the protocol its id is for
+        if decoded[0] != ASASyslogImporter.TEARDOWN_PROTOCOLS[message_id]:
+            return None
+        return decoded
 
     def timestring_to_seconds(self, ts):
         seconds = 0
@@ -74,87 +136,6 @@ class ASASyslogImporter(BaseImporter):
                 pass
         return seconds
 
-    def decode_tcp(self, msg):
-        # Teardown TCP connection id for interface :real-address /real-port [(idfw_user )] to interface :real-address /real-port [(idfw_user )] duration hh:mm:ss bytes bytes [reason ] [(user )]
-        # Teardown TCP connection 7779 for outside:104.31.70.170/80 to inside:192.168.1.5/44296 duration 0:00:46 bytes 816971 TCP FINs
-        match = ASASyslogImporter.tcp_regex.match(msg)
-        if not match:
-            return None
-        regexed = match.groupdict()
-
-        decoded = {
-            'dst': regexed['dst'],
-            'dstport': regexed['dstport'],
-            'src': regexed['src'],
-            'srcport': regexed['srcport'],
-            'bytes_received': regexed['bytes'],
-            'duration': self.timestring_to_seconds(regexed['duration']),
-            'protocol': 'TCP',
-        }
-
-        return decoded
-
-    def decode_udp(self, msg):
-        # Teardown UDP connection number for interface :real-address /real-port [(idfw_user )] to interface :real-address /real-port [(idfw_user )] duration hh :mm :ss bytes bytes [(user )]
-        # Teardown UDP connection 7881 for outside:158.69.125.231/123 to inside:192.168.1.8/59776 duration 0:02:01 bytes 96
-        match = ASASyslogImporter.udp_regex.match(msg)
-        if not match:
-            return None
-        regexed = match.groupdict()
-
-        decoded = {
-            'dst': regexed['dst'],
-            'dstport': regexed['dstport'],
-            'src': regexed['src'],
-            'srcport': regexed['srcport'],
-            'bytes_received': regexed['bytes'],
-            'duration': self.timestring_to_seconds(regexed['duration']),
-            'protocol': 'UDP',
-        }
-
-        return decoded
-
-    def decode_gre(self, msg):
-        # TODO: developed from specification not observation. May not be exact.
-        # Teardown GRE connection id from interface :real_address (translated_address ) [(idfw_user )] to interface :real_address /real_cid (translated_address /translated_cid ) [(idfw_user )] duration hh :mm :ss bytes bytes [(user )]
-        # Teardown GRE connection 7951 from outside:158.69.125.231/123 (158.69.125.231/123) [(idfw_user )] to inside:192.168.1.1/55443 (192.168.10.176/23456) duration 0:02:31 bytes 66429
-        match = ASASyslogImporter.gre_regex.match(msg)
-        if not match:
-            return None
-        regexed = match.groupdict()
-
-        decoded = {
-            'dst': regexed['dst'],
-            'dstport': regexed['dstport'],
-            'src': regexed['src'],
-            'srcport': regexed['srcport'],
-            'bytes_received': regexed['bytes'],
-            'duration': self.timestring_to_seconds(regexed['duration']),
-            'protocol': 'GRE',
-        }
-
-        return decoded
-
-    def decode_icmp(self, msg):
-        # Teardown ICMP connection for faddr {faddr | icmp_seq_num } [(idfw_user )] gaddr {gaddr | cmp_type } laddr laddr [(idfw_user )] (981) type {type } code {code }
-        # Teardown ICMP connection for faddr 13.107.21.200/0 gaddr 192.168.10.176/9984 laddr 192.168.1.5/27820
-        match = ASASyslogImporter.icmp_regex.match(msg)
-        if not match:
-            return None
-        regexed = match.groupdict()
-
-        decoded = {
-            'dst': regexed['faddr'],
-            'dstport': regexed['faddrport'],
-            'src': regexed['laddr'],
-            'srcport': regexed['laddrport'],
-            'bytes_received': '1',
-            'duration': 1,
-            'protocol': 'ICMP',
-        }
-
-        return decoded
-
     def translate(self, line, line_num, dictionary):
         """
         Converts a given syslog line into a dictionary of (ip, port, ip, port)
@@ -171,36 +152,26 @@ class ASASyslogImporter(BaseImporter):
             4 => other error putting keys in dictionary
         """
         # determine message_id:
-        message_id, message = self.get_message_id(line)
+        message_id, message = self.scan_message_id(line)
 
         # only accept particular messages
-        if message_id not in ASASyslogImporter.ACCEPTED_CODES:
+        if message_id not in ASASyslogImporter.TEARDOWN_PROTOCOLS:
             return 1
 
         # extract the relevant information out of the traffic log
-        if message_id == 302014:
-            decoded = self.decode_tcp(message)
-        elif message_id == 302016:
-            decoded = self.decode_udp(message)
-        elif message_id == 302018:
-            decoded = self.decode_gre(message)
-        elif message_id == 302021:
-            decoded = self.decode_icmp(message)
-        else:
-            return 2
-
+        decoded = self.decode_teardown(message_id, message)
         if decoded is None:
             return 3
 
         try:
-            # decoded has keys: src, srcport, dst, dstport, duration, bytes_received, protocol
-            dictionary['src'] = self.ip_to_int(*(decoded['src'].split(".")))
-            dictionary['srcport'] = int(decoded['srcport'])
-            dictionary['dst'] = self.ip_to_int(*(decoded['dst'].split(".")))
-            dictionary['dstport'] = int(decoded['dstport'])
-            dictionary['protocol'] = decoded['protocol']
-            dictionary['duration'] = int(decoded['duration'])
-            dictionary['bytes_received'] = int(decoded['bytes_received'])
+            protocol, src, srcport, dst, dstport, bytes_received, duration = decoded
+            dictionary['src'] = iputil.encode(src)
+            dictionary['srcport'] = int(srcport)
+            dictionary['dst'] = iputil.encode(dst)
+            dictionary['dstport'] = int(dstport)
+            dictionary['protocol'] = protocol
+            dictionary['duration'] = duration
+            dictionary['bytes_received'] = int(bytes_received)
             # missing keys: bytes_sent, packets_sent/received, timestamp
             dictionary['bytes_sent'] = 0
             dictionary['packets_received'] = 1
@@ -211,6 +182,42 @@ class ASASyslogImporter(BaseImporter):
             return 4
         return 0
 
+    def translate_batch(self, lines):
+        """
+        Converts many ASA syslog lines at once into typed column arrays.
+        Message ids are found with scan_message_id, and only teardown messages (TEARDOWN_PROTOCOLS) produce rows.
+        Args:
+            lines: An iterable of syslog lines
+
+        Returns:
+            A ColumnBatch of the successfully translated lines.
+        """
+        batch = ColumnBatch()
+        append = batch.append
+        encode_ip = iputil.encode
+        scan_message_id = self.scan_message_id
+        decode_teardown = self.decode_teardown
+        accepted = ASASyslogImporter.TEARDOWN_PROTOCOLS
+        now = int(time.time())
+        for line in lines:
+            message_id, message = scan_message_id(line)
+            if message_id not in accepted:
+                batch.skipped['non-teardown'] += 1
+                continue
+            decoded = decode_teardown(message_id, message)
+            if decoded is None:
+                batch.skipped['unparseable'] += 1
+                continue
+            protocol, src, srcport, dst, dstport, bytes_received, duration = decoded
+            try:
+                # missing values: bytes_sent, packets_sent/received, timestamp
+                append(encode_ip(src), int(srcport),
+                       encode_ip(dst), int(dstport),
+                       now, protocol, 0, int(bytes_received), 0, 1, duration)
+            except:
+                batch.skipped['unparseable'] += 1
+        return batch
+
 
 class_ = ASASyslogImporter
 
@@ -1,5 +1,6 @@
 import sys
-from sam.importers.import_base import BaseImporter
+from sam.importers.import_base import BaseImporter, ColumnBatch
+from sam import iputil
 import datetime
 
 
@@ -17,9 +18,9 @@ class AWSImporter(BaseImporter):
         """
         try:
             awsLog = line.split(" ")
-            dictionary['src'] = self.ip_to_int(*(awsLog[3].split(".")))
+            dictionary['src'] = iputil.encode(awsLog[3])
             dictionary['srcport'] = int(awsLog[5])
-            dictionary['dst'] = self.ip_to_int(*(awsLog[4].split(".")))
+            dictionary['dst'] = iputil.encode(awsLog[4])
             dictionary['dstport'] = int(awsLog[6])
             dictionary['timestamp'] = datetime.datetime.fromtimestamp((float(awsLog[10])))
 
@@ -35,6 +36,29 @@ class AWSImporter(BaseImporter):
             return 1
         return 0
 
+    def translate_batch(self, lines):
+        """
+        Converts many AWS flow log lines at once into typed column arrays.
+        Args:
+            lines: An iterable of flow log lines
+
+        Returns:
+            A ColumnBatch of the successfully translated lines.
+        """
+        batch = ColumnBatch()
+        append = batch.append
+        encode_ip = iputil.encode
+        for line in lines:
+            try:
+                awsLog = line.split(" ")
+                # TODO: protocol, duration, bytes and packets are placeholders, as in translate.
+                append(encode_ip(awsLog[3]), int(awsLog[5]),
+                       encode_ip(awsLog[4]), int(awsLog[6]),
+                       int(float(awsLog[10])), 'TCP', 1, 1, 1, 1, 1)
+            except:
+                batch.skipped['unparseable'] += 1
+        return batch
+
 
 class_ = AWSImporter
 
@@ -1,9 +1,18 @@
 import sys
 import os
+import time
 import numbers
+import itertools
+import collections
 import sam.constants
 import traceback
 import importlib
+from array import array
+from datetime import datetime
+from sam.importers.bulk_load import SyslogLoader
+from sam.importers.flow_aggregator import FlowAggregator
+from sam.importers.timestamps import format_epochs
+from sam import iputil
 common = None
 Datasources = None
 
@@ -23,6 +32,8 @@ class BaseImporter:
         "packets_received",
         "duration",
     ]
+    # whether packets can be translated independently of each other, e.g. by several processes
+    stateless_translation = True
 
     def __init__(self):
         self.instructions = """
@@ -39,6 +50,10 @@ Usage:
         self.ds_name = None  # datasource name
         self.ds_id = None  # datasource id
         self.failed_attempts = 0
+        self.skipped = collections.Counter()  # lines not translated since the last report, by reason
+        self.loader = None  # bulk loader for the destination Syslog table
+        self.loader_key = None  # (subscription, ds_id, ds_name, columns) the loader was made for
+        self.aggregator = None  # merges rows into 5-minute flows before insertion, if enabled
 
     @staticmethod
     def ip_to_int(a, b, c, d):
@@ -57,7 +72,7 @@ Usage:
         :return: The IP address as a simple 32-bit unsigned integer
         :rtype: int
         """
-        return (int(a) << 24) + (int(b) << 16) + (int(c) << 8) + int(d)
+        return iputil.ip_to_int(a, b, c, d)
 
     def main(self, argv):
         if not (1 < len(argv) < 4):
@@ -122,6 +137,24 @@ Usage:
                 translated.append(translated_line)
         return translated
 
+    def report_skipped(self):
+        """
+        Prints how many lines were skipped, and why, since the last report.
+        """
+        if self.skipped:
+            print(format_skipped(self.skipped))
+            self.skipped.clear()
+
+    def translate_packets(self, packets):
+        """
+        Take in packets received via collector and return them translated into typed column arrays.
+
+        :param packets: strings received by the collector. This base function presumes one ascii line each.
+        :type packets: list[ str ]
+        :return: the successfully translated lines
+        :rtype: ColumnBatch
+        """
+        return self.translate_batch([line.strip() for line in packets])
 
     def translate(self, line, line_num, dictionary):
         """
@@ -136,6 +169,70 @@ Usage:
         """
         raise NotImplementedError("importers must implement this function")
 
+    def translate_batch(self, lines):
+        """
+        Converts many syslog lines at once into typed column arrays.
+        Importers may override this with a faster implementation.
+        This default falls back to calling `translate` once per line.
+        Args:
+            lines: An iterable of syslog lines to parse
+
+        Returns:
+            A ColumnBatch holding every successfully translated line.
+            Lines that were not translated are counted in its `skipped` counter.
+        """
+        batch = ColumnBatch()
+        line_num = 0
+        for line in lines:
+            line_num += 1
+            translated_line = {}
+            try:
+                if self.translate(line, line_num, translated_line) != 0:
+                    batch.skipped['rejected'] += 1
+                    continue
+                batch.append_dict(translated_line)
+            except:
+                traceback.print_exc()
+                batch.skipped['unparseable'] += 1
+        return batch
+
+    def has_batch_translation(self):
+        """
+        Whether this importer provides its own translate_batch implementation.
+
+        :return: True if translate_batch is overridden by a subclass
+        :rtype: bool
+        """
+        return self.translate_batch.im_func is not BaseImporter.translate_batch.im_func
+
+    def import_lines(self, lines, batch_size=1000):
+        """
+        Translates and inserts lines in batches using the columnar translate_batch interface.
+        Args:
+            lines: An iterable of syslog lines
+            batch_size: The number of lines to translate and insert at a time
+
+        Returns:
+            The number of rows inserted
+        """
+        lines = iter(lines)
+        line_num = 0
+        lines_inserted = 0
+        while True:
+            chunk = list(itertools.islice(lines, batch_size))
+            if not chunk:
+                break
+            line_num += len(chunk)
+            batch = self.translate_batch(chunk)
+            self.skipped.update(batch.skipped)
+            if len(batch) > 0:
+                self.insert_batch(batch)
+                lines_inserted += len(batch)
+        self.flush_aggregation()
+        print("Done. {0} lines processed, {1} rows inserted".format(line_num, lines_inserted))
+        self.report_skipped()
+        return lines_inserted
+
     def import_string(self, s):
         """
         Takes a string containing one or more lines and attempts to import it into the database staging table.
@@ -146,6 +243,8 @@ Usage:
             None
         """
         all_lines = s.splitlines()
+        if self.has_batch_translation():
+            return self.import_lines(all_lines)
         line_num = 0
         lines_inserted = 0
         counter = 0
@@ -155,9 +254,11 @@ Usage:
 
             try:
                 if self.translate(line, line_num, rows[counter]) != 0:
+                    self.skipped['rejected'] += 1
                     continue
             except:
                 traceback.print_exc()
+                self.skipped['unparseable'] += 1
                 continue
 
             counter += 1
@@ -170,7 +271,9 @@ Usage:
         if counter != 0:
             self.insert_data(rows, counter)
             lines_inserted += counter
+        self.flush_aggregation()
         print("Done. {0} lines processed, {1} rows inserted".format(line_num, lines_inserted))
+        self.report_skipped()
         return lines_inserted
 
     def import_file(self, path_in):
@@ -182,6 +285,10 @@ Usage:
         Returns:
             None
         """
+        if self.has_batch_translation():
+            with open(path_in) as fin:
+                return self.import_lines(fin)
+
         with open(path_in) as fin:
             line_num = 0
             lines_inserted = 0
@@ -191,6 +298,7 @@ Usage:
                 line_num += 1
 
                 if self.translate(line, line_num, rows[counter]) != 0:
+                    self.skipped['rejected'] += 1
                     continue
 
                 counter += 1
@@ -203,9 +311,39 @@ Usage:
         if counter != 0:
             self.insert_data(rows, counter)
             lines_inserted += counter
+        self.flush_aggregation()
         print("Done. {0} lines processed, {1} rows inserted".format(line_num, lines_inserted))
+        self.report_skipped()
         return lines_inserted
 
+    def enable_aggregation(self, max_flows=None):
+        """
+        Merge translated rows into 5-minute flows in memory before inserting them (see FlowAggregator).
+        Merged rows record how many rows they replace in the Syslog `links` column.
+        Args:
+            max_flows: The number of merged rows to hold in memory before writing out the oldest.
+                Uses flow_aggregator.MAX_FLOWS if None.
+
+        Returns:
+            None
+        """
+        if max_flows is None:
+            self.aggregator = FlowAggregator()
+        else:
+            self.aggregator = FlowAggregator(max_flows=max_flows)
+
+    def flush_aggregation(self):
+        """
+        Insert all the merged rows still held by the aggregator. Import functions call this when their input ends.
+
+        Returns:
+            None
+        """
+        if self.aggregator is None or len(self.aggregator) == 0:
+            return
+        self.insert_rows(self.aggregator.flush())
+        print("Aggregated {0} rows into {1} flows".format(self.aggregator.rows_in, self.aggregator.rows_out))
+
     def set_subscription(self, sub_id):
         self.subscription = sub_id
 
@@ -243,17 +381,14 @@ Usage:
         conn['packets_received'] = conn['packets_sent']
         conn['packets_sent'] = temp
 
-    def insert_data(self, rows, count):
+    def get_loader(self):
         """
-        Attempt to insert the first 'count' items in 'rows' into the database table `samapper`.`Syslog`.
-        Exits script on critical failure.
-        Args:
-            rows: The iterable containing dictionaries to insert
-                (dictionaries must all have the same keys, matching column names)
-            count: The number of items from rows to insert
+        Find the Syslog table for this importer's subscription and datasource and prepare a bulk loader for it.
+        The datasource lookup is done once; the loader is reused until the subscription or datasource changes.
 
         Returns:
-            None
+            The loader for the destination Syslog table
+             :rtype: SyslogLoader
         """
         global common
         global Datasources
@@ -261,6 +396,15 @@ Usage:
         if self.subscription is None:
             raise ValueError("No account (subscription) specified.)")
 
+        # aggregated rows carry their links count as an extra column
+        if self.aggregator is None:
+            columns = self.keys
+        else:
+            columns = self.keys + ['links']
+
+        if self.loader is not None and self.loader_key == (self.subscription, self.ds_id, self.ds_name, columns):
+            return self.loader
+
         try:
             import sam.common
             common = sam.common
@@ -282,28 +426,71 @@ Usage:
             self.dsModel = Datasources(common.db_quiet, {}, self.subscription)
             if self.ds_name:
                 self.ds_id = self.dsModel.name_to_id(self.ds_name)
-            if self.ds_id is None and len(self.dsModel.ds_ids) == 1:
-                self.ds_id = self.dsModel.ds_ids[0]
-            else:
-                raise ValueError("No datasource specified")
+            if self.ds_id is None:
+                if len(self.dsModel.ds_ids) == 1:
+                    self.ds_id = self.dsModel.ds_ids[0]
+                else:
+                    raise ValueError("No datasource specified")
 
         table_name = "s{acct}_ds{ds}_Syslog".format(acct=self.subscription, ds=self.ds_id)
+        if common.db_quiet.dbname == 'mysql':
+            loader_db = common.get_infile_db(sam.constants.dbconfig)
+        else:
+            loader_db = common.db_quiet
+        self.loader = SyslogLoader(loader_db, table_name, columns)
+        self.loader_key = (self.subscription, self.ds_id, self.ds_name, columns)
+        return self.loader
+
+    def insert_data(self, rows, count):
+        """
+        Attempt to insert the first 'count' items in 'rows' into the database table `samapper`.`Syslog`.
+        Exits script on critical failure.
+        Args:
+            rows: The iterable containing dictionaries to insert
+                (dictionaries must all have the same keys, matching column names)
+            count: The number of items from rows to insert
 
+        Returns:
+            None
+        """
+        self.get_loader()
+
+        truncated_rows = rows[:count]
+        if not truncated_rows:
+            return
+        if set(rows[0].keys()) != set(self.keys):
+            print("Database keys don't match. Check that your importer's translate function "
+                  "fills all the dictionary keys in import_base.keys exactly.")
+            print("Expected keys: {0}".format(repr(sorted(self.keys))))
+            print("Received keys: {0}".format(repr(sorted(rows[0].keys()))))
+            raise AssertionError("Insertion keys do not match expected keys.")
+
+        if self.aggregator is not None:
+            batch = ColumnBatch()
+            for row in truncated_rows:
+                batch.append_dict(row)
+            self.insert_batch(batch)
+            return
+
+        keys = self.keys
+        self.insert_rows([tuple(row[key] for key in keys) for row in truncated_rows])
+
+    def insert_rows(self, rows):
+        """
+        Bulk load row tuples into the database table `Syslog`.
+        Exits script on critical failure.
+        Args:
+            rows: The row tuples to insert, with values in the same order as BaseImporter.keys
+                (followed by links, if aggregation is enabled)
+             :type rows: list[tuple]
+
+        Returns:
+            None
+        """
         try:
-            truncated_rows = rows[:count]
-            if set(rows[0].keys()) != set(self.keys):
-                print("Database keys don't match. Check that your importer's translate function "
-                      "fills all the dictionary keys in import_base.keys exactly.")
-                print("Expected keys: {0}".format(repr(sorted(self.keys))))
-                print("Received keys: {0}".format(repr(sorted(rows[0].keys()))))
-                raise AssertionError("Insertion keys do not match expected keys.")
-
-            # multiple_insert example:
-            # >>> table_name = "my_table"
-            # >>> values = [{"name": "foo", "email": "foo@example.com"}, {"name": "bar", "email": "bar@example.com"}]
-            # >>> db.multiple_insert(table_name, values=values)
-            common.db_quiet.multiple_insert(table_name, values=truncated_rows)
+            self.get_loader().load(rows)
         except Exception as e:
+            self.loader = None
             self.failed_attempts += 1
             print("Error inserting into database:")
             print("\t{0}".format(e))
@@ -311,7 +498,7 @@ Usage:
             if self.failed_attempts < 2:
                 if integrity.check_and_fix_integrity() == 0:
                     print("Resuming...")
-                    self.insert_data(rows, count)
+                    self.insert_rows(rows)
                 else:
                     print("Aborting...")
                     raise AssertionError("Failed to fix database access. ")
@@ -319,6 +506,151 @@ Usage:
                 print("Critical failure. Aborting.")
                 raise AssertionError("Failed to fix problem multiple times. Aborting.")
 
+    def insert_batch(self, batch):
+        """
+        Insert all the rows held in a ColumnBatch into the database table `Syslog`.
+        Timestamps are formatted from epoch seconds here, at the database boundary.
+        If aggregation is enabled, rows are merged first and only the flows from closed buckets are inserted.
+        Args:
+            batch: The translated lines to insert
+             :type batch: ColumnBatch
+
+        Returns:
+            None
+        """
+        if self.aggregator is not None:
+            rows = self.aggregator.add_batch(batch)
+            if rows:
+                self.insert_rows(rows)
+            return
+        self.insert_rows(batch.sql_rows())
+
+
+def format_skipped(skipped):
+    """
+    :param skipped: number of lines skipped, by reason
+     :type skipped: collections.Counter
+    :return: a summary, e.g. "Skipped 3 lines: 1 non-TRAFFIC, 2 unparseable"
+     :rtype: str
+    """
+    return "Skipped {0} lines: {1}".format(
+        sum(skipped.values()),
+        ", ".join("{0} {1}".format(count, reason) for reason, count in sorted(skipped.items())))
+
+
+class ColumnBatch(object):
+    """
+    A batch of translated log lines, stored as one column per key in BaseImporter.keys.
+    IP addresses are stored as unsigned 32-bit ints, ports as unsigned 16-bit ints and
+    timestamps as integer epoch seconds. The remaining columns are plain lists.
+    Lines that could not be translated into the batch are counted in `skipped`, by reason.
+    """
+    typecodes = {
+        'src': 'I',
+        'srcport': 'H',
+        'dst': 'I',
+        'dstport': 'H',
+        'timestamp': 'l',
+    }
+
+    def __init__(self):
+        self.columns = [array(self.typecodes[key]) if key in self.typecodes else []
+                        for key in BaseImporter.keys]
+        self.skipped = collections.Counter()
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __getitem__(self, key):
+        """
+        :param key: column name, from BaseImporter.keys
+         :type key: str
+        :return: The column of values for that key
+         :rtype: array.array or list
+        """
+        return self.columns[BaseImporter.keys.index(key)]
+
+    def append(self, *values):
+        """
+        Append one translated line. Values must be in the same order as BaseImporter.keys.
+        If any value cannot be stored (e.g. a port out of range) the batch is left unchanged
+        and the error is raised.
+        """
+        if len(values) != len(self.columns):
+            raise ValueError("Expected {0} values, received {1}".format(len(self.columns), len(values)))
+        size = len(self)
+        try:
+            for column, value in zip(self.columns, values):
+                column.append(value)
+        except:
+            self.truncate(size)
+            raise
+
+    def append_dict(self, dictionary):
+        """
+        Append one line as filled in by BaseImporter.translate.
+        Typed columns are coerced to int, and datetime timestamps to epoch seconds.
+        """
+        values = []
+        for key in BaseImporter.keys:
+            value = dictionary[key]
+            if key == 'timestamp' and isinstance(value, datetime):
+                value = int(time.mktime(value.timetuple()))
+            elif key in self.typecodes:
+                value = int(value)
+            values.append(value)
+        self.append(*values)
+
+    def extend(self, batch):
+        """
+        Append every line of another batch.
+
+        :param batch: the lines to append
+         :type batch: ColumnBatch
+        """
+        for column, values in zip(self.columns, batch.columns):
+            column.extend(values)
+        self.skipped.update(batch.skipped)
+
+    def truncate(self, size):
+        for column in self.columns:
+            del column[size:]
+
+    def rows(self):
+        """
+        :return: A list of row tuples, in BaseImporter.keys order, with timestamps as datetimes.
+         :rtype: list[tuple]
+        """
+        ts_index = BaseImporter.keys.index('timestamp')
+        stamps = {}
+        timestamps = []
+        for epoch in self.columns[ts_index]:
+            stamp = stamps.get(epoch)
+            if stamp is None:
+                stamp = stamps[epoch] = datetime.fromtimestamp(epoch)
+            timestamps.append(stamp)
+        columns = list(self.columns)
+        columns[ts_index] = timestamps
+        return zip(*columns)
+
+    def sql_rows(self):
+        """
+        :return: A list of row tuples, in BaseImporter.keys order, with timestamps formatted for the database.
+         :rtype: list[tuple]
+        """
+        ts_index = BaseImporter.keys.index('timestamp')
+        columns = list(self.columns)
+        columns[ts_index] = format_epochs(columns[ts_index])
+        return zip(*columns)
+
+    def to_dicts(self):
+        """
+        :return: A list of dictionaries, one per row, as accepted by BaseImporter.insert_data
+         :rtype: list[dict]
+        """
+        keys = BaseImporter.keys
+        return [dict(itertools.izip(keys, row)) for row in self.rows()]
+
 
 class_ = BaseImporter
 
@@ -1,13 +1,20 @@
 """
-This importer uses a few tools in the netflow nfdump tools package
-Specifically, it launches processes nfcapd and nfdump to capture netflow packets and translate them into usable text.
+This importer decodes NetFlow v5, v9 and IPFIX export packets natively (see netflow_decoder),
+either as they arrive at the collector or from a pcap recording of the export traffic.
 
+Capture files written by nfcapd are still read with the nfdump tool.
 """
 import sys
+import logging
 import subprocess
 from datetime import datetime
 import shlex
-from sam.importers.import_base import BaseImporter
+from sam.importers.import_base import BaseImporter, ColumnBatch
+from sam.importers.timestamps import ParseCache, strptime_parser
+from sam.importers.netflow_decoder import NetFlowDecoder
+from sam.importers import pcap_reader
+from sam import iputil
+logger = logging.getLogger(__name__)
 
 
 def safe_translate(value):
@@ -30,6 +37,10 @@ def safe_translate(value):
 
 class NetFlowImporter(BaseImporter):
     FORMAT = "fmt:%pr,%sa,%sp,%da,%dp,%te,%ibyt,%obyt,%ipkt,%opkt,%td"
+    # flow end time, without its milliseconds => epoch seconds
+    parse_timestamp = ParseCache(strptime_parser("%Y-%m-%d %H:%M:%S"))
+    # v9/IPFIX packets can only be decoded with templates learned from earlier packets
+    stateless_translation = False
     PROTOCOL = 0
     SRC = 1
     SRCPORT = 2
@@ -51,12 +62,78 @@ Optionally, include the name of the datasource to import in to. Default uses cur
 Usage:
     python {0} <input-file> <data source>
 """.format(sys.argv[0])
+        self.decoder = NetFlowDecoder()
+
+    def translate_packets(self, packets):
+        """
+        Decodes NetFlow/IPFIX export packets into typed column arrays.
+        Packets that cannot be decoded are logged and skipped.
+        Args:
+            packets: An iterable of UDP payloads, one export packet each
+
+        Returns:
+            A ColumnBatch of the decoded flows.
+        """
+        batch = ColumnBatch()
+        decode = self.decoder.decode
+        for packet in packets:
+            try:
+                decode(packet, batch)
+            except ValueError as e:
+                logger.warning("Skipping NetFlow packet: {0}".format(e))
+        return batch
+
+    def import_packets(self, packets):
+        """
+        Take in export packets received via collector and return translated lines.
+
+        :param packets: UDP payloads received by the collector
+        :type packets: list[ str ]
+        :return: a list translated log lines
+        :rtype: List [ Dict [ str, any ]
+        """
+        return self.translate_packets(packets).to_dicts()
+
+    def import_capture(self, path_in, batch_size=100):
+        """
+        Imports NetFlow export packets recorded in a pcap file (e.g. `tcpdump -w capture.pcap udp port 2055`).
+        Args:
+            path_in: The path to the pcap file
+            batch_size: The number of export packets to decode and insert at a time
+
+        Returns:
+            The number of rows inserted
+        """
+        packet_count = 0
+        lines_inserted = 0
+        packets = []
+        for src, srcport, payload in pcap_reader.udp_payloads(path_in):
+            packets.append(payload)
+            if len(packets) == batch_size:
+                batch = self.translate_packets(packets)
+                packet_count += len(packets)
+                packets = []
+                if len(batch) > 0:
+                    self.insert_batch(batch)
+                    lines_inserted += len(batch)
+        if packets:
+            batch = self.translate_packets(packets)
+            packet_count += len(packets)
+            if len(batch) > 0:
+                self.insert_batch(batch)
+                lines_inserted += len(batch)
+        self.flush_aggregation()
+        print("Done. {0} packets processed, {1} rows inserted".format(packet_count, lines_inserted))
+        return lines_inserted
 
     def import_file(self, path_in):
         #  verify file exists
         if not self.validate_file(path_in):
             raise ValueError("File not found: {}".format(path_in))
 
+        if pcap_reader.is_pcap(path_in):
+            return self.import_capture(path_in)
+
         # Assume a binary file as input
         args = shlex.split('nfdump -r {0} -b -o {1}'.format(path_in, NetFlowImporter.FORMAT))
         try:
@@ -65,43 +142,17 @@ Usage:
             sys.stderr.write("To use this importer, please install nfdump.\n\t`apt-get install nfdump`\n")
             raise e
 
-        line_num = -1
-        lines_inserted = 0
-        counter = 0
-        # prepare buffer
-        rows = [dict.fromkeys(self.keys, '') for _ in range(1000)]
-
         # skip the titles line at the start of the file
         proc.stdout.readline()
-
-        while True:
-            line_num += 1
-            line = proc.stdout.readline()
-            if line == '':
-                break
-
-            if self.translate(line, line_num, rows[counter]) != 0:
-                continue
-
-            counter += 1
-
-            if counter == 1000:
-                self.insert_data(rows, counter)
-                lines_inserted += counter
-                counter = 0
-        if counter != 0:
-            self.insert_data(rows, counter)
-            lines_inserted += counter
-
-        # pass through anything else and close the process
-        proc.poll()
-        while proc.returncode is None:
-            proc.stdout.readline()
+        try:
+            return self.import_lines(iter(proc.stdout.readline, ''))
+        finally:
+            # pass through anything else and close the process
             proc.poll()
-        proc.wait()
-
-        print("Done. {0} lines processed, {1} rows inserted".format(line_num, lines_inserted))
-        return lines_inserted
+            while proc.returncode is None:
+                proc.stdout.readline()
+                proc.poll()
+            proc.wait()
 
     def import_string(self, s):
         """
@@ -115,30 +166,7 @@ Usage:
         args = shlex.split('nfdump -b -o {0}'.format(NetFlowImporter.FORMAT))
         proc = subprocess.Popen(args, bufsize=-1, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
         stdout, stderr = proc.communicate(s)
-        all_lines = stdout.splitlines()
-
-        line_num = -1
-        lines_inserted = 0
-        counter = 0
-        rows = [dict.fromkeys(self.keys, '') for i in range(1000)]
-        for line in all_lines:
-            line_num += 1
-
-            if self.translate(line, line_num, rows[counter]) != 0:
-                continue
-
-            counter += 1
-
-            # Perform the actual insertion in batches of 1000
-            if counter == 1000:
-                self.insert_data(rows, counter)
-                lines_inserted += counter
-                counter = 0
-        if counter != 0:
-            self.insert_data(rows, counter)
-            lines_inserted += counter
-        print("Done. {0} lines processed, {1} rows inserted".format(line_num, lines_inserted))
-        return lines_inserted
+        return self.import_lines(stdout.splitlines())
 
     def translate(self, line, linenum, dictionary):
         # remove trailing newline
@@ -162,9 +190,9 @@ Usage:
         #        "duration",
         #    ]
         try:
-            dictionary['src'] = self.ip_to_int(*(split_data[NetFlowImporter.SRC].split(".")))
+            dictionary['src'] = iputil.encode(split_data[NetFlowImporter.SRC])
             dictionary['srcport'] = int(float(split_data[NetFlowImporter.SRCPORT]))
-            dictionary['dst'] = self.ip_to_int(*(split_data[NetFlowImporter.DST].split(".")))
+            dictionary['dst'] = iputil.encode(split_data[NetFlowImporter.DST])
             # The float cast is because sometimes nfdump reports port as 0.0 for ICMP connections
             dictionary['dstport'] = int(float(split_data[NetFlowImporter.DSTPORT]))
             dictionary['timestamp'] = datetime.strptime(split_data[NetFlowImporter.TIMESTAMP], "%Y-%m-%d %H:%M:%S.%f")
@@ -183,6 +211,50 @@ Usage:
 
         return 0
 
+    def translate_batch(self, lines):
+        """
+        Converts many lines of nfdump output at once into typed column arrays.
+        Timestamps are truncated to whole epoch seconds.
+        Args:
+            lines: An iterable of lines formatted by nfdump using NetFlowImporter.FORMAT
+
+        Returns:
+            A ColumnBatch of the successfully translated lines.
+        """
+        batch = ColumnBatch()
+        append = batch.append
+        encode_ip = iputil.encode
+        parse_timestamp = self.parse_timestamp
+        for line in lines:
+            split_data = line.rstrip("\n").split(",")
+            if len(split_data) != 11:
+                batch.skipped['unparseable'] += 1
+                continue
+            split_data = [i.strip(' ') for i in split_data]
+            try:
+                src = encode_ip(split_data[NetFlowImporter.SRC])
+                srcport = int(float(split_data[NetFlowImporter.SRCPORT]))
+                dst = encode_ip(split_data[NetFlowImporter.DST])
+                dstport = int(float(split_data[NetFlowImporter.DSTPORT]))
+                timestamp = parse_timestamp(split_data[NetFlowImporter.TIMESTAMP].partition(".")[0])
+                protocol = split_data[NetFlowImporter.PROTOCOL].upper()
+                bytes_sent = safe_translate(split_data[NetFlowImporter.B_SENT])
+                bytes_received = safe_translate(split_data[NetFlowImporter.B_RECEIVED])
+                packets_sent = safe_translate(split_data[NetFlowImporter.P_SENT])
+                packets_received = safe_translate(split_data[NetFlowImporter.P_RECEIVED])
+                duration = max(safe_translate(split_data[NetFlowImporter.DURATION]), 1)
+
+                # report is probably reversed to what it should be.
+                if srcport < dstport:
+                    append(dst, dstport, src, srcport, timestamp, protocol,
+                           bytes_received, bytes_sent, packets_received, packets_sent, duration)
+                else:
+                    append(src, srcport, dst, dstport, timestamp, protocol,
+                           bytes_sent, bytes_received, packets_sent, packets_received, duration)
+            except:
+                batch.skipped['unparseable'] += 1
+        return batch
+
 
 class_ = NetFlowImporter
 
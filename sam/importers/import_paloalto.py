@@ -1,6 +1,8 @@
 import json
 import sys
-from sam.importers.import_base import BaseImporter
+from sam.importers.import_base import BaseImporter, ColumnBatch
+from sam.importers.timestamps import ParseCache, strptime_parser
+from sam import iputil
 from datetime import datetime
 
 
@@ -27,6 +29,51 @@ class PaloAltoImporter(BaseImporter):
     # *bytes/packets sent/received not always supported.
     #     In that case store total in received and None in sent
 
+    # lines normally arrive wrapped as {"message":"..."}
+    MESSAGE_PREFIX = '{"message":"'
+    MESSAGE_SUFFIX = '"}'
+
+    # receive time => epoch seconds. Consecutive lines usually share a receive time.
+    parse_timestamp = ParseCache(strptime_parser("%Y/%m/%d %H:%M:%S"))
+
+    def extract_message(self, line):
+        """
+        Unwraps the CSV message from its JSON envelope.
+        The usual envelope is sliced off directly; anything else (e.g. escaped characters) goes through json.
+        Args:
+            line: The syslog line
+
+        Returns:
+            The CSV message, or None if the line cannot be decoded
+        """
+        line = line.strip()
+        start = len(PaloAltoImporter.MESSAGE_PREFIX)
+        end = len(line) - len(PaloAltoImporter.MESSAGE_SUFFIX)
+        if line.startswith(PaloAltoImporter.MESSAGE_PREFIX) and line.endswith(PaloAltoImporter.MESSAGE_SUFFIX) \
+                and line.find('"', start) == end and '\\' not in line:
+            return line[start:end]
+        try:
+            return json.loads(line)['message']
+        except:
+            return None
+
+    def extract_fields(self, message):
+        """
+        Splits the CSV message only as far as the last column used.
+        The type column is checked first so non-TRAFFIC records are rejected before the rest is split.
+        Args:
+            message: The CSV message
+
+        Returns:
+            The list of columns (the last one holds any unused remainder), or None if this isn't a TRAFFIC record
+        """
+        head = message.split(',', PaloAltoImporter.Type + 1)
+        if len(head) <= PaloAltoImporter.Type or head[PaloAltoImporter.Type] != "TRAFFIC":
+            return None
+        fields = head[:-1]
+        fields.extend(head[-1].split(',', PaloAltoImporter.PacketsReceived - PaloAltoImporter.Type))
+        return fields
+
     def translate(self, line, line_num, dictionary):
         """
         Converts a given syslog line into a dictionary of (ip, port, ip, port, timestamp)
@@ -41,23 +88,23 @@ class PaloAltoImporter(BaseImporter):
             2 => error in parsing the line.
             4 => Could not JSON decode the line.
         """
-        try:
-            data = json.loads(line)['message']
-        except:
+        data = self.extract_message(line)
+        if data is None:
+            self.skipped['undecodable'] += 1
             return 4
         # TODO: this assumes the data will not have any commas embedded in strings.
         #       Faster than csv parsing. Has been safe so far!
-        split_data = data.split(',')
+        split_data = self.extract_fields(data)
 
-        if split_data[PaloAltoImporter.Type] != "TRAFFIC":
-            print("Line {0}: Ignoring non-TRAFFIC entry (was {1})".format(line_num, split_data[3]))
+        if split_data is None:
+            self.skipped['non-TRAFFIC'] += 1
             return 1
 
         try:
             # srcIP, srcPort, dstIP, dstPort
-            dictionary['src'] = self.ip_to_int(*(split_data[PaloAltoImporter.SourceIP].split(".")))
+            dictionary['src'] = iputil.encode(split_data[PaloAltoImporter.SourceIP])
             dictionary['srcport'] = split_data[PaloAltoImporter.SourcePort]
-            dictionary['dst'] = self.ip_to_int(*(split_data[PaloAltoImporter.DestIP].split(".")))
+            dictionary['dst'] = iputil.encode(split_data[PaloAltoImporter.DestIP])
             dictionary['dstport'] = split_data[PaloAltoImporter.DestPort]
             dictionary['timestamp'] = datetime.strptime(
                 split_data[PaloAltoImporter.Timestamp], "%Y/%m/%d %H:%M:%S")
@@ -82,10 +129,69 @@ class PaloAltoImporter(BaseImporter):
             dictionary['duration'] = max(split_data[PaloAltoImporter.TimeElapsed], 1)
 
         except:
-            print("error parsing line {0}: {1}".format(line_num, line))
+            self.skipped['unparseable'] += 1
             return 2
         return 0
 
+    def translate_batch(self, lines):
+        """
+        Converts many Palo Alto log lines at once into typed column arrays.
+        Non-TRAFFIC entries and undecodable lines are skipped and counted in the batch's skipped counter.
+        Args:
+            lines: An iterable of syslog lines
+
+        Returns:
+            A ColumnBatch of the successfully translated lines.
+        """
+        batch = ColumnBatch()
+        append = batch.append
+        encode_ip = iputil.encode
+        extract_message = self.extract_message
+        extract_fields = self.extract_fields
+        parse_timestamp = self.parse_timestamp
+        skipped = batch.skipped
+        for line in lines:
+            data = extract_message(line)
+            if data is None:
+                skipped['undecodable'] += 1
+                continue
+            split_data = extract_fields(data)
+            if split_data is None:
+                skipped['non-TRAFFIC'] += 1
+                continue
+            try:
+                bytes_total = int(split_data[PaloAltoImporter.BytesTotal])
+                bytes_sent = split_data[PaloAltoImporter.BytesSent]
+                bytes_received = split_data[PaloAltoImporter.BytesReceived]
+                if bytes_sent and bytes_received and int(bytes_sent) + int(bytes_received) == bytes_total:
+                    bytes_sent = int(bytes_sent)
+                    bytes_received = int(bytes_received)
+                else:
+                    bytes_sent = None
+                    bytes_received = bytes_total
+
+                packets_total = int(split_data[PaloAltoImporter.TotalPackets])
+                packets_sent = split_data[PaloAltoImporter.PacketsSent]
+                packets_received = split_data[PaloAltoImporter.PacketsReceived]
+                if packets_sent and packets_received and int(packets_sent) + int(packets_received) == packets_total:
+                    packets_sent = int(packets_sent)
+                    packets_received = int(packets_received)
+                else:
+                    packets_sent = None
+                    packets_received = packets_total
+
+                append(encode_ip(split_data[PaloAltoImporter.SourceIP]),
+                       int(split_data[PaloAltoImporter.SourcePort]),
+                       encode_ip(split_data[PaloAltoImporter.DestIP]),
+                       int(split_data[PaloAltoImporter.DestPort]),
+                       parse_timestamp(split_data[PaloAltoImporter.Timestamp]),
+                       split_data[PaloAltoImporter.Protocol].upper(),
+                       bytes_sent, bytes_received, packets_sent, packets_received,
+                       max(int(split_data[PaloAltoImporter.TimeElapsed]), 1))
+            except:
+                skipped['unparseable'] += 1
+        return batch
+
 
 class_ = PaloAltoImporter
 
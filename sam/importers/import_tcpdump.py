@@ -1,6 +1,7 @@
 import sys
 import re
-from sam.importers.import_base import BaseImporter
+from sam.importers.import_base import BaseImporter, ColumnBatch
+from sam import iputil
 from datetime import datetime
 import time
 
@@ -72,6 +73,54 @@ class TCPDumpImporter(BaseImporter):
 
         return 0
 
+    def translate_batch(self, lines):
+        """
+        Converts many tcpdump lines at once into typed column arrays.
+        Args:
+            lines: An iterable of tcpdump lines
+
+        Returns:
+            A ColumnBatch of the successfully translated lines.
+        """
+        batch = ColumnBatch()
+        append = batch.append
+        encode_ip = iputil.encode
+        len_finder = TCPDumpImporter.len_finder
+        now = int(time.time())
+        for line in lines:
+            a = line.split()
+            try:
+                timestamp = int(float(a[0]))
+            except:
+                timestamp = now
+
+            try:
+                src_ip, _, src_port = a[2].rpartition(".")
+                src_port = int(src_port)
+                dst_ip, _, dst_port = a[4].rpartition(".")
+                dst_port = int(dst_port.strip(":"))
+                src = encode_ip(src_ip)
+                dst = encode_ip(dst_ip)
+
+                protocol = 'TCP'
+                if a[5].startswith('UDP'):
+                    protocol = 'UDP'
+
+                len_match = len_finder.search(line)
+                if len_match:
+                    n_bytes = int(len_match.group(1))
+                else:
+                    n_bytes = 1
+
+                # apply heuristic to direction: lower port is server, higher port is client
+                if src_port < dst_port:
+                    append(dst, dst_port, src, src_port, timestamp, protocol, 0, n_bytes, 0, 1, 1)
+                else:
+                    append(src, src_port, dst, dst_port, timestamp, protocol, n_bytes, 0, 1, 0, 1)
+            except:
+                batch.skipped['unparseable'] += 1
+        return batch
+
 
 class_ = TCPDumpImporter
 
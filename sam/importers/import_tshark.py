@@ -3,7 +3,10 @@ import subprocess
 import shlex
 import datetime
 import time
-from sam.importers.import_base import BaseImporter
+from sam.importers.import_base import BaseImporter, ColumnBatch
+from sam.importers.timestamps import ParseCache
+from sam.importers import pcap_reader
+from sam import iputil
 try:
     import dateutil.parser
     DATEUTIL = True
@@ -13,6 +16,89 @@ except ImportError as e:
     sys.stderr.write(e.message + '\n')
 
 
+def parse_frame_time(text):
+    """
+    :param text: a tshark frame.time without its fraction of a second, e.g. 'Sep  6, 2017 11:53:24'
+     :type text: str
+    :return: local epoch seconds
+     :rtype: int
+    """
+    try:
+        timestamp = datetime.datetime.strptime(text, "%b %d, %Y %H:%M:%S")
+    except ValueError:
+        if not DATEUTIL:
+            raise
+        timestamp = dateutil.parser.parse(text)
+    return int(time.mktime(timestamp.timetuple()))
+
+
+class FlowTable(object):
+    """
+    Aggregates captured packets into bidirectional flows keyed by (src, srcport, dst, dstport, protocol).
+    The first packet seen decides which end is the source. Like NetFlow, a flow is written out once it
+    has been idle for idle_timeout seconds, or in pieces every active_timeout seconds while it stays busy.
+    """
+    def __init__(self, idle_timeout=60, active_timeout=300):
+        self.idle_timeout = idle_timeout
+        self.active_timeout = active_timeout
+        self.flows = {}  # key => [first seen, last seen, bytes sent, bytes received, packets sent, packets received]
+        self.next_sweep = 0  # capture time of the next expiry check
+
+    def __len__(self):
+        return len(self.flows)
+
+    def add(self, timestamp, src, srcport, dst, dstport, protocol, length):
+        """
+        Count one packet towards its flow.
+        """
+        flow = self.flows.get((src, srcport, dst, dstport, protocol))
+        if flow is not None:
+            flow[2] += length
+            flow[4] += 1
+        else:
+            flow = self.flows.get((dst, dstport, src, srcport, protocol))
+            if flow is not None:
+                flow[3] += length
+                flow[5] += 1
+            else:
+                flow = self.flows[(src, srcport, dst, dstport, protocol)] = [timestamp, timestamp, length, 0, 1, 0]
+        if timestamp > flow[1]:
+            flow[1] = timestamp
+
+    def expire(self, now, batch):
+        """
+        Move flows that have timed out (as of `now`, in capture time) into the batch.
+        """
+        idle = now - self.idle_timeout
+        active = now - self.active_timeout
+        expired = [key for key, flow in self.flows.iteritems() if flow[1] < idle or flow[0] < active]
+        for key in expired:
+            self.emit(key, self.flows.pop(key), batch)
+        self.next_sweep = now + self.idle_timeout
+
+    def flush(self, batch):
+        """
+        Move all remaining flows into the batch.
+        """
+        for key, flow in self.flows.iteritems():
+            self.emit(key, flow, batch)
+        self.flows = {}
+        self.next_sweep = 0
+
+    @staticmethod
+    def emit(key, flow, batch):
+        src, srcport, dst, dstport, protocol = key
+        first, last, bytes_sent, bytes_received, packets_sent, packets_received = flow
+        duration = max(int(last - first), 1)
+        # the report is probably reversed to what it should be.
+        if srcport < dstport:
+            batch.append(dst, dstport, src, srcport, int(first), protocol,
+                         bytes_received, bytes_sent, packets_received, packets_sent, duration)
+        else:
+            batch.append(src, srcport, dst, dstport, int(first), protocol,
+                         bytes_sent, bytes_received, packets_sent, packets_received, duration)
+
+
 class TSharkImporter(BaseImporter):
     FIELDS = [
         'frame.number',
@@ -32,6 +118,7 @@ class TSharkImporter(BaseImporter):
     DSTPORT = 6  # or 7
     TIMESTAMP = 1
     PROTOCOL = 8
+    parse_timestamp = ParseCache(parse_frame_time)
 
     def __init__(self):
         BaseImporter.__init__(self)
@@ -43,7 +130,48 @@ Usage:
     python {0} <input-file> <data source>
 """.format(sys.argv[0])
 
+    def import_capture(self, path_in, batch_size=1000):
+        """
+        Reads a pcap or pcapng file directly and imports one row per flow (see FlowTable).
+        Args:
+            path_in: The path to the capture file
+            batch_size: The number of flows to insert at a time
+
+        Returns:
+            The number of rows inserted
+        """
+        table = FlowTable()
+        batch = ColumnBatch()
+        add = table.add
+        transport_headers = pcap_reader.transport_headers
+        packet_count = 0
+        lines_inserted = 0
+        for timestamp, linktype, frame in pcap_reader.read_packets(path_in):
+            packet_count += 1
+            headers = transport_headers(linktype, frame)
+            if headers is None:
+                continue
+            # expire first, so a packet after a long silence starts a new flow
+            if timestamp >= table.next_sweep:
+                table.expire(timestamp, batch)
+                if len(batch) >= batch_size:
+                    self.insert_batch(batch)
+                    lines_inserted += len(batch)
+                    batch = ColumnBatch()
+            add(timestamp, *headers)
+        table.flush(batch)
+        if len(batch) > 0:
+            self.insert_batch(batch)
+            lines_inserted += len(batch)
+        self.flush_aggregation()
+        print("Done. {0} packets processed, {1} flows inserted".format(packet_count, lines_inserted))
+        return lines_inserted
+
     def import_file(self, path_in):
+        # pcap and pcapng files are read natively. tshark is used for any other capture format.
+        if pcap_reader.is_pcap(path_in):
+            return self.import_capture(path_in)
+
         # Assume a binary file as input
         command = 'tshark -r {path} -E separator=@ {fields} -T fields'.format(
             path=path_in,
@@ -53,35 +181,10 @@ Usage:
         args = shlex.split(command)
         proc = subprocess.Popen(args, bufsize=-1, stdout=subprocess.PIPE)
 
-        line_num = -1
-        lines_inserted = 0
-        counter = 0
-        # prepare buffer
-        rows = [dict.fromkeys(self.keys, '') for _ in range(1000)]
-
-        # TODO: read everything, and combine the conversation streams (aggregate/group by ip:port->ip:port)
         # skip the titles line at the start of the file
         proc.stdout.readline()
 
-        while True:
-            line_num += 1
-            line = proc.stdout.readline()
-            #print line
-            if line == '':
-                break
-
-            if self.translate(line, line_num, rows[counter]) != 0:
-                continue
-
-            counter += 1
-
-            if counter == 1000:
-                self.insert_data(rows, counter)
-                lines_inserted += counter
-                counter = 0
-        if counter != 0:
-            self.insert_data(rows, counter)
-            lines_inserted += counter
+        lines_inserted = self.import_lines(iter(proc.stdout.readline, ''))
 
         # pass through anything else and close the process
         proc.poll()
@@ -89,8 +192,7 @@ Usage:
             proc.stdout.readline()
             proc.poll()
         proc.wait()
-
-        print("Done. {0} lines processed, {1} rows inserted".format(line_num, lines_inserted))
+        return lines_inserted
 
     def import_string(self, s):
         raise NotImplementedError("String interpretation has not been implemented for TShark. File: {0}".format(__file__))
@@ -150,6 +252,48 @@ Usage:
             BaseImporter.reverse_connection(dictionary)
         return 0
 
+    def translate_batch(self, lines):
+        """
+        Converts many lines of tshark field output at once into typed column arrays.
+        Args:
+            lines: An iterable of '@'-separated lines, with fields as in TSharkImporter.FIELDS
+
+        Returns:
+            A ColumnBatch of the successfully translated lines.
+        """
+        batch = ColumnBatch()
+        append = batch.append
+        encode_ip = iputil.encode
+        parse_timestamp = self.parse_timestamp
+        for line in lines:
+            split_data = line.rstrip("\n").split("@")
+            if len(split_data) < 5:
+                batch.skipped['unparseable'] += 1
+                continue
+            split_data = [i.strip(' ') for i in split_data]
+            try:
+                src = encode_ip(split_data[TSharkImporter.SRC].split(",")[0])
+                srcport = int(split_data[TSharkImporter.SRCPORT] or split_data[TSharkImporter.SRCPORT + 1])
+                dst = encode_ip(split_data[TSharkImporter.DST].split(",")[0])
+                dstport = int(split_data[TSharkImporter.DSTPORT] or split_data[TSharkImporter.DSTPORT + 1])
+                if split_data[TSharkImporter.PROTOCOL] in ('UDP', 'DNS'):
+                    protocol = 'UDP'
+                elif split_data[TSharkImporter.PROTOCOL] == 'ICMP':
+                    protocol = 'ICMP'
+                else:
+                    protocol = 'TCP'
+                # e.g. 'Sep  6, 2017 11:53:24.123456789 PDT'. Seconds are the cache key.
+                timestamp = parse_timestamp(split_data[TSharkImporter.TIMESTAMP].partition(".")[0])
+
+                # TODO: duration, bytes and packets are placeholders, as in translate.
+                if srcport < dstport:
+                    append(dst, dstport, src, srcport, timestamp, protocol, 0, 100, 0, 1, 1)
+                else:
+                    append(src, srcport, dst, dstport, timestamp, protocol, 100, 0, 1, 0, 1)
+            except:
+                batch.skipped['unparseable'] += 1
+        return batch
+
 
 class_ = TSharkImporter
 
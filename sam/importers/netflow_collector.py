@@ -17,6 +17,9 @@ logger = logging.getLogger(__name__)
 Live Collector
 -----------
 
+Note: the launcher now collects netflow with server_collector, which decodes export packets natively
+(NetFlowImporter.import_packets). This nfcapd/nfdump based collector is kept for existing setups.
+
 * runs client-side.
 * listens on a socket (usually localhost:514) for messages from a gateway or router
 * translates those messages into a standard SAM format
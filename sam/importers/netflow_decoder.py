@@ -0,0 +1,244 @@
+"""
+Decodes NetFlow v5, NetFlow v9 and IPFIX (NetFlow v10) datagrams directly, without nfcapd/nfdump.
+
+Datagrams are unpacked in place with precompiled struct formats. v9 and IPFIX templates
+are compiled once when they arrive and cached per exporter (version, source id, template id).
+Data sets that arrive before their template are counted in `missing_template` and dropped.
+
+Decoded flows are appended to a ColumnBatch in BaseImporter.keys order.
+Byte and packet counts follow nfdump: "in" counters become *_received, "out" counters become *_sent.
+"""
+import struct
+from sam.importers.import_base import ColumnBatch
+
+# NetFlow v9 / IPFIX information element ids used by SAM
+IN_BYTES = 1
+IN_PKTS = 2
+PROTOCOL = 4
+L4_SRC_PORT = 7
+IPV4_SRC_ADDR = 8
+L4_DST_PORT = 11
+IPV4_DST_ADDR = 12
+LAST_SWITCHED = 21  # sysUpTime milliseconds
+FIRST_SWITCHED = 22  # sysUpTime milliseconds
+OUT_BYTES = 23
+OUT_PKTS = 24
+FLOW_START_SECONDS = 150
+FLOW_END_SECONDS = 151
+FLOW_START_MILLISECONDS = 152
+FLOW_END_MILLISECONDS = 153
+INITIATOR_OCTETS = 231  # Cisco ASA NSEL forward bytes
+RESPONDER_OCTETS = 232  # Cisco ASA NSEL reverse bytes
+INITIATOR_PACKETS = 298
+RESPONDER_PACKETS = 299
+EVENT_TIME_MSEC = 323  # Cisco ASA NSEL event time
+
+FIELDS = {
+    IN_BYTES, IN_PKTS, PROTOCOL, L4_SRC_PORT, IPV4_SRC_ADDR, L4_DST_PORT, IPV4_DST_ADDR,
+    LAST_SWITCHED, FIRST_SWITCHED, OUT_BYTES, OUT_PKTS,
+    FLOW_START_SECONDS, FLOW_END_SECONDS, FLOW_START_MILLISECONDS, FLOW_END_MILLISECONDS,
+    INITIATOR_OCTETS, RESPONDER_OCTETS, INITIATOR_PACKETS, RESPONDER_PACKETS, EVENT_TIME_MSEC,
+}
+INTEGER_CODES = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+PROTOCOLS = {1: 'ICMP', 6: 'TCP', 17: 'UDP', 47: 'GRE', 50: 'ESP', 58: 'ICMP6'}
+
+V5_HEADER = struct.Struct('!HHIIIIBBH')
+V5_RECORD = struct.Struct('!IIIHHIIIIHHxBBBHHBBxx')
+V9_HEADER = struct.Struct('!HHIIII')
+IPFIX_HEADER = struct.Struct('!HHIII')
+SET_HEADER = struct.Struct('!HH')
+TEMPLATE_HEADER = struct.Struct('!HH')
+FIELD_SPEC = struct.Struct('!HH')
+ENTERPRISE = struct.Struct('!I')
+
+VARIABLE_LENGTH = 65535
+
+
+class Template(object):
+    """
+    A compiled v9/IPFIX data template. `fields` are the information element ids
+    in the order `record.unpack_from` returns them; other fields are skipped as padding.
+    """
+    def __init__(self, field_specs):
+        """
+        :param field_specs: (element id, length) for each field, in record order.
+            Enterprise-specific IPFIX fields have an element id of None.
+         :type field_specs: list[ tuple[ int or None, int ] ]
+        """
+        fmt = ['!']
+        self.fields = []
+        self.usable = True
+        for element, length in field_specs:
+            if length == VARIABLE_LENGTH:
+                # record offsets can't be precompiled
+                self.usable = False
+                break
+            if element in FIELDS and length in INTEGER_CODES:
+                fmt.append(INTEGER_CODES[length])
+                self.fields.append(element)
+            else:
+                fmt.append('{0}x'.format(length))
+        self.record = struct.Struct(''.join(fmt))
+        self.length = self.record.size
+
+
+class NetFlowDecoder(object):
+    def __init__(self):
+        self.templates = {}  # (version, source id, template id) => Template
+        self.missing_template = 0  # data sets dropped because their template hasn't been seen yet
+        self.unusable_template = 0  # data sets dropped because their template can't be compiled
+
+    def decode(self, datagram, batch=None):
+        """
+        Decode one NetFlow/IPFIX datagram.
+
+        :param datagram: the UDP payload of one export packet
+         :type datagram: str or buffer
+        :param batch: batch to append flows to. A new batch is created if None.
+         :type batch: ColumnBatch or None
+        :return: the batch, with a row appended for each decoded flow
+         :rtype: ColumnBatch
+        :raises ValueError: if the datagram is not a supported version or is truncated
+        """
+        if batch is None:
+            batch = ColumnBatch()
+        if len(datagram) < 2:
+            raise ValueError("Datagram too short")
+        version = struct.unpack_from('!H', datagram)[0]
+        try:
+            if version == 5:
+                self.decode_v5(datagram, batch)
+            elif version == 9:
+                self.decode_v9(datagram, batch)
+            elif version == 10:
+                self.decode_ipfix(datagram, batch)
+            else:
+                raise ValueError("Unsupported NetFlow version: {0}".format(version))
+        except struct.error as e:
+            raise ValueError("Truncated NetFlow v{0} datagram: {1}".format(version, e))
+        return batch
+
+    @staticmethod
+    def append_flow(batch, src, srcport, dst, dstport, timestamp, protocol,
+                    bytes_in, bytes_out, packets_in, packets_out, duration):
+        protocol = PROTOCOLS.get(protocol, str(protocol))
+        # the report is probably reversed to what it should be. (Same as NetFlowImporter.translate)
+        if srcport < dstport:
+            batch.append(dst, dstport, src, srcport, timestamp, protocol,
+                         bytes_in, bytes_out, packets_in, packets_out, duration)
+        else:
+            batch.append(src, srcport, dst, dstport, timestamp, protocol,
+                         bytes_out, bytes_in, packets_out, packets_in, duration)
+
+    def decode_v5(self, datagram, batch):
+        version, count, uptime, unix_secs, unix_nsecs, sequence, engine_type, engine_id, sampling \
+            = V5_HEADER.unpack_from(datagram)
+        boot_ms = unix_secs * 1000 + unix_nsecs // 1000000 - uptime
+        unpack_from = V5_RECORD.unpack_from
+        offset = V5_HEADER.size
+        if offset + count * V5_RECORD.size > len(datagram):
+            raise ValueError("Truncated NetFlow v5 datagram")
+        for _ in xrange(count):
+            src, dst, nexthop, if_in, if_out, packets, octets, first, last, srcport, dstport, \
+                tcp_flags, protocol, tos, src_as, dst_as, src_mask, dst_mask = unpack_from(datagram, offset)
+            offset += V5_RECORD.size
+            self.append_flow(batch, src, srcport, dst, dstport, (boot_ms + last) // 1000, protocol,
+                             octets, 0, packets, 0, max((last - first) // 1000, 1))
+
+    def decode_v9(self, datagram, batch):
+        version, count, uptime, unix_secs, sequence, source_id = V9_HEADER.unpack_from(datagram)
+        boot_ms = unix_secs * 1000 - uptime
+        self.decode_sets(datagram, V9_HEADER.size, len(datagram), batch, (9, source_id), 0, 1, unix_secs, boot_ms)
+
+    def decode_ipfix(self, datagram, batch):
+        version, length, export_time, sequence, domain_id = IPFIX_HEADER.unpack_from(datagram)
+        if length > len(datagram):
+            raise ValueError("Truncated IPFIX datagram")
+        self.decode_sets(datagram, IPFIX_HEADER.size, length, batch, (10, domain_id), 2, 3, export_time, None)
+
+    def decode_sets(self, datagram, offset, end, batch, exporter, template_set, options_set, export_time, boot_ms):
+        """
+        Walk the flowsets (v9) or sets (IPFIX) in a datagram, between offset and end.
+        """
+        while offset + SET_HEADER.size <= end:
+            set_id, set_length = SET_HEADER.unpack_from(datagram, offset)
+            if set_length < SET_HEADER.size or offset + set_length > end:
+                raise ValueError("Bad set length: {0}".format(set_length))
+            body = offset + SET_HEADER.size
+            offset += set_length
+            if set_id == template_set:
+                self.read_templates(datagram, body, offset, exporter)
+            elif set_id == options_set or set_id < 256:
+                continue  # options templates and reserved sets aren't needed
+            else:
+                template = self.templates.get(exporter + (set_id,))
+                if template is None:
+                    self.missing_template += 1
+                elif not template.usable:
+                    self.unusable_template += 1
+                else:
+                    self.read_records(datagram, body, offset, template, batch, export_time, boot_ms)
+
+    def read_templates(self, datagram, offset, end, exporter):
+        ipfix = exporter[0] == 10
+        while offset + TEMPLATE_HEADER.size <= end:
+            template_id, field_count = TEMPLATE_HEADER.unpack_from(datagram, offset)
+            offset += TEMPLATE_HEADER.size
+            if template_id < 256:
+                break  # padding
+            if field_count == 0:
+                # IPFIX template withdrawal
+                self.templates.pop(exporter + (template_id,), None)
+                continue
+            field_specs = []
+            for _ in xrange(field_count):
+                element, length = FIELD_SPEC.unpack_from(datagram, offset)
+                offset += FIELD_SPEC.size
+                if ipfix and element & 0x8000:
+                    # enterprise-specific element: skip the enterprise number
+                    offset += ENTERPRISE.size
+                    element = None
+                field_specs.append((element, length))
+            self.templates[exporter + (template_id,)] = Template(field_specs)
+
+    def read_records(self, datagram, offset, end, template, batch, export_time, boot_ms):
+        unpack_from = template.record.unpack_from
+        fields = template.fields
+        length = template.length
+        if length == 0:
+            return
+        while offset + length <= end:
+            record = dict(zip(fields, unpack_from(datagram, offset)))
+            offset += length
+            src = record.get(IPV4_SRC_ADDR)
+            dst = record.get(IPV4_DST_ADDR)
+            if src is None or dst is None:
+                continue  # not an IPv4 flow
+
+            # end and start times, in epoch milliseconds
+            if FLOW_END_MILLISECONDS in record:
+                end_ms = record[FLOW_END_MILLISECONDS]
+            elif FLOW_END_SECONDS in record:
+                end_ms = record[FLOW_END_SECONDS] * 1000
+            elif boot_ms is not None and LAST_SWITCHED in record:
+                end_ms = boot_ms + record[LAST_SWITCHED]
+            elif EVENT_TIME_MSEC in record:
+                end_ms = record[EVENT_TIME_MSEC]
+            else:
+                end_ms = export_time * 1000
+            if FLOW_START_MILLISECONDS in record:
+                start_ms = record[FLOW_START_MILLISECONDS]
+            elif FLOW_START_SECONDS in record:
+                start_ms = record[FLOW_START_SECONDS] * 1000
+            elif boot_ms is not None and FIRST_SWITCHED in record:
+                start_ms = boot_ms + record[FIRST_SWITCHED]
+            else:
+                start_ms = end_ms
+
+            self.append_flow(batch, src, record.get(L4_SRC_PORT, 0), dst, record.get(L4_DST_PORT, 0),
+                             end_ms // 1000, record.get(PROTOCOL, 0),
+                             record.get(IN_BYTES, record.get(INITIATOR_OCTETS, 0)),
+                             record.get(OUT_BYTES, record.get(RESPONDER_OCTETS, 0)),
+                             record.get(IN_PKTS, record.get(INITIATOR_PACKETS, 0)),
+                             record.get(OUT_PKTS, record.get(RESPONDER_PACKETS, 0)),
+                             max((end_ms - start_ms) // 1000, 1))
@@ -0,0 +1,163 @@
+"""
+Parallel importer for large line-based log files, and the worker side of the collector's translator pool.
+
+The log file is split at line boundaries into byte ranges. A pool of worker processes
+translates those ranges into ColumnBatches. The calling process is the only writer: it
+inserts the translated batches into the Syslog table in the same order as the file.
+"""
+import os
+import time
+import collections
+import multiprocessing
+from sam.importers.import_base import BaseImporter
+
+CHUNK_SIZE = 16 * 1024 * 1024  # bytes of log file handed to a worker at a time
+BATCH_SIZE = 1000  # lines per translated batch (and per database insert)
+
+# the importer used by a worker process. Set by the pool initializer.
+WORKER_IMPORTER = None
+
+
+def split_file(path, chunk_size=CHUNK_SIZE):
+    """
+    Divide a file into byte ranges of roughly chunk_size that begin and end on line boundaries.
+
+    :param path: path to the log file
+     :type path: str
+    :param chunk_size: approximate number of bytes per range
+     :type chunk_size: int
+    :return: list of (start, end) byte offsets, end exclusive
+     :rtype: list[ tuple[ int, int ] ]
+    """
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()  # advance to the end of the current line
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def is_line_based(importer):
+    """
+    Line-based importers read their input file line by line with BaseImporter.import_file.
+    Importers that override import_file (e.g. to run an external decoder) cannot be split.
+
+    :type importer: BaseImporter
+    :rtype: bool
+    """
+    return importer.import_file.im_func is BaseImporter.import_file.im_func
+
+
+def init_worker(importer):
+    global WORKER_IMPORTER
+    WORKER_IMPORTER = importer
+
+
+def translate_range(path, start, end):
+    """
+    Translate one byte range of a log file. Runs in a worker process.
+
+    :return: worker pid, number of lines read, translated batches, lines skipped by reason, seconds spent
+     :rtype: tuple[ int, int, list[ ColumnBatch ], collections.Counter, float ]
+    """
+    t_start = time.time()
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).splitlines()
+    batches = []
+    skipped = collections.Counter()
+    for i in xrange(0, len(lines), BATCH_SIZE):
+        batch = WORKER_IMPORTER.translate_batch(lines[i:i + BATCH_SIZE])
+        skipped.update(batch.skipped)
+        if len(batch) > 0:
+            batches.append(batch)
+    return os.getpid(), len(lines), batches, skipped, time.time() - t_start
+
+
+def translate_packets(packets):
+    """
+    Translate packets received by the collector. Runs in a worker process.
+
+    :param packets: strings received by the collector
+     :type packets: list[ str ]
+    :return: the translated lines
+     :rtype: ColumnBatch
+    """
+    return WORKER_IMPORTER.translate_packets(packets)
+
+
+def import_file(importer, path, workers, chunk_size=CHUNK_SIZE):
+    """
+    Import a log file using a pool of translating worker processes and a single writer.
+
+    :param importer: the importer to translate lines and insert rows with
+     :type importer: BaseImporter
+    :param path: path to the log file
+     :type path: str
+    :param workers: number of worker processes
+     :type workers: int
+    :param chunk_size: approximate number of bytes handed to a worker at a time
+     :type chunk_size: int
+    :return: number of rows inserted
+     :rtype: int
+    """
+    if not is_line_based(importer):
+        raise ValueError("{0} does not import line-based files".format(importer.__class__.__name__))
+
+    t_start = time.time()
+    ranges = iter(split_file(path, chunk_size))
+    stats = collections.OrderedDict()
+    line_num = 0
+    lines_inserted = 0
+
+    pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(importer,))
+    try:
+        # keep a bounded number of chunks in flight so memory stays flat while the writer catches up.
+        pending = collections.deque()
+        for start, end in ranges:
+            pending.append(pool.apply_async(translate_range, (path, start, end)))
+            if len(pending) >= workers * 2:
+                break
+
+        while pending:
+            pid, n_lines, batches, skipped, seconds = pending.popleft().get()
+            for start, end in ranges:
+                pending.append(pool.apply_async(translate_range, (path, start, end)))
+                break
+
+            # the single writer inserts in file order
+            n_rows = 0
+            for batch in batches:
+                importer.insert_batch(batch)
+                n_rows += len(batch)
+
+            line_num += n_lines
+            lines_inserted += n_rows
+            importer.skipped.update(skipped)
+            worker = stats.setdefault(pid, {'lines': 0, 'rows': 0, 'skipped': 0, 'seconds': 0.0})
+            worker['lines'] += n_lines
+            worker['rows'] += n_rows
+            worker['skipped'] += sum(skipped.values())
+            worker['seconds'] += seconds
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    importer.flush_aggregation()
+    elapsed = time.time() - t_start
+    for pid, worker in stats.iteritems():
+        print("Worker {0}: {1} lines, {2} rows, {3} skipped in {4:.2f}s ({5:.0f} lines/s)".format(
+            pid, worker['lines'], worker['rows'], worker['skipped'], worker['seconds'],
+            worker['lines'] / worker['seconds'] if worker['seconds'] else 0))
+    print("Done. {0} lines processed, {1} rows inserted in {2:.2f}s using {3} workers".format(
+        line_num, lines_inserted, elapsed, workers))
+    importer.report_skipped()
+    return lines_inserted
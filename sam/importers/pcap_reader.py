@@ -0,0 +1,238 @@
+"""
+Reads packets out of libpcap and pcapng capture files without tshark.
+
+The file is memory-mapped and packet headers are unpacked in place.
+Supported link types are Ethernet (with 802.1Q VLAN tags), raw IP and Linux cooked captures.
+"""
+import mmap
+import struct
+
+# global header magic numbers, as read little-endian
+PCAP_MAGIC = {
+    0xa1b2c3d4: ('<', 1e-6),
+    0xd4c3b2a1: ('>', 1e-6),
+    0xa1b23c4d: ('<', 1e-9),  # nanosecond timestamps
+    0x4d3cb2a1: ('>', 1e-9),
+}
+PCAPNG_SECTION_HEADER = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER = 0x1a2b3c4d
+PCAPNG_INTERFACE = 1
+PCAPNG_SIMPLE_PACKET = 3
+PCAPNG_ENHANCED_PACKET = 6
+PCAPNG_OPTION_TSRESOL = 9
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+IPPROTO_ICMP = 1
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+PROTOCOLS = {IPPROTO_ICMP: 'ICMP', IPPROTO_TCP: 'TCP', IPPROTO_UDP: 'UDP', 47: 'GRE', 50: 'ESP'}
+
+ETHERNET_HEADER = struct.Struct('!6s6sH')
+IPV4_HEADER = struct.Struct('!BBHHHBBHII')
+UDP_HEADER = struct.Struct('!HHHH')
+PORTS = struct.Struct('!HH')  # the start of both TCP and UDP headers
+
+
+def is_pcap(path):
+    """
+    :param path: path to a file
+     :type path: str
+    :return: True if the file starts with a libpcap or pcapng magic number
+     :rtype: bool
+    """
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    if len(head) != 4:
+        return False
+    magic = struct.unpack('<I', head)[0]
+    return magic in PCAP_MAGIC or magic == PCAPNG_SECTION_HEADER
+
+
+def read_packets(path):
+    """
+    Iterate over the packets in a libpcap or pcapng file.
+
+    :param path: path to the capture file
+     :type path: str
+    :return: generator of (timestamp, link type, packet data).
+        Packet data points into the mapped file; the mapping is released once no packet data refers to it.
+     :rtype: generator[ tuple[ float, int, buffer ] ]
+    :raises ValueError: if the file is not a libpcap or pcapng file, or (while iterating) its headers are malformed
+    """
+    with open(path, 'rb') as f:
+        if not is_pcap(path):
+            raise ValueError("Not a pcap file: {0}".format(path))
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if struct.unpack_from('<I', data)[0] == PCAPNG_SECTION_HEADER:
+        return read_pcapng_blocks(data)
+    return read_pcap_records(data)
+
+
+def read_pcap_records(data):
+    magic = struct.unpack_from('<I', data)[0] if len(data) >= 4 else None
+    if magic not in PCAP_MAGIC:
+        raise ValueError("Not a pcap file")
+    endian, resolution = PCAP_MAGIC[magic]
+    global_header = struct.Struct(endian + 'IHHiIII')
+    record_header = struct.Struct(endian + 'IIII')
+    if len(data) < global_header.size:
+        raise ValueError("Truncated pcap global header")
+    linktype = global_header.unpack_from(data)[6]
+    offset = global_header.size
+    size = len(data)
+    while offset + record_header.size <= size:
+        ts_sec, ts_frac, incl_len, orig_len = record_header.unpack_from(data, offset)
+        offset += record_header.size
+        if offset + incl_len > size:
+            break  # truncated capture
+        yield ts_sec + ts_frac * resolution, linktype, buffer(data, offset, incl_len)
+        offset += incl_len
+
+
+def read_pcapng_blocks(data):
+    endian = '<'
+    interfaces = []  # (link type, timestamp resolution) per interface id
+    offset = 0
+    size = len(data)
+    while offset + 12 <= size:
+        block_type = struct.unpack_from(endian + 'I', data, offset)[0]
+        if block_type == PCAPNG_SECTION_HEADER:
+            # each section declares its own byte order and interfaces
+            if struct.unpack_from('<I', data, offset + 8)[0] == PCAPNG_BYTE_ORDER:
+                endian = '<'
+            else:
+                endian = '>'
+            interfaces = []
+        block_length = struct.unpack_from(endian + 'I', data, offset + 4)[0]
+        if block_length < 12 or offset + block_length > size:
+            break  # truncated capture
+        body = offset + 8
+        if block_type == PCAPNG_ENHANCED_PACKET:
+            if block_length < 32:
+                raise ValueError("Malformed pcapng packet block at offset {0}".format(offset))
+            interface, ts_high, ts_low, captured, original = struct.unpack_from(endian + 'IIIII', data, body)
+            if interface >= len(interfaces):
+                raise ValueError("pcapng packet block for undeclared interface {0}".format(interface))
+            linktype, resolution = interfaces[interface]
+            frame = buffer(data, body + 20, min(captured, block_length - 32))
+            yield ((ts_high << 32) | ts_low) * resolution, linktype, frame
+        elif block_type == PCAPNG_SIMPLE_PACKET:
+            if block_length < 16:
+                raise ValueError("Malformed pcapng packet block at offset {0}".format(offset))
+            if not interfaces:
+                raise ValueError("pcapng packet block before any interface description")
+            original = struct.unpack_from(endian + 'I', data, body)[0]
+            linktype, resolution = interfaces[0]
+            yield 0.0, linktype, buffer(data, body + 4, min(original, block_length - 16))
+        elif block_type == PCAPNG_INTERFACE:
+            if block_length < 20:
+                raise ValueError("Malformed pcapng interface block at offset {0}".format(offset))
+            linktype = struct.unpack_from(endian + 'H', data, body)[0]
+            resolution = 1e-6
+            option = body + 8
+            end = offset + block_length - 4
+            while option + 4 <= end:
+                code, length = struct.unpack_from(endian + 'HH', data, option)
+                if code == 0:
+                    break
+                if code == PCAPNG_OPTION_TSRESOL and length >= 1:
+                    tsresol = ord(data[option + 4])
+                    if tsresol & 0x80:
+                        resolution = 2.0 ** -(tsresol & 0x7f)
+                    else:
+                        resolution = 10.0 ** -tsresol
+                option += 4 + length + (-length % 4)
+            interfaces.append((linktype, resolution))
+        offset += block_length
+
+
+def ip_packet(linktype, frame):
+    """
+    Strip the link layer header from a captured frame.
+
+    :return: the IPv4 packet, or None if the frame doesn't hold IPv4
+     :rtype: buffer or None
+    """
+    if linktype == LINKTYPE_ETHERNET:
+        if len(frame) < ETHERNET_HEADER.size:
+            return None
+        ethertype = ETHERNET_HEADER.unpack_from(frame)[2]
+        offset = ETHERNET_HEADER.size
+        while ethertype in ETHERTYPE_VLAN and len(frame) >= offset + 4:
+            ethertype = struct.unpack_from('!H', frame, offset + 2)[0]
+            offset += 4
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if len(frame) < 16:
+            return None
+        ethertype = struct.unpack_from('!H', frame, 14)[0]
+        offset = 16
+    elif linktype == LINKTYPE_RAW:
+        ethertype = ETHERTYPE_IPV4
+        offset = 0
+    else:
+        return None
+    if ethertype != ETHERTYPE_IPV4 or len(frame) < offset + IPV4_HEADER.size:
+        return None
+    return buffer(frame, offset)
+
+
+def udp_payloads(path, port=None):
+    """
+    Iterate over the UDP datagrams in a libpcap file. Fragmented datagrams are skipped.
+
+    :param path: path to the capture file
+     :type path: str
+    :param port: if given, only datagrams sent to this port are returned
+     :type port: int or None
+    :return: generator of (source ip, source port, payload)
+     :rtype: generator[ tuple[ int, int, buffer ] ]
+    """
+    for timestamp, linktype, frame in read_packets(path):
+        packet = ip_packet(linktype, frame)
+        if packet is None:
+            continue
+        version_ihl, tos, total_length, ident, fragment, ttl, protocol, checksum, src, dst \
+            = IPV4_HEADER.unpack_from(packet)
+        if version_ihl >> 4 != 4 or protocol != IPPROTO_UDP or fragment & 0x3fff:
+            continue
+        header_length = (version_ihl & 0x0f) * 4
+        if len(packet) < header_length + UDP_HEADER.size:
+            continue
+        srcport, dstport, udp_length, udp_checksum = UDP_HEADER.unpack_from(packet, header_length)
+        if port is not None and dstport != port:
+            continue
+        start = header_length + UDP_HEADER.size
+        yield src, srcport, buffer(packet, start, max(min(udp_length, len(packet) - header_length) - UDP_HEADER.size, 0))
+
+
+def transport_headers(linktype, frame):
+    """
+    Decode the IPv4 and TCP/UDP headers of a captured frame.
+    Fragments after the first are skipped since they carry no ports.
+
+    :param linktype: link type of the capture
+     :type linktype: int
+    :param frame: the captured frame
+     :type frame: buffer or str
+    :return: source ip, source port, destination ip, destination port, protocol name, IP length in bytes;
+        or None if the frame isn't IPv4.
+        Ports are 0 for protocols other than TCP and UDP.
+     :rtype: tuple[ int, int, int, int, str, int ] or None
+    """
+    packet = ip_packet(linktype, frame)
+    if packet is None:
+        return None
+    version_ihl, tos, total_length, ident, fragment, ttl, protocol, checksum, src, dst \
+        = IPV4_HEADER.unpack_from(packet)
+    if version_ihl >> 4 != 4 or fragment & 0x1fff:
+        return None
+    srcport = dstport = 0
+    if protocol == IPPROTO_TCP or protocol == IPPROTO_UDP:
+        header_length = (version_ihl & 0x0f) * 4
+        if len(packet) < header_length + PORTS.size:
+            return None
+        srcport, dstport = PORTS.unpack_from(packet, header_length)
+    return src, srcport, dst, dstport, PROTOCOLS.get(protocol, str(protocol)), total_length
@@ -0,0 +1,99 @@
+"""
+Timestamp handling for the import pipeline.
+
+Importers carry timestamps as integer epoch seconds (local time, as time.mktime gives).
+Log files repeat the same timestamp text on many consecutive lines, so parsing goes through
+a small LRU cache. Epoch seconds are only formatted for the database when rows are inserted.
+"""
+import time
+import collections
+
+SQL_FORMAT = '%Y-%m-%d %H:%M:%S'
+CACHE_SIZE = 4096
+
+
+class ParseCache(object):
+    """
+    A least-recently-used cache in front of a timestamp parsing function.
+    """
+    def __init__(self, parse, maxsize=CACHE_SIZE):
+        """
+        :param parse: function from timestamp text to epoch seconds
+         :type parse: callable
+        :param maxsize: number of parsed timestamps to keep. 0 disables caching.
+         :type maxsize: int
+        """
+        self.parse = parse
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, text):
+        """
+        :param text: the timestamp as written in the log
+         :type text: str
+        :return: epoch seconds
+         :rtype: int
+        :raises ValueError: if the text can't be parsed
+        """
+        cache = self.cache
+        try:
+            epoch = cache.pop(text)
+        except KeyError:
+            self.misses += 1
+            epoch = self.parse(text)
+            if self.maxsize <= 0:
+                return epoch
+            if len(cache) >= self.maxsize:
+                cache.popitem(last=False)
+        else:
+            self.hits += 1
+        cache[text] = epoch
+        return epoch
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+def strptime_parser(fmt):
+    """
+    :param fmt: time.strptime format of the timestamp text
+     :type fmt: str
+    :return: a function from timestamp text to local epoch seconds
+     :rtype: callable
+    """
+    def parse(text):
+        return int(time.mktime(time.strptime(text, fmt)))
+    return parse
+
+
+def format_epoch(epoch):
+    """
+    :param epoch: local epoch seconds
+     :type epoch: int
+    :return: the timestamp as the database expects it, e.g. '2017-09-06 11:53:24'
+     :rtype: str
+    """
+    return time.strftime(SQL_FORMAT, time.localtime(epoch))
+
+
+def format_epochs(epochs):
+    """
+    Format a column of epoch seconds for the database. Each distinct value is formatted once.
+
+    :param epochs: local epoch seconds
+     :type epochs: iterable[int]
+    :return: the formatted timestamps, in the same order
+     :rtype: list[str]
+    """
+    formatted = {}
+    column = []
+    for epoch in epochs:
+        text = formatted.get(epoch)
+        if text is None:
+            text = formatted[epoch] = format_epoch(epoch)
+        column.append(text)
+    return column
@@ -0,0 +1,283 @@
+"""
+Binary framing for translated rows sent from the collector to the aggregator.
+
+A message is a fixed header followed by a body, which is zlib-compressed when FLAG_ZLIB is set:
+
+    header: MAGIC (4 bytes), format version (uint8), flags (uint8),
+            then if FLAG_SEQUENCE is set: sender id (uint64), sequence number (uint64)
+    body:   access key (uint16 length + utf-8), protocol version (uint8 length + ascii),
+            message (uint8 length + ascii, e.g. 'handshake'), row count (uint32),
+            then one block per column, in BaseImporter.keys order:
+              src, dst                   uint32 each
+              srcport, dstport           uint16 each
+              timestamp                  int64 epoch seconds each
+              protocol                   uint8 count of distinct names (at most MAX_NAMES),
+                                         each uint8 length + ascii,
+                                         then uint8 index into those names for each row
+              bytes, packets, duration   int64 each, with -1 standing for NULL
+
+Decoded bodies are limited to MAX_BODY bytes, so a small compressed message can't expand
+without bound in the aggregator.
+
+The sequence number lets the aggregator acknowledge each upload and discard ones it has already
+accepted, when a collector retries an upload whose acknowledgement was lost.
+
+All integers are little-endian. Decoding never evaluates the payload, unlike the pickle format
+it replaces; Aggregator still accepts pickled packages from older collectors (see is_binary).
+"""
+import time
+import zlib
+import struct
+from array import array
+from datetime import datetime
+from sam.importers.import_base import BaseImporter, ColumnBatch
+
+MAGIC = 'SAMW'
+FORMAT_VERSION = 1
+FLAG_ZLIB = 0x01
+FLAG_SEQUENCE = 0x02
+HEADER = struct.Struct('<4sBB')
+SEQUENCE = struct.Struct('<QQ')  # sender id, sequence number
+NULL = -1
+MAX_NAMES = 255  # distinct protocol names in one message
+MAX_BODY = 64 * 1024 * 1024  # bytes, after decompression
+
+# struct codes for the fixed-width columns
+COLUMN_CODES = {
+    'src': 'I',
+    'dst': 'I',
+    'srcport': 'H',
+    'dstport': 'H',
+    'timestamp': 'q',
+    'bytes_sent': 'q',
+    'bytes_received': 'q',
+    'packets_sent': 'q',
+    'packets_received': 'q',
+    'duration': 'q',
+}
+NULLABLE = ('bytes_sent', 'bytes_received', 'packets_sent', 'packets_received', 'duration')
+
+
+def is_binary(data):
+    """
+    :param data: a message body as received by the aggregator
+     :type data: str
+    :return: True if data is in this format rather than a pickle
+     :rtype: bool
+    """
+    return data[:len(MAGIC)] == MAGIC
+
+
+def to_int(value):
+    if isinstance(value, (int, long)):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
+
+
+def to_epoch(value):
+    if isinstance(value, datetime):
+        return int(time.mktime(value.timetuple()))
+    return to_int(value)
+
+
+def encode_rows(lines, access_key, version, msg='', compress=True, sequence=None):
+    """
+    Encode rows as the collector buffers them.
+
+    :param lines: rows of values in BaseImporter.keys order, as filled in by BaseImporter.translate
+     :type lines: list[list]
+    :param access_key: the datasource's upload key
+     :type access_key: str
+    :param version: the collector/aggregator protocol version, e.g. "1.0"
+     :type version: str
+    :param msg: an optional message, e.g. 'handshake'
+     :type msg: str
+    :param sequence: optional sender id and sequence number, both unsigned 64-bit
+     :type sequence: tuple[int, int] or None
+    :param compress: zlib-compress the body
+     :type compress: bool
+    :return: the encoded message
+     :rtype: str
+    :raises ValueError: if a row has the wrong number of values or a value doesn't fit its column
+    """
+    if lines:
+        columns = [list(column) for column in zip(*lines)]
+        if len(columns) != len(BaseImporter.keys) or any(len(line) != len(BaseImporter.keys) for line in lines):
+            raise ValueError("Rows must have {0} values, in BaseImporter.keys order".format(len(BaseImporter.keys)))
+    else:
+        columns = [[] for _ in BaseImporter.keys]
+    stamps = {}
+    column = columns[BaseImporter.keys.index('timestamp')]
+    for j, value in enumerate(column):
+        epoch = stamps.get(value)
+        if epoch is None:
+            epoch = stamps[value] = to_epoch(value)
+        column[j] = epoch
+    return encode_columns(columns, access_key, version, msg, compress, sequence)
+
+
+def encode_batch(batch, access_key, version, msg='', compress=True, sequence=None):
+    """
+    Encode a ColumnBatch, as returned by an importer's translate_batch.
+    Parameters, return value and errors are as for encode_rows.
+    """
+    return encode_columns(batch.columns, access_key, version, msg, compress, sequence)
+
+
+def pack_string(text, length_code):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    if not isinstance(text, str):
+        raise ValueError("Cannot encode {0!r} as a string".format(text))
+    try:
+        return struct.pack('<' + length_code, len(text)) + text
+    except struct.error:
+        raise ValueError("String is too long to encode: {0!r}".format(text[:40]))
+
+
+def pack_names(column):
+    """
+    Pack a column of names (e.g. protocol) as the distinct names followed by each row's index into them.
+
+    :param column: the names, one per row
+     :type column: list[str]
+    :return: the packed column
+     :rtype: str
+    :raises ValueError: if a name isn't a string or there are more than MAX_NAMES distinct names
+    """
+    names = {}
+    for name in column:
+        if name not in names:
+            if len(names) == MAX_NAMES:
+                raise ValueError("Cannot encode more than {0} distinct names in a column".format(MAX_NAMES))
+            names[name] = len(names)
+    ordered = sorted(names, key=names.get)
+    parts = [struct.pack('<B', len(ordered))]
+    parts.extend(pack_string(name, 'B') for name in ordered)
+    parts.append(array('B', [names[name] for name in column]).tostring())
+    return b''.join(parts)
+
+
+def pack_column(key, column):
+    fmt = '<{0}{1}'.format(len(column), COLUMN_CODES[key])
+    if key in NULLABLE and None in column:
+        column = [NULL if value is None else value for value in column]
+    try:
+        return struct.pack(fmt, *column)
+    except struct.error:
+        # values translate left as text, e.g. '80' or '1.5'
+        pass
+    try:
+        return struct.pack(fmt, *map(to_int, column))
+    except (struct.error, TypeError, ValueError) as e:
+        raise ValueError("Cannot encode column {0}: {1}".format(key, e))
+
+
+def encode_columns(columns, access_key, version, msg, compress, sequence=None):
+    count = len(columns[0])
+    parts = [pack_string(access_key or '', 'H'),
+             pack_string(version or '', 'B'),
+             pack_string(msg or '', 'B'),
+             struct.pack('<I', count)]
+    for key, column in zip(BaseImporter.keys, columns):
+        if key == 'protocol':
+            parts.append(pack_names(column))
+        else:
+            parts.append(pack_column(key, column))
+    body = b''.join(parts)
+    flags = 0
+    if compress:
+        body = zlib.compress(body, 1)
+        flags |= FLAG_ZLIB
+    if sequence is None:
+        return HEADER.pack(MAGIC, FORMAT_VERSION, flags) + body
+    try:
+        packed = SEQUENCE.pack(*sequence)
+    except struct.error as e:
+        raise ValueError("Cannot encode sequence {0}: {1}".format(sequence, e))
+    return HEADER.pack(MAGIC, FORMAT_VERSION, flags | FLAG_SEQUENCE) + packed + body
+
+
+class Reader(object):
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, fmt):
+        values = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values
+
+    def string(self, length_code):
+        length = self.unpack('<' + length_code)[0]
+        text = self.data[self.offset:self.offset + length]
+        if len(text) != length:
+            raise ValueError("Message is truncated")
+        self.offset += length
+        return text
+
+
+def decode(data):
+    """
+    Decode a message made by encode_rows or encode_batch.
+
+    :param data: the encoded message
+     :type data: str
+    :return: a package like the pickled ones: access_key, version, headers and msg (if any),
+        with the rows in 'batch' as a ColumnBatch instead of in 'lines',
+        and the 'sender' and 'sequence' numbers if the message has them.
+     :rtype: dict
+    :raises ValueError: if the message is malformed or of an unsupported format version
+    """
+    try:
+        magic, format_version, flags = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("Not a binary SAM message")
+        if format_version != FORMAT_VERSION:
+            raise ValueError("Unsupported format version {0}, expected {1}".format(format_version, FORMAT_VERSION))
+        offset = HEADER.size
+        sequence = None
+        if flags & FLAG_SEQUENCE:
+            sequence = SEQUENCE.unpack_from(data, offset)
+            offset += SEQUENCE.size
+        body = data[offset:]
+        if flags & FLAG_ZLIB:
+            decompressor = zlib.decompressobj()
+            body = decompressor.decompress(body, MAX_BODY)
+            if decompressor.unconsumed_tail:
+                raise ValueError("Message body is larger than {0} bytes".format(MAX_BODY))
+        elif len(body) > MAX_BODY:
+            raise ValueError("Message body is larger than {0} bytes".format(MAX_BODY))
+
+        reader = Reader(body)
+        package = {
+            'access_key': reader.string('H').decode('utf-8'),
+            'version': reader.string('B'),
+            'headers': BaseImporter.keys,
+        }
+        if sequence is not None:
+            package['sender'], package['sequence'] = sequence
+        msg = reader.string('B')
+        if msg:
+            package['msg'] = msg
+        count = reader.unpack('<I')[0]
+
+        batch = ColumnBatch()
+        for i, key in enumerate(BaseImporter.keys):
+            if key == 'protocol':
+                names = [reader.string('B') for _ in range(reader.unpack('<B')[0])]
+                indexes = reader.unpack('<{0}B'.format(count))
+                batch.columns[i] = [names[index] for index in indexes]
+                continue
+            values = reader.unpack('<{0}{1}'.format(count, COLUMN_CODES[key]))
+            if key in NULLABLE:
+                batch.columns[i] = [None if value == NULL else value for value in values]
+            else:
+                batch.columns[i].extend(values)
+    except (struct.error, zlib.error, IndexError, OverflowError, UnicodeDecodeError) as e:
+        raise ValueError("Malformed message: {0}".format(e))
+    package['batch'] = batch
+    return package
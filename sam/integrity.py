@@ -31,6 +31,20 @@ def get_table_names(db):
         raise ValueError("Unknown dbn. Cannot determine tables")
     return tables
 
+def get_column_names(db, table):
+    """
+    :type db: web.DB
+    :param table: name of the table to inspect
+    :return: the names of the table's columns
+    """
+    if db.dbname == 'mysql':
+        columns = [row['Field'] for row in db.query("SHOW COLUMNS FROM {0};".format(table))]
+    elif db.dbname == 'sqlite':
+        columns = [row['name'] for row in db.query("PRAGMA table_info({0});".format(table))]
+    else:
+        raise ValueError("Unknown dbn. Cannot determine columns")
+    return columns
+
 def get_all_subs(db):
     rows = db.select("Subscriptions", what="subscription")
     subs = [row['subscription'] for row in rows]
@@ -413,6 +427,7 @@ def check_data_sources(db):
     :return: a dictionary containing issues identified in the settings. Dictionary may contain keys:
         "unused": a set of all tables without an owner datasource
         "malformed": a set of all datasources that are missing some of their tables
+        "outdated": a set of all Syslog tables without a links column
     """
     logger.debug("Checking data sources...")
     sub_model = Subscriptions(db)
@@ -424,6 +439,7 @@ def check_data_sources(db):
     # issue collections
     extra_tables = set()
     malformed_datasources = set()
+    outdated_tables = set()
 
     for sub_id in known_subscriptions:
         ds_model = Datasources(db, {}, sub_id)
@@ -432,18 +448,23 @@ def check_data_sources(db):
             if not expected_tables.issubset(ds_tables):
                 logger.warning("\tMissing Tables for sub {0}, ds {1}".format(sub_id, ds_id))
                 malformed_datasources.add((sub_id, ds_id))
+            else:
+                syslog_table = 's{acct}_ds{id}_Syslog'.format(acct=sub_id, id=ds_id)
+                if 'links' not in get_column_names(db, syslog_table):
+                    logger.warning("\tOutdated Syslog table for sub {0}, ds {1}".format(sub_id, ds_id))
+                    outdated_tables.add(syslog_table)
             ds_tables -= expected_tables
     extra_tables |= ds_tables
     if len(extra_tables) > 0:
         logger.warning("\tUnused tables: {0}".format(" ".join(extra_tables)))
 
-    if not malformed_datasources and not extra_tables:
+    if not malformed_datasources and not extra_tables and not outdated_tables:
         logger.debug("\tData sources confirmed")
         return {}
 
     # return {'malformed': malformed_datasources, 'unused': extra_tables}
     # unused tables may belong to a plugin. Do not delete them immediately.
-    return {'malformed': malformed_datasources}
+    return {'malformed': malformed_datasources, 'outdated': outdated_tables}
 
 
 def fix_data_sources(db, errors):
@@ -453,6 +474,7 @@ def fix_data_sources(db, errors):
     :param errors: a dictionary containing issues identified in the settings. Dictionary may contain keys:
         "unused": a set of all tables without an owner datasource
         "malformed": a set of all datasources that are missing some of their tables
+        "outdated": a set of all Syslog tables without a links column
     """
     logger.debug("Fixing data sources")
     if 'unused' in errors and len(errors['unused']) > 0:
@@ -467,6 +489,11 @@ def fix_data_sources(db, errors):
             ds_model = Datasources(db, {}, sub_id)
             ds_model.create_ds_tables(ds_id)
 
+    if 'outdated' in errors and len(errors['outdated']) > 0:
+        logger.debug("\tAdding links column to Syslog tables")
+        for table in errors['outdated']:
+            db.query("ALTER TABLE {0} ADD COLUMN links INT DEFAULT 1 NOT NULL;".format(table))
+
     if not any(map(len, errors.values())):
         logger.debug('\tNo fix needed')
     else:
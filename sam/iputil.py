@@ -0,0 +1,164 @@
+"""
+IPv4 address conversion between dotted-decimal strings and unsigned 32-bit integers.
+
+Scalar conversions use the C implementations in the socket module where the input allows it.
+The batch versions convert a whole column at once: encode_many packs every address into one
+buffer and reinterprets it as an array of unsigned ints; decode_many does the reverse.
+The arrays support the buffer protocol, so numpy.frombuffer(array, dtype='uint32') wraps one without copying.
+"""
+import sys
+import socket
+import struct
+from array import array
+
+ADDRESS = struct.Struct('!I')
+OCTETS = [str(i) for i in range(256)]
+DECODE_CACHE_SIZE = 65536
+
+# array typecode for unsigned 32-bit ints on this platform
+TYPECODE = 'I' if array('I').itemsize == 4 else 'L'
+BIG_ENDIAN = sys.byteorder == 'big'
+
+_pton = socket.inet_pton
+_ntoa = socket.inet_ntoa
+_AF_INET = socket.AF_INET
+
+
+def ip_to_int(a, b, c, d):
+    """
+    Converts an address from its four dotted-decimal segments into a single unsigned int.
+
+    :param a: IP address segment 1 ###.0.0.0
+    :type a: str or int
+    :param b: IP address segment 2 0.###.0.0
+    :type b: str or int
+    :param c: IP address segment 3 0.0.###.0
+    :type c: str or int
+    :param d: IP address segment 4 0.0.0.###
+    :type d: str or int
+    :return: The IP address as a simple 32-bit unsigned integer
+    :rtype: int
+    """
+    return (int(a) << 24) + (int(b) << 16) + (int(c) << 8) + int(d)
+
+
+def encode(ip):
+    """
+    Converts an address from dotted decimal notation into an unsigned int.
+
+    :param ip: dotted decimal ip address, like 12.34.56.78
+    :type ip: str
+    :return: The IP address as a simple 32-bit unsigned integer
+    :rtype: int
+    :raises ValueError: if ip doesn't have four numeric segments
+    """
+    try:
+        return ADDRESS.unpack(_pton(_AF_INET, ip))[0]
+    except (socket.error, TypeError, UnicodeEncodeError):
+        # e.g. leading zeros, which the socket module rejects
+        parts = ip.split(".")
+        if len(parts) != 4:
+            raise ValueError("Not an IPv4 address: {0!r}".format(ip))
+        return ip_to_int(*parts)
+
+
+def encode_partial(ip):
+    """
+    Converts a possibly incomplete address, e.g. "10.20" or "10.20.30.0/24", into an unsigned int.
+    Missing trailing segments and segments that aren't numbers count as 0. Any subnet mask is ignored.
+
+    :param ip: dotted decimal ip address, like 12.34.56.78 or 12.34
+    :type ip: str
+    :return: The IP address as a simple 32-bit unsigned integer
+    :rtype: int
+    """
+    try:
+        return ADDRESS.unpack(_pton(_AF_INET, ip))[0]
+    except (socket.error, TypeError, UnicodeEncodeError):
+        pass
+    parts = ip.partition("/")[0].split(".")
+    ip_int = 0
+    for i in range(4):
+        ip_int <<= 8
+        if len(parts) > i:
+            try:
+                ip_int += int(parts[i])
+            except ValueError:
+                pass
+    return ip_int
+
+
+def decode(ip_number):
+    """
+    Converts an address from an unsigned int into dotted decimal notation.
+
+    :param ip_number: an unsigned 32-bit integer representing an IP address
+    :type ip_number: int
+    :return: The IP address as a dotted-decimal string.
+    :rtype: str
+    """
+    return '.'.join((OCTETS[ip_number >> 24 & 0xFF],
+                     OCTETS[ip_number >> 16 & 0xFF],
+                     OCTETS[ip_number >> 8 & 0xFF],
+                     OCTETS[ip_number & 0xFF]))
+
+
+def encode_many(ips):
+    """
+    Converts many dotted-decimal addresses at once.
+
+    :param ips: dotted decimal ip addresses
+    :type ips: iterable[str]
+    :return: the addresses as unsigned 32-bit ints, in the same order
+    :rtype: array.array
+    :raises ValueError: if any address doesn't have four numeric segments
+    """
+    ips = list(ips)
+    try:
+        packed = b''.join([_pton(_AF_INET, ip) for ip in ips])
+    except (socket.error, TypeError, UnicodeEncodeError):
+        return array(TYPECODE, map(encode, ips))
+    addresses = array(TYPECODE)
+    addresses.fromstring(packed)
+    if not BIG_ENDIAN:
+        addresses.byteswap()
+    return addresses
+
+
+def decode_many(ip_numbers):
+    """
+    Converts many unsigned int addresses at once.
+
+    :param ip_numbers: unsigned 32-bit ints, e.g. an array.array, a ColumnBatch column or a numpy uint32 array
+    :type ip_numbers: iterable[int]
+    :return: the addresses in dotted decimal notation, in the same order
+    :rtype: list[str]
+    """
+    addresses = array(TYPECODE, ip_numbers)
+    if not BIG_ENDIAN:
+        addresses.byteswap()
+    packed = addresses.tostring()
+    return [_ntoa(packed[i:i + 4]) for i in xrange(0, len(packed), 4)]
+
+
+def make_cached_decoder(maxsize=DECODE_CACHE_SIZE):
+    """
+    Build a memoized `decode`, for use where the same addresses are decoded over and over,
+    such as the decodeIP SQLite function. The cache is emptied whenever it fills up.
+
+    :param maxsize: the number of decoded addresses to keep
+    :type maxsize: int
+    :return: a function like decode
+    :rtype: callable
+    """
+    cache = {}
+
+    def cached_decode(ip_number):
+        try:
+            return cache[ip_number]
+        except KeyError:
+            if len(cache) >= maxsize:
+                cache.clear()
+            text = cache[ip_number] = decode(ip_number)
+            return text
+    return cached_decode
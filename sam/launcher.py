@@ -12,7 +12,7 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=constants.log_level)
 application = None
 
-VALID_ARGS = ['format=', 'port=', 'target=', 'dest=', 'sub=', 'local', 'whois', 'wsgi']
+VALID_ARGS = ['format=', 'port=', 'target=', 'dest=', 'sub=', 'workers=', 'aggregate', 'async', 'local', 'whois', 'wsgi']
 VALID_TARGETS = ['local', 'aggregator', 'collector', 'collector_stream',
                  'webserver', 'import', 'test_dummy', 'template']
 
@@ -27,10 +27,16 @@ VALID_TARGETS = ['local', 'aggregator', 'collector', 'collector_stream',
 #     --target=aggregator --wsgi
 #   collector
 #     --target=collector
+#   collector, translating with several processes
+#     --target=collector --workers=4
 #   localmode combo
 #     --local --format=tcpdump
 #   import
 #     --target=import  --format=palo_alto /path/to/logfile
+#   parallel import
+#     --target=import  --format=palo_alto --workers=4 /path/to/logfile
+#   import, merging rows into 5-minute flows before they are stored
+#     --target=import  --format=tcpdump --aggregate /path/to/logfile
 #   template
 #     --target=template /path/to/template.yml
 # suggested demo invocation:
@@ -79,7 +85,10 @@ def parse_args(argv):
         'whois': False,
         'wsgi': False,
         'dest': 'default',
-        'sub': None
+        'sub': None,
+        'workers': None,
+        'aggregate': False,
+        'async': False
     }
 
     for key, val in kwargs:
@@ -99,6 +108,12 @@ def parse_args(argv):
             parsed_args['dest'] = val
         if key == '--sub':
             parsed_args['sub'] = val
+        if key == '--workers':
+            parsed_args['workers'] = val
+        if key == '--aggregate':
+            parsed_args['aggregate'] = True
+        if key == '--async':
+            parsed_args['async'] = True
     return parsed_args, args
 
 
@@ -123,34 +138,39 @@ def launch_webserver(parsed, args):
 
 
 def launch_collector(parsed, args):
+    try:
+        workers = int(parsed.get('workers') or 1)
+    except ValueError:
+        logger.error('Invalid number of workers. "--workers=N". Exiting.')
+        return None
     port = parsed.get('port', None)
     if port is None:
         port = constants.collector['listen_port']
     logger.info('launching collector on {}'.format(port))
 
-    # workaround for netflow processing with nfcapd:
-    if parsed['format'].lower() == "netflow":
-        from sam.importers import netflow_collector
-        collector = netflow_collector.Collector()
-        collector.run(port=port)
-    else:
-        import server_collector
-        collector = server_collector.Collector()
-        if parsed['format'] is None:
-            parsed['format'] = constants.collector['format']
-        collector.run(port=port, format=parsed['format'])
+    # netflow export packets are decoded natively by the netflow importer
+    import server_collector
+    collector = server_collector.Collector()
+    if parsed['format'] is None:
+        parsed['format'] = constants.collector['format']
+    collector.run(port=port, format=parsed['format'], workers=workers)
 
     logger.info('collector shut down.')
     return collector
 
 
 def launch_collector_stream(parsed, args):
+    try:
+        workers = int(parsed.get('workers') or 1)
+    except ValueError:
+        logger.error('Invalid number of workers. "--workers=N". Exiting.')
+        return None
     import server_collector
     logger.info('launching stdin collector')
     collector = server_collector.Collector()
     if parsed['format'] is None:
         parsed['format'] = constants.collector['format']
-    collector.run_streamreader(sys.stdin, format=parsed['format'])
+    collector.run_streamreader(sys.stdin, format=parsed['format'], workers=workers)
     logger.info('collector shut down.')
     return collector
 
@@ -165,8 +185,13 @@ def launch_aggregator(parsed, args):
         port = parsed.get('port', None)
         if port is None:
             port = constants.aggregator['listen_port']
-        logger.info('launching dev aggregator on {}'.format(port))
-        server_aggregator.start_server(port=port)
+        if parsed.get('async', False):
+            import server_aggregator_async
+            logger.info('launching async aggregator on {}'.format(port))
+            server_aggregator_async.start_server(port=port)
+        else:
+            logger.info('launching dev aggregator on {}'.format(port))
+            server_aggregator.start_server(port=port)
         logger.info('aggregator shut down.')
 
 
@@ -202,8 +227,21 @@ def launch_importer(parsed, args):
     if not importer:
         logger.error("Could not find importer for given format. ({})".format(log_format))
         return 7
+    try:
+        workers = int(parsed.get('workers') or 1)
+    except ValueError:
+        logger.error('Invalid number of workers. "--workers=N". Exiting.')
+        return 9
+    if parsed.get('aggregate'):
+        importer.enable_aggregation()
     if importer.validate_file(args[0]):
-        importer.import_file(args[0])
+        from sam.importers import parallel_import
+        if workers > 1 and parallel_import.is_line_based(importer):
+            parallel_import.import_file(importer, args[0], workers)
+        else:
+            if workers > 1:
+                logger.warning("{} importer cannot run in parallel. Importing serially.".format(log_format))
+            importer.import_file(args[0])
     else:
         logger.error("Could not open source file. Exiting.")
         return 8
@@ -1,9 +1,75 @@
 import os
 import math
+import time
 import base64
+import threading
+import collections
 import web
 
 
+class KeyCache(object):
+    """
+    A least-recently-used cache of access key validations, each kept for at most `ttl` seconds.
+    Keys that failed validation are cached too, so a misconfigured collector doesn't reach the database
+    with every upload.
+    LiveKeys empties it whenever keys are created or deleted. Changes made by another process
+    (e.g. the webserver, when the aggregator runs separately) are seen once the entries expire.
+    """
+    def __init__(self, maxsize=4096, ttl=60):
+        """
+        :param maxsize: number of keys to keep. 0 disables caching.
+         :type maxsize: int
+        :param ttl: seconds a validation is trusted
+         :type ttl: float
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.cache = collections.OrderedDict()  # key: (expiry time, validation result)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, validate):
+        """
+        :param key: an access key
+         :type key: str
+        :param validate: function from access key to validation result, called on a miss
+         :type validate: callable
+        :return: the (possibly cached) validation result
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.cache.pop(key, None)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                self.cache[key] = entry
+                return entry[1]
+            self.misses += 1
+        result = validate(key)
+        if self.maxsize > 0:
+            with self.lock:
+                while len(self.cache) >= self.maxsize:
+                    self.cache.popitem(last=False)
+                self.cache[key] = (now + self.ttl, result)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def stats(self):
+        """
+        :return: entries held, and hit and miss counts
+         :rtype: dict[str, int]
+        """
+        with self.lock:
+            return {'size': len(self.cache), 'hits': self.hits, 'misses': self.misses}
+
+
+# shared by every LiveKeys in this process, so changes made through any of them invalidate it
+KEY_CACHE = KeyCache()
+
+
 class LiveKeys:
     table_livekeys = "LiveKeys"
     table_ds = "Datasources"
@@ -38,6 +104,7 @@ class LiveKeys:
     def create(self, ds_id):
         key = LiveKeys.generate_salt(24)
         self.db.insert(LiveKeys.table_livekeys, subscription=self.sub, datasource=ds_id, access_key=key)
+        KEY_CACHE.clear()
         return key
     
     def read(self):
@@ -63,12 +130,21 @@ class LiveKeys:
         rows = self.db.select(LiveKeys.table_livekeys, where="access_key = $key", vars=qvars)
         return rows.first()
 
+    def validate_cached(self, key):
+        """
+        Like validate, but answered from KEY_CACHE when possible. For the upload path.
+
+        :rtype: dict or None
+        """
+        return KEY_CACHE.get(key, self.validate)
+
     def delete(self, key):
         qvars = {
             'sub': self.sub,
             'key': key
         }
         num_deleted = self.db.delete(LiveKeys.table_livekeys, where='subscription=$sub AND access_key=$key', vars=qvars)
+        KEY_CACHE.clear()
         return num_deleted
 
     def delete_ds(self, ds_id):
@@ -76,6 +152,7 @@ class LiveKeys:
             'id': ds_id
         }
         num_deleted = self.db.delete(LiveKeys.table_livekeys, where='datasource = $id', vars=qvars)
+        KEY_CACHE.clear()
         return num_deleted
 
     def delete_all(self):
@@ -83,4 +160,5 @@ class LiveKeys:
             'sub': self.sub
         }
         num_deleted = self.db.delete(LiveKeys.table_livekeys, where='subscription=$sub', vars=qvars)
+        KEY_CACHE.clear()
         return num_deleted
@@ -1,8 +1,99 @@
+import time
+import threading
+import collections
 import web
 from sam import common
 from sam.models.links import Links
 
 
+class NodeCache(object):
+    """
+    A least-recently-used cache of node ranges known to exist in each subscription's Nodes table,
+    with their layout (x, y, radius), so preprocessing only queries the table for addresses it hasn't
+    seen recently. Each entry is trusted for at most `ttl` seconds.
+    Nodes empties a subscription's entries whenever nodes are deleted through it. Nodes deleted by another
+    process (e.g. the webserver, when the aggregator runs separately) are seen once the entries expire.
+    """
+    def __init__(self, maxsize=1000000, ttl=300):
+        """
+        :param maxsize: number of node ranges to keep. 0 disables caching.
+         :type maxsize: int
+        :param ttl: seconds a node is trusted to still exist
+         :type ttl: float
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.cache = collections.OrderedDict()  # (subscription, ipstart, ipend): (expiry time, (x, y, radius))
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, sub, ranges):
+        """
+        :param sub: subscription id
+         :type sub: int
+        :param ranges: node ranges to look for
+         :type ranges: collections.Iterable[tuple[int, int]]
+        :return: the layout of each range found in the cache
+         :rtype: dict[tuple[int, int], tuple[float, float, float]]
+        """
+        now = time.time()
+        found = {}
+        with self.lock:
+            for ipstart, ipend in ranges:
+                key = (sub, ipstart, ipend)
+                entry = self.cache.pop(key, None)
+                if entry is not None and entry[0] > now:
+                    self.cache[key] = entry
+                    found[(ipstart, ipend)] = entry[1]
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        return found
+
+    def add(self, sub, layouts):
+        """
+        :param sub: subscription id
+         :type sub: int
+        :param layouts: the layout of each node range that exists in the database
+         :type layouts: dict[tuple[int, int], tuple[float, float, float]]
+        """
+        if self.maxsize <= 0:
+            return
+        expiry = time.time() + self.ttl
+        with self.lock:
+            for (ipstart, ipend), layout in layouts.iteritems():
+                key = (sub, ipstart, ipend)
+                self.cache.pop(key, None)
+                while len(self.cache) >= self.maxsize:
+                    self.cache.popitem(last=False)
+                self.cache[key] = (expiry, layout)
+
+    def clear(self, sub=None):
+        """
+        :param sub: subscription whose entries to drop, or None to drop everything
+         :type sub: int or None
+        """
+        with self.lock:
+            if sub is None:
+                self.cache.clear()
+                return
+            for key in [key for key in self.cache if key[0] == sub]:
+                del self.cache[key]
+
+    def stats(self):
+        """
+        :return: entries held, and hit and miss counts
+         :rtype: dict[str, int]
+        """
+        with self.lock:
+            return {'size': len(self.cache), 'hits': self.hits, 'misses': self.misses}
+
+
+# shared by everything in this process, so deletions made through any Nodes invalidate it
+NODE_CACHE = NodeCache()
+
+
 class Nodes(object):
     default_environments = {'production', 'dev', 'inherit'}
 
@@ -243,6 +334,7 @@ class Nodes(object):
         #    hostlist = str(tuple(map(int, collection)))
         # Which is better?
         deleted = self.db.delete(self.table_nodes, where='ipstart=ipend and ipstart IN {hosts}'.format(hosts=collection))
+        NODE_CACHE.clear(self.sub)
 
         # the deleted endpoints may have (now childless) aggregate parents
         # TODO: delete childless parent nodes (e.g. subnets like /24)
@@ -262,6 +354,7 @@ class Nodes(object):
             low, high = common.determine_range_string(node)
             where = 'ipstart={low} and ipend={high}'.format(low=low, high=high)
             deleted += self.db.delete(self.table_nodes, where=where)
+        NODE_CACHE.clear(self.sub)
 
         return deleted
 
@@ -3,6 +3,7 @@ import requests
 import time
 import threading
 from sam.models.nodes import Nodes
+from sam import iputil
 
 
 def ip_itos(ip_number):
@@ -16,11 +17,7 @@ def ip_itos(ip_number):
     Returns: The IP address as a dotted-decimal string.
 
     """
-    return "{0}.{1}.{2}.{3}".format(
-        (ip_number & 0xFF000000) >> 24,
-        (ip_number & 0xFF0000) >> 16,
-        (ip_number & 0xFF00) >> 8,
-        ip_number & 0xFF)
+    return iputil.decode(ip_number)
 
 
 def ip_stoi(ip):
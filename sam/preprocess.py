@@ -3,14 +3,22 @@ Preprocess the data in the database's upload table Syslog
 """
 import os
 import sys
+import copy
+import time
+import sqlite3
+import threading
+import collections
 import web
 import logging
 import traceback
 from sam import constants
 from sam import common
 from sam import integrity
+from sam.importers import flow_aggregator
+from sam.importers.bulk_load import SyslogLoader
 from sam.models.datasources import Datasources
 from sam.models.subscriptions import Subscriptions
+from sam.models.nodes import NODE_CACHE
 from sam.models.security import ruling_process, rules
 logger = logging.getLogger(__name__)
 
@@ -38,16 +46,230 @@ def determine_datasource(db, sub, argv):
         raise InvalidDatasource
 
 
+NODE_LEVELS = ((8, 24), (16, 16), (24, 8), (32, 0))  # node subnets, and the address bits below each
+NODE_LOOKUP_CHUNK = 500  # node ranges per query when looking for them in the Nodes table
+
+
+def node_layout(subnet, ipstart, layouts):
+    """
+    Place a new node: /8 nodes on a 16x16 grid, and smaller nodes on a 16x16 grid inside their parent.
+
+    :param subnet: 8, 16, 24 or 32
+    :type subnet: int
+    :param ipstart: the first address of the node
+    :type ipstart: int
+    :param layouts: (x, y, radius) of known nodes, by (ipstart, ipend)
+    :type layouts: dict[tuple[int, int], tuple[float, float, float]]
+    :return: the node's x, y and radius, or None if its parent node doesn't exist
+    :rtype: tuple[float, float, float] or None
+    """
+    ip = ipstart >> (32 - subnet)
+    if subnet == 8:
+        return 331776 * (ip % 16) / 7.5 - 331776, 331776 * (ip // 16) / 7.5 - 331776, 20736.0
+    parent_bits = 40 - subnet
+    parent_start = ipstart >> parent_bits << parent_bits
+    parent = layouts.get((parent_start, parent_start + (1 << parent_bits) - 1))
+    if parent is None:
+        return None
+    x, y, radius = parent
+    return ((radius * (ip % 16) / 7.5 - radius) + x,
+            (radius * (ip % 256 // 16) / 7.5 - radius) + y,
+            radius / 24.0)
+
+
+# the /8, /16, /24 and /32 prefix levels, as masks and the addresses after the first in each
+ROLLUP_LEVELS = """(SELECT 4278190080 AS 'mask', 16777215 AS 'span'
+    UNION ALL SELECT 4294901760, 65535
+    UNION ALL SELECT 4294967040, 255
+    UNION ALL SELECT 4294967295, 0)"""
+# at each level: the span of that level, or of the level src and dst first differ at if it is nearer
+ROLLUP_SHARED_SPAN = """CASE WHEN (src & lv.mask) = (dst & lv.mask) THEN lv.span
+    WHEN (src >> 24) != (dst >> 24) THEN 16777215
+    WHEN (src >> 16) != (dst >> 16) THEN 65535
+    WHEN (src >> 8) != (dst >> 8) THEN 255
+    ELSE lv.span END"""
+
+
+class ProfiledCursor(object):
+    """
+    A database cursor that reports each statement it runs to a QueryProfile.
+    """
+    def __init__(self, cursor, profile):
+        self.cursor = cursor
+        self.profile = profile
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, query, *params):
+        self.profile.explain_statement(self.cursor, query, params)
+        start = time.time()
+        try:
+            return self.cursor.execute(query, *params)
+        finally:
+            self.profile.add_statement(time.time() - start, self.cursor.rowcount)
+
+    def executemany(self, query, rows):
+        start = time.time()
+        try:
+            return self.cursor.executemany(query, rows)
+        finally:
+            self.profile.add_statement(time.time() - start, self.cursor.rowcount)
+
+
+class QueryProfile(object):
+    """
+    Times the statements run through a database connection and counts the rows they affect.
+    Statements run through `db`, a copy of the connection sharing its transactions, are counted.
+    """
+    EXPLAINED = ('SELECT', 'INSERT', 'REPLACE', 'UPDATE', 'DELETE')
+
+    def __init__(self, database, explain=False):
+        """
+        :param database: the connection to profile
+         :type database: web.DB
+        :param explain: also capture the query plan of each statement, by running EXPLAIN before it
+         :type explain: bool
+        """
+        self.explain = explain
+        if database.dbname == 'mysql':
+            self.explain_prefix = 'EXPLAIN '
+        else:
+            self.explain_prefix = 'EXPLAIN QUERY PLAN '
+        self.seconds = 0.0
+        self.statements = 0
+        self.rows = 0
+        self.plans = []
+        self.db = copy.copy(database)
+        self.db._db_cursor = lambda: ProfiledCursor(database._db_cursor(), self)
+
+    def add_statement(self, seconds, rows):
+        self.seconds += seconds
+        self.statements += 1
+        if rows > 0:
+            self.rows += rows
+
+    def explain_statement(self, cursor, query, params):
+        """
+        :param cursor: the cursor about to run the statement
+        :param query: the statement
+         :type query: str
+        :param params: the statement's parameters, if any, as a tuple of the arguments to cursor.execute
+         :type params: tuple
+        """
+        if not self.explain or query.lstrip().split(None, 1)[0].upper() not in self.EXPLAINED:
+            return
+        try:
+            cursor.execute(self.explain_prefix + query, *params)
+            plan = [' | '.join(map(unicode, row)) for row in cursor.fetchall()]
+        except Exception as e:
+            plan = ['EXPLAIN failed: {0}'.format(e)]
+        self.plans.append({'sql': ' '.join(query.split()), 'plan': plan})
+
+    def take(self):
+        """
+        :return: the time, statements, rows and plans counted since the last take, which are then reset
+        :rtype: dict
+        """
+        counts = {
+            'db_seconds': self.seconds,
+            'statements': self.statements,
+            'rows': self.rows,
+        }
+        if self.explain:
+            counts['plans'] = self.plans
+        self.seconds = 0.0
+        self.statements = 0
+        self.rows = 0
+        self.plans = []
+        return counts
+
+
+class ProfileHistory(object):
+    """
+    The most recent preprocessing runs, with the time, database time and rows of each of their stages.
+    """
+    def __init__(self, size=100):
+        """
+        :param size: number of runs to keep
+         :type size: int
+        """
+        self.runs = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, run):
+        """
+        :param run: a run's profile, as Preprocessor.run_all records it
+         :type run: dict
+        """
+        with self.lock:
+            self.runs.append(run)
+
+    def clear(self):
+        with self.lock:
+            self.runs.clear()
+
+    def stats(self):
+        """
+        :return: the kept runs, oldest first, and for each stage its run count and mean and maximum times
+        :rtype: dict
+        """
+        with self.lock:
+            runs = list(self.runs)
+        stages = collections.OrderedDict()
+        for run in runs:
+            for stage in run['stages']:
+                totals = stages.setdefault(stage['stage'], {'runs': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                            'db_seconds': 0.0, 'rows': 0})
+                totals['runs'] += 1
+                totals['seconds'] += stage['seconds']
+                totals['max_seconds'] = max(totals['max_seconds'], stage['seconds'])
+                totals['db_seconds'] += stage['db_seconds']
+                totals['rows'] += stage['rows']
+        for totals in stages.values():
+            totals['mean_seconds'] = totals.pop('seconds') / totals['runs']
+            totals['mean_db_seconds'] = totals.pop('db_seconds') / totals['runs']
+        return {'runs': runs, 'stages': stages}
+
+
+def format_profile(run):
+    """
+    :param run: a run's profile, as Preprocessor.run_all records it
+    :type run: dict
+    :return: a table of the run's stages, followed by any query plans captured
+    :rtype: str
+    """
+    lines = ["{0:<14}{1:>10}{2:>12}{3:>12}{4:>10}".format('stage', 'seconds', 'db seconds', 'statements', 'rows')]
+    for stage in run['stages']:
+        lines.append("{stage:<14}{seconds:>10.3f}{db_seconds:>12.3f}{statements:>12}{rows:>10}".format(**stage))
+    lines.append("{0:<14}{1:>10.3f}{2:>12.3f}".format('total', run['seconds'], run['db_seconds']))
+    for stage in run['stages']:
+        for plan in stage.get('plans', []):
+            lines.append('')
+            lines.append('{0}: {1}'.format(stage['stage'], plan['sql']))
+            lines.extend('    ' + row for row in plan['plan'])
+    return '\n'.join(lines)
+
+
 class Preprocessor:
-    def __init__(self, database, subscription, datasource, security_rules=True):
+    def __init__(self, database, subscription, datasource, security_rules=True, explain=False):
         """
         :type database: web.DB
+        :param explain: capture the query plan of each statement run_all runs, in its profile
+        :type explain: bool
         """
-        self.db = database
+        self.profile = QueryProfile(database, explain)
+        self.db = self.profile.db
         self.sub_id = subscription
         self.ds_id = datasource
         self.use_sec_rules = security_rules
         self.whois_thread = None
+        self.new_nodes = {}  # nodes added by this run, cached once it commits
+        self.stages = []  # the profile of each stage run_all has finished
+        self.last_profile = None
         if self.db.dbname == 'mysql':
             self.divop = 'DIV'
             self.timeround = 'SUBSTRING(TIMESTAMPADD(MINUTE, -(MINUTE(Timestamp) % 5), Timestamp), 1, 16)'
@@ -70,102 +292,78 @@ class Preprocessor:
         return row.cnt
 
     def syslog_to_nodes(self):
-        # Get all /8 nodes. Load them into Nodes8
-        query = """
-                INSERT INTO {table_nodes} (ipstart, ipend, subnet, x, y, radius)
-                SELECT (log.ip * 16777216) AS 'ipstart'
-                    , ((log.ip + 1) * 16777216 - 1) AS 'ipend'
-                    , 8 AS 'subnet'
-                    , (331776 * (log.ip % 16) / 7.5 - 331776) AS 'x'
-                    , (331776 * (log.ip {div} 16) / 7.5 - 331776) AS 'y'
-                    , 20736 AS 'radius'
-                FROM(
-                    SELECT src {div} 16777216 AS 'ip'
-                    FROM {table_syslog}
-                    UNION
-                    SELECT dst {div} 16777216 AS 'ip'
-                    FROM {table_syslog}
-                ) AS log
-                LEFT JOIN {table_nodes} AS `filter`
-                    ON (log.ip * 16777216) = `filter`.ipstart AND ((log.ip + 1) * 16777216 - 1) = `filter`.ipend
-                WHERE filter.ipstart IS NULL;
-            """.format(div=self.divop, **self.tables)
-        qvars = {"radius": 331776}
-        self.db.query(query, vars=qvars)
-
-        # Get all the /16 nodes. Load these into Nodes16
-        query = """
-                INSERT INTO {table_nodes} (ipstart, ipend, subnet, x, y, radius)
-                SELECT (log.ip * 65536) AS 'ipstart'
-                    , ((log.ip + 1) * 65536 - 1) AS 'ipend'
-                    , 16 AS 'subnet'
-                    , ((parent.radius * (log.ip % 16) / 7.5 - parent.radius) + parent.x) AS 'x'
-                    , ((parent.radius * (log.ip % 256 {div} 16) / 7.5 - parent.radius) + parent.y) AS 'y'
-                    , (parent.radius / 24) AS 'radius'
-                FROM(
-                    SELECT src {div} 65536 AS 'ip'
-                    FROM {table_syslog}
-                    UNION
-                    SELECT dst {div} 65536 AS 'ip'
-                    FROM {table_syslog}
-                ) AS log
-                JOIN {table_nodes} AS parent
-                    ON parent.subnet=8 AND parent.ipstart = (log.ip {div} 256 * 16777216)
-                LEFT JOIN {table_nodes} AS `filter`
-                    ON (log.ip * 65536) = `filter`.ipstart AND ((log.ip + 1) * 65536 - 1) = `filter`.ipend
-                WHERE filter.ipstart IS NULL;
-                """.format(div=self.divop, **self.tables)
-        self.db.query(query)
+        """
+        Add nodes for every src and dst address in the Syslog table.
 
-        # Get all the /24 nodes. Load these into Nodes24
+        :return: the number of nodes added
+        :rtype: int
+        """
         query = """
-                INSERT INTO {table_nodes} (ipstart, ipend, subnet, x, y, radius)
-                SELECT (log.ip * 256) AS 'ipstart'
-                    , ((log.ip + 1) * 256 - 1) AS 'ipend'
-                    , 24 AS 'subnet'
-                    , ((parent.radius * (log.ip % 16) / 7.5 - parent.radius) + parent.x) AS 'x'
-                    , ((parent.radius * (log.ip % 256 {div} 16) / 7.5 - parent.radius) + parent.y) AS 'y'
-                    , (parent.radius {div} 24) AS 'radius'
-                FROM(
-                    SELECT src {div} 256 AS 'ip'
-                    FROM {table_syslog}
-                    UNION
-                    SELECT dst {div} 256 AS 'ip'
-                    FROM {table_syslog}
-                ) AS log
-                JOIN {table_nodes} AS parent
-                    ON parent.subnet=16 AND parent.ipstart = (log.ip {div} 256 * 65536)
-                LEFT JOIN {table_nodes} AS `filter`
-                    ON (log.ip * 256) = `filter`.ipstart AND ((log.ip + 1) * 256 - 1) = `filter`.ipend
-                WHERE filter.ipstart IS NULL;
-                """.format(div=self.divop, **self.tables)
-        self.db.query(query)
+            SELECT src AS 'ip' FROM {table_syslog}
+            UNION
+            SELECT dst AS 'ip' FROM {table_syslog};
+        """.format(**self.tables)
+        return self.ips_to_nodes(set(row.ip for row in self.db.query(query)))
 
-        # Get all the /32 nodes. Load these into Nodes32
-        query = """
-                INSERT INTO {table_nodes} (ipstart, ipend, subnet, x, y, radius)
-                SELECT log.ip AS 'ipstart'
-                    , log.ip AS 'ipend'
-                    , 32 AS 'subnet'
-                    , ((parent.radius * (log.ip % 16) / 7.5 - parent.radius) + parent.x) AS 'x'
-                    , ((parent.radius * (log.ip % 256 {div} 16) / 7.5 - parent.radius) + parent.y) AS 'y'
-                    , (parent.radius / 24) AS 'radius'
-                FROM(
-                    SELECT src AS 'ip'
-                    FROM {table_syslog}
-                    UNION
-                    SELECT dst AS 'ip'
-                    FROM {table_syslog}
-                ) AS log
-                JOIN {table_nodes} AS parent
-                    ON parent.subnet=24 AND parent.ipstart = (log.ip {div} 256 * 256)
-                LEFT JOIN {table_nodes} AS `filter`
-                    ON log.ip = `filter`.ipstart AND log.ip = `filter`.ipend
-                WHERE filter.ipstart IS NULL;
-                """.format(div=self.divop, **self.tables)
-        self.db.query(query)
+    def ips_to_nodes(self, ips):
+        """
+        Add the /8, /16, /24 and /32 nodes of these addresses to the Nodes table, where they are missing.
+        Node ranges are looked up in NODE_CACHE, then in the table; the rest are laid out inside their parent
+        node and inserted together. New nodes are cached once run_all commits.
+
+        :param ips: distinct addresses, as 32-bit ints
+        :type ips: set[int]
+        :return: the number of nodes added
+        :rtype: int
+        """
+        levels = []
+        for subnet, shift in NODE_LEVELS:
+            levels.append(sorted(set((ip >> shift << shift, (ip >> shift << shift) + (1 << shift) - 1) for ip in ips)))
+        ranges = [node for level in levels for node in level]
+
+        layouts = NODE_CACHE.lookup(self.sub_id, ranges)
+        stored = self.read_node_layouts([node for node in ranges if node not in layouts])
+        NODE_CACHE.add(self.sub_id, stored)
+        layouts.update(stored)
+
+        rows = []
+        for (subnet, shift), level in zip(NODE_LEVELS, levels):
+            for ipstart, ipend in level:
+                if (ipstart, ipend) in layouts:
+                    continue
+                layout = node_layout(subnet, ipstart, layouts)
+                if layout is None:
+                    continue
+                layouts[(ipstart, ipend)] = self.new_nodes[(ipstart, ipend)] = layout
+                rows.append((ipstart, ipend, subnet) + layout)
+        # another datasource of this subscription may be adding the same nodes
+        loader = SyslogLoader(self.db, self.tables['table_nodes'], ['ipstart', 'ipend', 'subnet', 'x', 'y', 'radius'],
+                              ignore_duplicates=True)
+        return loader.load(rows)
+
+    def read_node_layouts(self, ranges):
+        """
+        :param ranges: node ranges to look up in the Nodes table
+        :type ranges: list[tuple[int, int]]
+        :return: the layout of each range that is in the table
+        :rtype: dict[tuple[int, int], tuple[float, float, float]]
+        """
+        wanted = set(ranges)
+        starts = sorted(set(ipstart for ipstart, ipend in ranges))
+        layouts = {}
+        for i in range(0, len(starts), NODE_LOOKUP_CHUNK):
+            chunk = ','.join(str(int(ipstart)) for ipstart in starts[i:i + NODE_LOOKUP_CHUNK])
+            rows = self.db.select(self.tables['table_nodes'], what='ipstart, ipend, x, y, radius',
+                                  where='ipstart IN ({0})'.format(chunk))
+            for row in rows:
+                node = (row.ipstart, row.ipend)
+                if node in wanted:
+                    layouts[node] = (row.x, row.y, row.radius)
+        return layouts
 
     def syslog_to_staging_links(self):
+        # Syslog rows may have been merged by the importer (see importers/flow_aggregator.py);
+        # `links` counts the log lines each row stands for.
         query = """
             INSERT INTO {table_staging_links} (src, dst, port, protocol, timestamp,
                 links, bytes_sent, bytes_received, packets_sent, packets_received, duration)
@@ -174,18 +372,98 @@ class Preprocessor:
                 , dstport
                 , protocol
                 , {timeround} AS ts
-                , COUNT(1) AS links
+                , SUM(links) AS links
                 , SUM(bytes_sent) AS 'bytes_sent'
                 , SUM(bytes_received) AS 'bytes_received'
                 , SUM(packets_sent) AS 'packets_sent'
                 , SUM(packets_received) AS 'packets_received'
-                , AVG(duration) AS 'duration'
+                , SUM(duration * links) / (SUM(links) * 1.0) AS 'duration'
             FROM {table_syslog}
             GROUP BY src, dst, dstport, protocol, ts;
         """.format(div=self.divop, timeround=self.timeround, **self.tables)
         self.db.query(query)
 
+    def link_timestamp(self, epoch):
+        """
+        :param epoch: the start of a 5-minute bucket, in epoch seconds
+        :type epoch: int
+        :return: the bucket's timestamp as syslog_to_staging_links writes it for this database
+        :rtype: int or str
+        """
+        if self.db.dbname == 'mysql':
+            local = time.localtime(epoch)
+            return '{0}{1:02d}'.format(time.strftime('%Y-%m-%d %H:', local), local.tm_min - local.tm_min % 5)
+        return epoch
+
+    def links_to_staging_links(self, links):
+        """
+        Write links summed in memory to StagingLinks, instead of reading them from the Syslog table.
+        Values are stored as syslog_to_staging_links would compute them from the same rows.
+
+        :param links: links, as collected by importers.flow_aggregator.LinkAccumulator
+        :type links: dict[tuple, list]
+        :return: the number of staging links written
+        :rtype: int
+        """
+        round_duration = self.db.dbname == 'mysql'  # MySQL rounds the averaged duration into the INT column
+        staged = {}
+        for (src, dst, port, protocol, bucket), counts in links.iteritems():
+            key = (src, dst, port, protocol, self.link_timestamp(bucket))
+            link = staged.get(key)
+            if link is None:
+                staged[key] = list(counts)
+                continue
+            # buckets that read the same in local time (e.g. when clocks go back) are one link
+            for i, value in enumerate(counts):
+                link[i] = flow_aggregator.add_counts(link[i], value)
+
+        rows = []
+        for key, (count, bytes_sent, bytes_received, packets_sent, packets_received, duration) in staged.iteritems():
+            if duration is not None:
+                duration /= float(count)
+                if round_duration:
+                    duration = int(round(duration))
+            rows.append(key + (count, bytes_sent, bytes_received, packets_sent, packets_received, duration))
+        loader = SyslogLoader(self.db, self.tables['table_staging_links'],
+                              ['src', 'dst', 'port', 'protocol', 'timestamp', 'links', 'bytes_sent',
+                               'bytes_received', 'packets_sent', 'packets_received', 'duration'])
+        return loader.load(rows)
+
     def staging_links_to_links(self):
+        """
+        Add the staged links to Links. New links are inserted; links already in Links have the staged counts
+        added, and their durations averaged by number of links, in place.
+        """
+        if self.db.dbname == 'mysql':
+            upsert = "ON DUPLICATE KEY UPDATE"
+            staged = "VALUES({0})"
+        elif sqlite3.sqlite_version_info >= (3, 24, 0):
+            upsert = "ON CONFLICT (src, dst, port, protocol, timestamp) DO UPDATE SET"
+            staged = "excluded.{0}"
+        else:
+            self.staging_links_to_links_replace()
+            return
+        # MySQL applies the assignments in order, so duration is averaged before links is added to
+        query = """
+        INSERT INTO {table_links} (src, dst, port, protocol, timestamp, links, bytes_sent, bytes_received, packets_sent, packets_received, duration)
+        SELECT src, dst, port, protocol, timestamp, links, bytes_sent, bytes_received, packets_sent, packets_received, duration
+        FROM {table_staging_links}
+        WHERE 1
+        {upsert}
+            duration = ({duration} * {links} + COALESCE({table_links}.duration * {table_links}.links, 0)) / ({table_links}.links + {links})
+            , links = {links} + {table_links}.links
+            , bytes_sent = {bytes_sent} + {table_links}.bytes_sent
+            , bytes_received = {bytes_received} + COALESCE({table_links}.bytes_received, 0)
+            , packets_sent = {packets_sent} + {table_links}.packets_sent
+            , packets_received = {packets_received} + COALESCE({table_links}.packets_received, 0);
+        """.format(upsert=upsert, **dict(self.tables, **{column: staged.format(column) for column in (
+            'links', 'bytes_sent', 'bytes_received', 'packets_sent', 'packets_received', 'duration')}))
+        self.db.query(query)
+
+    def staging_links_to_links_replace(self):
+        """
+        staging_links_to_links for SQLite before 3.24, which has no upsert: rewrite each staged link's row whole.
+        """
         query = """
         REPLACE INTO {table_links} (src, dst, port, protocol, timestamp, links, bytes_sent, bytes_received, packets_sent, packets_received, duration)
         SELECT `SL`.src, `SL`.dst, `SL`.port, `SL`.protocol, `SL`.timestamp
@@ -205,369 +483,173 @@ class Preprocessor:
         """.format(**self.tables)
         self.db.query(query)
 
-    def links_to_links_in_out(self):
-        rows = self.db.select(self.tables['table_staging_links'], what="MIN(timestamp) AS 'start', MAX(timestamp) AS 'end'")
-        timerange = rows[0]
-
-        self.db.delete(self.tables['table_links_in'], where="timestamp BETWEEN $start AND $end", vars=timerange)
-        self.db.delete(self.tables['table_links_out'], where="timestamp BETWEEN $start AND $end", vars=timerange)
-        self.links_to_links_in(timerange.start, timerange.end)
-        self.links_to_links_out(timerange.start, timerange.end)
-
-    def links_to_links_in(self, timestart, timestop):
-        time_vars = {
-            "start": timestart,
-            "stop": timestop
-        }
-
-        # /8 links
-        query = """
-            INSERT INTO {table_links_in} (src_start, src_end, dst_start, dst_end, protocols, port, timestamp, links, bytes, packets)
-            SELECT src {div} 16777216 * 16777216 AS 'src_start'
-                , src {div} 16777216 * 16777216 + 16777215 AS 'src_end'
-                , dst {div} 16777216 * 16777216 AS 'dst_start'
-                , dst {div} 16777216 * 16777216 + 16777215 AS 'dst_end'
-                , GROUP_CONCAT(DISTINCT protocol)
-                , port
-                , timestamp
-                , SUM(links)
-                , SUM(bytes_sent + COALESCE(bytes_received, 0))
-                , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE timestamp BETWEEN $start AND $stop
-            GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp;
-        """.format(div=self.divop, **self.tables)
-        self.db.query(query, vars=time_vars)
+    def sql_concat(self, *parts):
+        """
+        :param parts: SQL string expressions
+        :type parts: str
+        :return: an SQL expression joining them
+        :rtype: str
+        """
+        if self.db.dbname == 'mysql':
+            return 'CONCAT({0})'.format(', '.join(parts))
+        return ' || '.join(parts)
 
-        # /16 links
+    def links_to_links_in_out(self):
+        """
+        Merge the links in StagingLinks into the existing LinksIn and LinksOut rows.
+        The staged links are grouped as rollup_links_in_out groups Links, but per protocol, and each group is
+        inserted as a new aggregate row or added to the matching one in place, its protocol appended to the row's
+        protocols if not already listed. Only the staged rows are read, however many aggregate rows share their
+        time range.
+        """
+        if self.db.dbname == 'mysql':
+            upsert = "ON DUPLICATE KEY UPDATE"
+            staged = "VALUES({0})"
+        elif sqlite3.sqlite_version_info >= (3, 24, 0):
+            upsert = "ON CONFLICT (src_start, src_end, dst_start, dst_end, port, timestamp) DO UPDATE SET"
+            staged = "excluded.{0}"
+        else:
+            self.links_to_links_in_out_replace()
+            return
         query = """
-            INSERT INTO {table_links_in} (src_start, src_end, dst_start, dst_end, protocols, port, timestamp, links, bytes, packets)
-            SELECT src {div} 65536 * 65536 AS 'src_start'
-                , src {div} 65536 * 65536 + 65535 AS 'src_end'
-                , dst {div} 65536 * 65536 AS 'dst_start'
-                , dst {div} 65536 * 65536 + 65535 AS 'dst_end'
-                , GROUP_CONCAT(DISTINCT protocol)
-                , port
-                , timestamp
-                , SUM(links)
-                , SUM(bytes_sent + COALESCE(bytes_received, 0))
-                , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE (src {div} 16777216) = (dst {div} 16777216)
-              AND timestamp BETWEEN $start AND $stop
-            GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
-            UNION
-            SELECT src {div} 16777216 * 16777216 AS 'src_start'
-                , src {div} 16777216 * 16777216 + 16777215 AS 'src_end'
-                , dst {div} 65536 * 65536 AS 'dst_start'
-                , dst {div} 65536 * 65536 + 65535 AS 'dst_end'
-                , GROUP_CONCAT(DISTINCT protocol)
+            INSERT INTO {table} (src_start, src_end, dst_start, dst_end, protocols, port, timestamp, links, bytes, packets)
+            SELECT src - (src & {src_span}) AS 'src_start'
+                , src - (src & {src_span}) + {src_span} AS 'src_end'
+                , dst - (dst & {dst_span}) AS 'dst_start'
+                , dst - (dst & {dst_span}) + {dst_span} AS 'dst_end'
+                , protocol
                 , port
                 , timestamp
                 , SUM(links)
                 , SUM(bytes_sent + COALESCE(bytes_received, 0))
                 , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE (src {div} 16777216) != (dst {div} 16777216)
-              AND timestamp BETWEEN $start AND $stop
-            GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp;
-        """.format(div=self.divop, **self.tables)
-        self.db.query(query, vars=time_vars)
-
-        # /24 links
+            FROM {table_staging_links} CROSS JOIN {levels} AS lv
+            WHERE 1
+            GROUP BY src_start, src_end, dst_start, dst_end, protocol, port, timestamp
+            {upsert}
+                protocols = CASE WHEN {table}.protocols IS NULL THEN {protocols}
+                    WHEN INSTR({listed}, {protocol}) > 0 THEN {table}.protocols
+                    ELSE {appended} END
+                , links = {table}.links + {links}
+                , bytes = {table}.bytes + {bytes}
+                , packets = {table}.packets + {packets};
+        """
+        for table, src_span, dst_span in ((self.tables['table_links_in'], ROLLUP_SHARED_SPAN, 'lv.span'),
+                                          (self.tables['table_links_out'], 'lv.span', ROLLUP_SHARED_SPAN)):
+            columns = {column: staged.format(column) for column in ('protocols', 'links', 'bytes', 'packets')}
+            protocol_columns = dict(
+                listed=self.sql_concat("','", "{0}.protocols".format(table), "','"),
+                protocol=self.sql_concat("','", columns['protocols'], "','"),
+                appended=self.sql_concat("{0}.protocols".format(table), "','", columns['protocols']))
+            self.db.query(query.format(table=table, levels=ROLLUP_LEVELS, src_span=src_span, dst_span=dst_span,
+                                       upsert=upsert, **dict(self.tables, **dict(columns, **protocol_columns))))
+
+    def links_to_links_in_out_replace(self):
+        """
+        links_to_links_in_out for SQLite before 3.24, which has no upsert: rewrite each affected aggregate row whole,
+        reading its current sums and protocols through a LEFT JOIN.
+        """
+        protocol_listed = "INSTR({0}, {1}) > 0".format(self.sql_concat("','", "`A`.protocols", "','"),
+                                                      self.sql_concat("','", "`SL`.protocol", "','"))
         query = """
-            INSERT INTO {table_links_in} (src_start, src_end, dst_start, dst_end, protocols, port, timestamp, links, bytes, packets)
-            SELECT src {div} 256 * 256 AS 'src_start'
-                , src {div} 256 * 256 + 255 AS 'src_end'
-                , dst {div} 256 * 256 AS 'dst_start'
-                , dst {div} 256 * 256 + 255 AS 'dst_end'
-                , GROUP_CONCAT(DISTINCT protocol)
-                , port
-                , timestamp
-                , SUM(links)
-                , SUM(bytes_sent + COALESCE(bytes_received, 0))
-                , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE (src {div} 65536) = (dst {div} 65536)
-              AND timestamp BETWEEN $start AND $stop
-            GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
-            UNION
-            SELECT src {div} 65536 * 65536 AS 'src_start'
-                , src {div} 65536 * 65536 + 65535 AS 'src_end'
-                , dst {div} 256 * 256 AS 'dst_start'
-                , dst {div} 256 * 256 + 255 AS 'dst_end'
-                , GROUP_CONCAT(DISTINCT protocol)
-                , port
-                , timestamp
-                , SUM(links)
-                , SUM(bytes_sent + COALESCE(bytes_received, 0))
-                , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE (src {div} 16777216) = (dst {div} 16777216)
-              AND (src {div} 65536) != (dst {div} 65536)
-              AND timestamp BETWEEN $start AND $stop
-            GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
-            UNION
-            SELECT src {div} 16777216 * 16777216 AS 'src_start'
-                , src {div} 16777216 * 16777216 + 16777215 AS 'src_end'
-                , dst {div} 256 * 256 AS 'dst_start'
-                , dst {div} 256 * 256 + 255 AS 'dst_end'
-                , GROUP_CONCAT(DISTINCT protocol)
-                , port
-                , timestamp
-                , SUM(links)
-                , SUM(bytes_sent + COALESCE(bytes_received, 0))
-                , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE (src {div} 16777216) != (dst {div} 16777216)
-              AND timestamp BETWEEN $start AND $stop
-            GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp;
-        """.format(div=self.divop, **self.tables)
-        self.db.query(query, vars=time_vars)
-
-        # /32 links
+            REPLACE INTO {table} (src_start, src_end, dst_start, dst_end, protocols, port, timestamp, links, bytes, packets)
+            SELECT `D`.src_start, `D`.src_end, `D`.dst_start, `D`.dst_end
+                , CASE WHEN `D`.old_protocols IS NULL THEN `D`.new_protocols
+                    WHEN `D`.new_protocols IS NULL THEN `D`.old_protocols
+                    ELSE {merged_protocols} END
+                , `D`.port, `D`.timestamp, `D`.links, `D`.bytes, `D`.packets
+            FROM (
+                SELECT `SL`.src_start, `SL`.src_end, `SL`.dst_start, `SL`.dst_end, `SL`.port, `SL`.timestamp
+                    , MAX(`A`.protocols) AS 'old_protocols'
+                    , GROUP_CONCAT(DISTINCT CASE WHEN `A`.protocols IS NULL OR NOT {protocol_listed}
+                        THEN `SL`.protocol END) AS 'new_protocols'
+                    , SUM(`SL`.links) + COALESCE(MAX(`A`.links), 0) AS 'links'
+                    , SUM(`SL`.bytes) + COALESCE(MAX(`A`.bytes), 0) AS 'bytes'
+                    , SUM(`SL`.packets) + COALESCE(MAX(`A`.packets), 0) AS 'packets'
+                FROM (
+                    SELECT src - (src & {src_span}) AS 'src_start'
+                        , src - (src & {src_span}) + {src_span} AS 'src_end'
+                        , dst - (dst & {dst_span}) AS 'dst_start'
+                        , dst - (dst & {dst_span}) + {dst_span} AS 'dst_end'
+                        , protocol
+                        , port
+                        , timestamp
+                        , links
+                        , bytes_sent + COALESCE(bytes_received, 0) AS 'bytes'
+                        , packets_sent + COALESCE(packets_received, 0) AS 'packets'
+                    FROM {table_staging_links} CROSS JOIN {levels} AS lv
+                ) AS `SL`
+                LEFT JOIN {table} AS `A`
+                ON `A`.src_start = `SL`.src_start
+                 AND `A`.src_end = `SL`.src_end
+                 AND `A`.dst_start = `SL`.dst_start
+                 AND `A`.dst_end = `SL`.dst_end
+                 AND `A`.port = `SL`.port
+                 AND `A`.timestamp = `SL`.timestamp
+                GROUP BY `SL`.src_start, `SL`.src_end, `SL`.dst_start, `SL`.dst_end, `SL`.port, `SL`.timestamp
+            ) AS `D`;
+        """
+        merged_protocols = self.sql_concat("`D`.old_protocols", "','", "`D`.new_protocols")
+        self.db.query(query.format(table=self.tables['table_links_in'], levels=ROLLUP_LEVELS,
+                                   src_span=ROLLUP_SHARED_SPAN, dst_span='lv.span', merged_protocols=merged_protocols,
+                                   protocol_listed=protocol_listed, **self.tables))
+        self.db.query(query.format(table=self.tables['table_links_out'], levels=ROLLUP_LEVELS,
+                                   src_span='lv.span', dst_span=ROLLUP_SHARED_SPAN, merged_protocols=merged_protocols,
+                                   protocol_listed=protocol_listed, **self.tables))
+
+    def rollup_links_in_out(self, timestart, timestop):
+        """
+        Write LinksIn and LinksOut for a time range with one grouping query each.
+        Every Links row in the range is paired with each prefix level and grouped once, rather than scanning Links
+        once per prefix level and divergence case. rebuild_links_in_out uses it to recompute both tables.
+        At each level, LinksIn groups links by their destination's prefix at that level and their source's prefix
+        at the same level or, where the two diverge sooner, the level they first differ at.
+        LinksOut is the same with source and destination swapped.
+        """
         query = """
-            INSERT INTO {table_links_in} (src_start, src_end, dst_start, dst_end, protocols, port, timestamp, links, bytes, packets)
-            SELECT src AS 'src_start'
-                , src AS 'src_end'
-                , dst AS 'dst_start'
-                , dst AS 'dst_end'
+            INSERT INTO {table} (src_start, src_end, dst_start, dst_end, protocols, port, timestamp, links, bytes, packets)
+            SELECT src - (src & {src_span}) AS 'src_start'
+                , src - (src & {src_span}) + {src_span} AS 'src_end'
+                , dst - (dst & {dst_span}) AS 'dst_start'
+                , dst - (dst & {dst_span}) + {dst_span} AS 'dst_end'
                 , GROUP_CONCAT(DISTINCT protocol)
                 , port
                 , timestamp
                 , SUM(links)
                 , SUM(bytes_sent + COALESCE(bytes_received, 0))
                 , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE (src {div} 256) = (dst {div} 256)
-              AND timestamp BETWEEN $start AND $stop
-            GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
-            UNION
-            SELECT src {div} 256 * 256 AS 'src_start'
-                , src {div} 256 * 256 + 255 AS 'src_end'
-                , dst AS 'dst_start'
-                , dst AS 'dst_end'
-                , GROUP_CONCAT(DISTINCT protocol)
-                , port
-                , timestamp
-                , SUM(links)
-                , SUM(bytes_sent + COALESCE(bytes_received, 0))
-                , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE (src {div} 65536) = (dst {div} 65536)
-              AND (src {div} 256) != (dst {div} 256)
-              AND timestamp BETWEEN $start AND $stop
-            GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
-            UNION
-            SELECT src {div} 65536 * 65536 AS 'src_start'
-                , src {div} 65536 * 65536 + 65535 AS 'src_end'
-                , dst AS 'dst_start'
-                , dst AS 'dst_end'
-                , GROUP_CONCAT(DISTINCT protocol)
-                , port
-                , timestamp
-                , SUM(links)
-                , SUM(bytes_sent + COALESCE(bytes_received, 0))
-                , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE (src {div} 16777216) = (dst {div} 16777216)
-              AND (src {div} 65536) != (dst {div} 65536)
-              AND timestamp BETWEEN $start AND $stop
-            GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
-            UNION
-            SELECT src {div} 16777216 * 16777216 AS 'src_start'
-                , src {div} 16777216 * 16777216 + 16777215 AS 'src_end'
-                , dst AS 'dst_start'
-                , dst AS 'dst_end'
-                , GROUP_CONCAT(DISTINCT protocol)
-                , port
-                , timestamp
-                , SUM(links)
-                , SUM(bytes_sent + COALESCE(bytes_received, 0))
-                , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE (src {div} 16777216) != (dst {div} 16777216)
-              AND timestamp BETWEEN $start AND $stop
+            FROM {table_links} CROSS JOIN {levels} AS lv
+            WHERE timestamp BETWEEN $start AND $stop
             GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp;
-        """.format(div=self.divop, **self.tables)
-        self.db.query(query, vars=time_vars)
-
-    def links_to_links_out(self, timestart, timestop):
+        """
         time_vars = {
             "start": timestart,
             "stop": timestop
         }
-        # /8 links
-        query = """
-            INSERT INTO {table_links_out} (src_start, src_end, dst_start, dst_end, protocols, port, timestamp, links, bytes, packets)
-            SELECT src {div} 16777216 * 16777216 AS 'src_start'
-                , src {div} 16777216 * 16777216 + 16777215 AS 'src_end'
-                , dst {div} 16777216 * 16777216 AS 'dst_start'
-                , dst {div} 16777216 * 16777216 + 16777215 AS 'dst_end'
-                , GROUP_CONCAT(DISTINCT protocol)
-                , port
-                , timestamp
-                , SUM(links)
-                , SUM(bytes_sent + COALESCE(bytes_received, 0))
-                , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE timestamp BETWEEN $start AND $stop
-            GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp;
-        """.format(div=self.divop, **self.tables)
-        self.db.query(query, vars=time_vars)
-
-        # /16 links
-        query = """
-            INSERT INTO {table_links_out} (src_start, src_end, dst_start, dst_end, protocols, port, timestamp, links, bytes, packets)
-            SELECT src {div} 65536 * 65536 AS 'src_start'
-                , src {div} 65536 * 65536 + 65535 AS 'src_end'
-                , dst {div} 65536 * 65536 AS 'dst_start'
-                , dst {div} 65536 * 65536 + 65535 AS 'dst_end'
-                , GROUP_CONCAT(DISTINCT protocol)
-                , port
-                , timestamp
-                , SUM(links)
-                , SUM(bytes_sent + COALESCE(bytes_received, 0))
-                , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE (src {div} 16777216) = (dst {div} 16777216)
-              AND timestamp BETWEEN $start AND $stop
-            GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
-            UNION
-            SELECT src {div} 65536 * 65536 AS 'src_start'
-                , src {div} 65536 * 65536 + 65535 AS 'src_end'
-                , dst {div} 16777216 * 16777216 AS 'dst_start'
-                , dst {div} 16777216 * 16777216 + 16777215 AS 'dst_end'
-                , GROUP_CONCAT(DISTINCT protocol)
-                , port
-                , timestamp
-                , SUM(links)
-                , SUM(bytes_sent + COALESCE(bytes_received, 0))
-                , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE (src {div} 16777216) != (dst {div} 16777216)
-              AND timestamp BETWEEN $start AND $stop
-            GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp;
-        """.format(div=self.divop, **self.tables)
-        self.db.query(query, vars=time_vars)
+        self.db.query(query.format(table=self.tables['table_links_in'], levels=ROLLUP_LEVELS,
+                                   src_span=ROLLUP_SHARED_SPAN, dst_span='lv.span', **self.tables), vars=time_vars)
+        self.db.query(query.format(table=self.tables['table_links_out'], levels=ROLLUP_LEVELS,
+                                   src_span='lv.span', dst_span=ROLLUP_SHARED_SPAN, **self.tables), vars=time_vars)
 
-        # /24 links
-        query = """
-            INSERT INTO {table_links_out} (src_start, src_end, dst_start, dst_end, protocols, port, timestamp, links, bytes, packets)
-            SELECT src {div} 256 * 256 AS 'src_start'
-                , src {div} 256 * 256 + 255 AS 'src_end'
-                , dst {div} 256 * 256 AS 'dst_start'
-                , dst {div} 256 * 256 + 255 AS 'dst_end'
-                , GROUP_CONCAT(DISTINCT protocol)
-                , port
-                , timestamp
-                , SUM(links)
-                , SUM(bytes_sent + COALESCE(bytes_received, 0))
-                , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE (src {div} 65536) = (dst {div} 65536)
-              AND timestamp BETWEEN $start AND $stop
-            GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
-            UNION
-            SELECT src {div} 256 * 256 AS 'src_start'
-                , src {div} 256 * 256 + 255 AS 'src_end'
-                , dst {div} 65536 * 65536 AS 'dst_start'
-                , dst {div} 65536 * 65536 + 65535 AS 'dst_end'
-                , GROUP_CONCAT(DISTINCT protocol)
-                , port
-                , timestamp
-                , SUM(links)
-                , SUM(bytes_sent + COALESCE(bytes_received, 0))
-                , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE (src {div} 16777216) = (dst {div} 16777216)
-              AND (src {div} 65536) != (dst {div} 65536)
-              AND timestamp BETWEEN $start AND $stop
-            GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
-            UNION
-            SELECT src {div} 256 * 256 AS 'src_start'
-                , src {div} 256 * 256 + 255 AS 'src_end'
-                , dst {div} 16777216 * 16777216 AS 'dst_start'
-                , dst {div} 16777216 * 16777216 + 16777215 AS 'dst_end'
-                , GROUP_CONCAT(DISTINCT protocol)
-                , port
-                , timestamp
-                , SUM(links)
-                , SUM(bytes_sent + COALESCE(bytes_received, 0))
-                , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE (src {div} 16777216) != (dst {div} 16777216)
-              AND timestamp BETWEEN $start AND $stop
-            GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp;
-        """.format(div=self.divop, **self.tables)
-        self.db.query(query, vars=time_vars)
-
-        # /32 links
-        query = """
-            INSERT INTO {table_links_out} (src_start, src_end, dst_start, dst_end, protocols, port, timestamp, links, bytes, packets)
-            SELECT src AS 'src_start'
-                , src AS 'src_end'
-                , dst AS 'dst_start'
-                , dst AS 'dst_end'
-                , GROUP_CONCAT(DISTINCT protocol)
-                , port
-                , timestamp
-                , SUM(links)
-                , SUM(bytes_sent + COALESCE(bytes_received, 0))
-                , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE (src {div} 256) = (dst {div} 256)
-              AND timestamp BETWEEN $start AND $stop
-            GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
-            UNION
-            SELECT src AS 'src_start'
-                , src AS 'src_end'
-                , dst {div} 256 * 256 AS 'dst_start'
-                , dst {div} 256 * 256 + 255 AS 'dst_end'
-                , GROUP_CONCAT(DISTINCT protocol)
-                , port
-                , timestamp
-                , SUM(links)
-                , SUM(bytes_sent + COALESCE(bytes_received, 0))
-                , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE (src {div} 65536) = (dst {div} 65536)
-              AND (src {div} 256) != (dst {div} 256)
-              AND timestamp BETWEEN $start AND $stop
-            GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
-            UNION
-            SELECT src AS 'src_start'
-                , src AS 'src_end'
-                , dst {div} 65536 * 65536 AS 'dst_start'
-                , dst {div} 65536 * 65536 + 65535 AS 'dst_end'
-                , GROUP_CONCAT(DISTINCT protocol)
-                , port
-                , timestamp
-                , SUM(links)
-                , SUM(bytes_sent + COALESCE(bytes_received, 0))
-                , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE (src {div} 16777216) = (dst {div} 16777216)
-              AND (src {div} 65536) != (dst {div} 65536)
-              AND timestamp BETWEEN $start AND $stop
-            GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
-            UNION
-            SELECT src AS 'src_start'
-                , src AS 'src_end'
-                , dst {div} 16777216 * 16777216 AS 'dst_start'
-                , dst {div} 16777216 * 16777216 + 16777215 AS 'dst_end'
-                , GROUP_CONCAT(DISTINCT protocol)
-                , port
-                , timestamp
-                , SUM(links)
-                , SUM(bytes_sent + COALESCE(bytes_received, 0))
-                , SUM(packets_sent + COALESCE(packets_received, 0))
-            FROM {table_links}
-            WHERE (src {div} 16777216) != (dst {div} 16777216)
-              AND timestamp BETWEEN $start AND $stop
-            GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp;
-        """.format(div=self.divop, **self.tables)
-        self.db.query(query, vars=time_vars)
+    def rebuild_links_in_out(self):
+        """
+        Recompute LinksIn and LinksOut from the whole Links table with rollup_links_in_out, replacing their rows.
+        run_all merges each import into them as it goes; this repairs them if they no longer match Links,
+        e.g. after Links is edited by hand.
+        """
+        db_transaction = self.db.transaction()
+        try:
+            self.db.delete(self.tables['table_links_in'], where="1")
+            self.db.delete(self.tables['table_links_out'], where="1")
+            row = self.db.select(self.tables['table_links'],
+                                 what="MIN(timestamp) AS 'tstart', MAX(timestamp) AS 'tend'").first()
+            if row and row['tstart'] is not None:
+                self.rollup_links_in_out(row['tstart'], row['tend'])
+        except:
+            db_transaction.rollback()
+            raise
+        else:
+            db_transaction.commit()
 
     def get_staging_timerange(self):
         rows = self.db.select(self.tables['table_staging_links'], what="MIN(timestamp) AS 'tstart', MAX(timestamp) AS 'tend'")
@@ -599,33 +681,101 @@ class Preprocessor:
                 traceback.print_exc()
                 logger.error("Unable to call import hook {}. Is it callable?".format(hook))
 
-    def run_all(self):
+    def run_stage(self, name, method, *args):
+        """
+        Run one stage of run_all, recording its time, and the time, count and affected rows of its statements.
+
+        :param name: the stage's name in the profile
+        :type name: str
+        :return: what method returns
+        """
+        self.profile.take()
+        start = time.time()
+        result = method(*args)
+        stage = {'stage': name, 'seconds': time.time() - start}
+        stage.update(self.profile.take())
+        self.stages.append(stage)
+        logger.debug("PREPROCESSOR: {stage}: {seconds:.3f}s, {db_seconds:.3f}s in {statements} statements, "
+                     "{rows} rows".format(**stage))
+        return result
+
+    def links_ips_to_nodes(self, links):
+        """
+        :param links: links collected by a LinkAccumulator
+        :type links: dict[tuple, list]
+        :return: the number of nodes added
+        :rtype: int
+        """
+        ips = set()
+        for src, dst, port, protocol, bucket in links:
+            ips.add(src)
+            ips.add(dst)
+        return self.ips_to_nodes(ips)
+
+    def apply_security_rules(self):
+        t_range = self.get_staging_timerange()  # must do this before deleting staging data
+        if self.use_sec_rules:
+            self.run_security_rules(t_range[0], t_range[1])
+
+    def run_all(self, links=None):
+        """
+        Preprocess the Syslog table, or links already summed in memory, into the Links tables.
+        Each stage is timed; the run's profile is kept in last_profile and PROFILES.
+
+        :param links: links collected by a LinkAccumulator. If given, the Syslog table is not read.
+        :type links: dict[tuple, list] or None
+        """
         logger.info("PREPROCESSOR: beginning preprocessing...")
+        self.stages = []
+        started = time.time()
+        committed = False
         db_transaction = self.db.transaction()
         try:
-            logger.debug("PREPROCESSOR: importing nodes...")
-            self.syslog_to_nodes()  # import all nodes into the shared Nodes table
-            logger.debug("PREPROCESSOR: importing links...")
-            self.syslog_to_staging_links()  # import all link info into staging tables
+            if links is None:
+                logger.debug("PREPROCESSOR: importing nodes...")
+                self.run_stage('nodes', self.syslog_to_nodes)  # import all nodes into the shared Nodes table
+                logger.debug("PREPROCESSOR: importing links...")
+                self.run_stage('staging', self.syslog_to_staging_links)  # import all link info into staging tables
+            else:
+                logger.debug("PREPROCESSOR: importing nodes...")
+                self.run_stage('nodes', self.links_ips_to_nodes, links)
+                logger.debug("PREPROCESSOR: importing links...")
+                self.run_stage('staging', self.links_to_staging_links, links)
             logger.debug("PREPROCESSOR: copying from staging to master...")
-            self.staging_links_to_links()  # copy data from staging to master tables
+            self.run_stage('links', self.staging_links_to_links)  # copy data from staging to master tables
             logger.debug("PREPROCESSOR: precomputing aggregates...")
-            self.links_to_links_in_out()  # merge new data into the existing aggregates
+            self.run_stage('links_in_out', self.links_to_links_in_out)  # merge new data into the existing aggregates
 
-            t_range = self.get_staging_timerange() # must do this before deleting staging data
-            if self.use_sec_rules:
-                self.run_security_rules(t_range[0], t_range[1])
-            self.run_import_hooks()
+            self.run_stage('rules', self.apply_security_rules)
+            self.run_stage('hooks', self.run_import_hooks)
 
             logger.debug("PREPROCESSOR: deleting from staging...")
-            self.staging_to_null()  # delete all data from staging tables
+            self.run_stage('cleanup', self.staging_to_null)  # delete all data from staging tables
         except:
             db_transaction.rollback()
+            self.new_nodes = {}
             logger.info("PREPROCESSOR: Pre-processing rolled back.")
             raise
         else:
-            db_transaction.commit()
+            self.run_stage('commit', db_transaction.commit)
+            committed = True
+            NODE_CACHE.add(self.sub_id, self.new_nodes)
+            self.new_nodes = {}
             logger.info("PREPROCESSOR: Pre-processing completed successfully.")
+        finally:
+            self.last_profile = {
+                'subscription': self.sub_id,
+                'datasource': self.ds_id,
+                'started': started,
+                'seconds': time.time() - started,
+                'db_seconds': sum(stage['db_seconds'] for stage in self.stages),
+                'committed': committed,
+                'stages': self.stages,
+            }
+            PROFILES.add(self.last_profile)
+
+
+PROFILES = ProfileHistory()
 
 
 # If running as a script
@@ -635,12 +785,23 @@ if __name__ == "__main__":
         sub_model = Subscriptions(common.db_quiet)
         default_sub = sub_model.get_by_email(constants.subscription['default_email'])
         sub_id = default_sub['subscription']
+        args = [arg for arg in sys.argv if not arg.startswith('--')]
+        explain = '--explain' in sys.argv
+        profile = explain or '--profile' in sys.argv
         try:
-            ds = determine_datasource(common.db_quiet, sub_id, sys.argv)
-            processor = Preprocessor(common.db_quiet, sub_id, ds)
-            processor.run_all()
+            ds = determine_datasource(common.db_quiet, sub_id, args)
+            processor = Preprocessor(common.db_quiet, sub_id, ds, explain=explain)
+            if '--rebuild' in sys.argv:
+                processor.rebuild_links_in_out()
+            else:
+                try:
+                    processor.run_all()
+                finally:
+                    if profile:
+                        sys.stdout.write(format_profile(processor.last_profile) + '\n')
         except InvalidDatasource:
             logger.error("PREPROCESSOR: Data source missing or invalid. Aborting.")
-            logger.error("PREPROCESSOR: please run as \n\t`python {0} <datasource>`".format(sys.argv[0]))
+            logger.error("PREPROCESSOR: please run as \n\t`python {0} <datasource> [--profile] [--explain] [--rebuild]`"
+                         .format(sys.argv[0]))
     else:
         logger.error("PREPROCESSOR: Preprocess aborted. Database check failed.")
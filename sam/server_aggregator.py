@@ -3,8 +3,11 @@ import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
 import logging
 import time
+import json
 import cPickle
 import threading
+import collections
+import Queue
 import traceback
 from sam import constants
 import web
@@ -12,9 +15,13 @@ import sam.common
 import sam.models.livekeys
 import sam.models.nodes
 import sam.importers.import_base
+from sam.importers import wire_format
+from sam.importers.flow_aggregator import LinkAccumulator
 import sam.preprocess
 import sam.httpserver
 logger = logging.getLogger(__name__)
+BUSY = 'busy'  # reply to uploads refused for backpressure
+DUPLICATE = 'duplicate'  # an upload that was already accepted
 
 """
 Live Server
@@ -29,6 +36,38 @@ Live Server
 """
 
 
+def message_rows(message):
+    """
+    :param message: an upload, as decoded by Aggregator.handle
+    :return: the number of lines in it
+    :rtype: int
+    """
+    if not isinstance(message, dict):
+        return 0
+    if 'batch' in message:
+        return len(message['batch'])
+    return len(message.get('lines', ()))
+
+
+def message_batch(message):
+    """
+    :param message: an upload, as decoded by Aggregator.handle
+    :return: its lines as a ColumnBatch, with the counts of older pickled uploads coerced to int
+    :rtype: sam.importers.import_base.ColumnBatch
+    """
+    if 'batch' in message:
+        return message['batch']
+    headers = message['headers']
+    batch = sam.importers.import_base.ColumnBatch()
+    for line in message['lines']:
+        row = dict(zip(headers, line))
+        for key in ('bytes_sent', 'bytes_received', 'packets_sent', 'packets_received', 'duration'):
+            if row[key] is not None:
+                row[key] = int(row[key])
+        batch.append_dict(row)
+    return batch
+
+
 class Buffer:
     def __init__(self, sub, ds):
         self.sub = sub
@@ -37,16 +76,56 @@ class Buffer:
         self.last_proc_time = time.time()
         self.expiring = False
         self.lock = threading.Lock()
+        self.syslog_rows = None  # rows in the syslog table awaiting preprocessing. None until first counted.
+        self.ingest_rate = 0.0  # rows/second, averaged over recent preprocessing periods
+        self.proc_latency = 0.0  # seconds per preprocessing run, averaged
+        self.queued_rows = 0  # rows in messages
+        self.first_queued = None  # arrival time of the oldest message
+        self.syslog_since = None  # arrival time of the oldest row in the syslog table
+        self.busy = False  # a worker is inserting or preprocessing this buffer
+        self.links = LinkAccumulator()  # in direct mode, rows summed into links instead of the syslog table
 
     def pop_all(self):
         messages = self.messages
         self.messages = []
+        self.queued_rows = 0
+        self.first_queued = None
         return messages
 
     def add(self, message):
+        if not self.messages:
+            self.first_queued = time.time()
         self.messages.append(message)
+        self.queued_rows += message_rows(message)
         self.expiring = False
 
+    def lag(self):
+        """
+        :return: seconds since the oldest row not yet preprocessed arrived, or 0 if there are none
+        :rtype: float
+        """
+        arrivals = [t for t in (self.first_queued, self.syslog_since) if t is not None]
+        if not arrivals:
+            return 0.0
+        return time.time() - min(arrivals)
+
+    def stats(self):
+        """
+        :return: queue depths, lag, and the measurements preprocessing is scheduled by
+        :rtype: dict[str, any]
+        """
+        return {
+            'subscription': self.sub,
+            'datasource': self.ds,
+            'queued_messages': len(self.messages),
+            'queued_rows': self.queued_rows,
+            'syslog_rows': self.syslog_rows,
+            'lag': self.lag(),
+            'busy': self.busy,
+            'ingest_rate': self.ingest_rate,
+            'proc_latency': self.proc_latency,
+        }
+
     def flag_expired(self):
         self.expiring = True
         self.last_proc_time = time.time()
@@ -69,11 +148,23 @@ class MemoryBuffers:
         # each buffer needs a sub, ds, list-of-lines, and last_empty_time
         self.buffers = {}
         """:type buffers: dict[ int, dict[ int, Buffer]]"""
+        self.ready = threading.Event()  # set when a message is added, to wake the DatabaseInserter
+        self.lock = threading.RLock()  # guards self.buffers; buffers are added to and removed from different threads
 
     def create(self, sub, ds):
-        sub_buffers = self.buffers.get(sub, {})
-        sub_buffers[ds] = Buffer(sub, ds)
-        self.buffers[sub] = sub_buffers
+        with self.lock:
+            sub_buffers = self.buffers.get(sub, {})
+            sub_buffers[ds] = Buffer(sub, ds)
+            self.buffers[sub] = sub_buffers
+
+    def get(self, sub, ds):
+        """
+        :type sub: int
+        :type ds: int
+        :rtype: Buffer or None
+        """
+        with self.lock:
+            return self.buffers.get(sub, {}).get(ds)
 
     def add(self, sub, ds, message):
         """
@@ -82,12 +173,14 @@ class MemoryBuffers:
         :type message: any
         :rtype: None
         """
-        buff = self.buffers.get(sub, {}).get(ds)
-        if buff is None:
-            self.create(sub, ds)
+        with self.lock:
             buff = self.buffers.get(sub, {}).get(ds)
-        with buff.lock:
-            buff.add(message)
+            if buff is None:
+                self.create(sub, ds)
+                buff = self.buffers.get(sub, {}).get(ds)
+            with buff.lock:
+                buff.add(message)
+        self.ready.set()
 
     def remove(self, sub, ds):
         """
@@ -95,18 +188,34 @@ class MemoryBuffers:
         :type ds: int
         :rtype: None
         """
-        sub_buffer = self.buffers.get(sub)
-        if sub_buffer is not None:
-            if ds in sub_buffer:
-                del sub_buffer[ds]
-            if len(sub_buffer) == 0:
-                del self.buffers[sub]
+        with self.lock:
+            sub_buffer = self.buffers.get(sub)
+            if sub_buffer is not None:
+                if ds in sub_buffer:
+                    del sub_buffer[ds]
+                if len(sub_buffer) == 0:
+                    del self.buffers[sub]
+
+    def discard(self, buff):
+        """
+        Remove a buffer, unless messages have arrived for it since it was found idle.
+
+        :type buff: Buffer
+        :return: True if the buffer was removed
+        :rtype: bool
+        """
+        with self.lock:
+            if len(buff) or self.buffers.get(buff.sub, {}).get(buff.ds) is not buff:
+                return False
+            self.remove(buff.sub, buff.ds)
+            return True
 
     def get_all(self):
         """
         :rtype: list [ Buffer ]
         """
-        buffers = [self.buffers[subid][dsid] for subid in sorted(self.buffers.keys()) for dsid in sorted(self.buffers[subid].keys())]
+        with self.lock:
+            buffers = [self.buffers[subid][dsid] for subid in sorted(self.buffers.keys()) for dsid in sorted(self.buffers[subid].keys())]
         return buffers
 
     def yank(self, sub, ds):
@@ -115,7 +224,7 @@ class MemoryBuffers:
         :type ds: int
         :rtype: list
         """
-        buff = self.buffers.get(sub, {}).get(ds)
+        buff = self.get(sub, ds)
         if buff:
             with buff.lock:
                 lines = buff.pop_all()
@@ -123,51 +232,262 @@ class MemoryBuffers:
         else:
             return []
 
+    def stats(self):
+        """
+        :return: Buffer.stats for every buffer
+        :rtype: list[ dict[str, any] ]
+        """
+        return [buff.stats() for buff in self.get_all()]
+
+
+class FairQueue(object):
+    """
+    Buffers waiting for a worker, served round-robin across subscriptions so one subscription
+    with many busy data sources can't hold up the others.
+    """
+    def __init__(self):
+        self.queues = {}  # subscription: deque of items
+        self.order = collections.deque()  # subscriptions with items waiting, next to be served first
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        with self.condition:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def put(self, sub, item):
+        with self.condition:
+            queue = self.queues.get(sub)
+            if queue is None:
+                queue = self.queues[sub] = collections.deque()
+                self.order.append(sub)
+            queue.append(item)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        :param timeout: seconds to wait for an item
+        :type timeout: float or None
+        :return: the oldest item of the next subscription in turn
+        :raises Queue.Empty: if nothing was queued within the timeout
+        """
+        with self.condition:
+            if not self.order:
+                self.condition.wait(timeout)
+            if not self.order:
+                raise Queue.Empty()
+            sub = self.order.popleft()
+            queue = self.queues[sub]
+            item = queue.popleft()
+            if queue:
+                self.order.append(sub)
+            else:
+                del self.queues[sub]
+            return item
 
-class DatabaseInserter(threading.Thread):
-    SIZE_QUOTA = 1000  # log lines.  When the syslog has this many entries, process it.
-    TIME_QUOTA = 20  # seconds. Process a partially-filled syslog with this period.
-    CYCLE_SLEEP = 1  # seconds. sleep period between buffer-checking cycles
 
-    def __init__(self, buffers):
+class DatabaseInserter(threading.Thread):
+    """
+    Inserts uploaded lines into each data source's syslog table as they arrive, and preprocesses
+    the syslog tables into links on an adaptive schedule:
+
+    * A data source is preprocessed once its rows have waited `flush_delay`: HEADROOM times as long
+      as preprocessing recently took, within [MIN_DELAY, TIME_QUOTA]. When preprocessing is quick
+      (light load) rows are visible within about a second.
+    * It is preprocessed sooner once `size_quota` rows are waiting: about what arrives, at the recent
+      ingest rate, over that delay, within [MIN_BATCH, SIZE_QUOTA]. Under heavy load batches grow so
+      the fixed cost of each preprocessing run is spread over more rows.
+
+    Rows waiting in the syslog table are counted in memory as they are inserted; the table is only
+    counted once, when a buffer is created, to pick up rows left over from a previous run.
+    The thread sleeps until new data arrives or the next buffer is due.
+
+    In direct mode, lines are summed into each buffer's LinkAccumulator instead of being inserted into the
+    syslog table, and preprocessing writes them straight to StagingLinks. Lines not yet preprocessed are
+    then only held in memory, so they are lost if the aggregator stops abruptly.
+
+    Buffers that need attention are handed to a pool of worker threads through a FairQueue, so a slow
+    data source only holds up its own worker. Each buffer is held by at most one worker at a time, so
+    a data source never has two preprocessing runs in flight. With no workers, buffers are handled on
+    this thread.
+    """
+    SIZE_QUOTA = 100000  # log lines. Largest batch; when the syslog has this many entries, process it.
+    MIN_BATCH = 1000  # log lines. Smallest adaptive size quota.
+    TIME_QUOTA = 20  # seconds. Longest a partially-filled syslog waits; idle buffers are expired with this period.
+    MIN_DELAY = 1  # seconds. Shortest adaptive wait before processing a partially-filled syslog.
+    HEADROOM = 4  # wait this many times the preprocessing latency, so preprocessing takes at most ~1/4 of the time
+    AVERAGE_WEIGHT = 0.3  # weight of the newest observation in the latency and rate averages
+
+    def __init__(self, buffers, workers=None, direct=None):
         """
         :type buffers: MemoryBuffers
+        :param workers: number of worker threads. Defaults to the aggregator's `workers` setting.
+        :type workers: int or None
+        :param direct: bypass the syslog table. Defaults to the aggregator's `direct` setting.
+        :type direct: bool or None
         """
         threading.Thread.__init__(self)
         self.buffers = buffers
         self.alive = True
         self.e_shutdown = threading.Event()
+        if workers is None:
+            workers = int(constants.aggregator['workers'])
+        self.worker_count = workers
+        if direct is None:
+            direct = constants.aggregator['direct'].lower() == 'true'
+        self.direct = direct
+        self.workers = []
+        self.queue = FairQueue()
+        self.e_workers_stop = threading.Event()
 
     def run(self):
+        self.start_workers()
         while self.alive:
-            # sleep, but watch for shutdown requests
-            triggered = self.e_shutdown.wait(self.CYCLE_SLEEP)
-            if triggered:
+            # sleep until data arrives or a buffer is due, but watch for shutdown requests
+            self.buffers.ready.wait(self.next_wakeup())
+            self.buffers.ready.clear()
+            if self.e_shutdown.is_set():
                 self.alive = False
 
             buffers = self.buffers.get_all()
             for buff in buffers:
-                self.buffer_to_syslog(buff)
-                self.process_buffer(buff)
+                self.schedule(buff)
+        self.stop_workers()
+        # messages that arrived while their buffer was held by a worker
+        for buff in self.buffers.get_all():
+            if len(buff):
+                self.service(buff)
+            if len(buff.links):
+                # nothing else holds these lines
+                self.syslog_to_tables(buff)
+
+    def start_workers(self):
+        for i in range(self.worker_count):
+            worker = threading.Thread(target=self.work, name='{0}-worker-{1}'.format(self.name, i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def stop_workers(self):
+        # workers finish what is queued before stopping
+        self.e_workers_stop.set()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def schedule(self, buff):
+        """
+        Hand a buffer to a worker if it has messages waiting or is due for processing or expiry.
+
+        :type buff: Buffer
+        """
+        if buff.busy:
+            return
+        if not len(buff) and time.time() < self.due_time(buff):
+            return
+        if not self.workers:
+            self.service(buff)
+            return
+        buff.busy = True
+        self.queue.put(buff.sub, buff)
+
+    def work(self):
+        while True:
+            try:
+                buff = self.queue.get(timeout=0.5)
+            except Queue.Empty:
+                if self.e_workers_stop.is_set():
+                    return
+                continue
+            try:
+                self.service(buff)
+            except:
+                logger.exception("PREPROCESSOR: error processing {0}: {1}".format(buff.sub, buff.ds))
+            finally:
+                buff.busy = False
+                # let the scheduler look at this buffer again
+                self.buffers.ready.set()
+
+    def service(self, buff):
+        """
+        Insert a buffer's messages into its syslog table (or, in direct mode, its LinkAccumulator),
+        then preprocess it if it is due.
+
+        :type buff: Buffer
+        """
+        if self.direct:
+            self.buffer_to_links(buff)
+        else:
+            self.buffer_to_syslog(buff)
+        self.process_buffer(buff)
+
+    def due_time(self, buff):
+        """
+        :type buff: Buffer
+        :return: when this buffer is due for processing, or for expiry if its syslog table is empty
+        :rtype: float
+        """
+        if buff.syslog_rows is None:
+            return buff.last_proc_time
+        if buff.syslog_rows:
+            return buff.last_proc_time + self.flush_delay(buff)
+        return buff.last_proc_time + self.TIME_QUOTA
+
+    def next_wakeup(self):
+        """
+        :return: seconds until the earliest buffer is due for processing or expiry
+        :rtype: float
+        """
+        now = time.time()
+        wait = self.TIME_QUOTA
+        for buff in self.buffers.get_all():
+            if not buff.busy:
+                wait = min(wait, self.due_time(buff) - now)
+        return max(wait, 0.01)
+
+    def flush_delay(self, buff):
+        """
+        :type buff: Buffer
+        :return: seconds rows may wait in this buffer's syslog table before preprocessing
+        :rtype: float
+        """
+        return min(max(buff.proc_latency * self.HEADROOM, self.MIN_DELAY), self.TIME_QUOTA)
+
+    def size_quota(self, buff):
+        """
+        :type buff: Buffer
+        :return: number of waiting rows that triggers preprocessing
+        :rtype: int
+        """
+        batch = buff.ingest_rate * self.flush_delay(buff)
+        return int(min(max(batch, self.MIN_BATCH), self.SIZE_QUOTA))
+
+    def count_rows(self, buff):
+        """
+        :type buff: Buffer
+        :return: rows waiting in this buffer's syslog table
+        :rtype: int
+        """
+        if buff.syslog_rows is None:
+            processor = sam.preprocess.Preprocessor(sam.common.db_quiet, buff.sub, buff.ds)
+            buff.syslog_rows = processor.count_syslog()
+        return buff.syslog_rows
 
     def process_buffer(self, buff):
         """
         :type buff: Buffer
         :rtype: int
         """
-        sub_id = buff.sub
-        ds_id = buff.ds
-        processor = sam.preprocess.Preprocessor(sam.common.db_quiet, sub_id, ds_id)
-        rows = processor.count_syslog()
-        time_expired = time.time() > buff.last_proc_time + self.TIME_QUOTA
+        rows = self.count_rows(buff)
+        elapsed = time.time() - buff.last_proc_time
+        time_expired = elapsed > self.TIME_QUOTA
         rcode = 0
 
-        if rows >= self.SIZE_QUOTA:
+        if rows >= self.size_quota(buff):
             # buffer full: process the buffer
             logger.debug("PREPROCESSOR: exceeded size quota")
             self.syslog_to_tables(buff)
             rcode = 1
-        elif time_expired and rows > 0:
+        elif rows > 0 and elapsed > self.flush_delay(buff):
             # time's up: process the buffer
             logger.debug("PREPROCESSOR: exceeded time quota")
             self.syslog_to_tables(buff)
@@ -175,7 +495,7 @@ class DatabaseInserter(threading.Thread):
         elif time_expired and buff.expiring:
             # buffer has been flagged for removal. Remove it.
             logger.debug("PREPROCESSOR: removing {0}: {1}".format(buff.sub, buff.ds))
-            self.buffers.remove(buff.sub, buff.ds)
+            self.buffers.discard(buff)
             rcode = 3
         elif rows == 0 and time_expired:
             # buffer is empty and time has expired. Flag it for removal next time.
@@ -189,14 +509,25 @@ class DatabaseInserter(threading.Thread):
 
     def shutdown(self):
         self.e_shutdown.set()
+        self.buffers.ready.set()
 
     @staticmethod
     def run_importer(sub_id, ds_id, messages):
+        """
+        :return: the number of lines inserted
+        :rtype: int
+        """
         importer = sam.importers.import_base.BaseImporter()
         importer.set_subscription(sub_id)
         importer.set_datasource_id(ds_id)
 
+        inserted = 0
         for msg in messages:
+            if 'batch' in msg:
+                # decoded from the binary wire format
+                importer.insert_batch(msg['batch'])
+                inserted += len(msg['batch'])
+                continue
             lines = msg['lines']
             headers = msg['headers']
             # lines is a list of rows, where each row is a list of values
@@ -204,12 +535,15 @@ class DatabaseInserter(threading.Thread):
             # rows is a list of dictionaries where each dictionary is the headers applied to that row of data
             rows = [{headers[i]: v for i, v in enumerate(row)} for row in lines]
             importer.insert_data(rows, len(lines))
+            inserted += len(lines)
+        return inserted
 
     @staticmethod
-    def run_preprocessor(sub_id, ds):
+    def run_preprocessor(sub_id, ds, links=None):
         logger.debug("PREPROCESSOR: running syslog to tables for {0}: {1}".format(sub_id, ds))
-        processor = sam.preprocess.Preprocessor(sam.common.db_quiet, sub_id, ds)
-        processor.run_all()
+        explain = constants.aggregator['explain_preprocessing'].lower() == 'true'
+        processor = sam.preprocess.Preprocessor(sam.common.db_quiet, sub_id, ds, explain=explain)
+        processor.run_all(links)
 
     def buffer_to_syslog(self, buff):
         """
@@ -219,8 +553,37 @@ class DatabaseInserter(threading.Thread):
         """
         sub_id = buff.sub
         ds_id = buff.ds
-        lines = buff.pop_all()
-        DatabaseInserter.run_importer(sub_id, ds_id, lines)
+        with buff.lock:
+            arrived = buff.first_queued
+            lines = buff.pop_all()
+        if not lines:
+            return
+        # count any rows already waiting before adding to them
+        rows = self.count_rows(buff)
+        buff.syslog_rows = rows + DatabaseInserter.run_importer(sub_id, ds_id, lines)
+        if buff.syslog_since is None:
+            buff.syslog_since = arrived
+
+    def buffer_to_links(self, buff):
+        """
+        Immediately sum the contents of this buffer into its LinkAccumulator.
+
+        :type buff: Buffer
+        """
+        with buff.lock:
+            arrived = buff.first_queued
+            messages = buff.pop_all()
+        if not messages:
+            return
+        if buff.syslog_rows is None:
+            if self.count_rows(buff):
+                # rows left in the syslog table from before direct mode are preprocessed the usual way
+                DatabaseInserter.run_preprocessor(buff.sub, buff.ds)
+            buff.syslog_rows = 0
+        for message in messages:
+            buff.syslog_rows += buff.links.add_batch(message_batch(message))
+        if buff.syslog_since is None:
+            buff.syslog_since = arrived
 
     def syslog_to_tables(self, buff):
         """
@@ -230,19 +593,84 @@ class DatabaseInserter(threading.Thread):
         """
         sub = buff.sub
         ds = buff.ds
-        buff.last_proc_time = time.time()
+        start = time.time()
+        weight = self.AVERAGE_WEIGHT
+        elapsed = start - buff.last_proc_time
+        if buff.syslog_rows and elapsed > 0:
+            buff.ingest_rate += weight * (buff.syslog_rows / elapsed - buff.ingest_rate)
+        buff.last_proc_time = start
         buff.flag_unexpired()
-        DatabaseInserter.run_preprocessor(sub, ds)
+        if self.direct:
+            DatabaseInserter.run_preprocessor(sub, ds, buff.links.pop_all())
+        else:
+            DatabaseInserter.run_preprocessor(sub, ds)
+        buff.syslog_rows = 0
+        buff.syslog_since = None
+        buff.proc_latency += weight * (time.time() - start - buff.proc_latency)
+        logger.debug("PREPROCESSOR: {0}: {1:.0f} rows/s, preprocessing takes {2:.3f}s, lag {3:.1f}s".format(
+            buff, buff.ingest_rate, buff.proc_latency, buff.lag()))
+
+
+class SequenceTracker(object):
+    """
+    Remembers recent upload sequence numbers from each collector, so uploads that are sent again
+    (because the acknowledgement was lost) are only buffered once.
+    Only sequence numbers within WINDOW of the highest seen from a collector are remembered;
+    anything older is taken to be a duplicate. State is kept in memory, for the SENDERS most recent collectors.
+    """
+    WINDOW = 4096
+    SENDERS = 1024
+
+    def __init__(self):
+        self.senders = collections.OrderedDict()  # sender id: [highest sequence number, set of recent ones]
+        self.lock = threading.Lock()
+
+    def accept(self, sender, sequence):
+        """
+        :param sender: the collector's id
+        :type sender: int
+        :param sequence: the upload's sequence number
+        :type sequence: int
+        :return: False if this upload was accepted before
+        :rtype: bool
+        """
+        with self.lock:
+            state = self.senders.pop(sender, None)
+            if state is None:
+                state = [sequence, set()]
+                if len(self.senders) >= self.SENDERS:
+                    self.senders.popitem(last=False)
+            self.senders[sender] = state
+            highest, recent = state
+            if sequence in recent or sequence <= highest - self.WINDOW:
+                return False
+            recent.add(sequence)
+            if sequence > highest:
+                state[0] = sequence
+                if len(recent) > 2 * self.WINDOW:
+                    state[1] = set(n for n in recent if n > sequence - self.WINDOW)
+            return True
 
 
 class Aggregator(object):
+    # rows a data source may have waiting in memory. Beyond this, uploads are refused with 503 until it catches up.
+    MAX_QUEUED_ROWS = int(constants.aggregator['max_queued_rows'])
+    RETRY_AFTER = 5  # seconds, suggested to collectors whose uploads were refused
+
     @staticmethod
     def handle(rawdata):
         # logger.debug("SERVER: Handling input!")
-        try:
-            data = cPickle.loads(rawdata)
-        except:
-            return 'failed: could not unpickle data.'
+        if wire_format.is_binary(rawdata):
+            try:
+                data = wire_format.decode(rawdata)
+            except ValueError as e:
+                return 'failed: could not decode data. {0}'.format(e)
+        else:
+            # collectors older than the binary format send pickles
+            try:
+                data = cPickle.loads(rawdata)
+            except:
+                return 'failed: could not unpickle data.'
 
         if not data:
             return 'failed: no data received.'
@@ -251,8 +679,13 @@ class Aggregator(object):
 
         if errors == 'handshake':
             return 'handshake'
-        elif errors:
+        elif errors == BUSY:
+            return '{0}: too many lines waiting; retry later.'.format(BUSY)
+        elif errors and errors != DUPLICATE:
             return 'failed: {0}'.format(errors)
+        elif isinstance(data, dict) and 'sequence' in data:
+            # acknowledged either way, so the collector stops resending it
+            return 'ack {0}'.format(data['sequence'])
         else:
             return 'success'
 
@@ -271,7 +704,7 @@ class Aggregator(object):
             return {}, 'Version not compatible. Recieved {0}, expected {1}. Access Denied'.format(version, '1.0')
 
         key_model = sam.models.livekeys.LiveKeys(sam.common.db_quiet, 0)
-        access = key_model.validate(access_key)
+        access = key_model.validate_cached(access_key)
         return access, ''
 
     @staticmethod
@@ -292,6 +725,17 @@ class Aggregator(object):
             if data['msg'] == 'handshake':
                 return 'handshake'
 
+        # push back on collectors while this data source is too far behind
+        buff = BUFFERS.get(sub, ds)
+        if buff is not None and buff.queued_rows >= Aggregator.MAX_QUEUED_ROWS:
+            logger.warning("SERVER: {0} lines waiting for {1}: {2}; refusing upload.".format(buff.queued_rows, sub, ds))
+            return BUSY
+
+        if 'sequence' in data and not SEQUENCES.accept(data['sender'], data['sequence']):
+            logger.info("SERVER: Discarding upload {0} from collector {1:x}, already received.".format(
+                data['sequence'], data['sender']))
+            return DUPLICATE
+
         # read lines/etc
         # insert lines into buffer
         logger.info("SERVER: Received input.")
@@ -313,16 +757,66 @@ class Aggregator(object):
     def POST(self):
         response = Aggregator.handle(web.data())
         Aggregator.ensure_processing_thread()
+        if response.startswith(BUSY):
+            web.ctx.status = '503 Service Unavailable'
+            web.header('Retry-After', str(Aggregator.RETRY_AFTER))
         return response
 
 
+def stats():
+    """
+    :return: queue depths and lag (seconds since the oldest line not yet preprocessed arrived) for each
+        data source, and the access key cache's hit and miss counts
+    :rtype: dict
+    """
+    return {
+        'datasources': BUFFERS.stats(),
+        'key_cache': sam.models.livekeys.KEY_CACHE.stats(),
+    }
+
+
+def stats_allowed(address):
+    """
+    Whether a client may read /stats and /stats/preprocessing, according to the aggregator's stats_access setting:
+    'local' allows requests from this host only, 'all' allows any client, and anything else allows none.
+
+    :param address: the client's IP address
+    :type address: str
+    :rtype: bool
+    """
+    access = constants.aggregator['stats_access'].lower()
+    if access == 'all':
+        return True
+    if access == 'local':
+        return address == '::1' or address.startswith('127.') or address.startswith('::ffff:127.')
+    return False
+
+
+class AggregatorStats(object):
+    def GET(self):
+        if not stats_allowed(web.ctx.ip):
+            raise web.forbidden()
+        web.header('Content-Type', 'application/json')
+        return json.dumps(stats())
+
+
+class PreprocessingStats(object):
+    def GET(self):
+        if not stats_allowed(web.ctx.ip):
+            raise web.forbidden()
+        web.header('Content-Type', 'application/json')
+        return json.dumps(sam.preprocess.PROFILES.stats())
+
+
 def start_server(port=None):
     sam.common.load_plugins()
 
     if port is None:
         port = constants.aggregator['listen_port']
 
-    urls = ['/', 'Aggregator']
+    urls = ['/', 'Aggregator',
+            '/stats', 'AggregatorStats',
+            '/stats/preprocessing', 'PreprocessingStats']
     app = web.application(urls, globals(), autoreload=False)
     try:
         sam.httpserver.runwsgi(app.wsgifunc(sam.httpserver.PluginStaticMiddleware), port)
@@ -333,13 +827,20 @@ def start_server(port=None):
 def start_wsgi():
     global application
     sam.common.load_plugins()
-    urls = ['/', 'Aggregator']
+    urls = ['/', 'Aggregator',
+            '/stats', 'AggregatorStats',
+            '/stats/preprocessing', 'PreprocessingStats']
     app = web.application(urls, globals())
     return app.wsgifunc(sam.httpserver.PluginStaticMiddleware)
 
 
+# access keys are validated with every upload
+sam.models.livekeys.KEY_CACHE.ttl = float(constants.aggregator['key_cache_ttl'])
+
 # buffer to pass data between threads
 BUFFERS = MemoryBuffers()
+# upload sequence numbers seen from each collector
+SEQUENCES = SequenceTracker()
 # to persist the thread reference between invocations
 IMPORTER_THREAD = None
 
@@ -0,0 +1,346 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+import socket
+import fcntl
+import asyncore
+import asynchat
+import logging
+import threading
+import collections
+import Queue
+import json
+from sam import constants
+import sam.common
+import sam.preprocess
+from sam import server_aggregator
+logger = logging.getLogger(__name__)
+
+"""
+Asynchronous Aggregator
+-----------------------
+
+* an alternative to the web.py server for the aggregator (`--target=aggregator --async`)
+* one event loop thread accepts uploads over many keep-alive connections at once
+* complete uploads go through a bounded queue to decoder threads, which decode, authenticate
+  and buffer them for the DatabaseInserter, so the event loop never decodes
+* when the queue is full, uploads are refused with 503 right away
+* uploads with a sequence number are acknowledged with it ('ack N'). Collectors resend until
+  acknowledged, and uploads that arrive twice are only buffered once.
+
+"""
+
+STATUS_TEXT = {
+    200: 'OK',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    411: 'Length Required',
+    413: 'Request Entity Too Large',
+    503: 'Service Unavailable',
+}
+
+
+class IngestChannel(asynchat.async_chat):
+    """
+    One client connection. Reads HTTP/1.1 requests one at a time and hands them to the server.
+    """
+    MAX_HEADER = 65536  # bytes
+    MAX_BODY = 256 * 1024 ** 2  # bytes
+
+    def __init__(self, sock, server, channel_map):
+        asynchat.async_chat.__init__(self, sock, map=channel_map)
+        self.server = server
+        self.incoming = []
+        self.received = 0
+        self.request = None  # method, path and headers of a request whose body is being read
+        self.set_terminator('\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        self.received += len(data)
+        if self.request is None and self.received > self.MAX_HEADER:
+            self.respond(413, 'failed: request headers too large', close=True)
+            return
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        data = ''.join(self.incoming)
+        self.incoming = []
+        self.received = 0
+        if self.request is None:
+            try:
+                method, path, headers = self.parse_head(data)
+            except ValueError as e:
+                self.respond(400, 'failed: {0}'.format(e), close=True)
+                return
+            if headers.get('transfer-encoding', 'identity').lower() != 'identity':
+                self.respond(411, 'failed: uploads need a Content-Length', close=True)
+                return
+            try:
+                length = int(headers.get('content-length', 0))
+            except ValueError:
+                self.respond(400, 'failed: bad Content-Length', close=True)
+                return
+            if length > self.MAX_BODY:
+                self.respond(413, 'failed: upload too large', close=True)
+                return
+            if length > 0:
+                self.request = (method, path, headers)
+                self.set_terminator(length)
+                return
+            body = ''
+        else:
+            method, path, headers = self.request
+            self.request = None
+            self.set_terminator('\r\n\r\n')
+            body = data
+        self.keep_alive = headers.get('connection', '').lower() != 'close'
+        self.server.dispatch(self, method, path, body)
+
+    @staticmethod
+    def parse_head(data):
+        """
+        :param data: the request line and headers
+        :type data: str
+        :return: method, path and headers (with lower-case names)
+        :rtype: tuple[str, str, dict[str, str]]
+        :raises ValueError: if the request line is malformed
+        """
+        lines = data.split('\r\n')
+        parts = lines[0].split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise ValueError("malformed request line")
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return parts[0].upper(), parts[1].split('?', 1)[0], headers
+
+    def respond(self, status, body, headers=(), close=False):
+        """
+        Send a response. Call from the event loop thread only.
+
+        :param status: HTTP status code
+        :type status: int
+        :param body: the response body
+        :type body: str
+        :param headers: extra header names and values
+        :type headers: list[tuple[str, str]]
+        :param close: close the connection once the response is sent
+        :type close: bool
+        """
+        close = close or not getattr(self, 'keep_alive', True)
+        lines = ['HTTP/1.1 {0} {1}'.format(status, STATUS_TEXT.get(status, '')),
+                 'Content-Type: {0}'.format(dict(headers).get('Content-Type', 'text/plain')),
+                 'Content-Length: {0}'.format(len(body))]
+        lines.extend('{0}: {1}'.format(name, value) for name, value in headers if name != 'Content-Type')
+        if close:
+            lines.append('Connection: close')
+        self.push('\r\n'.join(lines) + '\r\n\r\n' + body)
+        if close:
+            self.close_when_done()
+
+    def handle_error(self):
+        logger.exception("AGGREGATOR: error on connection")
+        self.close()
+
+
+class Waker(asyncore.file_dispatcher):
+    """
+    Wakes the event loop when decoder threads have responses ready for it to send.
+    """
+    def __init__(self, channel_map):
+        self.read_fd, self.write_fd = os.pipe()
+        # a full pipe already guarantees a wakeup, so writers never need to wait for it
+        fcntl.fcntl(self.write_fd, fcntl.F_SETFL, fcntl.fcntl(self.write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        asyncore.file_dispatcher.__init__(self, self.read_fd, map=channel_map)
+        self.callbacks = collections.deque()
+
+    def writable(self):
+        return False
+
+    def call_soon(self, callback, *args):
+        """
+        Run a callback on the event loop thread. Safe to call from any thread.
+        """
+        self.callbacks.append((callback, args))
+        try:
+            os.write(self.write_fd, 'x')
+        except OSError:
+            pass
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except (OSError, socket.error):
+            pass
+        while self.callbacks:
+            callback, args = self.callbacks.popleft()
+            callback(*args)
+
+    def handle_close(self):
+        self.close()
+        os.close(self.write_fd)
+
+
+class AsyncAggregator(asyncore.dispatcher):
+    DECODERS = 4  # threads decoding and buffering uploads
+    QUEUE_SIZE = 64  # uploads waiting for a decoder. Beyond this, uploads are refused.
+    POLL_TIMEOUT = 0.5  # seconds
+
+    def __init__(self, address, decoders=DECODERS, queue_size=QUEUE_SIZE):
+        """
+        :param address: host and port to listen on. Port 0 picks a free port.
+        :type address: tuple[str, int]
+        :param decoders: number of decoder threads
+        :type decoders: int
+        :param queue_size: uploads waiting for a decoder before further uploads are refused
+        :type queue_size: int
+        """
+        self.channel_map = {}
+        asyncore.dispatcher.__init__(self, map=self.channel_map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(128)
+        self.waker = Waker(self.channel_map)
+        self.queue = Queue.Queue(queue_size)
+        self.decoder_count = decoders
+        self.decoders = []
+        self.alive = False
+        self.lock = threading.Lock()
+        self.received = 0
+        self.refused = 0
+
+    @property
+    def address(self):
+        return self.socket.getsockname()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            IngestChannel(pair[0], self, self.channel_map)
+
+    def dispatch(self, channel, method, path, body):
+        """
+        Route a complete request. Runs on the event loop thread.
+
+        :type channel: IngestChannel
+        :type method: str
+        :type path: str
+        :type body: str
+        """
+        if path in ('/stats', '/stats/preprocessing'):
+            if method != 'GET':
+                channel.respond(405, 'failed: use GET')
+                return
+            if not server_aggregator.stats_allowed(channel.addr[0]):
+                channel.respond(403, 'failed: forbidden')
+                return
+            if path == '/stats':
+                stats = self.stats()
+            else:
+                stats = sam.preprocess.PROFILES.stats()
+            channel.respond(200, json.dumps(stats), [('Content-Type', 'application/json')])
+            return
+        if path != '/':
+            channel.respond(404, 'failed: not found')
+            return
+        if method != 'POST':
+            channel.respond(405, 'failed: use POST')
+            return
+        try:
+            self.queue.put_nowait((channel, body))
+        except Queue.Full:
+            with self.lock:
+                self.refused += 1
+            self.reply(channel, '{0}: too many uploads waiting; retry later.'.format(server_aggregator.BUSY))
+            return
+        with self.lock:
+            self.received += 1
+
+    @staticmethod
+    def reply(channel, response):
+        """
+        Send Aggregator.handle's response to an upload.
+        """
+        if response.startswith(server_aggregator.BUSY):
+            channel.respond(503, response, [('Retry-After', str(server_aggregator.Aggregator.RETRY_AFTER))])
+        else:
+            channel.respond(200, response)
+
+    def decode(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            channel, body = item
+            try:
+                response = server_aggregator.Aggregator.handle(body)
+                server_aggregator.Aggregator.ensure_processing_thread()
+            except:
+                logger.exception("AGGREGATOR: error handling upload")
+                response = 'failed: error handling upload'
+            self.waker.call_soon(self.reply, channel, response)
+
+    def stats(self):
+        """
+        :return: server_aggregator.stats, plus uploads received, refused and waiting to be decoded
+        :rtype: dict
+        """
+        stats = server_aggregator.stats()
+        with self.lock:
+            stats['uploads'] = {
+                'received': self.received,
+                'refused': self.refused,
+                'waiting': self.queue.qsize(),
+                'connections': len(self.channel_map) - 2,  # less the listener and the waker
+            }
+        return stats
+
+    def start_decoders(self):
+        for i in range(self.decoder_count):
+            decoder = threading.Thread(target=self.decode, name='aggregator-decoder-{0}'.format(i))
+            decoder.daemon = True
+            decoder.start()
+            self.decoders.append(decoder)
+
+    def serve_forever(self):
+        self.alive = True
+        self.start_decoders()
+        server_aggregator.Aggregator.ensure_processing_thread()
+        try:
+            while self.alive:
+                asyncore.loop(timeout=self.POLL_TIMEOUT, use_poll=True, map=self.channel_map, count=1)
+        finally:
+            for _ in self.decoders:
+                self.queue.put(None)
+            for decoder in self.decoders:
+                decoder.join()
+            self.decoders = []
+            # send any last responses, then close every connection
+            self.waker.handle_read()
+            asyncore.close_all(map=self.channel_map)
+
+    def shutdown(self):
+        self.alive = False
+        self.waker.call_soon(lambda: None)
+
+
+def start_server(port=None):
+    sam.common.load_plugins()
+
+    if port is None:
+        port = constants.aggregator['listen_port']
+
+    server = AsyncAggregator((constants.aggregator['listen_host'], int(port)),
+                             decoders=int(constants.aggregator['decoders']),
+                             queue_size=int(constants.aggregator['upload_queue_size']))
+    logger.info("AGGREGATOR: listening on {0}:{1}".format(*server.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("{} shutting down.".format(sys.argv[0]))
@@ -1,12 +1,23 @@
-import SocketServer
+import os
+import errno
+import socket
 import logging
 import signal
 import threading
 import time
+import Queue
+import collections
+import itertools
+import multiprocessing
+import struct
 # import web
 from sam import constants
 import sam.importers.import_base as base_importer
+from sam.importers import parallel_import
+from sam.importers import wire_format
+from sam.spill_queue import SpillQueue, SEGMENT_SIZE, MAX_DISK, DROP_OLDEST
 import requests
+import requests.adapters
 import cPickle
 import select
 logger = logging.getLogger(__name__)
@@ -16,45 +27,204 @@ Live Collector
 -----------
 
 * runs client-side.
-* listens on a socket (usually localhost:514) for messages from a gateway or router
+* listens on a socket (usually localhost:514) for messages from a gateway or router,
+  reading datagrams in batches into a swap-on-drain buffer
 * translates those messages into a standard SAM format
 * periodically opens an SSL connection to live_server to send accumulated messages
 
 * two threads: one to read the socket, one to translate and transmit
+* optionally, a pool of processes translating in parallel (--workers=N)
+* uploads go out from a small pool of sender threads, so translation continues while they're in flight
 """
 
 
 class SocketBuffer(object):
-    def __init__(self):
-        self.buffer = []
+    """
+    Holds received packets until the batch processor takes them all at once.
+    Packets are written into one of two preallocated slot lists; pop_all swaps the lists, so receiving
+    continues into one while the packets taken from the other are processed.
+    Packets that arrive while the buffer is full are dropped and counted.
+    """
+    CAPACITY = 262144  # packets
+    DRAIN_SIZE = 2000  # packets. Once this many are stored, `ready` is set to wake the batch processor.
+
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self.spare = [None] * capacity
+        self.count = 0
+        self.dropped = 0
         self.buffer_lock = threading.Lock()
+        self.ready = threading.Event()
 
     def store_data(self, packet):
-        # acquire lock
+        self.store_batch((packet,))
+
+    def store_batch(self, packets):
+        """
+        :param packets: packets received, oldest first
+        :type packets: list or tuple
+        """
         with self.buffer_lock:
-            # append packet
-            self.buffer.append(packet)
-            # release lock
+            count = self.count
+            room = self.capacity - count
+            if len(packets) > room:
+                self.dropped += len(packets) - room
+                packets = packets[:room]
+            end = count + len(packets)
+            self.slots[count:end] = packets
+            self.count = end
+        if end >= self.DRAIN_SIZE:
+            self.ready.set()
 
     def __len__(self):
-        return len(self.buffer)
+        return self.count
 
     def pop_all(self):
+        """
+        Take every stored packet. Only one thread may call this.
+
+        :return: the packets, oldest first
+        :rtype: list
+        """
         with self.buffer_lock:
-            packets = self.buffer
-            self.buffer = []
+            slots = self.slots
+            count = self.count
+            self.slots = self.spare
+            self.spare = slots
+            self.count = 0
+            self.ready.clear()
+        packets = slots[:count]
+        # release the packets; the next swap reuses these slots
+        slots[:count] = [None] * count
         return packets
 
 
+def udp_drops(sock):
+    """
+    Datagrams the kernel dropped for a UDP socket because its receive buffer was full.
+
+    :param sock: a bound UDP socket
+    :type sock: socket.socket
+    :return: the drop counter, or None where /proc/net/udp isn't available
+    :rtype: int or None
+    """
+    try:
+        inode = os.fstat(sock.fileno()).st_ino
+        with open('/proc/net/udp') as f:
+            f.readline()
+            for line in f:
+                fields = line.split()
+                if len(fields) > 12 and int(fields[9]) == inode:
+                    return int(fields[12])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+class UDPReceiver(threading.Thread):
+    """
+    Receives syslog datagrams on a dedicated socket with a large kernel receive buffer.
+    Each time the socket becomes readable it is drained with non-blocking reads, and the datagrams are
+    stored as one batch rather than with one handler call and one lock acquisition each.
+    """
+    RCVBUF_SIZE = 8 * 1024 ** 2  # bytes requested. Linux caps this at net.core.rmem_max.
+    MAX_DATAGRAM = 65535  # bytes
+    BATCH_SIZE = 1024  # datagrams read before storing them
+    REPORT_PERIOD = 10  # seconds between logged receive rates
+
+    def __init__(self, address, buffer):
+        """
+        :param address: (host, port) to listen on
+        :type address: tuple[str, int]
+        :param buffer: where received datagrams go
+        :type buffer: SocketBuffer
+        """
+        threading.Thread.__init__(self)
+        self.buffer = buffer
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCVBUF_SIZE)
+        self.socket.bind(address)
+        self.socket.setblocking(False)
+        self.rcvbuf = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        self.alive = True
+        self.received = 0  # datagrams
+        self.received_bytes = 0
+        self.rate = 0.0  # datagrams per second over the last report period
+        self.kernel_drops = udp_drops(self.socket)
+        if self.rcvbuf < self.RCVBUF_SIZE:
+            logger.warning("COLLECTOR: UDP receive buffer is {0} bytes; raise net.core.rmem_max to allow {1}"
+                           .format(self.rcvbuf, self.RCVBUF_SIZE))
+
+    @property
+    def address(self):
+        return self.socket.getsockname()
+
+    def run(self):
+        sock = self.socket
+        recv = sock.recv
+        store_batch = self.buffer.store_batch
+        last_report = time.time()
+        reported = self.received
+        while self.alive:
+            if sock in select.select([sock], [], [], 0.5)[0]:
+                batch = []
+                try:
+                    while len(batch) < self.BATCH_SIZE:
+                        batch.append(recv(self.MAX_DATAGRAM))
+                except socket.error as e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        logger.error("COLLECTOR: Error receiving: {0}".format(e))
+                if batch:
+                    store_batch(batch)
+                    self.received += len(batch)
+                    self.received_bytes += sum(map(len, batch))
+
+            now = time.time()
+            if now - last_report >= self.REPORT_PERIOD:
+                self.rate = (self.received - reported) / (now - last_report)
+                reported = self.received
+                last_report = now
+                self.report()
+        sock.close()
+
+    def report(self):
+        drops = udp_drops(self.socket)
+        if drops is not None and self.kernel_drops is not None and drops > self.kernel_drops:
+            logger.warning("COLLECTOR: kernel dropped {0} datagrams".format(drops - self.kernel_drops))
+        if drops is not None:
+            self.kernel_drops = drops
+        logger.info("COLLECTOR: receiving {0:.0f} datagrams/s. {1}".format(self.rate, self.stats()))
+
+    def stats(self):
+        """
+        :return: datagrams and bytes received, the receive rate per second, the kernel's drop counter for
+            the socket (None if unavailable), datagrams dropped because the buffer was full,
+            and the kernel receive buffer size
+        :rtype: dict[str, int or float or None]
+        """
+        return {
+            'received': self.received,
+            'received_bytes': self.received_bytes,
+            'rate': self.rate,
+            'kernel_drops': self.kernel_drops,
+            'buffer_drops': self.buffer.dropped,
+            'rcvbuf': self.rcvbuf,
+        }
+
+    def shutdown(self):
+        self.alive = False
+
+
+def init_translator(importer):
+    # the collector process handles interrupts and shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    parallel_import.init_worker(importer)
+
+
 # used to send data between threads.
 SOCKET_BUFFER = SocketBuffer()
 
-class SocketListener(SocketServer.BaseRequestHandler):
-    def handle(self):
-        global SOCKET_BUFFER
-        data = self.request[0]
-        SOCKET_BUFFER.store_data(data)
-
 
 class FileListener(threading.Thread):
     def set_file(self, f):
@@ -79,21 +249,214 @@ class FileListener(threading.Thread):
         self.alive = False
 
 
+class AggregatorBusy(Exception):
+    """
+    The aggregator refused an upload because it is too far behind; the upload should be retried later.
+    """
+    REPLY = 'busy'
+
+
+class Sender(object):
+    """
+    Uploads encoded packages to the aggregator over one pooled keep-alive session.
+    Once started, packages are queued and posted from background threads, and failed uploads are
+    retried with exponential backoff without holding up translation.
+    Packages queue in a SpillQueue, so a long outage spills them to disk rather than memory.
+    An aggregator that is too far behind replies 'busy'; those uploads are retried the same way.
+    """
+    QUEUE_SIZE = 8  # packages held in memory, when no queue is given
+    THREADS = 2  # concurrent uploads
+    RETRY_DELAY = 0.5  # seconds before the first retry. Doubles with each failure.
+    RETRY_MAX_DELAY = 30  # seconds
+    LATENCY_WEIGHT = 0.2  # weight of the newest sample in the latency moving average
+    TIMEOUT = 60  # seconds to wait for the aggregator's reply
+
+    def __init__(self, target_address, queue=None):
+        """
+        :param target_address: the aggregator's url
+        :type target_address: str
+        :param queue: where packages wait to be sent. Defaults to a memory-only queue of QUEUE_SIZE packages.
+        :type queue: SpillQueue or None
+        """
+        self.target_address = target_address
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.THREADS)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.queue = queue if queue is not None else SpillQueue(self.QUEUE_SIZE)
+        self.threads = []
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.sent = 0  # packages delivered
+        self.failures = 0  # upload attempts that failed
+        self.latency = None  # seconds, moving average
+        self.last_latency = None  # seconds
+
+    def start(self):
+        for i in range(self.THREADS):
+            thread = threading.Thread(target=self.run, name="sender-{0}".format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def is_running(self):
+        return bool(self.threads) and not self.stop_event.is_set()
+
+    def stop(self, timeout=None):
+        """
+        Stop the sender threads once the queue is empty or uploads fail.
+        Packages left over stay on disk for next time, if the queue spills to disk.
+        """
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+        self.queue.close()
+
+    def post(self, data):
+        """
+        Upload one package and wait for the reply.
+
+        :param data: the encoded package
+        :type data: str
+        :return: the aggregator's reply
+        :rtype: str
+        :raises AggregatorBusy: if the aggregator refused the upload for now
+        """
+        with self.lock:
+            self.in_flight += 1
+        t_start = time.time()
+        try:
+            response = self.session.request('POST', self.target_address, data=data, timeout=self.TIMEOUT)
+            reply = response.content
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        elapsed = time.time() - t_start
+        with self.lock:
+            self.last_latency = elapsed
+            if self.latency is None:
+                self.latency = elapsed
+            else:
+                self.latency += (elapsed - self.latency) * self.LATENCY_WEIGHT
+        if isinstance(reply, str) and reply.startswith(AggregatorBusy.REPLY):
+            raise AggregatorBusy(reply)
+        return reply
+
+    def enqueue(self, data, line_count):
+        """
+        :param data: the encoded package
+        :type data: str
+        :param line_count: number of lines in the package
+        :type line_count: int
+        :return: False if the queue dropped the package
+        :rtype: bool
+        """
+        return self.queue.put(data, line_count)
+
+    def run(self):
+        while True:
+            try:
+                data, line_count = self.queue.get(timeout=0.5)
+            except Queue.Empty:
+                if self.stop_event.is_set():
+                    return
+                continue
+            if not self.deliver(data, line_count):
+                # shutting down, and the aggregator is unreachable
+                self.queue.unget(data, line_count)
+                return
+
+    def deliver(self, data, line_count):
+        """
+        Post a package, retrying until it succeeds or the sender is stopped.
+
+        :return: True if the package was delivered
+        :rtype: bool
+        """
+        delay = self.RETRY_DELAY
+        while True:
+            try:
+                reply = self.post(data)
+            except Exception as e:
+                with self.lock:
+                    self.failures += 1
+                if self.stop_event.is_set():
+                    logger.error("COLLECTOR: Error sending package at shutdown: {0}".format(e))
+                    return False
+                logger.error("COLLECTOR: Error sending package; retrying in {0:.1f}s: {1}".format(delay, e))
+                self.stop_event.wait(delay)
+                delay = min(delay * 2, self.RETRY_MAX_DELAY)
+                continue
+            with self.lock:
+                self.sent += 1
+            logger.info("COLLECTOR: Sent {0} lines in {1:.0f}ms (in flight: {2}, queued: {3}). Reply: {4}".format(
+                line_count, self.last_latency * 1000, self.in_flight, len(self.queue), reply))
+            return True
+
+    def stats(self):
+        """
+        :return: in-flight packages, counts of packages sent and failed attempts, the average and most
+            recent upload latency in milliseconds, and the queue depth as SpillQueue.depth gives it
+        :rtype: dict[str, int or float or None]
+        """
+        stats = self.queue.depth()
+        with self.lock:
+            stats.update({
+                'in_flight': self.in_flight,
+                'sent': self.sent,
+                'failures': self.failures,
+                'latency_ms': None if self.latency is None else self.latency * 1000,
+                'last_latency_ms': None if self.last_latency is None else self.last_latency * 1000,
+            })
+        return stats
+
+
 class Collector(object):
+    TRANSLATE_CHUNK = 2000  # packets per task for the translator processes
+    MIN_TRANSMIT_ROWS = 500  # smallest adaptive transmit_buffer_threshold
+    MAX_TRANSMIT_ROWS = 50000  # largest adaptive transmit_buffer_threshold
+    TRANSMIT_PERIOD = 1.0  # seconds. Under load, upload about this much traffic at a time.
+    SKIP_REPORT_PERIOD = 60.0  # seconds between logging the number of lines that could not be translated
+
     def __init__(self):
         self.listen_address = (constants.collector['listen_host'], int(constants.collector['listen_port']))
         self.target_address = constants.collector['target_address']
         self.access_key = constants.collector['upload_key']
         self.default_format = constants.collector['format']
-        self.transmit_buffer = []
+        self.wire_format = constants.collector.get('wire_format', 'binary')
+        self.compress = constants.collector.get('compress', 'True').lower() == 'true'
+        # binary uploads carry this collector's id and a sequence number, so the aggregator
+        # can acknowledge each one and ignore any it receives twice.
+        self.sender_id = struct.unpack('<Q', os.urandom(8))[0]
+        self.sequence = itertools.count(1)
+        self.transmit_buffer = base_importer.ColumnBatch()
         self.transmit_buffer_size = 0
-        self.transmit_buffer_threshold = 500  # push the transmit buffer to the database server if it reaches this many entries.
-        self.time_between_imports = 1  # float, seconds. Period for translating lines from SOCKET to TRANSMIT buffers
+        # push the transmit buffer to the database server if it reaches this many entries.
+        # Adjusted to the traffic rate with each transmission.
+        self.transmit_buffer_threshold = self.MIN_TRANSMIT_ROWS
+        self.time_between_imports = 0.1  # float, seconds. Longest wait before translating lines from SOCKET to TRANSMIT buffers
         self.time_between_transmits = 10  # float, seconds. Period for transmitting to the database server.
         self.listener = None
         self.listener_thread = None
         self.shutdown_event = threading.Event()
         self.importer = None
+        self.workers = 1
+        self.pool = None  # translator processes, if there is more than one worker
+        self.pending = collections.deque()  # translations in progress, oldest first
+        self.interrupted = False  # set by the SIGINT handler
+        self.last_transmit = None
+        self.skipped = collections.Counter()  # lines not translated since the last report, by reason
+        self.last_skip_report = time.time()
+        spill_dir = constants.collector.get('spill_dir') or None
+        if spill_dir:
+            spill_dir = os.path.abspath(os.path.expanduser(spill_dir))
+        queue = SpillQueue(Sender.QUEUE_SIZE, spill_dir,
+                           segment_size=int(constants.collector.get('spill_segment_size', SEGMENT_SIZE)),
+                           max_disk=int(constants.collector.get('spill_max_size', MAX_DISK)),
+                           policy=constants.collector.get('spill_policy', DROP_OLDEST))
+        self.sender = Sender(self.target_address, queue)
 
     def get_importer(self, format):
         if format is None:
@@ -113,7 +476,7 @@ class Collector(object):
             attempts += 1
         return connected
 
-    def run(self, port=None, format=None, access_key=None):
+    def run(self, port=None, format=None, access_key=None, workers=None):
         # set up the importer
         self.importer = self.get_importer(format)
         if not self.importer:
@@ -136,27 +499,31 @@ class Collector(object):
 
             # register signals for safe shut down
         def sig_handler(num, frame):
-            logger.debug('\nInterrupt received.')
-            self.shutdown()
+            # only flag it: the batch processor may be holding the locks shutdown() needs
+            self.interrupted = True
 
         signal.signal(signal.SIGINT, sig_handler)
-        self.listener = SocketServer.UDPServer(self.listen_address, SocketListener)
+        self.listener = UDPReceiver(self.listen_address, SOCKET_BUFFER)
 
         # Start the daemon listening on the port in an infinite loop that exits when the program is killed
-        self.listener_thread = threading.Thread(target=self.listener.serve_forever)
+        self.listener_thread = self.listener
         self.listener_thread.daemon = True
         self.listener_thread.start()
         logger.info("Live Collector listening on {0}:{1}.".format(*self.listen_address))
 
+        self.sender.start()
+        self.start_translators(workers)
         try:
             self.thread_batch_processor()
         except:
             logger.exception("Live_collector server has encountered a critical error.")
             self.shutdown()
+        self.stop_translators()
+        self.sender.stop()
 
         logger.info("Live_collector server shut down successfully.")
 
-    def run_streamreader(self, stream, format=None, access_key=None):
+    def run_streamreader(self, stream, format=None, access_key=None, workers=None):
         # set up the importer
         self.importer = self.get_importer(format)
         if not self.importer:
@@ -173,8 +540,8 @@ class Collector(object):
 
             # register signals for safe shut down
         def sig_handler(num, frame):
-            logger.debug('\nInterrupt received.')
-            self.shutdown()
+            # only flag it: the batch processor may be holding the locks shutdown() needs
+            self.interrupted = True
 
         signal.signal(signal.SIGINT, sig_handler)
         self.listener = FileListener()
@@ -186,14 +553,44 @@ class Collector(object):
         self.listener_thread.start()
         logger.info('Collector: listening to {}.'.format(stream.name if hasattr(stream, 'name') else 'stream'))
 
+        self.sender.start()
+        self.start_translators(workers)
         try:
             self.thread_batch_processor()
         except:
             logger.exception("Collector: server has encountered a critical error.")
             self.shutdown()
+        self.stop_translators()
+        self.sender.stop()
 
         logger.info("Collector: server shut down successfully.")
 
+    def start_translators(self, workers):
+        """
+        Start a pool of translator processes, if more than one worker is requested and the importer allows it.
+
+        :param workers: number of translator processes. None or 1 translates on the batch processor thread.
+        :type workers: int or None
+        """
+        self.workers = workers or 1
+        if self.workers <= 1:
+            return
+        if not self.importer.stateless_translation:
+            logger.warning("COLLECTOR: {0} packets must be translated in order; using one worker.".format(
+                self.importer.__class__.__name__))
+            self.workers = 1
+            return
+        self.pool = multiprocessing.Pool(self.workers, initializer=init_translator, initargs=(self.importer,))
+        logger.info("COLLECTOR: translating with {0} processes".format(self.workers))
+
+    def stop_translators(self):
+        if self.pool is None:
+            return
+        self.collect_translations(wait=True)
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+
     def thread_batch_processor(self):
         global SOCKET_BUFFER
         # loop:
@@ -204,8 +601,13 @@ class Collector(object):
         last_processing = time.time()  # time.time() is in floating point seconds
         alive = True
         while alive:
-            triggered = self.shutdown_event.wait(self.time_between_imports)
-            if triggered:
+            # wake when enough packets are waiting, or after a short while
+            SOCKET_BUFFER.ready.wait(self.time_between_imports)
+            if self.interrupted:
+                logger.debug('Interrupt received.')
+                self.interrupted = False
+                self.shutdown()
+            if self.shutdown_event.is_set():
                 alive = False
 
             deltatime = time.time() - last_processing
@@ -229,66 +631,155 @@ class Collector(object):
                 last_processing = time.time()
 
             # import lines in memory buffer:
-            if len(SOCKET_BUFFER) > 0:
+            if len(SOCKET_BUFFER) > 0 or self.pending:
                 self.import_packets()
 
+            if time.time() - self.last_skip_report > self.SKIP_REPORT_PERIOD:
+                self.report_skipped()
+
+        self.report_skipped()
         logger.info("COLLECTOR: process server shutting down")
 
     def import_packets(self):
         global SOCKET_BUFFER
+        self.collect_translations()
+        # translators are all busy: wait for the oldest rather than queueing more
+        while len(self.pending) >= self.workers * 2:
+            self.collect_translations(wait=True, limit=1)
+
         # clear socket buffer
         packets = SOCKET_BUFFER.pop_all()
+        if not packets:
+            return
 
         # translate lines
-        translations = self.importer.import_packets(packets)
-
-        # insert translations into TRANSMIT_BUFFER
-        headers = base_importer.BaseImporter.keys
-        for line in translations:
-            list_line = [line[header] for header in headers]
-            self.transmit_buffer.append(list_line)
-
+        if self.pool is None:
+            self.add_translations(self.importer.translate_packets(packets))
+            return
+        for i in xrange(0, len(packets), self.TRANSLATE_CHUNK):
+            self.pending.append(self.pool.apply_async(parallel_import.translate_packets,
+                                                      (packets[i:i + self.TRANSLATE_CHUNK],)))
+
+    def collect_translations(self, wait=False, limit=None):
+        """
+        Move finished translations into the TRANSMIT buffer, in the order the packets arrived.
+
+        :param wait: wait for translations still in progress
+        :type wait: bool
+        :param limit: the most translations to collect
+        :type limit: int or None
+        """
+        collected = 0
+        while self.pending and (wait or self.pending[0].ready()) and (limit is None or collected < limit):
+            try:
+                self.add_translations(self.pending.popleft().get())
+            except Exception as e:
+                logger.error("COLLECTOR: Error translating packets: {0}".format(e))
+            collected += 1
+
+    def add_translations(self, batch):
+        """
+        :param batch: translated lines
+        :type batch: ColumnBatch
+        """
+        self.transmit_buffer.extend(batch)
+        self.skipped.update(batch.skipped)
         # update TRANSMIT_BUFFER size
         self.transmit_buffer_size = len(self.transmit_buffer)
 
+    def report_skipped(self):
+        """
+        Log how many lines the translators skipped, and why, since the last report.
+        """
+        if self.skipped:
+            logger.info("COLLECTOR: {0}".format(base_importer.format_skipped(self.skipped)))
+            self.skipped.clear()
+        self.last_skip_report = time.time()
+
+    def adapt_threshold(self, rows, seconds):
+        """
+        Size uploads to about TRANSMIT_PERIOD seconds of traffic at the current rate.
+
+        :param rows: rows in this transmission
+        :type rows: int
+        :param seconds: time since the previous transmission
+        :type seconds: float
+        """
+        if seconds <= 0:
+            return
+        threshold = rows / seconds * self.TRANSMIT_PERIOD
+        self.transmit_buffer_threshold = int(min(max(threshold, self.MIN_TRANSMIT_ROWS), self.MAX_TRANSMIT_ROWS))
+
     def transmit_lines(self):
         access_key = self.access_key
         version = "1.0"
         headers = base_importer.BaseImporter.keys
         lines = self.transmit_buffer
-        self.transmit_buffer = []
+        self.transmit_buffer = base_importer.ColumnBatch()
         self.transmit_buffer_size = 0
         package = {
             'access_key': access_key,
             'version': version,
             'headers': headers,
-            'lines': lines
+            'batch': lines
         }
+        now = time.time()
+        if self.last_transmit is not None:
+            self.adapt_threshold(len(lines), now - self.last_transmit)
+        self.last_transmit = now
+
+        try:
+            data = self.encode_package(package)
+        except (ValueError, TypeError) as e:
+            logger.error("COLLECTOR: Could not encode package; dropping {0} lines: {1}".format(len(lines), e))
+            return 'error'
+
+        if self.sender.is_running():
+            if self.sender.enqueue(data, len(lines)):
+                return 'queued'
+            logger.warning("COLLECTOR: Send queue is full; dropped {0} lines. {1}".format(
+                len(lines), self.sender.stats()))
+            return 'dropped'
 
         logger.info("COLLECTOR: Sending package...")
         try:
-            response = requests.request('POST', self.target_address, data=cPickle.dumps(package))
-            reply = response.content
+            reply = self.sender.post(data)
             logger.debug("COLLECTOR: Received reply: {0}".format(reply))
         except Exception as e:
             reply = 'error'
             logger.error("COLLECTOR: Error sending package: {0}".format(e))
-            # keep the unsent lines around
-            self.transmit_buffer.extend(lines)
-            self.transmit_buffer_size = len(self.transmit_buffer)
+            # keep the unsent package for the sender to retry
+            self.sender.enqueue(data, len(lines))
         return reply
 
+    def encode_package(self, package):
+        """
+        Serialize a package for upload, in the configured wire format.
+
+        :param package: access_key, version, headers, batch (a ColumnBatch) and optionally msg
+        :type package: dict
+        :return: the request body
+        :rtype: str
+        """
+        if self.wire_format == 'pickle':
+            # older aggregators expect a list of lines, with datetime timestamps
+            package = dict(package)
+            package['lines'] = [list(row) for row in package.pop('batch').rows()]
+            return cPickle.dumps(package, cPickle.HIGHEST_PROTOCOL)
+        return wire_format.encode_batch(package['batch'], package['access_key'], package['version'],
+                                        msg=package.get('msg', ''), compress=self.compress,
+                                        sequence=(self.sender_id, next(self.sequence)))
+
     def test_connection(self):
         package = {
             'access_key': self.access_key,
             'version': '1.0',
             'headers': base_importer.BaseImporter.keys,
             'msg': 'handshake',
-            'lines': []
+            'batch': base_importer.ColumnBatch()
         }
         try:
-            response = requests.request('POST', self.target_address, data=cPickle.dumps(package))
-            reply = response.content
+            reply = self.sender.post(self.encode_package(package))
         except Exception as e:
             logger.error("Collector: Testing connection...Failed")
             return False
@@ -312,6 +803,7 @@ class Collector(object):
             logger.info("COLLECTOR: Handler stopped.")
         logger.info("COLLECTOR: Shutting down batch processor.")
         self.shutdown_event.set()
+        SOCKET_BUFFER.ready.set()
 
 
 if __name__ == "__main__":
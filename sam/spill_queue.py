@@ -0,0 +1,275 @@
+"""
+A FIFO queue of encoded packages that holds a few in memory and spills the rest to disk.
+
+Packages beyond `memory_items` are appended to segment files in `directory`. Each record is
+a header (data length, line count) followed by the data. Once anything has spilled, new packages
+also go to disk so they are replayed in the order they were queued. A segment file is deleted
+once every package in it has been read.
+
+Disk use is capped at `max_disk` bytes. When a package doesn't fit, the drop policy decides:
+  drop_oldest:  delete the oldest segment files until it fits
+  drop_newest:  discard the new package
+Without a directory the queue is memory-only, and the policy applies once memory is full.
+
+Segments left behind by a previous run are replayed on startup. Packages still in memory at close
+are written to disk; they are replayed after anything that was already there.
+"""
+import os
+import struct
+import logging
+import threading
+import collections
+import Queue
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+POLICIES = (DROP_OLDEST, DROP_NEWEST)
+SEGMENT_SIZE = 16 * 1024 ** 2  # bytes
+MAX_DISK = 1024 ** 3  # bytes
+SUFFIX = '.seg'
+RECORD = struct.Struct('<II')  # data length, line count
+
+
+class Segment(object):
+    def __init__(self, path, items=0, size=0):
+        self.path = path
+        self.items = items  # records not yet read
+        self.size = size  # bytes on disk
+
+
+class SpillQueue(object):
+    def __init__(self, memory_items, directory=None, segment_size=SEGMENT_SIZE, max_disk=MAX_DISK,
+                 policy=DROP_OLDEST):
+        """
+        :param memory_items: packages to hold in memory before spilling to disk
+         :type memory_items: int
+        :param directory: where to keep segment files. None keeps the queue in memory only.
+         :type directory: str or None
+        :param segment_size: bytes written to a segment file before starting the next one
+         :type segment_size: int
+        :param max_disk: bytes all segment files together may use
+         :type max_disk: int
+        :param policy: DROP_OLDEST or DROP_NEWEST
+         :type policy: str
+        """
+        if policy not in POLICIES:
+            raise ValueError("Drop policy must be one of {0}, not {1!r}".format(', '.join(POLICIES), policy))
+        self.memory_items = memory_items
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_disk = max_disk
+        self.policy = policy
+        self.memory = collections.deque()  # (data, line count)
+        self.segments = collections.deque()  # Segment, oldest first
+        self.disk_items = 0
+        self.disk_bytes = 0
+        self.reader = None  # open file of the oldest segment
+        self.writer = None  # open file of the newest segment
+        self.next_segment = 0
+        self.dropped = 0  # packages
+        self.dropped_lines = 0
+        self.condition = threading.Condition()
+        if directory:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.recover()
+
+    def __len__(self):
+        return len(self.memory) + self.disk_items
+
+    def depth(self):
+        """
+        :return: packages held in memory and on disk, bytes on disk, and packages and lines dropped
+         :rtype: dict[str, int]
+        """
+        with self.condition:
+            return {
+                'memory': len(self.memory),
+                'disk': self.disk_items,
+                'disk_bytes': self.disk_bytes,
+                'dropped': self.dropped,
+                'dropped_lines': self.dropped_lines,
+            }
+
+    def put(self, data, line_count):
+        """
+        :param data: an encoded package
+         :type data: str
+        :param line_count: number of lines in the package
+         :type line_count: int
+        :return: False if the package was dropped
+         :rtype: bool
+        """
+        with self.condition:
+            if not self.segments and len(self.memory) < self.memory_items:
+                self.memory.append((data, line_count))
+            elif not self.directory:
+                if self.policy == DROP_NEWEST or not self.memory:
+                    self.drop(1, line_count)
+                    return False
+                self.drop(1, self.memory.popleft()[1])
+                self.memory.append((data, line_count))
+            elif not self.spill(data, line_count):
+                return False
+            self.condition.notify()
+            return True
+
+    def unget(self, data, line_count):
+        """
+        Return a package taken with get to the front of the queue.
+        """
+        with self.condition:
+            self.memory.appendleft((data, line_count))
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        :param timeout: seconds to wait for a package
+         :type timeout: float or None
+        :return: the oldest package and its line count
+         :rtype: tuple[str, int]
+        :raises Queue.Empty: if nothing was queued within the timeout
+        """
+        with self.condition:
+            if not len(self):
+                self.condition.wait(timeout)
+            while len(self):
+                if self.memory:
+                    return self.memory.popleft()
+                package = self.read()
+                if package is not None:
+                    return package
+            raise Queue.Empty()
+
+    def close(self):
+        """
+        Write packages still held in memory to disk, if there is a directory, and close the segment files.
+        """
+        with self.condition:
+            if self.directory:
+                while self.memory:
+                    self.spill(*self.memory.popleft())
+            if self.reader:
+                self.reader.close()
+                self.reader = None
+            if self.writer:
+                self.writer.close()
+                self.writer = None
+
+    def drop(self, packages, lines):
+        self.dropped += packages
+        self.dropped_lines += lines
+
+    def spill(self, data, line_count):
+        size = RECORD.size + len(data)
+        if self.policy == DROP_OLDEST:
+            while self.segments and self.disk_bytes + size > self.max_disk:
+                segment = self.segments[0]
+                logger.warning("SpillQueue: disk budget exceeded; dropping {0} packages in {1}".format(
+                    segment.items, segment.path))
+                # line counts of unread records aren't known without reading them
+                self.drop(segment.items, 0)
+                self.remove_oldest()
+        if self.disk_bytes + size > self.max_disk:
+            self.drop(1, line_count)
+            return False
+
+        if self.writer is None or self.segments[-1].size >= self.segment_size:
+            self.start_segment()
+        self.writer.write(RECORD.pack(len(data), line_count))
+        self.writer.write(data)
+        self.writer.flush()
+        segment = self.segments[-1]
+        segment.items += 1
+        segment.size += size
+        self.disk_items += 1
+        self.disk_bytes += size
+        return True
+
+    def start_segment(self):
+        if self.writer is not None:
+            self.writer.close()
+        path = os.path.join(self.directory, '{0:012d}{1}'.format(self.next_segment, SUFFIX))
+        self.next_segment += 1
+        self.writer = open(path, 'ab')
+        self.segments.append(Segment(path))
+
+    def remove_oldest(self):
+        segment = self.segments.popleft()
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        if not self.segments and self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.disk_items -= segment.items
+        self.disk_bytes -= segment.size
+        try:
+            os.remove(segment.path)
+        except OSError:
+            logger.exception("SpillQueue: could not remove {0}".format(segment.path))
+
+    def read(self):
+        segment = self.segments[0]
+        if self.reader is None:
+            self.reader = open(segment.path, 'rb')
+        header = self.reader.read(RECORD.size)
+        package = None
+        if len(header) == RECORD.size:
+            length, line_count = RECORD.unpack(header)
+            data = self.reader.read(length)
+            if len(data) == length:
+                package = (data, line_count)
+        if package is None:
+            logger.error("SpillQueue: {0} is truncated; dropping its last {1} packages".format(
+                segment.path, segment.items))
+            self.drop(segment.items, 0)
+            self.remove_oldest()
+            return None
+        segment.items -= 1
+        self.disk_items -= 1
+        if segment.items == 0:
+            self.remove_oldest()
+        return package
+
+    def recover(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(SUFFIX))
+        for name in names:
+            path = os.path.join(self.directory, name)
+            items, size = self.scan(path)
+            if items:
+                self.segments.append(Segment(path, items, size))
+                self.disk_items += items
+                self.disk_bytes += size
+            else:
+                os.remove(path)
+            try:
+                self.next_segment = max(self.next_segment, int(name[:-len(SUFFIX)]) + 1)
+            except ValueError:
+                pass
+        if self.disk_items:
+            logger.info("SpillQueue: replaying {0} packages from {1}".format(self.disk_items, self.directory))
+
+    @staticmethod
+    def scan(path):
+        """
+        Count the complete records in a segment file, cutting off any partial record at the end.
+
+        :return: number of records and size of the file
+         :rtype: tuple[int, int]
+        """
+        items = 0
+        offset = 0
+        with open(path, 'r+b') as f:
+            while True:
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                length = RECORD.unpack(header)[0]
+                if len(f.read(length)) < length:
+                    break
+                items += 1
+                offset += RECORD.size + length
+            f.truncate(offset)
+        return items, offset
@@ -11,6 +11,7 @@ CREATE TABLE If NOT EXISTS s{acct}_ds{id}_Syslog
 ,packets_sent      INT NOT NULL
 ,packets_received  INT
 ,duration          INT NOT NULL
+,links             INT DEFAULT 1 NOT NULL  -- number of log lines merged into this row
 );
 
 -- -----------------------
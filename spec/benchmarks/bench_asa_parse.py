@@ -0,0 +1,153 @@
+"""
+Benchmark: parsing ASA syslog lines.
+
+Generates a synthetic ASA log and measures lines/sec and reject rate for
+the importer's former regex-per-line parser (a message id regex, then one regex
+per teardown type), kept here as the baseline, and the tiered path used by
+ASASyslogImporter.translate_batch.
+Nothing is written to the database.
+
+Usage:
+    python -m spec.benchmarks.bench_asa_parse [lines]
+"""
+import re
+import sys
+import time
+import random
+from sam.importers.import_base import ColumnBatch
+from sam.importers.import_asasyslog import ASASyslogImporter
+
+TEMPLATES = [
+    # (weight, template)
+    (30, "<166>%ASA-6-302013: Built outbound TCP connection {conn} for outside:{ip1}/{port1} ({ip1}/{port1}) to inside:{ip2}/{port2} ({ip2}/{port2})"),
+    (25, "<166>%ASA-6-302014: Teardown TCP connection {conn} for outside:{ip1}/{port1} to inside:{ip2}/{port2} duration {duration} bytes {bytes} TCP FINs"),
+    (15, "<166>%ASA-6-302015: Built outbound UDP connection {conn} for outside:{ip1}/{port1} ({ip1}/{port1}) to inside:{ip2}/{port2} ({ip2}/{port2})"),
+    (12, "<166>%ASA-6-302016: Teardown UDP connection {conn} for outside:{ip1}/{port1} to inside:{ip2}/{port2} duration {duration} bytes {bytes}"),
+    (2, "<166>%ASA-6-302018: Teardown GRE connection {conn} from inside:{ip1}/{port1} ({ip1}/{port1}) to inside:{ip2}/{port2} ({ip2}/{port2}) duration {duration} bytes {bytes}"),
+    (4, "<166>%ASA-6-302021: Teardown ICMP connection for faddr {ip1}/0 gaddr {ip2}/{port2} laddr {ip2}/{port1}"),
+    (6, "<166>%ASA-6-106015: Deny TCP (no connection) from {ip1}/{port1} to {ip2}/{port2} flags FIN ACK  on interface inside"),
+    (4, "<166>%ASA-4-106023: Deny tcp src outside:{ip1}/{port1} dst inside:{ip2}/{port2} by access-group \"outside_in\""),
+    (1, "<166>%ASA-6-302014: Teardown TCP connection {conn} for outside:{ip1} truncated"),
+    (1, "nonsensical entry {conn}"),
+]
+
+
+def random_ip():
+    return "{0}.{1}.{2}.{3}".format(random.randint(1, 223), random.randint(0, 255),
+                                    random.randint(0, 255), random.randint(1, 254))
+
+
+def make_corpus(count):
+    choices = []
+    for weight, template in TEMPLATES:
+        choices.extend([template] * weight)
+    lines = []
+    for i in xrange(count):
+        lines.append(random.choice(choices).format(
+            conn=i,
+            ip1=random_ip(),
+            ip2=random_ip(),
+            port1=random.choice([22, 53, 80, 123, 443]),
+            port2=random.randint(1024, 65535),
+            duration="0:{0:02d}:{1:02d}".format(random.randint(0, 10), random.randint(0, 59)),
+            bytes=random.randint(0, 1000000)))
+    return lines
+
+
+# the former per-line parser
+message_regex = re.compile(r"^[<>:%\w\-]+-(\d+):\s+(.+)$")
+tcp_regex = re.compile(r"^Teardown TCP connection (?P<connection>\d+) for (?P<dst_interface>\w+)\s*:(?P<dst>[\d\.]+)\s*\/(?P<dstport>\d+) (?:\(\w+\)\s)?to (?P<src_interface>\w+)\s*:(?P<src>[\d\.]+)\s*\/(?P<srcport>\d+) (?:\(\w+\)\s)?duration (?P<duration>[\d:\s]+) bytes (?P<bytes>\d+).*$")
+udp_regex = re.compile(r"^Teardown UDP connection (?P<connection>\d+) for (?P<dst_interface>\w+)\s*:(?P<dst>[\d\.]+)\s*\/(?P<dstport>\d+) (?:\(\w+\)\s)?to (?P<src_interface>\w+)\s*:(?P<src>[\d\.]+)\s*\/(?P<srcport>\d+) (?:\(\w+\)\s)?duration (?P<duration>[\d:\s]+) bytes (?P<bytes>\d+).*$")
+icmp_regex = re.compile(r"^Teardown ICMP connection for faddr (?P<faddr>[\d.]+)\s*\/(?P<faddrport>\d+) (?P<idw_user1>\(\w+\)\s)?gaddr (?P<gaddr>[\d.]+)\s*\/(?P<gaddrport>\d+) laddr (?P<laddr>[\d.]+)\s*\/(?P<laddrport>\d+)(?P<idw_user2>\s?\(\w+\)\s)?.*$")
+gre_regex = re.compile(r"^Teardown GRE connection (?P<connection>\d+) from (?P<src_iface>\w+):(?P<src>[\d.]+)\s*\/(?P<srcport>\d+) \([\d./]*\) (?P<idw_user1>\(\w+\)\s)?to (?P<dst_iface>\w+):(?P<dst>[\d.]+)\s*\/(?P<dstport>\d+) \([\d./]*\) (?P<idw_user2>\(\w+\)\s)?duration (?P<duration>[\d:\s]+) bytes (?P<bytes>\d+).*$")
+
+
+def get_message_id(line):
+    match = message_regex.match(line)
+    if match:
+        return int(match.group(1)), match.group(2)
+    return None, line
+
+
+def decode_connection(importer, regex, protocol, msg):
+    # TCP, UDP and GRE teardowns
+    match = regex.match(msg)
+    if not match:
+        return None
+    regexed = match.groupdict()
+    return {
+        'dst': regexed['dst'],
+        'dstport': regexed['dstport'],
+        'src': regexed['src'],
+        'srcport': regexed['srcport'],
+        'bytes_received': regexed['bytes'],
+        'duration': importer.timestring_to_seconds(regexed['duration']),
+        'protocol': protocol,
+    }
+
+
+def decode_icmp(importer, msg):
+    match = icmp_regex.match(msg)
+    if not match:
+        return None
+    regexed = match.groupdict()
+    return {
+        'dst': regexed['faddr'],
+        'dstport': regexed['faddrport'],
+        'src': regexed['laddr'],
+        'srcport': regexed['laddrport'],
+        'bytes_received': '1',
+        'duration': 1,
+        'protocol': 'ICMP',
+    }
+
+
+DECODERS = {
+    302014: lambda importer, msg: decode_connection(importer, tcp_regex, 'TCP', msg),
+    302016: lambda importer, msg: decode_connection(importer, udp_regex, 'UDP', msg),
+    302018: lambda importer, msg: decode_connection(importer, gre_regex, 'GRE', msg),
+    302021: decode_icmp,
+}
+
+
+def regex_path(importer, lines):
+    """The former per-line regex parser: message_regex followed by a regex per teardown type."""
+    batch = ColumnBatch()
+    now = int(time.time())
+    for line in lines:
+        message_id, message = get_message_id(line)
+        decoder = DECODERS.get(message_id)
+        if decoder is None:
+            continue
+        decoded = decoder(importer, message)
+        if decoded is None:
+            continue
+        batch.append(importer.ip_to_int(*(decoded['src'].split("."))), int(decoded['srcport']),
+                     importer.ip_to_int(*(decoded['dst'].split("."))), int(decoded['dstport']),
+                     now, decoded['protocol'], 0, int(decoded['bytes_received']), 0, 1,
+                     int(decoded['duration']))
+    return batch
+
+
+def tiered_path(importer, lines):
+    return importer.translate_batch(lines)
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 1000000
+    lines = make_corpus(count)
+    print("Parsing {0} synthetic ASA lines".format(count))
+    batch_size = 1000
+    for label, method in (('regex per line', regex_path), ('tiered', tiered_path)):
+        importer = ASASyslogImporter()
+        rows = 0
+        t_start = time.time()
+        for i in xrange(0, count, batch_size):
+            rows += len(method(importer, lines[i:i + batch_size]))
+        elapsed = time.time() - t_start
+        print("{0:<16}{1:>9.3f}s{2:>12.0f} lines/s   {3} rows, reject rate {4:.1%}".format(
+            label, elapsed, count / elapsed, rows, 1 - float(rows) / count))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,49 @@
+"""
+Benchmark: collector translation stage.
+
+Fills the collector's SOCKET_BUFFER with tcpdump lines and times import_packets until
+every line is in the transmit buffer, translating on the batch processor thread (1 worker) and
+with a pool of translator processes. Gains depend on the number of cores.
+
+Usage:
+    python -m spec.benchmarks.bench_collector_translate [lines] [workers]
+"""
+import sys
+import time
+import multiprocessing
+from sam import server_collector
+from sam.importers.import_tcpdump import TCPDumpImporter
+
+LINE = ("{0}.268015 IP 192.168.10.{1}.{2} > 172.217.3.196.443: Flags [P.], seq 256:730, ack 116, win 3818, "
+        "options [nop,nop,TS val 71847613 ecr 4161606244], length 474")
+
+
+def measure(lines, workers):
+    collector = server_collector.Collector()
+    collector.importer = TCPDumpImporter()
+    collector.start_translators(workers)
+    buffer = server_collector.SOCKET_BUFFER
+    buffer.pop_all()
+    t_start = time.time()
+    for i in xrange(0, len(lines), buffer.DRAIN_SIZE):
+        buffer.store_batch(lines[i:i + buffer.DRAIN_SIZE])
+        collector.import_packets()
+    collector.stop_translators()
+    elapsed = time.time() - t_start
+    assert collector.transmit_buffer_size == len(lines)
+    return elapsed
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 200000
+    most = int(argv[2]) if len(argv) > 2 else multiprocessing.cpu_count()
+    lines = [LINE.format(1491525948 + i // 100, i % 250, 1024 + i % 60000) for i in xrange(count)]
+    workers = 1
+    while workers <= most:
+        elapsed = measure(lines, workers)
+        print("{0:>3} workers {1:>12.0f} lines/s".format(workers, count / elapsed))
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main(sys.argv)
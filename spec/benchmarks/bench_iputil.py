@@ -0,0 +1,74 @@
+"""
+Benchmark: IPv4 address conversion.
+
+Measures addresses/sec for the string parsing and formatting helpers that existed before sam.iputil
+(common.IPtoInt on split segments, common.IPtoString) against the sam.iputil scalar and batch versions.
+Addresses are random, so the cached decoder is measured on a column that repeats a small set of hosts,
+as decodeIP sees when the same nodes are queried over and over.
+
+Usage:
+    python -m spec.benchmarks.bench_iputil [addresses]
+"""
+import sys
+import time
+import random
+from sam import iputil
+
+
+def old_encode(ip):
+    a, b, c, d = ip.split(".")
+    return (int(a) << 24) + (int(b) << 16) + (int(c) << 8) + int(d)
+
+
+def old_decode(ip_number):
+    return "{0}.{1}.{2}.{3}".format(
+        (ip_number & 0xFF000000) >> 24,
+        (ip_number & 0xFF0000) >> 16,
+        (ip_number & 0xFF00) >> 8,
+        ip_number & 0xFF)
+
+
+def timed(function, values):
+    t_start = time.time()
+    result = function(values)
+    return result, time.time() - t_start
+
+
+def report(label, count, before, after):
+    print("{0:<20}{1:>12.0f} /s{2:>12.0f} /s{3:>+9.0%}".format(
+        label, count / before, count / after, before / after - 1))
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 500000
+    nums = [random.randint(0, 2**32 - 1) for _ in xrange(count)]
+    ips = map(old_decode, nums)
+    hosts = random.sample(nums, 1000)
+    repeated = [random.choice(hosts) for _ in xrange(count)]
+
+    print("{0:<20}{1:>15}{2:>15}{3:>10}".format('conversion', 'old', 'iputil', 'change'))
+
+    expected, before = timed(lambda v: map(old_encode, v), ips)
+    result, after = timed(lambda v: map(iputil.encode, v), ips)
+    assert result == expected
+    report('encode', count, before, after)
+    result, after = timed(iputil.encode_many, ips)
+    assert list(result) == expected
+    report('encode_many', count, before, after)
+
+    expected, before = timed(lambda v: map(old_decode, v), nums)
+    result, after = timed(lambda v: map(iputil.decode, v), nums)
+    assert result == expected
+    report('decode', count, before, after)
+    result, after = timed(iputil.decode_many, nums)
+    assert result == expected
+    report('decode_many', count, before, after)
+
+    expected, before = timed(lambda v: map(old_decode, v), repeated)
+    result, after = timed(lambda v: map(iputil.make_cached_decoder(), v), repeated)
+    assert result == expected
+    report('cached decode', count, before, after)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
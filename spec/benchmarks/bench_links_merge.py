@@ -0,0 +1,116 @@
+"""
+Benchmark: merging staged links into a large Links table.
+
+Compares the old merge (REPLACE INTO Links, reading existing rows through a LEFT JOIN)
+with the upsert (INSERT ... ON DUPLICATE KEY UPDATE on mysql, INSERT ... ON CONFLICT DO UPDATE
+on sqlite). Each staged batch holds half links already in Links and half new ones.
+Reports the time to merge one batch at each size of Links.
+
+Usage:
+    python -m spec.benchmarks.bench_links_merge [batch] [existing ...]
+
+existing defaults to 1000000 10000000; filling Links to 10M rows takes several minutes.
+sqlite is always measured, using a temporary database file.
+mysql is measured too when the configured database (sam/default.cfg or SAM__DATABASE__* variables) is mysql.
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import sam.constants
+import sam.common
+from sam.importers.bulk_load import SyslogLoader
+from sam.preprocess import Preprocessor
+
+SUB = 'bench'
+DS = 0
+ROUNDS = 3  # batches merged by each method, at each size
+FILL_CHUNK = 100000
+COLUMNS = ['src', 'dst', 'port', 'protocol', 'timestamp', 'links', 'bytes_sent', 'bytes_received', 'packets_sent',
+           'packets_received', 'duration']
+
+
+def make_link(processor, start, i):
+    """
+    The i-th link. Every i gives a different key.
+    """
+    return ((10 << 24) + i // 4096, (50 << 24) + i % 4096, 80, 'TCP', processor.link_timestamp(start + 300 * (i % 12)),
+            random.randint(1, 20), random.randint(0, 100000), random.randint(0, 100000), random.randint(1, 100),
+            random.randint(1, 100), random.randint(0, 600))
+
+
+def create_tables(db):
+    drop = sam.common.parse_sql_file(os.path.join(sam.constants.base_path, 'sql/drop_datasource.sql'),
+                                     {'acct': SUB, 'id': DS})
+    for command in drop:
+        db.query(command)
+    path = os.path.join(sam.constants.base_path, 'sql/setup_datasource_{0}.sql'.format(db.dbname))
+    for command in sam.common.parse_sql_file(path, {'acct': SUB, 'id': DS}):
+        db.query(command)
+
+
+def fill(processor, start, first, last):
+    loader = SyslogLoader(processor.db, processor.tables['table_links'], COLUMNS)
+    for i in xrange(first, last, FILL_CHUNK):
+        loader.load([make_link(processor, start, j) for j in xrange(i, min(i + FILL_CHUNK, last))])
+
+
+def merge_batch(processor, method, start, existing, new_start, batch):
+    """
+    Stage half a batch of existing links and half a batch of new ones, and time merging them.
+
+    :return: seconds taken to merge
+    :rtype: float
+    """
+    links = [make_link(processor, start, i) for i in random.sample(xrange(existing), batch // 2)]
+    links.extend(make_link(processor, start, i) for i in xrange(new_start, new_start + batch - batch // 2))
+    SyslogLoader(processor.db, processor.tables['table_staging_links'], COLUMNS).load(links)
+    t_start = time.time()
+    method()
+    elapsed = time.time() - t_start
+    processor.staging_to_null()
+    return elapsed
+
+
+def measure(name, db, batch, sizes):
+    processor = Preprocessor(db, SUB, DS, security_rules=False)
+    methods = (('REPLACE INTO', processor.staging_links_to_links_replace), ('upsert', processor.staging_links_to_links))
+    start = int(time.time()) // 300 * 300
+    create_tables(db)
+    count = 0
+    for size in sizes:
+        fill(processor, start, count, size)
+        count = size
+        totals = [0.0, 0.0]
+        for _ in range(ROUNDS):
+            for i, (_, method) in enumerate(methods):
+                totals[i] += merge_batch(processor, method, start, size, count, batch)
+                count += batch - batch // 2
+        for (label, method), total in zip(methods, totals):
+            print("{0:<8}{1:>10} rows  {2:<14}{3:>10.1f}ms per batch".format(name, size, label,
+                                                                            total * 1000 / ROUNDS))
+        print("{0:<8}{1:>10} rows  speedup: {2:.1f}x".format(name, size, totals[0] / totals[1]))
+    create_tables(db)
+
+
+def main(argv):
+    batch = int(argv[1]) if len(argv) > 1 else 10000
+    sizes = sorted(int(arg) for arg in argv[2:]) or [1000000, 10000000]
+    print("Merging batches of {0} links into Links of {1} rows".format(batch, ', '.join(map(str, sizes))))
+
+    handle, path = tempfile.mkstemp(suffix='.db', prefix='sam_bench_')
+    os.close(handle)
+    try:
+        _, db = sam.common.get_db({'dbn': 'sqlite', 'db': path})
+        measure('sqlite', db, batch, sizes)
+    finally:
+        os.remove(path)
+
+    if sam.constants.dbconfig['dbn'] == 'mysql':
+        _, db = sam.common.get_db(sam.constants.dbconfig.copy())
+        measure('mysql', db, batch, sizes)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
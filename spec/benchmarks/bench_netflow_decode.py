@@ -0,0 +1,98 @@
+"""
+Benchmark: decoding NetFlow.
+
+Measures flows/sec for the native decoder reading a pcap recording of NetFlow v5, v9 and IPFIX
+export packets, and for the nfdump subprocess path reading the recorded nfcapd fixture
+(spec/python/importers/nfcapd_test), when nfdump is installed.
+Nothing is written to the database.
+
+Usage:
+    python -m spec.benchmarks.bench_netflow_decode [packets]
+"""
+import os
+import sys
+import time
+import shlex
+import random
+import tempfile
+import subprocess
+from sam.importers import pcap_reader
+from sam.importers.import_netflow import NetFlowImporter
+from spec.python.importers import netflow_fixtures as fixtures
+
+FLOWS_PER_PACKET = 24
+NFCAPD_FIXTURE = os.path.join(os.path.dirname(__file__), '..', 'python', 'importers', 'nfcapd_test')
+
+
+def random_flows(count):
+    flows = []
+    for _ in xrange(count):
+        first = random.randint(0, fixtures.UPTIME)
+        flows.append((random.randint(0, 2**32 - 1), random.randint(1024, 65535),
+                      random.randint(0, 2**32 - 1), random.choice([22, 53, 80, 443]),
+                      random.choice([6, 17]), random.randint(40, 10**6), random.randint(1, 1000),
+                      first, random.randint(first, fixtures.UPTIME)))
+    return flows
+
+
+def make_capture(path, count):
+    payloads = [fixtures.v9_packet([fixtures.v9_template_flowset()]),
+                fixtures.ipfix_packet([fixtures.ipfix_template_set()])]
+    for i in xrange(count):
+        flows = random_flows(FLOWS_PER_PACKET)
+        if i % 3 == 0:
+            payloads.append(fixtures.v5_packet(flows))
+        elif i % 3 == 1:
+            payloads.append(fixtures.v9_packet([fixtures.v9_data_flowset(flows)]))
+        else:
+            payloads.append(fixtures.ipfix_packet([fixtures.ipfix_data_set(flows)]))
+    fixtures.write_pcap(path, payloads)
+
+
+def native_path(path):
+    importer = NetFlowImporter()
+    rows = 0
+    packets = []
+    for src, srcport, payload in pcap_reader.udp_payloads(path):
+        packets.append(payload)
+        if len(packets) == 100:
+            rows += len(importer.translate_packets(packets))
+            packets = []
+    rows += len(importer.translate_packets(packets))
+    return rows
+
+
+def subprocess_path(path):
+    importer = NetFlowImporter()
+    args = shlex.split('nfdump -r {0} -b -o {1}'.format(path, NetFlowImporter.FORMAT))
+    proc = subprocess.Popen(args, bufsize=-1, stdout=subprocess.PIPE)
+    stdout, stderr = proc.communicate()
+    return len(importer.translate_batch(stdout.splitlines()[1:]))
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 20000
+    handle, path = tempfile.mkstemp(suffix='.pcap', prefix='sam_bench_')
+    os.close(handle)
+    try:
+        make_capture(path, count)
+        t_start = time.time()
+        rows = native_path(path)
+        elapsed = time.time() - t_start
+        print("{0:<12}{1:>9} flows{2:>9.3f}s{3:>12.0f} flows/s".format('native', rows, elapsed, rows / elapsed))
+    finally:
+        os.remove(path)
+
+    try:
+        rows = 0
+        t_start = time.time()
+        while time.time() - t_start < 5:
+            rows += subprocess_path(NFCAPD_FIXTURE)
+        elapsed = time.time() - t_start
+        print("{0:<12}{1:>9} flows{2:>9.3f}s{3:>12.0f} flows/s".format('nfdump', rows, elapsed, rows / elapsed))
+    except OSError:
+        print("nfdump       not installed; subprocess path not measured")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
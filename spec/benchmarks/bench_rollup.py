@@ -0,0 +1,490 @@
+"""
+Benchmark: preprocessing Links into LinksIn and LinksOut.
+
+Compares the preprocessor's former queries (links_to_links_in and links_to_links_out
+below: a scan of Links per prefix level and divergence case) with the rollup
+(Preprocessor.rollup_links_in_out: one grouping query per table, pairing each link
+with every prefix level).
+Links holds earlier windows too, as it does in use, and only the newest window is preprocessed.
+Reports the time to preprocess each 100k links in the window.
+
+Usage:
+    python -m spec.benchmarks.bench_rollup [links] [windows] [hosts]
+
+sqlite is always measured, using a temporary database file.
+mysql is measured too when the configured database (sam/default.cfg or SAM__DATABASE__* variables) is mysql.
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import sam.constants
+import sam.common
+from sam.preprocess import Preprocessor
+
+SUB = 'bench'
+DS = 0
+BUCKETS = 12  # 5-minute buckets in each window
+
+
+def make_links(count, hosts, start):
+    """
+    Random links between a pool of hosts, as importers.flow_aggregator.LinkAccumulator collects them.
+    """
+    random.seed(hosts)
+    pool = [random.randint(1, 16) << 24 | random.randint(0, 2**24 - 1) for _ in xrange(hosts)]
+    random.seed()
+    links = {}
+    while len(links) < count:
+        key = (random.choice(pool), random.choice(pool), random.choice([22, 53, 80, 443, 3306]),
+               random.choice(['TCP', 'UDP']), start + 300 * random.randint(0, BUCKETS - 1))
+        links[key] = (random.randint(1, 20), random.randint(0, 100000), random.randint(0, 100000),
+                      random.randint(1, 100), random.randint(1, 100), random.randint(0, 600))
+    return links
+
+
+def create_tables(db):
+    drop = sam.common.parse_sql_file(os.path.join(sam.constants.base_path, 'sql/drop_datasource.sql'),
+                                     {'acct': SUB, 'id': DS})
+    for command in drop:
+        db.query(command)
+    db.query("DROP TABLE IF EXISTS s{0}_Nodes".format(SUB))
+    path = os.path.join(sam.constants.base_path, 'sql/setup_subscription_tables_{0}.sql'.format(db.dbname))
+    db.query(sam.common.parse_sql_file(path, {'acct': SUB})[0])  # the Nodes table is the first statement
+    path = os.path.join(sam.constants.base_path, 'sql/setup_datasource_{0}.sql'.format(db.dbname))
+    for command in sam.common.parse_sql_file(path, {'acct': SUB, 'id': DS}):
+        db.query(command)
+
+
+def fill(db, windows):
+    """
+    Load each window of links into StagingLinks and on into Links.
+
+    :return: a preprocessor, with the newest window left in StagingLinks
+    :rtype: Preprocessor
+    """
+    processor = Preprocessor(db, SUB, DS, security_rules=False)
+    ips = set()
+    for links in windows:
+        for src, dst, port, protocol, bucket in links:
+            ips.add(src)
+            ips.add(dst)
+    # LinksIn and LinksOut refer to the nodes on mysql
+    processor.ips_to_nodes(ips)
+    for links in windows:
+        db.query("DELETE FROM {table_staging_links}".format(**processor.tables))
+        processor.links_to_staging_links({key: list(counts) for key, counts in links.iteritems()})
+        db.query("INSERT INTO {table_links} SELECT * FROM {table_staging_links}".format(**processor.tables))
+    return processor
+
+
+def links_to_links_in(processor, timestart, timestop):
+    time_vars = {
+        "start": timestart,
+        "stop": timestop
+    }
+
+    # /8 links
+    query = """
+        INSERT INTO {table_links_in} (src_start, src_end, dst_start, dst_end, protocols, port, timestamp, links, bytes, packets)
+        SELECT src {div} 16777216 * 16777216 AS 'src_start'
+            , src {div} 16777216 * 16777216 + 16777215 AS 'src_end'
+            , dst {div} 16777216 * 16777216 AS 'dst_start'
+            , dst {div} 16777216 * 16777216 + 16777215 AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp;
+    """.format(div=processor.divop, **processor.tables)
+    processor.db.query(query, vars=time_vars)
+
+    # /16 links
+    query = """
+        INSERT INTO {table_links_in} (src_start, src_end, dst_start, dst_end, protocols, port, timestamp, links, bytes, packets)
+        SELECT src {div} 65536 * 65536 AS 'src_start'
+            , src {div} 65536 * 65536 + 65535 AS 'src_end'
+            , dst {div} 65536 * 65536 AS 'dst_start'
+            , dst {div} 65536 * 65536 + 65535 AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE (src {div} 16777216) = (dst {div} 16777216)
+          AND timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
+        UNION
+        SELECT src {div} 16777216 * 16777216 AS 'src_start'
+            , src {div} 16777216 * 16777216 + 16777215 AS 'src_end'
+            , dst {div} 65536 * 65536 AS 'dst_start'
+            , dst {div} 65536 * 65536 + 65535 AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE (src {div} 16777216) != (dst {div} 16777216)
+          AND timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp;
+    """.format(div=processor.divop, **processor.tables)
+    processor.db.query(query, vars=time_vars)
+
+    # /24 links
+    query = """
+        INSERT INTO {table_links_in} (src_start, src_end, dst_start, dst_end, protocols, port, timestamp, links, bytes, packets)
+        SELECT src {div} 256 * 256 AS 'src_start'
+            , src {div} 256 * 256 + 255 AS 'src_end'
+            , dst {div} 256 * 256 AS 'dst_start'
+            , dst {div} 256 * 256 + 255 AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE (src {div} 65536) = (dst {div} 65536)
+          AND timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
+        UNION
+        SELECT src {div} 65536 * 65536 AS 'src_start'
+            , src {div} 65536 * 65536 + 65535 AS 'src_end'
+            , dst {div} 256 * 256 AS 'dst_start'
+            , dst {div} 256 * 256 + 255 AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE (src {div} 16777216) = (dst {div} 16777216)
+          AND (src {div} 65536) != (dst {div} 65536)
+          AND timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
+        UNION
+        SELECT src {div} 16777216 * 16777216 AS 'src_start'
+            , src {div} 16777216 * 16777216 + 16777215 AS 'src_end'
+            , dst {div} 256 * 256 AS 'dst_start'
+            , dst {div} 256 * 256 + 255 AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE (src {div} 16777216) != (dst {div} 16777216)
+          AND timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp;
+    """.format(div=processor.divop, **processor.tables)
+    processor.db.query(query, vars=time_vars)
+
+    # /32 links
+    query = """
+        INSERT INTO {table_links_in} (src_start, src_end, dst_start, dst_end, protocols, port, timestamp, links, bytes, packets)
+        SELECT src AS 'src_start'
+            , src AS 'src_end'
+            , dst AS 'dst_start'
+            , dst AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE (src {div} 256) = (dst {div} 256)
+          AND timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
+        UNION
+        SELECT src {div} 256 * 256 AS 'src_start'
+            , src {div} 256 * 256 + 255 AS 'src_end'
+            , dst AS 'dst_start'
+            , dst AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE (src {div} 65536) = (dst {div} 65536)
+          AND (src {div} 256) != (dst {div} 256)
+          AND timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
+        UNION
+        SELECT src {div} 65536 * 65536 AS 'src_start'
+            , src {div} 65536 * 65536 + 65535 AS 'src_end'
+            , dst AS 'dst_start'
+            , dst AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE (src {div} 16777216) = (dst {div} 16777216)
+          AND (src {div} 65536) != (dst {div} 65536)
+          AND timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
+        UNION
+        SELECT src {div} 16777216 * 16777216 AS 'src_start'
+            , src {div} 16777216 * 16777216 + 16777215 AS 'src_end'
+            , dst AS 'dst_start'
+            , dst AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE (src {div} 16777216) != (dst {div} 16777216)
+          AND timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp;
+    """.format(div=processor.divop, **processor.tables)
+    processor.db.query(query, vars=time_vars)
+
+def links_to_links_out(processor, timestart, timestop):
+    time_vars = {
+        "start": timestart,
+        "stop": timestop
+    }
+    # /8 links
+    query = """
+        INSERT INTO {table_links_out} (src_start, src_end, dst_start, dst_end, protocols, port, timestamp, links, bytes, packets)
+        SELECT src {div} 16777216 * 16777216 AS 'src_start'
+            , src {div} 16777216 * 16777216 + 16777215 AS 'src_end'
+            , dst {div} 16777216 * 16777216 AS 'dst_start'
+            , dst {div} 16777216 * 16777216 + 16777215 AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp;
+    """.format(div=processor.divop, **processor.tables)
+    processor.db.query(query, vars=time_vars)
+
+    # /16 links
+    query = """
+        INSERT INTO {table_links_out} (src_start, src_end, dst_start, dst_end, protocols, port, timestamp, links, bytes, packets)
+        SELECT src {div} 65536 * 65536 AS 'src_start'
+            , src {div} 65536 * 65536 + 65535 AS 'src_end'
+            , dst {div} 65536 * 65536 AS 'dst_start'
+            , dst {div} 65536 * 65536 + 65535 AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE (src {div} 16777216) = (dst {div} 16777216)
+          AND timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
+        UNION
+        SELECT src {div} 65536 * 65536 AS 'src_start'
+            , src {div} 65536 * 65536 + 65535 AS 'src_end'
+            , dst {div} 16777216 * 16777216 AS 'dst_start'
+            , dst {div} 16777216 * 16777216 + 16777215 AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE (src {div} 16777216) != (dst {div} 16777216)
+          AND timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp;
+    """.format(div=processor.divop, **processor.tables)
+    processor.db.query(query, vars=time_vars)
+
+    # /24 links
+    query = """
+        INSERT INTO {table_links_out} (src_start, src_end, dst_start, dst_end, protocols, port, timestamp, links, bytes, packets)
+        SELECT src {div} 256 * 256 AS 'src_start'
+            , src {div} 256 * 256 + 255 AS 'src_end'
+            , dst {div} 256 * 256 AS 'dst_start'
+            , dst {div} 256 * 256 + 255 AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE (src {div} 65536) = (dst {div} 65536)
+          AND timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
+        UNION
+        SELECT src {div} 256 * 256 AS 'src_start'
+            , src {div} 256 * 256 + 255 AS 'src_end'
+            , dst {div} 65536 * 65536 AS 'dst_start'
+            , dst {div} 65536 * 65536 + 65535 AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE (src {div} 16777216) = (dst {div} 16777216)
+          AND (src {div} 65536) != (dst {div} 65536)
+          AND timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
+        UNION
+        SELECT src {div} 256 * 256 AS 'src_start'
+            , src {div} 256 * 256 + 255 AS 'src_end'
+            , dst {div} 16777216 * 16777216 AS 'dst_start'
+            , dst {div} 16777216 * 16777216 + 16777215 AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE (src {div} 16777216) != (dst {div} 16777216)
+          AND timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp;
+    """.format(div=processor.divop, **processor.tables)
+    processor.db.query(query, vars=time_vars)
+
+    # /32 links
+    query = """
+        INSERT INTO {table_links_out} (src_start, src_end, dst_start, dst_end, protocols, port, timestamp, links, bytes, packets)
+        SELECT src AS 'src_start'
+            , src AS 'src_end'
+            , dst AS 'dst_start'
+            , dst AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE (src {div} 256) = (dst {div} 256)
+          AND timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
+        UNION
+        SELECT src AS 'src_start'
+            , src AS 'src_end'
+            , dst {div} 256 * 256 AS 'dst_start'
+            , dst {div} 256 * 256 + 255 AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE (src {div} 65536) = (dst {div} 65536)
+          AND (src {div} 256) != (dst {div} 256)
+          AND timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
+        UNION
+        SELECT src AS 'src_start'
+            , src AS 'src_end'
+            , dst {div} 65536 * 65536 AS 'dst_start'
+            , dst {div} 65536 * 65536 + 65535 AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE (src {div} 16777216) = (dst {div} 16777216)
+          AND (src {div} 65536) != (dst {div} 65536)
+          AND timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp
+        UNION
+        SELECT src AS 'src_start'
+            , src AS 'src_end'
+            , dst {div} 16777216 * 16777216 AS 'dst_start'
+            , dst {div} 16777216 * 16777216 + 16777215 AS 'dst_end'
+            , GROUP_CONCAT(DISTINCT protocol)
+            , port
+            , timestamp
+            , SUM(links)
+            , SUM(bytes_sent + COALESCE(bytes_received, 0))
+            , SUM(packets_sent + COALESCE(packets_received, 0))
+        FROM {table_links}
+        WHERE (src {div} 16777216) != (dst {div} 16777216)
+          AND timestamp BETWEEN $start AND $stop
+        GROUP BY src_start, src_end, dst_start, dst_end, port, timestamp;
+    """.format(div=processor.divop, **processor.tables)
+    processor.db.query(query, vars=time_vars)
+
+
+def old_path(processor, start, end):
+    links_to_links_in(processor, start, end)
+    links_to_links_out(processor, start, end)
+
+
+def rollup_path(processor, start, end):
+    processor.rollup_links_in_out(start, end)
+
+
+def measure(name, db, windows):
+    count = len(windows[-1])
+    results = []
+    for label, method in (('SQL per level', old_path), ('rollup', rollup_path)):
+        create_tables(db)
+        processor = fill(db, windows)
+        bounds = db.select(processor.tables['table_staging_links'],
+                           what="MIN(timestamp) AS 'start', MAX(timestamp) AS 'end'")
+        bounds = bounds.first()
+        t_start = time.time()
+        method(processor, bounds.start, bounds.end)
+        elapsed = time.time() - t_start
+        written = db.query("SELECT (SELECT COUNT(1) FROM {table_links_in}) + (SELECT COUNT(1) FROM {table_links_out})"
+                           " AS 'c'".format(**processor.tables)).first()['c']
+        results.append(elapsed)
+        print("{0:<8}{1:<16}{2:>10.3f}s{3:>10.3f}s per 100k links{4:>10} rows".format(
+            name, label, elapsed, elapsed * 100000 / count, written))
+    create_tables(db)
+    print("{0:<8}speedup: {1:.1f}x".format(name, results[0] / results[1]))
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100000
+    window_count = int(argv[2]) if len(argv) > 2 else 5
+    hosts = int(argv[3]) if len(argv) > 3 else 5000
+    newest = int(time.time()) // 300 * 300
+    windows = [make_links(count, hosts, newest - 300 * BUCKETS * i) for i in reversed(range(window_count))]
+    print("Preprocessing the newest of {0} windows of {1} links between {2} hosts".format(window_count, count, hosts))
+
+    handle, path = tempfile.mkstemp(suffix='.db', prefix='sam_bench_')
+    os.close(handle)
+    try:
+        _, db = sam.common.get_db({'dbn': 'sqlite', 'db': path})
+        measure('sqlite', db, windows)
+    finally:
+        os.remove(path)
+
+    if sam.constants.dbconfig['dbn'] == 'mysql':
+        _, db = sam.common.get_db(sam.constants.dbconfig.copy())
+        measure('mysql', db, windows)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,102 @@
+"""
+Benchmark: inserting translated rows into a Syslog table.
+
+Compares the old path (web.py multiple_insert of one dict per row)
+with the bulk loader (executemany on sqlite, LOAD DATA LOCAL INFILE on mysql).
+
+Usage:
+    python -m spec.benchmarks.bench_syslog_insert [rows] [batch_size]
+
+sqlite is always measured, using a temporary database file.
+mysql is measured too when the configured database (sam/default.cfg or SAM__DATABASE__* variables) is mysql.
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+from datetime import datetime
+import sam.constants
+import sam.common
+from sam.importers.import_base import BaseImporter
+from sam.importers.bulk_load import SyslogLoader
+
+TABLE = 'sbench_ds0_Syslog'
+
+
+def make_rows(count):
+    start = int(time.time())
+    rows = []
+    for i in xrange(count):
+        rows.append((
+            random.randint(0, 2**32 - 1),
+            random.randint(1024, 65535),
+            random.randint(0, 2**32 - 1),
+            random.choice([22, 53, 80, 443, 3306]),
+            datetime.fromtimestamp(start + i // 100),
+            random.choice(['TCP', 'UDP']),
+            random.randint(0, 100000),
+            random.randint(0, 100000),
+            random.randint(1, 100),
+            random.randint(1, 100),
+            random.randint(0, 600),
+        ))
+    return rows
+
+
+def create_table(db):
+    path = os.path.join(sam.constants.base_path, 'sql/setup_datasource_{0}.sql'.format(db.dbname))
+    commands = sam.common.parse_sql_file(path, {'acct': 'bench', 'id': 0})
+    db.query("DROP TABLE IF EXISTS {0}".format(TABLE))
+    db.query(commands[0])  # the Syslog table is the first statement
+
+
+def old_path(db, rows, batch_size):
+    keys = BaseImporter.keys
+    for i in xrange(0, len(rows), batch_size):
+        dicts = [dict(zip(keys, row)) for row in rows[i:i + batch_size]]
+        db.multiple_insert(TABLE, values=dicts)
+
+
+def bulk_path(db, rows, batch_size):
+    loader = SyslogLoader(db, TABLE, BaseImporter.keys)
+    for i in xrange(0, len(rows), batch_size):
+        loader.load(rows[i:i + batch_size])
+
+
+def measure(name, db, rows, batch_size):
+    results = []
+    for label, method in (('multiple_insert', old_path), ('bulk loader', bulk_path)):
+        create_table(db)
+        t_start = time.time()
+        method(db, rows, batch_size)
+        elapsed = time.time() - t_start
+        stored = db.query("SELECT COUNT(1) AS 'c' FROM {0}".format(TABLE)).first()['c']
+        assert stored == len(rows)
+        results.append(elapsed)
+        print("{0:<8}{1:<18}{2:>10.3f}s{3:>14.0f} rows/s".format(name, label, elapsed, len(rows) / elapsed))
+    db.query("DROP TABLE IF EXISTS {0}".format(TABLE))
+    print("{0:<8}speedup: {1:.1f}x".format(name, results[0] / results[1]))
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100000
+    batch_size = int(argv[2]) if len(argv) > 2 else 1000
+    rows = make_rows(count)
+    print("Inserting {0} rows in batches of {1}".format(count, batch_size))
+
+    handle, path = tempfile.mkstemp(suffix='.db', prefix='sam_bench_')
+    os.close(handle)
+    try:
+        _, db = sam.common.get_db({'dbn': 'sqlite', 'db': path})
+        measure('sqlite', db, rows, batch_size)
+    finally:
+        os.remove(path)
+
+    if sam.constants.dbconfig['dbn'] == 'mysql':
+        db = sam.common.get_infile_db(sam.constants.dbconfig)
+        measure('mysql', db, rows, batch_size)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
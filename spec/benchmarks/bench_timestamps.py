@@ -0,0 +1,107 @@
+"""
+Benchmark: timestamp handling during import.
+
+For each line-based importer, measures lines/sec for translate_batch followed by preparing the
+rows for insertion, two ways:
+  datetime:  every timestamp string is parsed (no cache) and rows carry datetime objects (ColumnBatch.rows)
+  epoch:     timestamp strings go through the importer's LRU parse cache and rows carry
+             epoch seconds until they are formatted for the database (ColumnBatch.sql_rows)
+Logs are synthetic, with LINES_PER_SECOND lines sharing each timestamp.
+Nothing is written to the database.
+
+Usage:
+    python -m spec.benchmarks.bench_timestamps [lines]
+"""
+import sys
+import time
+import random
+from sam.importers.timestamps import ParseCache
+from sam.importers.import_paloalto import PaloAltoImporter
+from sam.importers.import_netflow import NetFlowImporter
+from sam.importers.import_tshark import TSharkImporter
+from sam.importers.import_tcpdump import TCPDumpImporter
+from sam.importers.import_aws import AWSImporter
+from sam.importers.import_asasyslog import ASASyslogImporter
+
+LINES_PER_SECOND = 20
+START = 1504722134
+
+PALOALTO = ('{{"message":"1,{time},0009C100218,TRAFFIC,end,1,{time},{ip1},{ip2},0.0.0.0,0.0.0.0,Allow export to '
+            'Syslog,,,incomplete,vsys1,TAP-T0000R021,TAP-T0000R021,ethernet1/3,ethernet1/3,Copy Traffic Logs to '
+            'Syslog,{time},309703,1,{port2},{port1},0,0,0x19,tcp,allow,66,66,0,1,{time},5,any,0,945780,0x0,'
+            '8.0.0.0-8.255.255.255,US,0,1,0,aged-out,0,0,0,0,,Palo-Alto-Networks,from-policy"}}')
+NETFLOW = "TCP  ,{ip1:>16},{port2:>6},{ip2:>16},{port1:>6},{time}.960,     100,     200,       1,       2,    0.000"
+TSHARK = '1@{time}.635436385 PDT@{ip1}@{port2}@@{ip2}@{port1}@@TCP'
+TCPDUMP = "{epoch}.268015 IP {ip1}.{port2} > {ip2}.{port1}: Flags [P.], seq 256:730, ack 116, win 3818, length 474"
+AWS = "2 123456789010 eni-abc123de {ip1} {ip2} {port2} {port1} 6 20 4249 {epoch}.778341 1418530070 ACCEPT OK"
+ASA = ("<166>%ASA-6-302014: Teardown TCP connection 1 for outside:{ip1}/{port1} to inside:{ip2}/{port2} "
+       "duration 0:01:02 bytes 1234 TCP FINs")
+
+IMPORTERS = [
+    # (label, importer class, line template, strftime format of {time})
+    ('paloalto', PaloAltoImporter, PALOALTO, "%Y/%m/%d %H:%M:%S"),
+    ('netflow', NetFlowImporter, NETFLOW, "%Y-%m-%d %H:%M:%S"),
+    ('tshark', TSharkImporter, TSHARK, "%b %d, %Y %H:%M:%S"),
+    ('tcpdump', TCPDumpImporter, TCPDUMP, None),
+    ('aws', AWSImporter, AWS, None),
+    ('asasyslog', ASASyslogImporter, ASA, None),
+]
+
+
+def random_ip():
+    return "{0}.{1}.{2}.{3}".format(random.randint(1, 223), random.randint(0, 255),
+                                    random.randint(0, 255), random.randint(1, 254))
+
+
+def make_lines(template, fmt, count):
+    lines = []
+    for i in xrange(count):
+        epoch = START + i // LINES_PER_SECOND
+        lines.append(template.format(
+            epoch=epoch,
+            time=time.strftime(fmt, time.localtime(epoch)) if fmt else '',
+            ip1=random_ip(),
+            ip2=random_ip(),
+            port1=random.choice([22, 53, 80, 443]),
+            port2=random.randint(1024, 65535)))
+    return lines
+
+
+def run(importer, lines, epoch_rows, batch_size=1000):
+    t_start = time.time()
+    rows = 0
+    for i in xrange(0, len(lines), batch_size):
+        batch = importer.translate_batch(lines[i:i + batch_size])
+        if epoch_rows:
+            rows += len(batch.sql_rows())
+        else:
+            rows += len(batch.rows())
+    return rows, time.time() - t_start
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 200000
+    print("{0:<12}{1:>16}{2:>16}{3:>10}".format('importer', 'datetime', 'epoch', 'change'))
+    for label, importer_class, template, fmt in IMPORTERS:
+        lines = make_lines(template, fmt, count)
+
+        importer = importer_class()
+        parser = getattr(importer, 'parse_timestamp', None)
+        if parser is not None:
+            importer.parse_timestamp = ParseCache(parser.parse, maxsize=0)
+        rows_before, before = run(importer, lines, epoch_rows=False)
+
+        importer = importer_class()
+        if parser is not None:
+            importer.parse_timestamp = ParseCache(parser.parse)
+        rows_after, after = run(importer, lines, epoch_rows=True)
+
+        if rows_before != rows_after or rows_after == 0:
+            print("{0:<12} rows differ: {1} vs {2}".format(label, rows_before, rows_after))
+            continue
+        print("{0:<12}{1:>10.0f} l/s{2:>12.0f} l/s{3:>+9.0%}".format(
+            label, count / before, count / after, before / after - 1))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,84 @@
+"""
+Benchmark: collector UDP receive path.
+
+A separate process sends syslog-sized datagrams to localhost as fast as it can, and this process
+counts how many arrive in the collector's SOCKET_BUFFER, two ways:
+  handler:   SocketServer.UDPServer with a request handler per datagram (the collector's former path)
+  receiver:  UDPReceiver, batched non-blocking reads into the swap-on-drain SocketBuffer
+The rest were dropped by the kernel. Results depend heavily on the machine and net.core.rmem_max.
+
+Usage:
+    python -m spec.benchmarks.bench_udp_receive [datagrams]
+"""
+import sys
+import time
+import socket
+import threading
+import SocketServer
+import multiprocessing
+from sam import server_collector
+
+LINE = ("<14>Sep  6 11:53:24 fw 1,2017/09/06 11:53:24,0009C100218,TRAFFIC,end,1,2017/09/06 11:53:24,"
+        "10.20.30.40,50.60.70.80,0.0.0.0,0.0.0.0,Allow,,,incomplete,vsys1,TAP,TAP,ethernet1/3,ethernet1/3,"
+        "Copy,2017/09/06 11:53:24,309703,1,53438,443,0,0,0x19,tcp,allow,66,66,0,1,2017/09/06 11:53:24,5")
+
+
+class SocketListener(SocketServer.BaseRequestHandler):
+    # the collector's former receive path
+    def handle(self):
+        server_collector.SOCKET_BUFFER.store_data(self.request[0])
+
+
+def blast(address, count):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for _ in xrange(count):
+        sock.sendto(LINE, address)
+    sock.close()
+
+
+def measure(address, count):
+    buffer = server_collector.SOCKET_BUFFER
+    buffer.pop_all()
+    sender = multiprocessing.Process(target=blast, args=(address, count))
+    t_start = time.time()
+    sender.start()
+    sender.join()
+    received = 0
+    quiet_since = time.time()
+    # drain until nothing more has arrived for a moment
+    while time.time() - quiet_since < 0.3:
+        packets = len(buffer.pop_all())
+        received += packets
+        if packets:
+            quiet_since = time.time()
+        time.sleep(0.01)
+    return received, time.time() - t_start - 0.3
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 200000
+
+    server = SocketServer.UDPServer(('127.0.0.1', 0), SocketListener)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    handled, elapsed = measure(server.server_address, count)
+    server.shutdown()
+    server.server_close()
+    print("{0:<10}{1:>10} of {2} received ({3:.1%}){4:>12.0f} datagrams/s".format(
+        'handler', handled, count, handled / float(count), handled / elapsed))
+
+    receiver = server_collector.UDPReceiver(('127.0.0.1', 0), server_collector.SOCKET_BUFFER)
+    receiver.daemon = True
+    receiver.start()
+    received, elapsed = measure(receiver.address, count)
+    stats = receiver.stats()
+    receiver.shutdown()
+    receiver.join()
+    print("{0:<10}{1:>10} of {2} received ({3:.1%}){4:>12.0f} datagrams/s".format(
+        'receiver', received, count, received / float(count), received / elapsed))
+    print("receiver stats: {0}".format(stats))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,81 @@
+"""
+Benchmark: collector to aggregator wire formats.
+
+For a package of translated rows as the collector buffers them, measures bytes per row and
+encode/decode rows/sec for:
+  pickle:       cPickle.dumps of the package (the original format); decoding includes building
+                the row dictionaries DatabaseInserter.run_importer needs
+  binary:       wire_format.encode_rows without compression; decoding yields a ColumnBatch
+  binary+zlib:  the same, zlib-compressed (the collector's default)
+Rows are synthetic, with a few thousand hosts talking on a handful of ports.
+
+Usage:
+    python -m spec.benchmarks.bench_wire_format [rows]
+"""
+import sys
+import time
+import random
+import cPickle
+from datetime import datetime, timedelta
+from sam.importers import wire_format
+from sam.importers.import_base import BaseImporter
+
+START = datetime(2017, 9, 6, 11, 53, 24)
+
+
+def make_lines(count):
+    hosts = [random.randint(0, 2**32 - 1) for _ in xrange(5000)]
+    lines = []
+    for i in xrange(count):
+        lines.append([random.choice(hosts), random.randint(1024, 65535), random.choice(hosts),
+                      random.choice([22, 53, 80, 443]), START + timedelta(seconds=i // 20),
+                      random.choice(['TCP', 'UDP']), random.randint(0, 100000), random.randint(0, 100000),
+                      random.randint(1, 100), random.randint(1, 100), random.randint(1, 300)])
+    return lines
+
+
+def pickle_encode(lines):
+    return cPickle.dumps({'access_key': 'key', 'version': '1.0', 'headers': BaseImporter.keys, 'lines': lines})
+
+
+def pickle_decode(data):
+    package = cPickle.loads(data)
+    headers = package['headers']
+    return [{headers[i]: v for i, v in enumerate(row)} for row in package['lines']]
+
+
+def binary_encoder(compress):
+    def encode(lines):
+        return wire_format.encode_rows(lines, 'key', '1.0', compress=compress)
+    return encode
+
+
+def binary_decode(data):
+    return wire_format.decode(data)['batch']
+
+
+FORMATS = [
+    ('pickle', pickle_encode, pickle_decode),
+    ('binary', binary_encoder(False), binary_decode),
+    ('binary+zlib', binary_encoder(True), binary_decode),
+]
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100000
+    lines = make_lines(count)
+    print("{0:<14}{1:>12}{2:>18}{3:>18}".format('format', 'bytes/row', 'encode', 'decode'))
+    for label, encode, decode in FORMATS:
+        t_start = time.time()
+        data = encode(lines)
+        encoding = time.time() - t_start
+        t_start = time.time()
+        rows = decode(data)
+        decoding = time.time() - t_start
+        assert len(rows) == count
+        print("{0:<14}{1:>12.1f}{2:>14.0f} r/s{3:>14.0f} r/s".format(
+            label, len(data) / float(count), count / encoding, count / decoding))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
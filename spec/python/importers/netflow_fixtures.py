@@ -0,0 +1,81 @@
+"""
+Builders for NetFlow v5, v9 and IPFIX export packets, and pcap recordings of them.
+Used by the netflow decoder tests and benchmark.
+"""
+import struct
+
+# (src, srcport, dst, dstport, protocol, bytes, packets, first, last)
+# first/last are milliseconds of sysUpTime.
+FLOWS = [
+    (0xC0A80107, 54766, 0x173C489D, 443, 6, 12557, 20, 1000, 3500),
+    (0xC0A80108, 43047, 0xC713A724, 123, 17, 76, 1, 2000, 2000),
+    (0xC0A80107, 0, 0xC0A80101, 0, 1, 84, 1, 2500, 2600),
+    (0xAC153341, 8080, 0xAC1533EC, 38597, 6, 4292, 10, 0, 236000),
+]
+UNIX_SECS = 1504650000
+UPTIME = 300000
+V9_TEMPLATE_ID = 256
+V9_FIELDS = [(8, 4), (12, 4), (7, 2), (11, 2), (4, 1), (1, 4), (2, 4), (22, 4), (21, 4), (5, 1)]
+IPFIX_TEMPLATE_ID = 300
+IPFIX_FIELDS = [(8, 4), (12, 4), (7, 2), (11, 2), (4, 1), (1, 8), (2, 8), (152, 8), (153, 8)]
+
+
+def v5_packet(flows, unix_secs=UNIX_SECS, uptime=UPTIME):
+    header = struct.pack('!HHIIIIBBH', 5, len(flows), uptime, unix_secs, 0, 0, 0, 0, 0)
+    records = [struct.pack('!IIIHHIIIIHHxBBBHHBBxx', src, dst, 0, 0, 0, packets, octets, first, last,
+                           srcport, dstport, 0, protocol, 0, 0, 0, 0, 0)
+               for src, srcport, dst, dstport, protocol, octets, packets, first, last in flows]
+    return header + ''.join(records)
+
+
+def v9_template_flowset():
+    body = struct.pack('!HH', V9_TEMPLATE_ID, len(V9_FIELDS))
+    body += ''.join(struct.pack('!HH', *field) for field in V9_FIELDS)
+    return struct.pack('!HH', 0, len(body) + 4) + body
+
+
+def v9_data_flowset(flows):
+    records = ''.join(struct.pack('!IIHHBIIIIB', src, dst, srcport, dstport, protocol, octets, packets,
+                                  first, last, 0)
+                      for src, srcport, dst, dstport, protocol, octets, packets, first, last in flows)
+    padding = '\x00' * (-len(records) % 4)
+    return struct.pack('!HH', V9_TEMPLATE_ID, len(records) + len(padding) + 4) + records + padding
+
+
+def v9_packet(flowsets, source_id=1, unix_secs=UNIX_SECS, uptime=UPTIME):
+    return struct.pack('!HHIIII', 9, len(flowsets), uptime, unix_secs, 0, source_id) + ''.join(flowsets)
+
+
+def ipfix_template_set():
+    body = struct.pack('!HH', IPFIX_TEMPLATE_ID, len(IPFIX_FIELDS) + 1)
+    body += ''.join(struct.pack('!HH', *field) for field in IPFIX_FIELDS)
+    # an enterprise-specific field, which the decoder skips
+    body += struct.pack('!HHI', 0x8000 | 1, 4, 9)
+    return struct.pack('!HH', 2, len(body) + 4) + body
+
+
+def ipfix_data_set(flows, unix_secs=UNIX_SECS, uptime=UPTIME):
+    boot_ms = unix_secs * 1000 - uptime
+    records = ''.join(struct.pack('!IIHHBQQQQI', src, dst, srcport, dstport, protocol, octets, packets,
+                                  boot_ms + first, boot_ms + last, 0)
+                      for src, srcport, dst, dstport, protocol, octets, packets, first, last in flows)
+    return struct.pack('!HH', IPFIX_TEMPLATE_ID, len(records) + 4) + records
+
+
+def ipfix_packet(sets, domain_id=1, unix_secs=UNIX_SECS):
+    body = ''.join(sets)
+    return struct.pack('!HHIII', 10, len(body) + 16, unix_secs, 0, domain_id) + body
+
+
+def write_pcap(path, payloads, dstport=2055):
+    """
+    Record export packets as Ethernet/IPv4/UDP frames in a libpcap file.
+    """
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        for i, payload in enumerate(payloads):
+            udp = struct.pack('!HHHH', 9995, dstport, len(payload) + 8, 0) + payload
+            ip = struct.pack('!BBHHHBBHII', 0x45, 0, len(udp) + 20, i, 0, 64, 17, 0, 0x0A000001, 0x0A000002) + udp
+            frame = '\x00\x11\x22\x33\x44\x55' + '\x66\x77\x88\x99\xaa\xbb' + struct.pack('!H', 0x0800) + ip
+            f.write(struct.pack('<IIII', UNIX_SECS + i, 0, len(frame), len(frame)))
+            f.write(frame)
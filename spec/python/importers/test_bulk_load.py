@@ -0,0 +1,78 @@
+import pytest
+from datetime import datetime
+from spec.python import db_connection
+from sam.importers import bulk_load, import_base
+
+db = db_connection.db
+sub_id = db_connection.default_sub
+ds_id = db_connection.dsid_default
+table_name = "s{acct}_ds{ds}_Syslog".format(acct=sub_id, ds=ds_id)
+
+
+def test_tsv_value():
+    assert bulk_load.tsv_value(None) == '\\N'
+    assert bulk_load.tsv_value(12) == '12'
+    assert bulk_load.tsv_value(datetime(2017, 3, 23, 4, 5, 6)) == '2017-03-23 04:05:06'
+    assert bulk_load.tsv_value('TCP') == 'TCP'
+    assert bulk_load.tsv_value('a\tb\\c\nd') == 'a\\tb\\\\c\\nd'
+    assert bulk_load.tsv_value(u'caf\xe9\t') == 'caf\xc3\xa9\\t'
+
+
+def test_load():
+    db.query("DELETE FROM {}".format(table_name))
+    loader = bulk_load.SyslogLoader(db, table_name, import_base.BaseImporter.keys)
+    assert loader.use_infile is False
+    rows = [
+        (1, 2, 3, 4, datetime(2017, 3, 23, 4, 5, 6), 'TCP', 7, 8, 9, 10, 11),
+        (5, 6, 7, 8, datetime(2017, 3, 23, 4, 5, 7), 'UDP', 7, None, 9, None, 11),
+    ]
+    assert loader.load([]) == 0
+    assert loader.load(rows) == 2
+
+    stored = list(db.select(table_name, order="src"))
+    assert len(stored) == 2
+    assert stored[0]['dstport'] == 4
+    assert stored[0]['protocol'] == 'TCP'
+    assert stored[1]['src'] == 5
+    assert stored[1]['bytes_received'] is None
+    db.query("DELETE FROM {}".format(table_name))
+
+
+def test_load_infile_errors():
+    db.query("DELETE FROM {}".format(table_name))
+    loader = bulk_load.SyslogLoader(db, table_name, import_base.BaseImporter.keys)
+    rows = [(1, 2, 3, 4, datetime(2017, 3, 23, 4, 5, 6), 'TCP', 7, 8, 9, 10, 11)]
+    errors = []
+
+    def load_infile(rows):
+        raise errors.pop(0)
+    loader.load_infile = load_infile
+    loader.use_infile = True
+    try:
+        # a lock wait timeout belongs to this load only
+        errors.append(Exception(1205, "Lock wait timeout exceeded"))
+        with pytest.raises(Exception):
+            loader.load(rows)
+        assert loader.use_infile is True
+
+        # LOCAL INFILE disabled by the server: fall back to executemany from now on
+        errors.append(Exception(3948, "Loading local data is disabled"))
+        assert loader.load(rows) == 1
+        assert loader.use_infile is False
+        assert len(list(db.select(table_name))) == 1
+    finally:
+        db.query("DELETE FROM {}".format(table_name))
+
+
+def test_loader_cache():
+    bi = import_base.BaseImporter()
+    bi.set_subscription(sub_id)
+    bi.set_datasource_id(ds_id)
+    loader = bi.get_loader()
+    assert loader.table == table_name
+    assert bi.get_loader() is loader
+
+    bi.set_datasource_id(db_connection.dsid_short)
+    loader2 = bi.get_loader()
+    assert loader2 is not loader
+    assert loader2.table == "s{acct}_ds{ds}_Syslog".format(acct=sub_id, ds=db_connection.dsid_short)
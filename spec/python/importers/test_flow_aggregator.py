@@ -0,0 +1,123 @@
+from spec.python import db_connection
+from sam.importers import import_base, flow_aggregator
+from sam.importers.timestamps import format_epoch
+from sam.models.datasources import Datasources
+import sam.preprocess
+
+db = db_connection.db
+sub_id = db_connection.default_sub
+
+T0 = 1500000000  # on a 5-minute boundary
+
+# src, srcport, dst, dstport, timestamp, protocol, bytes_sent, bytes_received, packets_sent, packets_received, duration
+sample_rows = [
+    (1, 40000, 2, 80, T0 + 10, 'TCP', 100, 1000, 1, 2, 1),
+    (1, 40001, 2, 80, T0 + 5, 'TCP', 100, 2000, 1, 3, 3),
+    (1, 40002, 2, 80, T0 + 299, 'TCP', 100, 3000, 1, 4, 8),
+    (1, 40003, 2, 443, T0 + 20, 'TCP', 50, 50, 1, 1, 1),
+    (1, 40004, 2, 80, T0 + 20, 'UDP', 60, None, 1, None, 1),
+    (1, 40005, 2, 80, T0 + 21, 'UDP', 60, None, 1, None, 1),
+    (3, 50000, 2, 80, T0 + 300, 'TCP', 10, 20, 1, 1, 2),
+    (1, 40006, 2, 80, T0 + 301, 'TCP', 100, 1000, 1, 2, 1),
+    (1, 40007, 2, 80, T0 + 900, 'TCP', 100, 1000, 1, 2, 1),
+]
+
+
+def make_batch(rows):
+    batch = import_base.ColumnBatch()
+    for row in rows:
+        batch.append(*row)
+    return batch
+
+
+def test_merge():
+    aggregator = flow_aggregator.FlowAggregator()
+    assert aggregator.add_batch(make_batch(sample_rows[:6])) == []
+    assert len(aggregator) == 3
+
+    rows = sorted(aggregator.flush())
+    assert len(aggregator) == 0
+    assert rows == [
+        (1, 40000, 2, 80, format_epoch(T0 + 5), 'TCP', 300, 6000, 3, 9, 4, 3),
+        (1, 40003, 2, 443, format_epoch(T0 + 20), 'TCP', 50, 50, 1, 1, 1, 1),
+        # NULL counts stay NULL
+        (1, 40004, 2, 80, format_epoch(T0 + 20), 'UDP', 120, None, 2, None, 1, 2),
+    ]
+    assert aggregator.rows_in == 6
+    assert aggregator.rows_out == 3
+
+
+def test_buckets_close():
+    aggregator = flow_aggregator.FlowAggregator()
+    # the first bucket stays open while the input is one bucket past it
+    assert aggregator.add_batch(make_batch(sample_rows[:8])) == []
+    assert len(aggregator) == 5
+
+    # two buckets on, the first two buckets close; the new one stays open
+    rows = aggregator.add_batch(make_batch(sample_rows[8:]))
+    assert len(rows) == 5
+    assert len(aggregator) == 1
+    assert aggregator.flush()[0][4] == format_epoch(T0 + 900)
+
+
+def test_max_flows():
+    aggregator = flow_aggregator.FlowAggregator(max_flows=2)
+    rows = aggregator.add_batch(make_batch(sample_rows[:8]))
+    # the oldest bucket is written early to stay under the cap
+    assert len(rows) == 3
+    assert len(aggregator) == 2
+    assert all(row[4] < format_epoch(T0 + 300) for row in rows)
+
+
+def test_link_accumulator():
+    accumulator = flow_aggregator.LinkAccumulator()
+    assert accumulator.add_batch(make_batch(sample_rows[:7])) == 7
+    assert len(accumulator) == 4
+    assert accumulator.rows == 7
+    links = accumulator.pop_all()
+    assert len(accumulator) == 0
+    assert links[(1, 2, 80, 'TCP', T0)] == [3, 300, 6000, 3, 9, 12]
+    # NULL counts stay NULL
+    assert links[(1, 2, 80, 'UDP', T0)] == [2, 120, None, 2, None, 2]
+    assert links[(3, 2, 80, 'TCP', T0 + 300)] == [1, 10, 20, 1, 1, 2]
+
+
+def read_staging_links(processor):
+    table = processor.tables['table_staging_links']
+    # timestamp + 0 reads the bucket as a number on both databases
+    rows = list(db.select(table, what="src, dst, port, protocol, timestamp + 0 AS 'ts', links, bytes_sent, "
+                                      "bytes_received, packets_sent, packets_received, duration"))
+    links = sorted((r.src, r.dst, r.port, r.protocol, r.ts, r.links, r.bytes_sent, r.bytes_received,
+                    r.packets_sent, r.packets_received, r.duration) for r in rows)
+    db.delete(table, where="1")
+    db.delete(processor.tables['table_syslog'], where="1")
+    return links
+
+
+def test_preprocess_equivalence():
+    ds_model = Datasources(db, {}, sub_id)
+    ds_id = ds_model.create_datasource('aggregation test')
+    try:
+        processor = sam.preprocess.Preprocessor(db, sub_id, ds_id, security_rules=False)
+        importer = import_base.BaseImporter()
+        importer.set_subscription(sub_id)
+        importer.set_datasource_id(ds_id)
+
+        importer.insert_batch(make_batch(sample_rows))
+        processor.syslog_to_staging_links()
+        expected = read_staging_links(processor)
+
+        importer.enable_aggregation()
+        importer.insert_batch(make_batch(sample_rows))
+        importer.flush_aggregation()
+        assert len(list(db.select(processor.tables['table_syslog']))) == 6
+        processor.syslog_to_staging_links()
+        actual = read_staging_links(processor)
+
+        assert len(actual) == len(expected) == 6
+        for a, e in zip(actual, expected):
+            assert a[:-1] == e[:-1]
+            # durations are averaged before they are stored, so may be rounded
+            assert abs(a[-1] - e[-1]) < 1
+    finally:
+        ds_model.remove_datasource(ds_id)
@@ -1,4 +1,5 @@
 from spec.python import db_connection
+import re
 import datetime
 from sam.importers import import_base, import_asasyslog
 
@@ -50,14 +51,21 @@ def test_class():
     assert import_asasyslog.class_ == import_asasyslog.ASASyslogImporter
 
 
-def test_get_message_id():
+def test_scan_message_id():
     asa = import_asasyslog.ASASyslogImporter()
 
     line = "<166>%ASA-6-302020: Built"
-    assert asa.get_message_id(line) == (302020, "Built")
+    assert asa.scan_message_id(line) == ("302020", "Built")
 
     line = '<166>:%ASA-session-6-302015: Built'
-    assert asa.get_message_id(line) == (302015, "Built")
+    assert asa.scan_message_id(line) == ("302015", "Built")
+
+    for line in sample_log:
+        match = re.match(r"^[<>:%\w\-]+-(\d+):\s+(.+)$", line)
+        if match is None:
+            assert asa.scan_message_id(line) == (None, line)
+        else:
+            assert asa.scan_message_id(line) == match.groups()
 
 
 def test_timestring_to_seconds():
@@ -76,120 +84,80 @@ def test_decode_tcp():
     asa = import_asasyslog.ASASyslogImporter()
 
     msg = "Teardown TCP connection 7765 for outside:216.58.193.69/443 to inside:192.168.1.5/37904 duration 0:02:51 bytes 5670 TCP FINs"
-    decoded = asa.decode_tcp(msg)
-    expected = {
-        'dst': '216.58.193.69',
-        'dstport': '443',
-        'src': '192.168.1.5',
-        'srcport': '37904',
-        'duration': 171,
-        'bytes_received': '5670',
-        'protocol': 'TCP'
-    }
-    assert decoded == expected
+    decoded = asa.decode_teardown('302014', msg)
+    assert decoded == ('TCP', '192.168.1.5', '37904', '216.58.193.69', '443', '5670', 171)
 
     msg = "Teardown TCP connection 7777 for outside :104.31.70.170 /80 (idfw_user1) to inside :192.168.1.5 /44292 (idfw_user2) duration 11:22:33 bytes 767157 TCP FINs"
-    decoded = asa.decode_tcp(msg)
-    expected = {
-        'dst': '104.31.70.170',
-        'dstport': '80',
-        'src': '192.168.1.5',
-        'srcport': '44292',
-        'duration': 40953,
-        'bytes_received': '767157',
-        'protocol': 'TCP'
-    }
-    assert decoded == expected
+    decoded = asa.decode_teardown('302014', msg)
+    assert decoded == ('TCP', '192.168.1.5', '44292', '104.31.70.170', '80', '767157', 40953)
 
 
 def test_decode_udp():
     asa = import_asasyslog.ASASyslogImporter()
 
-    msg = "Teardown TCP connection 7765 for outside:216.58.193.69/443 to inside:192.168.1.5/37904 duration 0:02:51 bytes 5670 TCP FINs"
-    decoded = asa.decode_tcp(msg)
-    expected = {
-        'dst': '216.58.193.69',
-        'dstport': '443',
-        'src': '192.168.1.5',
-        'srcport': '37904',
-        'duration': 171,
-        'bytes_received': '5670',
-        'protocol': 'TCP'
-    }
-    assert decoded == expected
+    msg = "Teardown UDP connection 7881 for outside:158.69.125.231/123 to inside:192.168.1.8/59776 duration 0:02:01 bytes 96"
+    decoded = asa.decode_teardown('302016', msg)
+    assert decoded == ('UDP', '192.168.1.8', '59776', '158.69.125.231', '123', '96', 121)
 
-    msg = "Teardown TCP connection 7777 for outside :104.31.70.170 /80 (idfw_user1) to inside :192.168.1.5 /44292 (idfw_user2) duration 11:22:33 bytes 767157 TCP FINs"
-    decoded = asa.decode_tcp(msg)
-    expected = {
-        'dst': '104.31.70.170',
-        'dstport': '80',
-        'src': '192.168.1.5',
-        'srcport': '44292',
-        'duration': 40953,
-        'bytes_received': '767157',
-        'protocol': 'TCP'
-    }
-    assert decoded == expected
+    msg = "Teardown UDP connection 7881 for outside :158.69.125.231 /123 (idw_user1) to inside :192.168.1.8 /59776 (idfw_user2) duration 1 :2 :3 bytes 96 (user3)"
+    decoded = asa.decode_teardown('302016', msg)
+    assert decoded == ('UDP', '192.168.1.8', '59776', '158.69.125.231', '123', '96', 3723)
 
 
 def test_decode_gre():
     asa = import_asasyslog.ASASyslogImporter()
 
     msg = "Teardown GRE connection 7951 from inside:192.168.1.5/3316 (192.168.1.5/3316) to inside:192.168.1.1/55443 (192.168.10.176/23456) duration 0:02:31 bytes 66429"
-    decoded = asa.decode_gre(msg)
-    expected = {
-        'dst': '192.168.1.1',
-        'dstport': '55443',
-        'src': '192.168.1.5',
-        'srcport': '3316',
-        'duration': 151,
-        'bytes_received': '66429',
-        'protocol': 'GRE'
-    }
-    assert decoded == expected
+    decoded = asa.decode_teardown('302018', msg)
+    assert decoded == ('GRE', '192.168.1.5', '3316', '192.168.1.1', '55443', '66429', 151)
 
     msg = "Teardown GRE connection 7951 from inside:192.168.1.5/3316 (192.168.1.5/3316) (idfw_user1) to inside:192.168.1.1/55443 (192.168.10.176/23456) (idfw_user2) duration 0:02:31 bytes 66429 (user3)"
-    decoded = asa.decode_gre(msg)
-    expected = {
-        'dst': '192.168.1.1',
-        'dstport': '55443',
-        'src': '192.168.1.5',
-        'srcport': '3316',
-        'duration': 151,
-        'bytes_received': '66429',
-        'protocol': 'GRE'
-    }
-    assert decoded == expected
+    decoded = asa.decode_teardown('302018', msg)
+    assert decoded == ('GRE', '192.168.1.5', '3316', '192.168.1.1', '55443', '66429', 151)
 
 
 def test_decode_icmp():
     asa = import_asasyslog.ASASyslogImporter()
 
     msg = "Teardown ICMP connection for faddr 216.58.216.174/0 gaddr 192.168.10.176/39510 laddr 192.168.1.5/27819"
-    decoded = asa.decode_icmp(msg)
-    expected = {
-        'dst': '216.58.216.174',
-        'dstport': '0',
-        'src': '192.168.1.5',
-        'srcport': '27819',
-        'duration': 1,
-        'bytes_received': '1',
-        'protocol': 'ICMP'
-    }
-    assert decoded == expected
+    decoded = asa.decode_teardown('302021', msg)
+    assert decoded == ('ICMP', '192.168.1.5', '27819', '216.58.216.174', '0', '1', 1)
 
     msg = "Teardown ICMP connection for faddr 216.58.216.174 /0 (you) gaddr 192.168.10.176 /39510 laddr 192.168.1.5 /27819 (you) (981) type something code 44"
-    decoded = asa.decode_icmp(msg)
-    expected = {
-        'dst': '216.58.216.174',
-        'dstport': '0',
-        'src': '192.168.1.5',
-        'srcport': '27819',
-        'duration': 1,
-        'bytes_received': '1',
-        'protocol': 'ICMP'
-    }
-    assert decoded == expected
+    decoded = asa.decode_teardown('302021', msg)
+    assert decoded == ('ICMP', '192.168.1.5', '27819', '216.58.216.174', '0', '1', 1)
+
+
+def test_parse_duration():
+    asa = import_asasyslog.ASASyslogImporter()
+    asa.DURATION_CACHE_SIZE = 2
+
+    assert asa.parse_duration("0:02:51") == 171
+    assert asa.parse_duration("1 :2 :3") == 3723
+    assert asa.parse_duration("0:02:51") == 171
+    assert len(asa.duration_cache) == 2
+    assert asa.parse_duration("50") == 50
+    assert asa.duration_cache == {"50": 50}
+
+
+def test_decode_teardown():
+    asa = import_asasyslog.ASASyslogImporter()
+    decoded_count = 0
+    for line in sample_log:
+        message_id, message = asa.scan_message_id(line)
+        if message_id not in asa.TEARDOWN_PROTOCOLS:
+            continue
+        decoded = asa.decode_teardown(message_id, message)
+        assert decoded is not None
+        assert decoded[0] == asa.TEARDOWN_PROTOCOLS[message_id]
+        decoded_count += 1
+    assert decoded_count == 12
+
+    # the message must match its id
+    msg = "Teardown UDP connection 7881 for outside:158.69.125.231/123 to inside:192.168.1.8/59776 duration 0:02:01 bytes 96"
+    assert asa.decode_teardown('302016', msg) is not None
+    assert asa.decode_teardown('302014', msg) is None
+    assert asa.decode_teardown('302016', "Teardown UDP connection garbage") is None
 
 
 def test_translate():
@@ -221,3 +189,14 @@ def test_translate():
         assert False
     finally:
         datetime.datetime = old_dt
+
+
+def test_translate_batch():
+    asa = import_asasyslog.ASASyslogImporter()
+    batch = asa.translate_batch(sample_log)
+    assert len(batch) == 12
+    translated = {}
+    asa.translate(sample_log[1], 1, translated)
+    row = batch.rows()[0]
+    assert row[:4] == (translated['src'], translated['srcport'], translated['dst'], translated['dstport'])
+    assert row[5:] == ('TCP', 0, 5670, 0, 1, 171)
@@ -40,3 +40,12 @@ def test_translate():
         "packets_received": '1',
         "duration": '1',
     }
+
+
+def test_translate_batch():
+    aws = import_aws.AWSImporter()
+    batch = aws.translate_batch(sample_log)
+    assert len(batch) == 1
+    assert batch.rows()[0] == (16909060, 54417, 84281096, 80, datetime.fromtimestamp(1504722134),
+                               'TCP', 1, 1, 1, 1, 1)
+    assert batch.skipped == {'unparseable': 3}
@@ -260,3 +260,96 @@ def test_insert_data():
     bi.insert_data(param_rows, param_count)
     count = db.query("SELECT COUNT(1) AS 'c' FROM {}".format(table_name)).first()['c']
     assert count == 1
+
+
+def test_column_batch():
+    batch = import_base.ColumnBatch()
+    assert len(batch) == 0
+    batch.append(1, 2, 3, 4, 5, 'TCP', 7, 8, 9, 10, 11)
+    batch.append(4294967295, 65535, 0, 0, 1500000000, 'UDP', None, 8, None, 10, 1)
+    assert len(batch) == 2
+    assert batch['src'].typecode == 'I'
+    assert batch['dstport'].typecode == 'H'
+    assert batch['timestamp'].typecode == 'l'
+    assert list(batch['src']) == [1, 4294967295]
+    assert batch['protocol'] == ['TCP', 'UDP']
+
+    # a bad value leaves the batch unchanged
+    with pytest.raises(OverflowError):
+        batch.append(1, 70000, 3, 4, 5, 'TCP', 7, 8, 9, 10, 11)
+    with pytest.raises(ValueError):
+        batch.append(1, 2, 3)
+    assert len(batch) == 2
+    assert all(len(column) == 2 for column in batch.columns)
+
+    rows = batch.rows()
+    assert rows[0] == (1, 2, 3, 4, datetime.fromtimestamp(5), 'TCP', 7, 8, 9, 10, 11)
+    dicts = batch.to_dicts()
+    assert set(dicts[1].keys()) == set(import_base.BaseImporter.keys)
+    assert dicts[1]['timestamp'] == datetime.fromtimestamp(1500000000)
+
+    batch.append_dict({
+        "src": '1', "srcport": 2, "dst": 3, "dstport": '4', "timestamp": datetime.fromtimestamp(5),
+        "protocol": 'TCP', "bytes_sent": 7, "bytes_received": 8, "packets_sent": 9,
+        "packets_received": 10, "duration": 11,
+    })
+    assert len(batch) == 3
+    assert batch.rows()[2] == rows[0]
+
+
+def test_translate_batch_fallback():
+    bi = import_base.BaseImporter()
+    assert bi.has_batch_translation() is False
+
+    def mock_translate(l, ln, d):
+        if ln % 2 == 0:
+            return 1
+        d.update(dict.fromkeys(import_base.BaseImporter.keys, 0))
+        d['src'] = ln
+        return 0
+    bi.translate = mock_translate
+
+    batch = bi.translate_batch(["blank"] * 10)
+    assert len(batch) == 5
+    assert list(batch['src']) == [1, 3, 5, 7, 9]
+    assert batch.skipped == {'rejected': 5}
+
+
+def test_import_lines_skipped():
+    class BatchImporter(import_base.BaseImporter):
+        def translate_batch(self, lines):
+            batch = import_base.ColumnBatch()
+            batch.skipped['unparseable'] += len(lines)
+            return batch
+
+    bi = BatchImporter()
+    bi.insert_batch = db_connection.Mocker()
+    reported = []
+    bi.report_skipped = lambda: reported.append(sum(bi.skipped.values()))
+    assert bi.import_string("blank\n" * 1500) == 0
+    assert len(bi.insert_batch.calls) == 0
+    assert bi.skipped == {'unparseable': 1500}
+    assert reported == [1500]
+
+
+def test_import_lines(tmpdir):
+    class BatchImporter(import_base.BaseImporter):
+        def translate_batch(self, lines):
+            batch = import_base.ColumnBatch()
+            for line in lines:
+                batch.append(1, 2, 3, 4, 5, 'TCP', 7, 8, 9, 10, 11)
+            return batch
+
+    bi = BatchImporter()
+    assert bi.has_batch_translation() is True
+    bi.insert_batch = db_connection.Mocker()
+    inserted = bi.import_string("blank\n" * 2010)
+    assert inserted == 2010
+    assert len(bi.insert_batch.calls) == 3
+    assert map(len, [call[1][0] for call in bi.insert_batch.calls]) == [1000, 1000, 10]
+
+    path = tmpdir.join("log.txt")
+    path.write("blank\n" * 1500)
+    bi.insert_batch = db_connection.Mocker()
+    assert bi.import_file(str(path)) == 1500
+    assert len(bi.insert_batch.calls) == 2
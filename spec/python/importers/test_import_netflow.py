@@ -40,10 +40,7 @@ def test_safe_translate():
 def test_import_file():
     nf = import_netflow.NetFlowImporter()
     collected = []
-    def mock_inserter(rows, counter):
-        print("adding {} lines.".format(counter))
-        collected.extend(rows[:counter])
-    nf.insert_data = mock_inserter
+    nf.insert_batch = lambda batch: collected.extend(batch.to_dicts())
 
     with pytest.raises(ValueError):
         nf.import_file(os.path.join(os.path.dirname(__file__), "error"))
@@ -61,7 +58,7 @@ def test_import_file():
         'protocol': 'TCP',
         'src': 3232235783,
         'srcport': 45092,
-        'timestamp': datetime(2017, 9, 5, 15, 29, 12, 530000)
+        'timestamp': datetime(2017, 9, 5, 15, 29, 12)
     }
 
 
@@ -70,10 +67,7 @@ def test_import_string():
         data = f.read()
     nf = import_netflow.NetFlowImporter()
     collected = []
-    def mock_inserter(rows, counter):
-        print("adding {} lines.".format(counter))
-        collected.extend(rows[:counter])
-    nf.insert_data = mock_inserter
+    nf.insert_batch = lambda batch: collected.extend(batch.to_dicts())
 
     assert nf.import_string(data) == 8
     assert len(collected) == 8
@@ -88,7 +82,7 @@ def test_import_string():
         'protocol': 'TCP',
         'src': 3232235783,
         'srcport': 45092,
-        'timestamp': datetime(2017, 9, 5, 15, 29, 12, 530000)
+        'timestamp': datetime(2017, 9, 5, 15, 29, 12)
     }
 
 
@@ -143,3 +137,17 @@ def test_translate():
         "packets_received": 7756,
         "duration": 152,
     }
+
+
+def test_translate_batch():
+    nf = import_netflow.NetFlowImporter()
+    batch = nf.translate_batch(sample_log)
+    translated = []
+    for i, line in enumerate(sample_log):
+        d = {}
+        if nf.translate(line, i, d) == 0:
+            translated.append(d)
+    assert len(batch) == len(translated)
+    for row, expected in zip(batch.to_dicts(), translated):
+        expected['timestamp'] = expected['timestamp'].replace(microsecond=0)
+        assert row == expected
@@ -1,3 +1,4 @@
+import json
 from datetime import datetime
 from spec.python import db_connection
 from sam.importers import import_base, import_paloalto
@@ -63,3 +64,48 @@ def test_translate():
         "duration": '30',
     }
 
+
+
+def test_translate_batch():
+    pa = import_paloalto.PaloAltoImporter()
+    batch = pa.translate_batch(sample_log)
+    assert len(batch) == 8
+    assert batch.rows()[3] == (143794053, 64533, 121815120, 443, datetime(2011, 6, 21, 18, 6, 21),
+                               'TCP', 20009, 0, 30, 0, 3600)
+
+
+def test_extract_message():
+    pa = import_paloalto.PaloAltoImporter()
+    assert pa.extract_message('{"message":"1,2,3,TRAFFIC"}\n') == '1,2,3,TRAFFIC'
+    # non-standard envelopes fall back to json
+    assert pa.extract_message('{"message": "1,2,3,TRAFFIC"}') == '1,2,3,TRAFFIC'
+    assert pa.extract_message('{"message":"1,\\"2\\",3,TRAFFIC"}') == '1,"2",3,TRAFFIC'
+    assert pa.extract_message('{"other":"1,2,3,TRAFFIC","message":"4,5"}') == '4,5'
+    assert pa.extract_message('nonsensical entry') is None
+    assert pa.extract_message('') is None
+    for line in sample_log[1:-3]:
+        assert pa.extract_message(line) == json.loads(line)['message']
+
+
+def test_extract_fields():
+    pa = import_paloalto.PaloAltoImporter()
+    assert pa.extract_fields('1,2,3,CONFIG,5,6') is None
+    assert pa.extract_fields('1,2,3') is None
+    message = ",".join(["TRAFFIC" if i == 3 else str(i) for i in range(60)])
+    fields = pa.extract_fields(message)
+    assert len(fields) == import_paloalto.PaloAltoImporter.PacketsReceived + 2
+    assert fields[:46] == message.split(',')[:46]
+    assert fields[-1] == ",".join(str(i) for i in range(46, 60))
+
+
+def test_skipped():
+    pa = import_paloalto.PaloAltoImporter()
+    for i, line in enumerate(sample_log):
+        pa.translate(line, i + 1, {})
+    assert pa.skipped == {'undecodable': 4, 'non-TRAFFIC': 1, 'unparseable': 1}
+    pa.report_skipped()
+    assert not pa.skipped
+
+    batch = pa.translate_batch(sample_log)
+    assert batch.skipped == {'undecodable': 4, 'non-TRAFFIC': 1, 'unparseable': 1}
+    assert not pa.skipped
@@ -71,3 +71,13 @@ def test_translate():
         "duration": '1',
     }
 
+
+
+def test_translate_batch():
+    tcp = import_tcpdump.TCPDumpImporter()
+    batch = tcp.translate_batch(sample_log)
+    assert len(batch) == 3
+    assert batch.rows()[1] == (4025413100, 55943, 3232238334, 1900, datetime.fromtimestamp(1491525737),
+                               'UDP', 0, 166, 0, 1, 1)
+    assert batch.skipped == {'unparseable': 6}
+    assert list(batch['bytes_sent']) == [474, 0, 449]
@@ -1,6 +1,8 @@
+import struct
+import pytest
 from datetime import datetime
 from spec.python import db_connection
-from sam.importers import import_base, import_tshark
+from sam.importers import import_base, import_tshark, pcap_reader
 
 sample_log = [
     "",
@@ -83,3 +85,149 @@ def test_translate():
         "packets_received": 1,
         "duration": 1,
     }
+
+
+def test_translate_batch():
+    ts = import_tshark.TSharkImporter()
+    batch = ts.translate_batch(sample_log)
+    translated = []
+    for i, line in enumerate(sample_log):
+        d = {}
+        if ts.translate(line, i, d) == 0:
+            translated.append(d)
+    assert len(batch) == len(translated)
+    assert list(batch['src']) == [d['src'] for d in translated]
+    assert list(batch['dstport']) == [d['dstport'] for d in translated]
+    assert batch['bytes_received'] == [d['bytes_received'] for d in translated]
+
+
+# (timestamp, src, srcport, dst, dstport, protocol, payload bytes)
+sample_packets = [
+    (1504723000.25, 0xC0A80107, 40548, 0x4A7D87BD, 443, 6, 0),
+    (1504723000.50, 0x4A7D87BD, 443, 0xC0A80107, 40548, 6, 1000),
+    (1504723003.75, 0xC0A80107, 40548, 0x4A7D87BD, 443, 6, 0),
+    (1504723001.00, 0xC0A80107, 56863, 0xC0A80AFE, 53, 17, 30),
+    (1504723001.10, 0xC0A80AFE, 53, 0xC0A80107, 56863, 17, 90),
+    (1504723002.00, 0xC0A80107, 0, 0xC0A80101, 0, 1, 56),
+    # the DNS conversation again, after the flow went idle
+    (1504723100.00, 0xC0A80107, 56863, 0xC0A80AFE, 53, 17, 30),
+]
+
+
+def ethernet_frame(src, srcport, dst, dstport, protocol, payload):
+    if protocol == 6:
+        transport = struct.pack('!HHIIBBHHH', srcport, dstport, 0, 0, 0x50, 0x18, 1024, 0, 0)
+    elif protocol == 17:
+        transport = struct.pack('!HHHH', srcport, dstport, payload + 8, 0)
+    else:
+        transport = struct.pack('!BBHI', 8, 0, 0, 0)
+    transport += '\x00' * payload
+    ip = struct.pack('!BBHHHBBHII', 0x45, 0, len(transport) + 20, 0, 0x4000, 64, protocol, 0, src, dst)
+    return '\x00\x11\x22\x33\x44\x55\x66\x77\x88\x99\xaa\xbb\x08\x00' + ip + transport
+
+
+def write_pcap(path, packets):
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        for packet in packets:
+            frame = ethernet_frame(*packet[1:])
+            f.write(struct.pack('<IIII', int(packet[0]), int(packet[0] % 1 * 1e6), len(frame), len(frame)))
+            f.write(frame)
+
+
+def write_pcapng(path, packets):
+    def block(block_type, body):
+        body += '\x00' * (-len(body) % 4)
+        return struct.pack('<II', block_type, len(body) + 12) + body + struct.pack('<I', len(body) + 12)
+
+    with open(path, 'wb') as f:
+        f.write(block(0x0a0d0d0a, struct.pack('<IHHq', 0x1a2b3c4d, 1, 0, -1)))
+        # nanosecond timestamps (if_tsresol = 9), then the end of options
+        f.write(block(1, struct.pack('<HHI', 1, 0, 65535) + struct.pack('<HHB3x', 9, 1, 9) + struct.pack('<HH', 0, 0)))
+        for packet in packets:
+            frame = ethernet_frame(*packet[1:])
+            ts = int(round(packet[0] * 1e9))
+            f.write(block(6, struct.pack('<IIIII', 0, ts >> 32, ts & 0xffffffff, len(frame), len(frame)) + frame))
+
+
+def test_read_packets(tmpdir):
+    path = str(tmpdir.join('capture.pcap'))
+    write_pcap(path, sample_packets)
+    path_ng = str(tmpdir.join('capture.pcapng'))
+    write_pcapng(path_ng, sample_packets)
+    assert pcap_reader.is_pcap(path)
+    assert pcap_reader.is_pcap(path_ng)
+
+    for p in (path, path_ng):
+        packets = list(pcap_reader.read_packets(p))
+        assert len(packets) == len(sample_packets)
+        headers = [pcap_reader.transport_headers(linktype, frame) for ts, linktype, frame in packets]
+        assert headers[0] == (0xC0A80107, 40548, 0x4A7D87BD, 443, 'TCP', 40)
+        assert headers[4] == (0xC0A80AFE, 53, 0xC0A80107, 56863, 'UDP', 118)
+        assert headers[5] == (0xC0A80107, 0, 0xC0A80101, 0, 'ICMP', 84)
+        assert abs(packets[1][0] - sample_packets[1][0]) < 1e-3
+
+
+def test_read_packets_malformed(tmpdir):
+    truncated = tmpdir.join('truncated.pcap')
+    truncated.write_binary(struct.pack('<IH', 0xa1b2c3d4, 2))
+    with pytest.raises(ValueError):
+        list(pcap_reader.read_packets(str(truncated)))
+
+    # a packet on interface 1, when only interface 0 is described
+    section = struct.pack('<IIIHHq', 0x0a0d0d0a, 28, 0x1a2b3c4d, 1, 0, -1) + struct.pack('<I', 28)
+    interface = struct.pack('<IIHHI', 1, 20, 1, 0, 65535) + struct.pack('<I', 20)
+    packet = struct.pack('<IIIIIII', 6, 32, 1, 0, 0, 0, 0) + struct.pack('<I', 32)
+    undeclared = tmpdir.join('undeclared.pcapng')
+    undeclared.write_binary(section + interface + packet)
+    with pytest.raises(ValueError):
+        list(pcap_reader.read_packets(str(undeclared)))
+    ts = import_tshark.TSharkImporter()
+    ts.insert_batch = lambda batch: None
+    with pytest.raises(ValueError):
+        ts.import_file(str(undeclared))
+
+    # a packet block too short to hold its own header
+    short = tmpdir.join('short.pcapng')
+    short.write_binary(section + interface + struct.pack('<III', 6, 12, 12))
+    with pytest.raises(ValueError):
+        list(pcap_reader.read_packets(str(short)))
+
+
+def test_import_capture(tmpdir):
+    path = str(tmpdir.join('capture.pcapng'))
+    write_pcapng(path, sample_packets)
+    ts = import_tshark.TSharkImporter()
+    batches = []
+    ts.insert_batch = batches.append
+    assert ts.import_file(path) == 4
+
+    rows = sorted(row for batch in batches for row in batch.rows())
+    stamp = datetime.fromtimestamp
+    assert rows == [
+        # the idle DNS flow was written out before it started again
+        (0xC0A80107, 0, 0xC0A80101, 0, stamp(1504723002), 'ICMP', 84, 0, 1, 0, 1),
+        (0xC0A80107, 40548, 0x4A7D87BD, 443, stamp(1504723000), 'TCP', 80, 1040, 2, 1, 3),
+        (0xC0A80107, 56863, 0xC0A80AFE, 53, stamp(1504723001), 'UDP', 58, 118, 1, 1, 1),
+        (0xC0A80107, 56863, 0xC0A80AFE, 53, stamp(1504723100), 'UDP', 58, 0, 1, 0, 1),
+    ]
+
+
+def test_flow_table():
+    table = import_tshark.FlowTable(idle_timeout=10, active_timeout=30)
+    batch = import_base.ColumnBatch()
+    # the first packet is from the server; rows are still reported from the high port
+    table.add(100.0, 2, 443, 1, 50000, 'TCP', 500)
+    table.add(101.0, 1, 50000, 2, 443, 'TCP', 40)
+    assert len(table) == 1
+    for t in range(102, 140, 5):
+        if t >= table.next_sweep:
+            table.expire(t, batch)
+        table.add(float(t), 1, 50000, 2, 443, 'TCP', 40)
+    # active timeout split the long flow
+    assert len(batch) == 1
+    assert batch.rows()[0][:4] == (1, 50000, 2, 443)
+    assert batch.rows()[0][6:] == (280, 500, 7, 1, 27)
+    table.flush(batch)
+    assert len(table) == 0
+    assert len(batch) == 2
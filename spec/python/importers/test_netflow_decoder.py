@@ -0,0 +1,128 @@
+import pytest
+from datetime import datetime
+from sam.importers import netflow_decoder, import_netflow, pcap_reader
+from spec.python.importers import netflow_fixtures as fixtures
+
+end_time = fixtures.UNIX_SECS - fixtures.UPTIME // 1000
+expected_rows = [
+    (0xC0A80107, 54766, 0x173C489D, 443, end_time + 3, 'TCP', 0, 12557, 0, 20, 2),
+    (0xC0A80108, 43047, 0xC713A724, 123, end_time + 2, 'UDP', 0, 76, 0, 1, 1),
+    (0xC0A80107, 0, 0xC0A80101, 0, end_time + 2, 'ICMP', 0, 84, 0, 1, 1),
+    # reversed, because the source port is lower
+    (0xAC1533EC, 38597, 0xAC153341, 8080, end_time + 236, 'TCP', 4292, 0, 10, 0, 236),
+]
+
+
+def batch_tuples(batch):
+    return zip(*batch.columns)
+
+
+def test_decode_v5():
+    decoder = netflow_decoder.NetFlowDecoder()
+    batch = decoder.decode(fixtures.v5_packet(fixtures.FLOWS))
+    assert batch_tuples(batch) == expected_rows
+
+    with pytest.raises(ValueError):
+        decoder.decode(fixtures.v5_packet(fixtures.FLOWS)[:-10])
+
+
+def test_decode_v9():
+    decoder = netflow_decoder.NetFlowDecoder()
+    data = fixtures.v9_data_flowset(fixtures.FLOWS)
+
+    # data before its template can't be decoded
+    batch = decoder.decode(fixtures.v9_packet([data]))
+    assert len(batch) == 0
+    assert decoder.missing_template == 1
+
+    batch = decoder.decode(fixtures.v9_packet([fixtures.v9_template_flowset(), data]))
+    assert batch_tuples(batch) == expected_rows
+
+    # the template is cached
+    batch = decoder.decode(fixtures.v9_packet([data]))
+    assert batch_tuples(batch) == expected_rows
+    assert decoder.missing_template == 1
+
+    # but only for the exporter that sent it
+    batch = decoder.decode(fixtures.v9_packet([data], source_id=2))
+    assert len(batch) == 0
+    assert decoder.missing_template == 2
+
+
+def test_decode_ipfix():
+    decoder = netflow_decoder.NetFlowDecoder()
+    packet = fixtures.ipfix_packet([fixtures.ipfix_template_set(), fixtures.ipfix_data_set(fixtures.FLOWS)])
+    batch = decoder.decode(packet)
+    assert batch_tuples(batch) == expected_rows
+
+    # template withdrawal
+    withdrawal = fixtures.ipfix_packet([''.join([
+        '\x00\x02\x00\x08',
+        '\x01\x2c\x00\x00',
+    ])])
+    decoder.decode(withdrawal)
+    batch = decoder.decode(fixtures.ipfix_packet([fixtures.ipfix_data_set(fixtures.FLOWS)]))
+    assert len(batch) == 0
+    assert decoder.missing_template == 1
+
+
+def test_decode_errors():
+    decoder = netflow_decoder.NetFlowDecoder()
+    with pytest.raises(ValueError):
+        decoder.decode('')
+    with pytest.raises(ValueError):
+        decoder.decode('\x00\x07' + '\x00' * 30)
+    with pytest.raises(ValueError):
+        decoder.decode(fixtures.ipfix_packet([fixtures.ipfix_template_set()])[:-6])
+
+
+def test_template_variable_length():
+    template = netflow_decoder.Template([(8, 4), (82, 65535), (12, 4)])
+    assert template.usable is False
+    template = netflow_decoder.Template([(8, 4), (82, 16), (12, 4), (None, 2)])
+    assert template.usable is True
+    assert template.fields == [8, 12]
+    assert template.length == 26
+
+
+def test_udp_payloads(tmpdir):
+    path = str(tmpdir.join('netflow.pcap'))
+    payloads = [fixtures.v5_packet(fixtures.FLOWS[:2]), fixtures.v5_packet(fixtures.FLOWS[2:])]
+    fixtures.write_pcap(path, payloads)
+    assert pcap_reader.is_pcap(path)
+    datagrams = [(src, port, str(payload)) for src, port, payload in pcap_reader.udp_payloads(path)]
+    assert datagrams == [(0x0A000001, 9995, payloads[0]), (0x0A000001, 9995, payloads[1])]
+    assert list(pcap_reader.udp_payloads(path, port=9999)) == []
+
+
+def test_importer_capture(tmpdir):
+    path = str(tmpdir.join('netflow.pcap'))
+    fixtures.write_pcap(path, [
+        fixtures.v9_packet([fixtures.v9_template_flowset()]),
+        fixtures.v9_packet([fixtures.v9_data_flowset(fixtures.FLOWS)]),
+        'garbage',
+    ])
+    nf = import_netflow.NetFlowImporter()
+    batches = []
+    nf.insert_batch = batches.append
+    assert nf.import_file(path) == 4
+    assert batch_tuples(batches[0]) == expected_rows
+
+
+def test_importer_packets():
+    nf = import_netflow.NetFlowImporter()
+    translated = nf.import_packets([fixtures.v5_packet(fixtures.FLOWS), 'garbage'])
+    assert len(translated) == 4
+    assert translated[0] == {
+        'src': 0xC0A80107,
+        'srcport': 54766,
+        'dst': 0x173C489D,
+        'dstport': 443,
+        'timestamp': datetime.fromtimestamp(end_time + 3),
+        'protocol': 'TCP',
+        'bytes_sent': 0,
+        'bytes_received': 12557,
+        'packets_sent': 0,
+        'packets_received': 20,
+        'duration': 2,
+    }
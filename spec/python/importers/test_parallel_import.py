@@ -0,0 +1,55 @@
+from spec.python import db_connection
+from sam.importers import import_base, import_netflow, import_tcpdump, parallel_import
+
+sample_lines = [
+    "1491525948.268015 IP 192.168.10.113.33060 > 172.217.3.196.443: Flags [P.], seq 256:730, length 474",
+    "1491525947.915376 ARP, Request who-has 192.168.10.106 tell 192.168.10.254, length 46",
+    "1491525737.317942 IP 192.168.10.254.55943 > 239.255.255.250.1900: UDP, length 449",
+]
+
+
+def test_split_file(tmpdir):
+    path = tmpdir.join("log.txt")
+    path.write("".join("line {}\n".format(i) for i in range(100)))
+    size = path.size()
+
+    ranges = parallel_import.split_file(str(path), chunk_size=50)
+    assert len(ranges) > 1
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == size
+    with open(str(path), 'rb') as f:
+        data = f.read()
+    for (start, end), (next_start, _) in zip(ranges, ranges[1:]):
+        assert end == next_start
+        assert data[end - 1] == '\n'
+    assert "".join(data[start:end] for start, end in ranges) == data
+
+    empty = tmpdir.join("empty.txt")
+    empty.write("")
+    assert parallel_import.split_file(str(empty)) == []
+
+
+def test_is_line_based():
+    assert parallel_import.is_line_based(import_tcpdump.TCPDumpImporter()) is True
+    assert parallel_import.is_line_based(import_netflow.NetFlowImporter()) is False
+
+
+def test_import_file(tmpdir):
+    path = tmpdir.join("tcpdump.log")
+    path.write("\n".join(sample_lines * 1000) + "\n")
+
+    importer = import_tcpdump.TCPDumpImporter()
+    importer.insert_batch = db_connection.Mocker()
+    importer.report_skipped = db_connection.Mocker()
+    inserted = parallel_import.import_file(importer, str(path), workers=2, chunk_size=4096)
+    assert inserted == 2000
+    # the ARP lines, counted by the workers
+    assert importer.skipped == {'unparseable': 1000}
+    assert len(importer.report_skipped.calls) == 1
+
+    batches = [call[1][0] for call in importer.insert_batch.calls]
+    assert sum(map(len, batches)) == 2000
+    # the writer receives batches in file order
+    src = [ip for batch in batches for ip in batch['src']]
+    serial = importer.translate_batch(sample_lines * 1000)
+    assert src == list(serial['src'])
@@ -0,0 +1,56 @@
+import time
+import pytest
+from datetime import datetime
+from sam.importers import timestamps, import_base, import_paloalto, import_tshark
+
+
+def test_parse_cache():
+    calls = []
+
+    def parse(text):
+        calls.append(text)
+        return int(text)
+
+    cache = timestamps.ParseCache(parse, maxsize=2)
+    assert cache('1') == 1
+    assert cache('1') == 1
+    assert cache('2') == 2
+    assert calls == ['1', '2']
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    # '1' was used more recently than '2', so '2' is evicted
+    cache('1')
+    cache('3')
+    assert cache.cache.keys() == ['1', '3']
+    cache('2')
+    assert calls == ['1', '2', '3', '2']
+
+    # parse errors aren't cached
+    with pytest.raises(ValueError):
+        cache('x')
+    assert 'x' not in cache.cache
+
+    uncached = timestamps.ParseCache(parse, maxsize=0)
+    uncached('1')
+    uncached('1')
+    assert uncached.misses == 2
+    assert len(uncached.cache) == 0
+
+
+def test_strptime_parser():
+    parse = timestamps.strptime_parser("%Y/%m/%d %H:%M:%S")
+    epoch = parse('2017/09/06 11:53:24')
+    assert datetime.fromtimestamp(epoch) == datetime(2017, 9, 6, 11, 53, 24)
+    assert import_tshark.parse_frame_time('Sep  6, 2017 11:53:24') == epoch
+    assert import_paloalto.PaloAltoImporter.parse_timestamp('2017/09/06 11:53:24') == epoch
+
+
+def test_format_epochs():
+    epoch = int(time.mktime(datetime(2017, 9, 6, 11, 53, 24).timetuple()))
+    assert timestamps.format_epoch(epoch) == '2017-09-06 11:53:24'
+    assert timestamps.format_epochs([epoch, epoch + 1, epoch]) == \
+        ['2017-09-06 11:53:24', '2017-09-06 11:53:25', '2017-09-06 11:53:24']
+
+    batch = import_base.ColumnBatch()
+    batch.append(1, 2, 3, 4, epoch, 'TCP', 7, 8, 9, 10, 11)
+    assert batch.sql_rows() == [(1, 2, 3, 4, '2017-09-06 11:53:24', 'TCP', 7, 8, 9, 10, 11)]
@@ -0,0 +1,103 @@
+import time
+import zlib
+import pytest
+from datetime import datetime
+from sam.importers import wire_format
+from sam.importers.import_base import BaseImporter, ColumnBatch
+
+dt = datetime(2016, 7, 22, 13, 20)
+epoch = int(time.mktime(dt.timetuple()))
+lines = [
+    [2852047408, 54323, 2852061180, 80, dt, 'TCP', 0, 2340, 0, 30, 1830],
+    [2852047409, '54323', 2852061181, '80', dt, 'UDP', None, '2340', None, '30', '1.5'],
+    [4294967295, 65535, 0, 0, epoch + 1, 'ICMP', 2**40, 0, 1, 0, 1],
+]
+expected = [
+    (2852047408, 54323, 2852061180, 80, epoch, 'TCP', 0, 2340, 0, 30, 1830),
+    (2852047409, 54323, 2852061181, 80, epoch, 'UDP', None, 2340, None, 30, 1),
+    (4294967295, 65535, 0, 0, epoch + 1, 'ICMP', 2**40, 0, 1, 0, 1),
+]
+
+
+def batch_rows(batch):
+    return zip(*batch.columns)
+
+
+def test_round_trip():
+    for compress in (True, False):
+        data = wire_format.encode_rows(lines, u'key\xe9', '1.0', compress=compress)
+        assert wire_format.is_binary(data)
+        package = wire_format.decode(data)
+        assert package['access_key'] == u'key\xe9'
+        assert package['version'] == '1.0'
+        assert package['headers'] == BaseImporter.keys
+        assert 'msg' not in package
+        assert batch_rows(package['batch']) == expected
+
+    batch = ColumnBatch()
+    for row in expected:
+        batch.append(*row)
+    package = wire_format.decode(wire_format.encode_batch(batch, 'key', '1.0', msg='handshake'))
+    assert package['msg'] == 'handshake'
+    assert batch_rows(package['batch']) == expected
+
+    package = wire_format.decode(wire_format.encode_rows([], 'key', '1.0'))
+    assert len(package['batch']) == 0
+
+
+def test_sequence():
+    for compress in (True, False):
+        data = wire_format.encode_rows(lines, 'key', '1.0', compress=compress, sequence=(2**64 - 1, 42))
+        package = wire_format.decode(data)
+        assert package['sender'] == 2**64 - 1
+        assert package['sequence'] == 42
+        assert batch_rows(package['batch']) == expected
+
+    package = wire_format.decode(wire_format.encode_rows(lines, 'key', '1.0'))
+    assert 'sender' not in package and 'sequence' not in package
+
+    with pytest.raises(ValueError):
+        wire_format.encode_rows(lines, 'key', '1.0', sequence=(-1, 1))
+    data = wire_format.encode_rows(lines, 'key', '1.0', sequence=(1, 1))
+    with pytest.raises(ValueError):
+        wire_format.decode(data[:wire_format.HEADER.size + 4])
+
+
+def test_compression_flag():
+    plain = wire_format.encode_rows(lines * 100, 'key', '1.0', compress=False)
+    packed = wire_format.encode_rows(lines * 100, 'key', '1.0', compress=True)
+    assert len(packed) < len(plain)
+    header = wire_format.HEADER.size
+    assert zlib.decompress(packed[header:]) == plain[header:]
+
+
+def test_bad_input():
+    with pytest.raises(ValueError):
+        wire_format.encode_rows([[1, 2, 3]], 'key', '1.0')
+    with pytest.raises(ValueError):
+        wire_format.encode_rows([[1, 70000, 2, 80, dt, 'TCP', 0, 0, 0, 0, 1]], 'key', '1.0')
+    with pytest.raises(ValueError):
+        wire_format.encode_rows([[1, 2, 3, 4, dt, None, 0, 0, 0, 0, 1]], 'key', '1.0')
+    many = [[1, 2, 3, 4, dt, 'P{0}'.format(i), 0, 0, 0, 0, 1] for i in range(wire_format.MAX_NAMES + 1)]
+    wire_format.encode_rows(many[:-1], 'key', '1.0')
+    with pytest.raises(ValueError):
+        wire_format.encode_rows(many, 'key', '1.0')
+
+    data = wire_format.encode_rows(lines, 'key', '1.0', compress=False)
+    assert not wire_format.is_binary('(dp0\n')
+    with pytest.raises(ValueError):
+        wire_format.decode(data[:-1])
+    with pytest.raises(ValueError):
+        wire_format.decode(data[:4] + chr(wire_format.FORMAT_VERSION + 1) + data[5:])
+    with pytest.raises(ValueError):
+        wire_format.decode(data[:5] + chr(wire_format.FLAG_ZLIB) + data[6:])
+
+
+def test_max_body(monkeypatch):
+    monkeypatch.setattr(wire_format, 'MAX_BODY', 1000)
+    small = wire_format.encode_rows(lines, 'key', '1.0')
+    assert len(wire_format.decode(small)['batch']) == 3
+    for compress in (True, False):
+        large = wire_format.encode_rows(lines * 100, 'key', '1.0', compress=compress)
+        with pytest.raises(ValueError):
+            wire_format.decode(large)
@@ -1,5 +1,7 @@
 from spec.python import db_connection
-from sam.models.livekeys import LiveKeys
+import time
+from sam.models import livekeys
+from sam.models.livekeys import LiveKeys, KeyCache
 
 db = db_connection.db
 sub_id = db_connection.default_sub
@@ -72,3 +74,68 @@ def test_delete_ds():
     assert len(new_keys) == 2
     assert new_keys[0]['ds_id'] == ds_empty
     assert new_keys[1]['ds_id'] == ds_empty
+
+
+def test_KeyCache():
+    calls = []
+
+    def validate(key):
+        calls.append(key)
+        return {'key': key} if key.startswith('good') else None
+
+    cache = KeyCache(maxsize=2, ttl=0.1)
+    assert cache.get('good1', validate) == {'key': 'good1'}
+    assert cache.get('good1', validate) == {'key': 'good1'}
+    assert cache.get('bad', validate) is None
+    assert cache.get('bad', validate) is None
+    assert calls == ['good1', 'bad']
+    assert cache.stats() == {'size': 2, 'hits': 2, 'misses': 2}
+
+    # the least recently used entry makes room
+    cache.get('good2', validate)
+    cache.get('good1', validate)
+    assert calls == ['good1', 'bad', 'good2', 'good1']
+
+    # entries expire
+    time.sleep(0.15)
+    cache.get('good2', validate)
+    assert calls[-1] == 'good2'
+
+    cache.clear()
+    cache.get('good2', validate)
+    assert calls.count('good2') == 3
+
+    cache = KeyCache(maxsize=0)
+    cache.get('good1', validate)
+    cache.get('good1', validate)
+    assert cache.stats() == {'size': 0, 'hits': 0, 'misses': 2}
+
+
+def test_validate_cached():
+    lk_model = LiveKeys(db, sub_id)
+    lk_model.delete_all()
+    key = lk_model.create(ds_full)
+    other = lk_model.create(ds_empty)
+    stats = livekeys.KEY_CACHE.stats()
+
+    match = lk_model.validate_cached(key)
+    assert match and match['datasource'] == ds_full
+    match = lk_model.validate_cached(key)
+    assert match and match['datasource'] == ds_full
+    assert livekeys.KEY_CACHE.stats()['hits'] == stats['hits'] + 1
+    assert livekeys.KEY_CACHE.stats()['misses'] == stats['misses'] + 1
+
+    # deleting keys invalidates the cache
+    assert lk_model.validate_cached(other)
+    lk_model.delete(key)
+    assert lk_model.validate_cached(key) is None
+    lk_model.delete_ds(ds_empty)
+    assert lk_model.validate_cached(other) is None
+
+    # as does creating them
+    assert lk_model.validate_cached('not yet') is None
+    db.insert(LiveKeys.table_livekeys, subscription=sub_id, datasource=ds_full, access_key='not yet')
+    lk_model.create(ds_full)
+    assert lk_model.validate_cached('not yet')
+    lk_model.delete_all()
+    assert lk_model.validate_cached('not yet') is None
@@ -261,3 +261,33 @@ def test_del_collection():
         assert common.IPStringtoInt("99.99.99.99") in ips
     finally:
         db.delete(m_nodes.table_nodes, where="ipstart BETWEEN $start AND $end", vars={'start': t_low, 'end': t_high})
+
+
+def test_NodeCache():
+    cache = nodes.NodeCache(maxsize=2)
+    cache.add(1, {(10, 10): (1.0, 2.0, 3.0)})
+    cache.add(1, {(20, 20): (4.0, 5.0, 6.0)})
+    cache.add(2, {(10, 10): (7.0, 8.0, 9.0)})  # pushes out the oldest entry
+    assert cache.lookup(1, [(10, 10), (20, 20)]) == {(20, 20): (4.0, 5.0, 6.0)}
+    assert cache.lookup(2, [(10, 10)]) == {(10, 10): (7.0, 8.0, 9.0)}
+    assert cache.stats() == {'size': 2, 'hits': 2, 'misses': 1}
+
+    cache.clear(1)
+    assert cache.lookup(1, [(20, 20)]) == {}
+    assert cache.lookup(2, [(10, 10)]) != {}
+    cache.clear()
+    assert cache.stats()['size'] == 0
+
+    cache = nodes.NodeCache(ttl=0)
+    cache.add(1, {(10, 10): (1.0, 2.0, 3.0)})
+    assert cache.lookup(1, [(10, 10)]) == {}
+
+
+def test_deletes_clear_node_cache():
+    m_nodes = nodes.Nodes(db, sub_id)
+    nodes.NODE_CACHE.add(sub_id, {(1, 1): (0.0, 0.0, 1.0)})
+    m_nodes.delete_hosts([1])
+    assert nodes.NODE_CACHE.lookup(sub_id, [(1, 1)]) == {}
+    nodes.NODE_CACHE.add(sub_id, {(1, 1): (0.0, 0.0, 1.0)})
+    m_nodes.delete_collection(["0.0.0.1"])
+    assert nodes.NODE_CACHE.lookup(sub_id, [(1, 1)]) == {}
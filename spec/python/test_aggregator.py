@@ -6,11 +6,15 @@ import multiprocessing
 import time
 import signal
 import pytest
+import web
 from datetime import datetime
 from spec.python import db_connection
+from sam import constants
 from sam import server_aggregator
 from sam.importers.import_base import BaseImporter
+from sam.importers import wire_format
 from sam.models.livekeys import LiveKeys
+from sam.models.datasources import Datasources
 from py._path.local import LocalPath
 
 db = db_connection.db
@@ -136,6 +140,27 @@ def test_dbi_importer():
     assert rows.first().c == 0
 
 
+def test_dbi_importer_binary():
+    dbi = server_aggregator.DatabaseInserter
+    table_syslog = "s{}_ds{}_Syslog".format(sub_id, ds_id)
+    dt = datetime(2016,7,22,13,20)
+    lines = [
+        [2852047408, 54323, 2852061180, 80, dt, 'TCP', 0, 2340, 0, 30, 1830],
+        [2852047411, 54323, 2852061183, 137, dt, 'UDP', 10, 2340, 1, 30, 1830],
+    ]
+    message = wire_format.decode(wire_format.encode_rows(lines, 'key', '1.0'))
+    try:
+        dbi.run_importer(sub_id, ds_id, [message])
+        rows = list(db.query("SELECT src, dstport, protocol, bytes_sent, bytes_received FROM {} ORDER BY src"
+                             .format(table_syslog)))
+        assert [(r.src, r.dstport, r.protocol, r.bytes_sent, r.bytes_received) for r in rows] == [
+            (2852047408, 80, 'TCP', 0, 2340),
+            (2852047411, 137, 'UDP', 10, 2340),
+        ]
+    finally:
+        db.query("DELETE FROM {}".format(table_syslog))
+
+
 def test_dbi_preprocessor():
     # tests run_preprocessor and syslog_to_tables
     dbi = server_aggregator.DatabaseInserter
@@ -202,6 +227,78 @@ def test_dbi_preprocessor():
     assert rows.first().c == 0
 
 
+def read_link_tables(ds):
+    links = "src, dst, port, protocol, links, bytes_sent, bytes_received, packets_sent, packets_received, duration"
+    aggregates = "src_start, src_end, dst_start, dst_end, protocols, port, links, bytes, packets"
+    tables = {}
+    for name, columns in (('Links', links), ('LinksIn', aggregates), ('LinksOut', aggregates)):
+        # timestamp + 0 reads the bucket as a number on both databases
+        rows = db.select("s{0}_ds{1}_{2}".format(sub_id, ds, name), what=columns + ", timestamp + 0 AS 'ts'")
+        records = []
+        for row in rows:
+            if 'protocols' in row:
+                # GROUP_CONCAT doesn't promise an order
+                row['protocols'] = sorted(row['protocols'].split(','))
+            records.append(sorted(row.items()))
+        tables[name] = sorted(records)
+    return tables
+
+
+def test_dbi_direct_equivalence():
+    ds_model = Datasources(db, {}, sub_id)
+    ds_syslog = ds_model.create_datasource('syslog path')
+    ds_direct = ds_model.create_datasource('direct path')
+    dt = datetime(2016, 7, 22, 13, 20)
+    dt2 = datetime(2016, 7, 22, 13, 24, 59)
+    dt3 = datetime(2016, 7, 22, 13, 25, 1)
+    rounds = [
+        [{'headers': BaseImporter.keys,
+          'lines': [
+              [169090600, 54323, 842810961, 80, dt, 'TCP', 10, 2340, 1, 30, 1830],
+              [169090600, 54324, 842810961, 80, dt2, 'TCP', 20, None, 2, None, 1],
+              [169090600, 54325, 842810961, 80, dt3, 'TCP', 30, 2340, 3, 30, 4],
+              [169091115, 54323, 843074132, 137, dt, 'UDP', 0, '2340', 0, '30', '1830'],
+              [169353772, 54323, 169353773, 443, dt2, 'TCP', 5, 5, 5, 5, 5],
+          ]}],
+        [{'headers': BaseImporter.keys,
+          'lines': [
+              [169090600, 54326, 842810961, 80, dt, 'TCP', 40, 100, 4, 5, 8],
+              [169090600, 54326, 842810961, 80, dt, 'UDP', 40, 100, 4, 5, 7],
+              [169091114, 1000, 842811475, 22, dt3, 'TCP', 1, 2, 3, 4, 5],
+          ]}],
+    ]
+    try:
+        syslog_dbi = server_aggregator.DatabaseInserter(server_aggregator.MemoryBuffers(), direct=False)
+        direct_dbi = server_aggregator.DatabaseInserter(server_aggregator.MemoryBuffers(), direct=True)
+        b_syslog = server_aggregator.Buffer(sub_id, ds_syslog)
+        b_direct = server_aggregator.Buffer(sub_id, ds_direct)
+        for messages in rounds:
+            map(b_syslog.add, messages)
+            syslog_dbi.service(b_syslog)
+            syslog_dbi.syslog_to_tables(b_syslog)
+
+            map(b_direct.add, messages)
+            direct_dbi.service(b_direct)
+            assert len(b_direct.links) > 0
+            rows = list(db.query("SELECT COUNT(0) AS 'c' FROM s{0}_ds{1}_Syslog".format(sub_id, ds_direct)))
+            assert rows[0].c == 0
+            direct_dbi.syslog_to_tables(b_direct)
+            assert len(b_direct.links) == 0
+
+        expected = read_link_tables(ds_syslog)
+        assert len(expected['Links']) == 6
+        assert read_link_tables(ds_direct) == expected
+        # 10.24.42.44 and 10.24.42.45 share a /24, and keep their own /32 rows
+        for name in ('LinksIn', 'LinksOut'):
+            rows = [dict(row) for row in expected[name]]
+            hosts = [(row['src_start'], row['src_end'], row['dst_start'], row['dst_end']) for row in rows
+                     if row['port'] == 443 and row['dst_end'] == 169353773]
+            assert hosts == [(169353772, 169353772, 169353773, 169353773)]
+    finally:
+        ds_model.remove_datasource(ds_syslog)
+        ds_model.remove_datasource(ds_direct)
+
+
 def test_dbi_process_buffer():
     dbi = server_aggregator.DatabaseInserter(server_aggregator.MemoryBuffers())
     dbi.syslog_to_tables = lambda x: True
@@ -248,6 +345,174 @@ def test_dbi_process_buffer():
     db.query("DELETE FROM {}".format(table_syslog))
 
 
+def test_dbi_adaptive_quotas():
+    dbi = server_aggregator.DatabaseInserter(server_aggregator.MemoryBuffers())
+    b = server_aggregator.Buffer(sub_id, ds_id)
+
+    # light load: quick preprocessing, so rows wait only briefly
+    b.syslog_rows = 10
+    b.proc_latency = 0.05
+    b.ingest_rate = 10
+    assert dbi.flush_delay(b) == dbi.MIN_DELAY
+    assert dbi.size_quota(b) == dbi.MIN_BATCH
+
+    # heavy load: slow preprocessing and a high rate make for larger batches
+    b.proc_latency = 2.0
+    b.ingest_rate = 5000
+    assert dbi.flush_delay(b) == 8.0
+    assert dbi.size_quota(b) == 40000
+    b.ingest_rate = 50000
+    assert dbi.size_quota(b) == dbi.SIZE_QUOTA
+    b.proc_latency = 60
+    assert dbi.flush_delay(b) == dbi.TIME_QUOTA
+
+    # waiting rows are counted in memory, not in the database
+    b = server_aggregator.Buffer(sub_id, ds_id)
+    b.syslog_rows = 5
+    dbi.syslog_to_tables = lambda x: True
+    assert dbi.count_rows(b) == 5
+    b.last_proc_time = time.time()
+    assert dbi.process_buffer(b) == 5
+    b.last_proc_time = time.time() - dbi.MIN_DELAY - 0.1
+    assert dbi.process_buffer(b) == 2
+
+
+def test_dbi_syslog_to_tables_measures():
+    dbi = server_aggregator.DatabaseInserter(server_aggregator.MemoryBuffers())
+    old_run_preprocessor = server_aggregator.DatabaseInserter.run_preprocessor
+    try:
+        server_aggregator.DatabaseInserter.run_preprocessor = staticmethod(lambda sub, ds: time.sleep(0.05))
+        b = server_aggregator.Buffer(sub_id, ds_id)
+        b.syslog_rows = 100
+        b.last_proc_time = time.time() - 10
+        dbi.syslog_to_tables(b)
+        assert b.syslog_rows == 0
+        assert 2.9 < b.ingest_rate < 3.1  # 30% of 10 rows/s
+        assert b.proc_latency >= 0.3 * 0.05
+    finally:
+        server_aggregator.DatabaseInserter.run_preprocessor = old_run_preprocessor
+
+
+def test_dbi_wakes_on_data():
+    m = server_aggregator.MemoryBuffers()
+    dbi = server_aggregator.DatabaseInserter(m)
+    dbi.TIME_QUOTA = 10
+    inserted = threading.Event()
+    dbi.buffer_to_syslog = lambda buff: len(buff) and buff.pop_all() and inserted.set()
+    dbi.process_buffer = lambda buff: 5
+    dbi.daemon = True
+    dbi.start()
+    try:
+        time.sleep(0.05)
+        m.add(sub_id, ds_id, 'datum')
+        # handled right away rather than at the next poll
+        assert inserted.wait(1)
+    finally:
+        dbi.shutdown()
+        dbi.join(1)
+    assert not dbi.is_alive()
+
+
+def test_Buffer_lag():
+    b = server_aggregator.Buffer(sub_id, ds_id)
+    assert b.lag() == 0
+    b.add({'headers': BaseImporter.keys, 'lines': [[1], [2]]})
+    b.add('bogus')
+    assert b.queued_rows == 2
+    b.first_queued -= 5
+    assert 5 <= b.lag() < 6
+    stats = b.stats()
+    assert stats['queued_messages'] == 2
+    assert stats['queued_rows'] == 2
+    assert stats['busy'] is False
+
+    # rows moved to the syslog table keep their arrival time until preprocessed
+    b.syslog_since = b.first_queued
+    b.pop_all()
+    assert b.queued_rows == 0
+    assert 5 <= b.lag() < 6
+    b.syslog_since = None
+    assert b.lag() == 0
+
+
+def test_FairQueue():
+    q = server_aggregator.FairQueue()
+    for item in ['1a', '1b', '1c']:
+        q.put(1, item)
+    q.put(2, '2a')
+    q.put(3, '3a')
+    q.put(2, '2b')
+    assert len(q) == 6
+    order = [q.get(timeout=0) for _ in range(6)]
+    # subscriptions take turns, however many items each has queued
+    assert order == ['1a', '2a', '3a', '1b', '2b', '1c']
+    with pytest.raises(server_aggregator.Queue.Empty):
+        q.get(timeout=0)
+
+
+def test_dbi_workers():
+    m = server_aggregator.MemoryBuffers()
+    dbi = server_aggregator.DatabaseInserter(m, workers=2)
+    assert dbi.worker_count == 2
+    slow_started = threading.Event()
+    release = threading.Event()
+    handled = []
+    in_flight = {}
+    overlap = []
+
+    def service(buff):
+        key = (buff.sub, buff.ds)
+        if in_flight.get(key):
+            overlap.append(key)
+        in_flight[key] = True
+        buff.pop_all()
+        buff.syslog_rows = 0
+        handled.append(key)
+        if buff.sub == 1:
+            slow_started.set()
+            release.wait(2)
+        in_flight[key] = False
+    dbi.service = service
+    dbi.daemon = True
+    dbi.start()
+    try:
+        m.add(1, 1, 'slow')
+        assert slow_started.wait(1)
+        m.add(1, 1, 'more for the slow data source')
+        m.add(2, 1, 'fast')
+        deadline = time.time() + 1
+        while (2, 1) not in handled and time.time() < deadline:
+            time.sleep(0.01)
+        # another subscription isn't held up by the slow one
+        assert handled.count((2, 1)) == 1
+        assert m.get(1, 1).busy
+        assert handled.count((1, 1)) == 1
+    finally:
+        release.set()
+        dbi.shutdown()
+        dbi.join(2)
+    assert not dbi.is_alive()
+    assert overlap == []
+    assert handled.count((1, 1)) == 2
+
+
+def test_dbi_serial():
+    m = server_aggregator.MemoryBuffers()
+    dbi = server_aggregator.DatabaseInserter(m, workers=0)
+    serviced = []
+    dbi.service = serviced.append
+    m.add(1, 1, 'msg')
+    m.create(1, 2)
+    for buff in m.get_all():
+        dbi.schedule(buff)
+    # buffers with messages or an unknown syslog count are handled on the calling thread
+    assert map(str, serviced) == ['1-1-1', '1-2-0']
+    m.get(1, 2).syslog_rows = 0
+    del serviced[:]
+    dbi.schedule(m.get(1, 2))
+    assert serviced == []
+
+
 def test_dbi_run():
     m = server_aggregator.MemoryBuffers()
     m.add(sub_id, ds_id, 'bogus')
@@ -313,7 +578,7 @@ def test_agg_socket_to_buffer():
     def good_response(x):
         return {'subscription': sub_id, 'datasource': ds_id}, ''
 
-    old_validate = server_aggregator.Aggregator.validate_data
+    old_validate = server_aggregator.Aggregator.__dict__['validate_data']
     try:
         server_aggregator.Aggregator.validate_data = error_response
         assert agg.socket_to_buffer('datum1') == "failed: blah"
@@ -339,6 +604,69 @@ def test_agg_socket_to_buffer():
         server_aggregator.Aggregator.validate_data = old_validate
 
 
+def test_agg_backpressure():
+    @staticmethod
+    def good_response(x):
+        return {'subscription': 7, 'datasource': 8}, ''
+
+    old_validate = server_aggregator.Aggregator.__dict__['validate_data']
+    old_stb = server_aggregator.Aggregator.__dict__['socket_to_buffer']
+    old_max = server_aggregator.Aggregator.MAX_QUEUED_ROWS
+    agg = server_aggregator.Aggregator()
+    dt = datetime(2016, 7, 22, 13, 20)
+    data = {
+        'headers': BaseImporter.keys,
+        'lines': [[2852047408, 54323, 2852061180, 80, dt, 'TCP', 0, 2340, 0, 30, 1830]] * 2
+    }
+    try:
+        server_aggregator.Aggregator.validate_data = good_response
+        server_aggregator.Aggregator.MAX_QUEUED_ROWS = 3
+        assert agg.socket_to_buffer(dict(data)) is False
+        assert agg.socket_to_buffer(dict(data)) is False
+        assert agg.socket_to_buffer(dict(data)) == server_aggregator.BUSY
+        server_aggregator.Aggregator.socket_to_buffer = staticmethod(lambda x: server_aggregator.BUSY)
+        assert agg.handle(cPickle.dumps(data)).startswith(server_aggregator.BUSY)
+    finally:
+        server_aggregator.Aggregator.validate_data = old_validate
+        server_aggregator.Aggregator.MAX_QUEUED_ROWS = old_max
+        server_aggregator.Aggregator.socket_to_buffer = old_stb
+        server_aggregator.BUFFERS.remove(7, 8)
+
+
+def test_SequenceTracker():
+    tracker = server_aggregator.SequenceTracker()
+    assert tracker.accept(1, 5)
+    assert not tracker.accept(1, 5)
+    assert tracker.accept(1, 3)  # out of order, but not seen before
+    assert tracker.accept(2, 5)  # another collector
+    assert tracker.accept(1, 5 + tracker.WINDOW)
+    assert not tracker.accept(1, 4)  # too old to tell; taken to be a duplicate
+    assert not tracker.accept(1, 5 + tracker.WINDOW)
+
+
+def test_agg_sequences():
+    @staticmethod
+    def good_response(x):
+        return {'subscription': 7, 'datasource': 8}, ''
+
+    old_validate = server_aggregator.Aggregator.__dict__['validate_data']
+    old_sequences = server_aggregator.SEQUENCES
+    agg = server_aggregator.Aggregator()
+    lines = [[2852047408, 54323, 2852061180, 80, datetime(2016, 7, 22, 13, 20), 'TCP', 0, 2340, 0, 30, 1830]]
+    try:
+        server_aggregator.Aggregator.validate_data = good_response
+        server_aggregator.SEQUENCES = server_aggregator.SequenceTracker()
+        upload = wire_format.encode_rows(lines, 'key', '1.0', sequence=(12, 1))
+        assert agg.handle(upload) == 'ack 1'
+        assert agg.handle(upload) == 'ack 1'
+        assert agg.handle(wire_format.encode_rows(lines, 'key', '1.0', sequence=(12, 2))) == 'ack 2'
+        assert server_aggregator.BUFFERS.get(7, 8).queued_rows == 2
+    finally:
+        server_aggregator.Aggregator.validate_data = old_validate
+        server_aggregator.SEQUENCES = old_sequences
+        server_aggregator.BUFFERS.remove(7, 8)
+
+
 def test_agg_handle():
     agg = server_aggregator.Aggregator()
     result = agg.handle("bad_data")
@@ -359,7 +687,7 @@ def test_agg_handle():
     def handshake_response(x):
         return 'handshake'
 
-    old_stb = server_aggregator.Aggregator.socket_to_buffer
+    old_stb = server_aggregator.Aggregator.__dict__['socket_to_buffer']
     try:
         server_aggregator.Aggregator.socket_to_buffer = handshake_response
         result = agg.handle(cPickle.dumps(['test']))
@@ -372,10 +700,36 @@ def test_agg_handle():
         server_aggregator.Aggregator.socket_to_buffer = success_response
         result = agg.handle(cPickle.dumps(['test']))
         assert result == 'success'
+
+        result = agg.handle(wire_format.encode_rows([], 'key', '1.0'))
+        assert result == 'success'
+        result = agg.handle(wire_format.MAGIC + 'garbage')
+        assert result.startswith("failed")
     finally:
         server_aggregator.Aggregator.socket_to_buffer = old_stb
 
 
+def test_stats_allowed(monkeypatch):
+    assert constants.aggregator['stats_access'] == 'local'
+    assert server_aggregator.stats_allowed('127.0.0.1') is True
+    assert server_aggregator.stats_allowed('::1') is True
+    assert server_aggregator.stats_allowed('::ffff:127.0.0.1') is True
+    assert server_aggregator.stats_allowed('10.0.0.5') is False
+
+    monkeypatch.setitem(constants.aggregator, 'stats_access', 'all')
+    assert server_aggregator.stats_allowed('10.0.0.5') is True
+    monkeypatch.setitem(constants.aggregator, 'stats_access', 'none')
+    assert server_aggregator.stats_allowed('127.0.0.1') is False
+
+
+def test_stats_pages():
+    app = web.application(['/stats', 'AggregatorStats', '/stats/preprocessing', 'PreprocessingStats'],
+                          vars(server_aggregator), autoreload=False)
+    for path in ('/stats', '/stats/preprocessing'):
+        assert app.request(path, env={'REMOTE_ADDR': '127.0.0.1'}).status == '200 OK'
+        assert app.request(path, env={'REMOTE_ADDR': '10.0.0.5'}).status == '403 Forbidden'
+
+
 def test_agg_ensure_thread():
     assert server_aggregator.IMPORTER_THREAD is None or not server_aggregator.IMPORTER_THREAD.is_alive()
     agg = server_aggregator.Aggregator()
@@ -0,0 +1,118 @@
+import json
+import time
+import socket
+import threading
+import requests
+from datetime import datetime
+from spec.python import db_connection
+from sam import constants
+from sam import server_aggregator
+from sam import server_aggregator_async
+from sam.importers import wire_format
+from sam.models.livekeys import LiveKeys
+
+db = db_connection.db
+sub_id = db_connection.default_sub
+ds_id = db_connection.dsid_short
+dt = datetime(2016, 7, 22, 13, 20)
+LINES = [
+    [2852047408, 54323, 2852061180, 80, dt, 'TCP', 0, 2340, 0, 30, 1830],
+    [2852047413, 54323, 2852061185, 137, dt, 'UDP', 0, 2340, 0, 30, 1830],
+]
+
+
+class Running(object):
+    """
+    Runs an AsyncAggregator on a free port for the duration of a with block,
+    without starting the DatabaseInserter.
+    """
+    def __init__(self, **kwargs):
+        self.server = server_aggregator_async.AsyncAggregator(('127.0.0.1', 0), **kwargs)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+
+    def __enter__(self):
+        self.old_ensure = server_aggregator.Aggregator.__dict__['ensure_processing_thread']
+        self.old_sequences = server_aggregator.SEQUENCES
+        server_aggregator.Aggregator.ensure_processing_thread = staticmethod(lambda: None)
+        server_aggregator.SEQUENCES = server_aggregator.SequenceTracker()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.thread.join()
+        server_aggregator.Aggregator.ensure_processing_thread = self.old_ensure
+        server_aggregator.SEQUENCES = self.old_sequences
+        server_aggregator.BUFFERS.remove(sub_id, ds_id)
+
+
+def test_parse_head():
+    head = 'POST /?x=1 HTTP/1.1\r\nHost: localhost\r\nContent-Length: 12'
+    method, path, headers = server_aggregator_async.IngestChannel.parse_head(head)
+    assert method == 'POST'
+    assert path == '/'
+    assert headers == {'host': 'localhost', 'content-length': '12'}
+
+
+def test_upload_and_ack():
+    l_model = LiveKeys(db, sub_id)
+    access_key = l_model.create(ds_id)
+    try:
+        with Running(decoders=2) as running:
+            session = requests.Session()
+            upload = wire_format.encode_rows(LINES, access_key, '1.0', sequence=(99, 1))
+            response = session.post(running.url, data=upload, timeout=10)
+            assert response.status_code == 200
+            assert response.content == 'ack 1'
+            # sent again: acknowledged, but only buffered once
+            response = session.post(running.url, data=upload, timeout=10)
+            assert response.content == 'ack 1'
+            assert server_aggregator.BUFFERS.get(sub_id, ds_id).queued_rows == 2
+
+            response = session.post(running.url, data=wire_format.encode_rows(LINES, access_key, '1.0'), timeout=10)
+            assert response.content == 'success'
+            response = session.post(running.url, data=wire_format.encode_rows(LINES, 'bad key', '1.0'), timeout=10)
+            assert response.content == 'failed: Not Authorized'
+
+            assert requests.get(running.url + '/nowhere', timeout=10).status_code == 404
+            assert requests.get(running.url, timeout=10).status_code == 405
+            stats = json.loads(requests.get(running.url + '/stats', timeout=10).content)
+            assert stats['uploads']['received'] == 4
+            assert stats['uploads']['refused'] == 0
+            assert 'datasources' in stats and 'key_cache' in stats
+            stats = json.loads(requests.get(running.url + '/stats/preprocessing', timeout=10).content)
+            assert 'runs' in stats and 'stages' in stats
+    finally:
+        l_model.delete_all()
+
+
+def test_stats_access(monkeypatch):
+    monkeypatch.setitem(constants.aggregator, 'stats_access', 'none')
+    with Running(decoders=0) as running:
+        assert requests.get(running.url + '/stats', timeout=10).status_code == 403
+        assert requests.get(running.url + '/stats/preprocessing', timeout=10).status_code == 403
+
+
+def test_refused_when_queue_full():
+    with Running(decoders=0, queue_size=1) as running:
+        # with no decoders, the first upload waits in the queue
+        waiting = socket.create_connection(running.server.address)
+        waiting.sendall('POST / HTTP/1.1\r\nContent-Length: 4\r\n\r\ndata')
+        deadline = time.time() + 10
+        while running.server.received == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        response = requests.post(running.url, data='more', timeout=10)
+        assert response.status_code == 503
+        assert response.content.startswith(server_aggregator.BUSY)
+        assert response.headers['Retry-After'] == str(server_aggregator.Aggregator.RETRY_AFTER)
+        waiting.close()
+
+
+def test_chunked_refused():
+    with Running(decoders=1) as running:
+        sock = socket.create_connection(running.server.address)
+        sock.sendall('POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n')
+        reply = sock.recv(4096)
+        assert reply.startswith('HTTP/1.1 411')
+        sock.close()
@@ -1,20 +1,30 @@
 import os
-import requests
+import socket
 import cPickle
 from spec.python import db_connection
 from sam import server_collector
+from sam.importers import wire_format
+from sam.importers.import_base import ColumnBatch
 from sam.importers.import_tcpdump import TCPDumpImporter
 from sam.importers.import_paloalto import PaloAltoImporter
 import threading
 import multiprocessing
 import time
 import signal
+from datetime import datetime
 
 # db = db_connection.db
 # sub_id = db_connection.default_sub
 # ds_full = db_connection.dsid_default
 
 
+def make_batch(lines):
+    batch = ColumnBatch()
+    for line in lines:
+        batch.append_dict(dict(zip(server_collector.base_importer.BaseImporter.keys, line)))
+    return batch
+
+
 def test_SocketBuffer():
     assert isinstance(server_collector.SOCKET_BUFFER, server_collector.SocketBuffer)
 
@@ -32,17 +42,55 @@ def test_SocketBuffer():
     assert contents[2] == bs
 
 
-def test_SocketListener():
-    buffer = server_collector.SOCKET_BUFFER
+def test_SocketBuffer_capacity():
+    buffer = server_collector.SocketBuffer(capacity=4)
+    buffer.store_batch(['a', 'b', 'c'])
+    buffer.store_batch(['d', 'e', 'f'])
+    assert len(buffer) == 4
+    assert buffer.dropped == 2
+    assert buffer.pop_all() == ['a', 'b', 'c', 'd']
+
+    # receiving continues into the other slot list
+    buffer.store_data('g')
+    assert buffer.pop_all() == ['g']
+    assert buffer.pop_all() == []
+    assert buffer.slots == [None] * 4 and buffer.spare == [None] * 4
+
+
+def test_SocketBuffer_ready():
+    buffer = server_collector.SocketBuffer()
+    buffer.DRAIN_SIZE = 3
+    buffer.store_batch(['a', 'b'])
+    assert not buffer.ready.is_set()
+    buffer.store_data('c')
+    assert buffer.ready.is_set()
     buffer.pop_all()
-    assert len(buffer) == 0
+    assert not buffer.ready.is_set()
 
-    server_collector.SocketListener(('data1', None), ('foreign', 'address'), None)
-    server_collector.SocketListener(('data2\n', None), ('foreign', 'address'), None)
-    server_collector.SocketListener((' \t data3', None), ('foreign', 'address'), None)
-    assert len(buffer) == 3
-    datas = buffer.pop_all()
-    assert datas == ['data1', 'data2\n', ' \t data3']
+
+def test_UDPReceiver():
+    buffer = server_collector.SocketBuffer()
+    receiver = server_collector.UDPReceiver(('127.0.0.1', 0), buffer)
+    receiver.daemon = True
+    receiver.start()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for i in range(100):
+            sender.sendto('line {0}'.format(i), receiver.address)
+        deadline = time.time() + 2
+        while len(buffer) < 100 and time.time() < deadline:
+            time.sleep(0.01)
+        assert buffer.pop_all() == ['line {0}'.format(i) for i in range(100)]
+        stats = receiver.stats()
+        assert stats['received'] == 100
+        assert stats['buffer_drops'] == 0
+        assert stats['rcvbuf'] > 0
+        if os.path.exists('/proc/net/udp'):
+            assert stats['kernel_drops'] == 0
+    finally:
+        sender.close()
+        receiver.shutdown()
+        receiver.join()
 
 
 def test_FileListener():
@@ -87,47 +135,178 @@ def test_import_packets():
     collector = server_collector.Collector()
     collector.importer = TCPDumpImporter()
     assert len(buffer) == 9
-    assert collector.transmit_buffer == []
+    assert len(collector.transmit_buffer) == 0
     assert collector.transmit_buffer_size == 0
 
     collector.import_packets()
     assert len(buffer) == 0
     assert len(collector.transmit_buffer) == 3
     assert collector.transmit_buffer_size == 3
+    assert collector.skipped == {'unparseable': 6}
+    collector.report_skipped()
+    assert not collector.skipped
+    return buffer_data, collector.transmit_buffer.rows()
 
 
-def test_transmit_lines():
+def test_import_packets_pool():
+    buffer = server_collector.SOCKET_BUFFER
+    buffer_data, expected = test_import_packets()
+
     collector = server_collector.Collector()
-    collector.transmit_buffer = ['data1', 'data2', 'data3']
-    old_request = requests.request
+    collector.importer = TCPDumpImporter()
+    collector.TRANSLATE_CHUNK = 2
+    collector.start_translators(2)
     try:
-        mocker = db_connection.Mocker()
-        class Response:
-            content = "test_response"
-        mocker._retval = Response()
-        requests.request = mocker
-
-        assert collector.transmit_lines() == 'test_response'
-        assert len(mocker.calls) == 1
-        call_data_pickled = mocker.calls[0][2]['data']
-        call_data = cPickle.loads(call_data_pickled)
-        assert set(call_data.keys()) == {'access_key', 'version', 'headers', 'lines'}
-        assert collector.transmit_buffer == []
-        assert collector.transmit_buffer_size == 0
-
-        mocker._retval = None
-        collector.transmit_buffer = ['data1', 'data2', 'data3']
-        assert collector.transmit_lines() == 'error'
-        assert collector.transmit_buffer == ['data1', 'data2', 'data3']
+        assert collector.pool is not None
+        map(buffer.store_data, buffer_data)
+        collector.import_packets()
+        assert len(buffer) == 0
+        # chunks may finish in any order, but are added in the order they arrived
+        collector.collect_translations(wait=True)
+        assert not collector.pending
+        assert collector.transmit_buffer.rows() == expected
         assert collector.transmit_buffer_size == 3
+        assert collector.skipped == {'unparseable': 6}
     finally:
-        requests.request = old_request
+        collector.stop_translators()
+    assert collector.pool is None
+
+
+def test_stateful_translation_single_process():
+    from sam.importers.import_netflow import NetFlowImporter
+    collector = server_collector.Collector()
+    collector.importer = NetFlowImporter()
+    collector.start_translators(4)
+    assert collector.pool is None
+    assert collector.workers == 1
+
+
+def test_transmit_lines():
+    collector = server_collector.Collector()
+    dt = datetime(2016, 7, 22, 13, 20)
+    lines = [
+        [2852047408, 54323, 2852061180, 80, dt, 'TCP', 0, 2340, 0, 30, 1830],
+        [2852047409, '54323', 2852061181, '80', dt, 'TCP', None, '2340', None, '30', '1830'],
+        [2852047410, 54323, 2852061182, 80, dt, 'UDP', 0, 2340, 0, 30, 1830],
+    ]
+    collector.transmit_buffer = make_batch(lines)
+    mocker = db_connection.Mocker()
+    class Response:
+        content = "test_response"
+    mocker._retval = Response()
+    collector.sender.session.request = mocker
+
+    assert collector.transmit_lines() == 'test_response'
+    assert len(mocker.calls) == 1
+    call_data = wire_format.decode(mocker.calls[0][2]['data'])
+    assert set(call_data.keys()) == {'access_key', 'version', 'headers', 'batch', 'sender', 'sequence'}
+    assert len(call_data['batch']) == 3
+    assert call_data['sender'] == collector.sender_id
+    assert call_data['sequence'] == 1
+    assert len(collector.transmit_buffer) == 0
+    assert collector.transmit_buffer_size == 0
+
+    # unsent packages are queued for the sender to retry
+    mocker._retval = None
+    collector.transmit_buffer = make_batch(lines)
+    assert collector.transmit_lines() == 'error'
+    assert len(collector.transmit_buffer) == 0
+    assert collector.transmit_buffer_size == 0
+    assert len(collector.sender.queue) == 1
+    data, line_count = collector.sender.queue.get(timeout=0)
+    assert line_count == 3
+    # each package gets the next sequence number, and keeps it when it is resent
+    assert wire_format.decode(data)['sequence'] == 2
+
+    # aggregators older than the binary format are still sent pickles
+    mocker._retval = Response()
+    collector.wire_format = 'pickle'
+    collector.transmit_buffer = make_batch(lines)
+    assert collector.transmit_lines() == 'test_response'
+    call_data = cPickle.loads(mocker.calls[-1][2]['data'])
+    assert set(call_data.keys()) == {'access_key', 'version', 'headers', 'lines'}
+    assert call_data['lines'] == [list(row) for row in make_batch(lines).rows()]
+    assert call_data['lines'][0][4] == dt
+
+
+def test_adapt_threshold():
+    collector = server_collector.Collector()
+    assert collector.transmit_buffer_threshold == collector.MIN_TRANSMIT_ROWS
+    collector.adapt_threshold(20000, 0.5)
+    assert collector.transmit_buffer_threshold == 40000
+    collector.adapt_threshold(100000, 0.5)
+    assert collector.transmit_buffer_threshold == collector.MAX_TRANSMIT_ROWS
+    collector.adapt_threshold(10, 5)
+    assert collector.transmit_buffer_threshold == collector.MIN_TRANSMIT_ROWS
+    collector.adapt_threshold(10, 0)
+    assert collector.transmit_buffer_threshold == collector.MIN_TRANSMIT_ROWS
+
+
+def test_transmit_lines_queued():
+    collector = server_collector.Collector()
+    dt = datetime(2016, 7, 22, 13, 20)
+    lines = [[2852047408, 54323, 2852061180, 80, dt, 'TCP', 0, 2340, 0, 30, 1830]]
+    sender = collector.sender
+    sender.RETRY_DELAY = 0.01
+    replies = [None, None]  # two failed attempts, then success
+
+    class Response:
+        content = "success"
+
+    def request(method, url, data=None, timeout=None):
+        return replies.pop(0) if replies else Response()
+
+    sender.session.request = request
+    sender.start()
+    try:
+        collector.transmit_buffer = make_batch(lines)
+        assert collector.transmit_lines() == 'queued'
+        assert len(collector.transmit_buffer) == 0
+        time.sleep(0.2)
+        stats = sender.stats()
+        assert stats['sent'] == 1
+        assert stats['failures'] == 2
+        assert stats['memory'] == 0
+        assert stats['disk'] == 0
+        assert stats['in_flight'] == 0
+        assert stats['latency_ms'] is not None
+
+        # packages the queue can't hold are dropped, rather than held in memory
+        sender.enqueue = lambda data, line_count: False
+        collector.transmit_buffer = make_batch(lines)
+        assert collector.transmit_lines() == 'dropped'
+        assert len(collector.transmit_buffer) == 0
+    finally:
+        sender.stop()
+    assert not sender.is_running()
+
+
+def test_sender_busy():
+    collector = server_collector.Collector()
+    mocker = db_connection.Mocker()
+    collector.sender.session.request = mocker
+
+    class BusyResponse:
+        content = "busy: too many lines waiting; retry later."
+
+    mocker._retval = BusyResponse()
+    try:
+        collector.sender.post('data')
+        assert False, "expected AggregatorBusy"
+    except server_collector.AggregatorBusy:
+        pass
+
+    # refused uploads are kept for the sender to retry
+    collector.transmit_buffer = make_batch([[2852047408, 54323, 2852061180, 80, datetime(2016, 7, 22, 13, 20),
+                                             'TCP', 0, 2340, 0, 30, 1830]])
+    assert collector.transmit_lines() == 'error'
+    assert len(collector.sender.queue) == 1
 
 
 def test_test_connection():
     collector = server_collector.Collector()
-    old_request = requests.request
     mocker = db_connection.Mocker()
+    collector.sender.session.request = mocker
 
     class GoodResponse:
         content = "handshake"
@@ -145,26 +324,20 @@ def test_test_connection():
         def __init__(self):
             pass
 
-    try:
-
-        mocker._retval = GoodResponse()
-        requests.request = mocker
-        assert collector.test_connection() is True
+    mocker._retval = GoodResponse()
+    assert collector.test_connection() is True
 
-        mocker._retval = BadResponse()
-        requests.request = mocker
-        assert collector.test_connection() is False
+    mocker._retval = BadResponse()
+    assert collector.test_connection() is False
 
-        mocker._retval = NoResponse()
-        assert collector.test_connection() is False
+    mocker._retval = NoResponse()
+    assert collector.test_connection() is False
 
-        assert len(mocker.calls) == 3
-        call_data_pickled = mocker.calls[0][2]['data']
-        call_data = cPickle.loads(call_data_pickled)
-        assert set(call_data.keys()) == {'access_key', 'version', 'headers', 'msg', 'lines'}
-        assert call_data['msg'] == 'handshake'
-    finally:
-        requests.request = old_request
+    assert len(mocker.calls) == 3
+    call_data = wire_format.decode(mocker.calls[0][2]['data'])
+    assert set(call_data.keys()) == {'access_key', 'version', 'headers', 'msg', 'batch', 'sender', 'sequence'}
+    assert call_data['msg'] == 'handshake'
+    assert len(call_data['batch']) == 0
 
 
 def test_thread_batch_processor():
@@ -197,6 +197,24 @@ def test_get_db():
     assert isinstance(db, web.db.SqliteDB)
 
 
+def test_get_infile_db():
+    mysqlconfig = {
+        'dbn': "mysql",
+        'db': db_connection.TEST_DATABASE_MYSQL,
+        'host': "localhost",
+        'user': "root",
+        'pw': constants.dbconfig['pw'],
+        'port': 3306
+    }
+    db, dbq = common.get_db(dict(mysqlconfig))
+    assert 'local_infile' not in db.keywords
+    assert 'local_infile' not in dbq.keywords
+
+    db = common.get_infile_db(mysqlconfig)
+    assert 'local_infile' not in mysqlconfig
+    assert db.keywords['local_infile'] == 1
+
+
 def test_db_concat():
     class C:
         def __init__(self, dbn):
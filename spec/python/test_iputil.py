@@ -0,0 +1,54 @@
+import pytest
+from sam import iputil
+
+
+def test_encode():
+    assert iputil.encode("0.0.0.0") == 0
+    assert iputil.encode("1.2.3.4") == 16909060
+    assert iputil.encode("255.255.255.255") == 2**32 - 1
+    assert iputil.encode(u"192.168.10.113") == 3232238193
+    # the socket module rejects leading zeros; they still parse
+    assert iputil.encode("010.020.030.040") == 169090600
+    with pytest.raises(ValueError):
+        iputil.encode("1.2.3")
+    with pytest.raises(ValueError):
+        iputil.encode("1.2.3.x")
+
+
+def test_encode_partial():
+    assert iputil.encode_partial("10.20.30.40") == 169090600
+    assert iputil.encode_partial("10") == 167772160
+    assert iputil.encode_partial("10.20") == 169082880
+    assert iputil.encode_partial("10.20.30.0/24") == 169090560
+    assert iputil.encode_partial("10.x.30.40") == 167779880
+
+
+def test_decode():
+    assert iputil.decode(0) == "0.0.0.0"
+    assert iputil.decode(16909060) == "1.2.3.4"
+    assert iputil.decode(2**32 - 1) == "255.255.255.255"
+    assert iputil.decode(3232238193L) == "192.168.10.113"
+
+
+def test_batches():
+    ips = ["1.2.3.4", "255.255.255.255", "0.0.0.0", "192.168.10.113"]
+    nums = [16909060, 2**32 - 1, 0, 3232238193]
+    encoded = iputil.encode_many(ips)
+    assert encoded.itemsize == 4
+    assert list(encoded) == nums
+    assert iputil.decode_many(encoded) == ips
+    assert iputil.decode_many(nums) == ips
+    assert list(iputil.encode_many(["01.2.3.4", "1.2.3.4"])) == [16909060, 16909060]
+    assert list(iputil.encode_many([])) == []
+    assert iputil.decode_many([]) == []
+    with pytest.raises(ValueError):
+        iputil.encode_many(["1.2.3.4", "1.2"])
+
+
+def test_cached_decoder():
+    decode = iputil.make_cached_decoder(maxsize=2)
+    assert decode(16909060) == "1.2.3.4"
+    assert decode(16909060) == "1.2.3.4"
+    assert decode(0) == "0.0.0.0"
+    assert decode(1) == "0.0.0.1"
+    assert decode(16909060) == "1.2.3.4"
@@ -8,6 +8,7 @@ from sam import constants, launcher, preprocess
 from sam import server_webserver
 from sam import server_collector
 from sam import server_aggregator
+from sam import server_aggregator_async
 from sam.importers import import_base
 from sam.models.livekeys import LiveKeys
 from sam.models.datasources import Datasources
@@ -41,7 +42,10 @@ def test_parse_args():
         'whois': False,
         'wsgi': False,
         'dest': 'default',
-        'sub': None
+        'sub': None,
+        'workers': None,
+        'aggregate': False,
+        'async': False
     }
     assert args == []
 
@@ -54,7 +58,10 @@ def test_parse_args():
         'whois': False,
         'wsgi': False,
         'dest': 'default',
-        'sub': None
+        'sub': None,
+        'workers': None,
+        'aggregate': False,
+        'async': False
     }
     assert args == []
 
@@ -67,7 +74,10 @@ def test_parse_args():
         'whois': False,
         'wsgi': True,
         'dest': 'default',
-        'sub': None
+        'sub': None,
+        'workers': None,
+        'aggregate': False,
+        'async': False
     }
     assert args == []
 
@@ -80,7 +90,10 @@ def test_parse_args():
         'whois': False,
         'wsgi': False,
         'dest': 'default',
-        'sub': None
+        'sub': None,
+        'workers': None,
+        'aggregate': False,
+        'async': False
     }
     assert args == ['wsgi']
 
@@ -93,7 +106,10 @@ def test_parse_args():
         'whois': True,
         'wsgi': False,
         'dest': 'default',
-        'sub': None
+        'sub': None,
+        'workers': None,
+        'aggregate': False,
+        'async': False
     }
     assert args == []
 
@@ -106,7 +122,10 @@ def test_parse_args():
         'whois': False,
         'wsgi': False,
         'dest': 'default',
-        'sub': None
+        'sub': None,
+        'workers': None,
+        'aggregate': False,
+        'async': False
     }
     assert args == []
 
@@ -119,7 +138,10 @@ def test_parse_args():
         'whois': False,
         'wsgi': False,
         'dest': 'newds',
-        'sub': '4'
+        'sub': '4',
+        'workers': None,
+        'aggregate': False,
+        'async': False
     }
     assert args == []
 
@@ -132,7 +154,10 @@ def test_parse_args():
         'whois': False,
         'wsgi': False,
         'dest': 'default',
-        'sub': None
+        'sub': None,
+        'workers': None,
+        'aggregate': False,
+        'async': False
     }
     assert args == []
 
@@ -145,10 +170,51 @@ def test_parse_args():
         'whois': False,
         'wsgi': False,
         'dest': 'default',
-        'sub': None
+        'sub': None,
+        'workers': None,
+        'aggregate': False,
+        'async': False
     }
     assert args == ['../data/syslog']
 
+    argv = 'launcher.py --target=import --format=paloalto --workers=4 ../data/syslog'.split()
+    parsed, args = launcher.parse_args(argv)
+    assert parsed == {
+        'format': 'paloalto',
+        'port': None,
+        'target': 'import',
+        'whois': False,
+        'wsgi': False,
+        'dest': 'default',
+        'sub': None,
+        'workers': '4',
+        'aggregate': False,
+        'async': False
+    }
+    assert args == ['../data/syslog']
+
+    argv = 'launcher.py --target=import --format=tcpdump --aggregate ../data/syslog'.split()
+    parsed, args = launcher.parse_args(argv)
+    assert parsed == {
+        'format': 'tcpdump',
+        'port': None,
+        'target': 'import',
+        'whois': False,
+        'wsgi': False,
+        'dest': 'default',
+        'sub': None,
+        'workers': None,
+        'aggregate': True,
+        'async': False
+    }
+    assert args == ['../data/syslog']
+
+    argv = 'launcher.py --target=aggregator --async'.split()
+    parsed, args = launcher.parse_args(argv)
+    assert parsed['target'] == 'aggregator'
+    assert parsed['async'] is True
+    assert args == []
+
 
 def test_launch_webserver():
     old_start_wsgi = server_webserver.start_wsgi
@@ -186,12 +252,16 @@ def test_launch_collector():
         parsed = {'port': '8040', 'format': 'aws'}
         mocker = launcher.launch_collector(parsed, None)
         assert len(mocker.calls) == 1
-        assert mocker.calls[0] == ('run', (), {'port': '8040', 'format': 'aws'})
+        assert mocker.calls[0] == ('run', (), {'port': '8040', 'format': 'aws', 'workers': 1})
 
-        parsed = {'port': None, 'format': 'tcpdump'}
+        parsed = {'port': None, 'format': 'tcpdump', 'workers': '4'}
         mocker = launcher.launch_collector(parsed, None)
         assert len(mocker.calls) == 1
-        assert mocker.calls[0] == ('run', (), {'port': constants.collector['listen_port'], 'format': 'tcpdump'})
+        assert mocker.calls[0] == ('run', (), {'port': constants.collector['listen_port'], 'format': 'tcpdump',
+                                               'workers': 4})
+
+        parsed = {'port': None, 'format': 'tcpdump', 'workers': 'many'}
+        assert launcher.launch_collector(parsed, None) is None
     finally:
         server_collector.Collector = old_collector
 
@@ -229,7 +299,7 @@ def test_launch_collector_stream():
         assert len(mocker.calls) == 1
         assert mocker.calls[0][0] == 'run_streamreader'
         assert mocker.calls[0][1][0] is sys.stdin
-        assert mocker.calls[0][2] == {'format': 'paloalto'}
+        assert mocker.calls[0][2] == {'format': 'paloalto', 'workers': 1}
     finally:
         server_collector.Collector = old_collector
 
@@ -237,9 +307,11 @@ def test_launch_collector_stream():
 def test_launch_aggregator():
     old_start_wsgi = server_aggregator.start_wsgi
     old_start_server = server_aggregator.start_server
+    old_start_async = server_aggregator_async.start_server
     try:
         server_aggregator.start_wsgi = db_connection.Mocker()
         server_aggregator.start_server = db_connection.Mocker()
+        server_aggregator_async.start_server = db_connection.Mocker()
 
         parsed = {'port': '8040', 'wsgi': False}
         launcher.launch_aggregator(parsed, None)
@@ -257,9 +329,16 @@ def test_launch_aggregator():
         launcher.launch_aggregator(parsed, None)
         assert len(server_aggregator.start_wsgi.calls) == 1
         assert len(server_aggregator.start_server.calls) == 2
+
+        parsed = {'port': '8040', 'wsgi': False, 'async': True}
+        launcher.launch_aggregator(parsed, None)
+        assert len(server_aggregator.start_server.calls) == 2
+        assert len(server_aggregator_async.start_server.calls) == 1
+        assert server_aggregator_async.start_server.calls[0][2] == {'port': '8040'}
     finally:
         server_aggregator.start_wsgi = old_start_wsgi
         server_aggregator.start_server = old_start_server
+        server_aggregator_async.start_server = old_start_async
 
 
 def test_launch_importer():
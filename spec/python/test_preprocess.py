@@ -0,0 +1,262 @@
+from datetime import datetime
+from spec.python import db_connection
+from sam import common
+from sam import preprocess
+from sam.models import nodes
+from sam.importers.import_base import BaseImporter
+from spec.benchmarks import bench_rollup
+
+db = db_connection.db
+sub_id = db_connection.default_sub
+ds_id = db_connection.dsid_short
+ds_full = db_connection.dsid_default
+ds_empty = db_connection.dsid_live
+
+
+def read_nodes(prefix):
+    low, high = common.determine_range_string(prefix)
+    rows = db.select("s{0}_Nodes".format(sub_id), what="ipstart, ipend, subnet, x, y, radius",
+                     where="ipstart BETWEEN $low AND $high", vars={'low': low, 'high': high})
+    return {(row.ipstart, row.ipend): (row.subnet, row.x, row.y, row.radius) for row in rows}
+
+
+def read_aggregates(table):
+    rows = db.select(table, what="src_start, src_end, dst_start, dst_end, protocols, port, timestamp + 0 AS 'ts'"
+                                 ", links, bytes, packets")
+    aggregates = {}
+    for row in rows:
+        key = (row.src_start, row.src_end, row.dst_start, row.dst_end, row.port, row.ts)
+        aggregates[key] = (sorted(row.protocols.split(',')), row.links, row.bytes, row.packets)
+    return aggregates
+
+
+def test_rollup_matches_sql():
+    processor = preprocess.Preprocessor(db, sub_id, ds_empty, security_rules=False)
+    links_in = processor.tables['table_links_in']
+    links_out = processor.tables['table_links_out']
+    src = common.IPStringtoInt('202.1.2.3')
+    # a host in the same /24, the same /16, the same /8 and another /8
+    dsts = map(common.IPStringtoInt, ['202.1.2.4', '202.1.9.4', '202.7.2.4', '203.1.2.3'])
+    links = {(src, dst, 80, 'TCP', 1469218800): [1, 100, 10, 2, 1, 5] for dst in dsts}
+    nodes.NODE_CACHE.clear()
+    try:
+        processor.ips_to_nodes(set(dsts) | {src})
+        processor.links_to_staging_links(links)
+        processor.staging_links_to_links()
+        processor.staging_to_null()
+        span = db.select(processor.tables['table_links'],
+                         what="MIN(timestamp) AS 'tstart', MAX(timestamp) AS 'tend'").first()
+        bench_rollup.old_path(processor, span.tstart, span.tend)
+        expected_in = read_aggregates(links_in)
+        expected_out = read_aggregates(links_out)
+
+        processor.rebuild_links_in_out()
+        assert read_aggregates(links_in) == expected_in
+        assert read_aggregates(links_out) == expected_out
+        # within a /24, both hosts keep their own /32 rows
+        assert [key[:4] for key in expected_in if key[3] == dsts[0]] == [(src, src, dsts[0], dsts[0])]
+        assert [key[:4] for key in expected_out if key[0] == src and key[2] == dsts[0]] == [(src, src, dsts[0], dsts[0])]
+    finally:
+        for table in ('table_staging_links', 'table_links_in', 'table_links_out', 'table_links'):
+            db.delete(processor.tables[table], where="1")
+        for prefix in ('202', '203'):
+            low, high = common.determine_range_string(prefix)
+            db.delete("s{0}_Nodes".format(sub_id), where="ipstart BETWEEN $low AND $high",
+                      vars={'low': low, 'high': high})
+        nodes.NODE_CACHE.clear()
+
+
+def test_links_merge():
+    processor = preprocess.Preprocessor(db, sub_id, ds_full, security_rules=False)
+    links = processor.tables['table_links']
+    link = db.select(links, what="src, dst, port, protocol, timestamp + 0 AS 'ts'", limit=1).first()
+    staged = [
+        # a new protocol for existing aggregates
+        dict(src=link.src, dst=link.dst, port=link.port, protocol='ICMP', timestamp=link.ts, links=2,
+             bytes_sent=100, bytes_received=10, packets_sent=2, packets_received=1, duration=1),
+        # more of an existing link
+        dict(src=link.src, dst=link.dst, port=link.port, protocol=link.protocol, timestamp=link.ts, links=1,
+             bytes_sent=100, bytes_received=0, packets_sent=2, packets_received=0, duration=1),
+        # a new port
+        dict(src=link.dst, dst=link.src, port=9, protocol='UDP', timestamp=link.ts, links=3,
+             bytes_sent=300, bytes_received=30, packets_sent=6, packets_received=3, duration=1),
+        # another host in the same /24
+        dict(src=link.src, dst=link.src ^ 1, port=9, protocol='TCP', timestamp=link.ts, links=1,
+             bytes_sent=50, bytes_received=5, packets_sent=1, packets_received=1, duration=1),
+    ]
+    before = db.select(links, what="links, bytes_sent, packets_sent, duration",
+                       where="src=$src AND dst=$dst AND port=$port AND protocol=$protocol AND timestamp + 0 = $ts",
+                       vars=link).first()
+
+    def restore():
+        db.delete(links, where="timestamp + 0 = $ts AND (protocol = 'ICMP' OR port = 9)", vars=link)
+        db.update(links, where="src=$src AND dst=$dst AND port=$port AND protocol=$protocol AND timestamp + 0 = $ts",
+                  vars=link, links=before.links, bytes_sent=before.bytes_sent, packets_sent=before.packets_sent,
+                  duration=before.duration)
+        processor.rebuild_links_in_out()
+
+    nodes.NODE_CACHE.clear()
+    try:
+        processor.ips_to_nodes({link.src ^ 1})
+        db.multiple_insert(processor.tables['table_staging_links'], values=staged)
+        processor.staging_links_to_links()
+        processor.links_to_links_in_out()
+        merged_in = read_aggregates(processor.tables['table_links_in'])
+        merged_out = read_aggregates(processor.tables['table_links_out'])
+        # both hosts in the same /24 keep their own /32 rows
+        assert (link.src, link.src, link.src ^ 1, link.src ^ 1, 9, link.ts) in merged_in
+        assert (link.src, link.src, link.src ^ 1, link.src ^ 1, 9, link.ts) in merged_out
+
+        processor.rebuild_links_in_out()
+        assert merged_in == read_aggregates(processor.tables['table_links_in'])
+        assert merged_out == read_aggregates(processor.tables['table_links_out'])
+
+        # the former per-level queries
+        db.delete(processor.tables['table_links_in'], where="1")
+        db.delete(processor.tables['table_links_out'], where="1")
+        span = db.select(links, what="MIN(timestamp) AS 'tstart', MAX(timestamp) AS 'tend'").first()
+        bench_rollup.old_path(processor, span.tstart, span.tend)
+        assert merged_in == read_aggregates(processor.tables['table_links_in'])
+        assert merged_out == read_aggregates(processor.tables['table_links_out'])
+
+        # the fallback for old SQLite versions, from the aggregates before the staged links were added
+        restore()
+        processor.links_to_links_in_out_replace()
+        assert merged_in == read_aggregates(processor.tables['table_links_in'])
+        assert merged_out == read_aggregates(processor.tables['table_links_out'])
+    finally:
+        processor.staging_to_null()
+        restore()
+        for ipstart, ipend in processor.new_nodes:
+            db.delete("s{0}_Nodes".format(sub_id), where="ipstart=$ipstart AND ipend=$ipend",
+                      vars={'ipstart': ipstart, 'ipend': ipend})
+        nodes.NODE_CACHE.clear()
+
+
+def test_staging_links_upsert():
+    processor = preprocess.Preprocessor(db, sub_id, ds_full, security_rules=False)
+    links = processor.tables['table_links']
+    link = db.select(links, what="src, dst, port, protocol, timestamp + 0 AS 'ts', links, bytes_sent, bytes_received"
+                                 ", packets_sent, packets_received, duration", limit=1).first()
+    staged = [
+        dict(src=link.src, dst=link.dst, port=link.port, protocol=link.protocol, timestamp=link.ts, links=3,
+             bytes_sent=100, bytes_received=10, packets_sent=2, packets_received=1, duration=link.duration + 40),
+        dict(src=link.src, dst=link.dst, port=9, protocol='UDP', timestamp=link.ts, links=3,
+             bytes_sent=300, bytes_received=30, packets_sent=6, packets_received=3, duration=1),
+    ]
+    where = "src=$src AND dst=$dst AND port IN ($port, 9) AND timestamp + 0 = $ts"
+    columns = "port, links, bytes_sent, bytes_received, packets_sent, packets_received, duration"
+
+    def merge(method):
+        try:
+            db.multiple_insert(processor.tables['table_staging_links'], values=staged)
+            method()
+            return db.select(links, what=columns, where=where, vars=link, order="port").list()
+        finally:
+            processor.staging_to_null()
+            db.delete(links, where="timestamp + 0 = $ts AND port = 9", vars=link)
+            db.update(links, where=where, vars=link, links=link.links, bytes_sent=link.bytes_sent,
+                      bytes_received=link.bytes_received, packets_sent=link.packets_sent,
+                      packets_received=link.packets_received, duration=link.duration)
+
+    upserted = merge(processor.staging_links_to_links)
+    assert upserted == merge(processor.staging_links_to_links_replace)
+    existing = [row for row in upserted if row.port == link.port][0]
+    assert existing.links == link.links + 3
+    assert existing.bytes_sent == link.bytes_sent + 100
+    assert existing.duration == (link.duration * link.links + (link.duration + 40) * 3) // (link.links + 3)
+    assert [row.links for row in upserted if row.port == 9] == [3]
+
+
+def test_run_all_profile():
+    processor = preprocess.Preprocessor(db, sub_id, ds_empty, security_rules=False, explain=True)
+    dt = datetime(2016, 7, 22, 13, 20)
+    lines = [
+        [169090600, 54323, 842810961, 80, dt, 'TCP', 0, 2340, 0, 30, 1830],
+        [169090601, 54323, 842811474, 80, dt, 'TCP', 0, 2340, 0, 30, 1830],
+        [169091115, 54323, 843074132, 137, dt, 'UDP', 0, 2340, 0, 30, 1830],
+        [169090600, 54323, 842810961, 80, dt, 'TCP', 0, 2340, 0, 30, 1830],
+    ]
+    db.multiple_insert(processor.tables['table_syslog'], values=[dict(zip(BaseImporter.keys, line)) for line in lines])
+    preprocess.PROFILES.clear()
+    try:
+        processor.run_all()
+        profile = processor.last_profile
+        assert profile['committed']
+        assert [stage['stage'] for stage in profile['stages']] == [
+            'nodes', 'staging', 'links', 'links_in_out', 'rules', 'hooks', 'cleanup', 'commit']
+        stages = {stage['stage']: stage for stage in profile['stages']}
+        assert stages['staging']['rows'] == 3
+        assert stages['links']['rows'] == 3
+        assert stages['cleanup']['rows'] == 3 + 4
+        assert stages['links_in_out']['statements'] == 2
+        assert profile['db_seconds'] <= profile['seconds']
+        # the aggregate merge is explained before it runs
+        assert len(stages['links_in_out']['plans']) == 2
+        assert all(plan['plan'] for plan in stages['links_in_out']['plans'])
+        assert profile['stages'][0]['stage'] in preprocess.format_profile(profile)
+
+        stats = preprocess.PROFILES.stats()
+        assert stats['runs'] == [profile]
+        assert stats['stages']['links']['runs'] == 1
+        assert stats['stages']['links']['max_seconds'] == stages['links']['seconds']
+    finally:
+        for table in ('table_syslog', 'table_staging_links', 'table_links_in', 'table_links_out', 'table_links'):
+            db.delete(processor.tables[table], where="1")
+        preprocess.PROFILES.clear()
+
+
+def test_ProfileHistory():
+    history = preprocess.ProfileHistory(size=2)
+    for seconds in (1.0, 2.0, 4.0):
+        history.add({'stages': [{'stage': 'links', 'seconds': seconds, 'db_seconds': seconds / 2, 'rows': 1}]})
+    stats = history.stats()
+    assert len(stats['runs']) == 2
+    assert stats['stages'] == {'links': {'runs': 2, 'max_seconds': 4.0, 'mean_seconds': 3.0,
+                                         'mean_db_seconds': 1.5, 'rows': 2}}
+
+
+def test_node_layout():
+    layouts = {}
+    ip = common.IPStringtoInt('201.2.3.4')
+    # 201 = 12 * 16 + 9
+    layouts[(ip >> 24 << 24, (ip >> 24 << 24) + 0xffffff)] = preprocess.node_layout(8, ip >> 24 << 24, layouts)
+    x, y, radius = layouts.values()[0]
+    assert (x, y, radius) == (331776 * 9 / 7.5 - 331776, 331776 * 12 / 7.5 - 331776, 20736)
+    # 201.2 is in column 2, row 0 of its parent
+    assert preprocess.node_layout(16, ip >> 16 << 16, layouts) == (
+        (radius * 2 / 7.5 - radius) + x, (radius * 0 / 7.5 - radius) + y, radius / 24)
+    # no parent: not placed
+    assert preprocess.node_layout(24, ip >> 8 << 8, layouts) is None
+
+
+def test_ips_to_nodes():
+    m_nodes = nodes.Nodes(db, sub_id)
+    ips = set(map(common.IPStringtoInt, ['201.2.3.4', '201.2.3.5', '201.2.4.1', '201.9.1.1']))
+    nodes.NODE_CACHE.clear()
+    try:
+        processor = preprocess.Preprocessor(db, sub_id, ds_id, security_rules=False)
+        # 201; 201.2, 201.9; 201.2.3, 201.2.4, 201.9.1; and the 4 hosts
+        assert processor.ips_to_nodes(ips) == 10
+        stored = read_nodes('201')
+        assert len(stored) == 10
+        assert stored[common.determine_range_string('201.2.3')][0] == 24
+        # only nodes that were committed are cached
+        assert nodes.NODE_CACHE.stats()['size'] == 0
+        assert len(processor.new_nodes) == 10
+
+        # known nodes are found in the table, and not added again
+        processor = preprocess.Preprocessor(db, sub_id, ds_id, security_rules=False)
+        assert processor.ips_to_nodes(ips | {common.IPStringtoInt('201.2.3.6')}) == 1
+        assert nodes.NODE_CACHE.stats()['size'] == 10
+        for (ipstart, ipend), (subnet, x, y, radius) in stored.iteritems():
+            assert nodes.NODE_CACHE.lookup(sub_id, [(ipstart, ipend)]) == {(ipstart, ipend): (x, y, radius)}
+
+        # a stale cache entry for a deleted node is dropped with the delete
+        m_nodes.delete_hosts([common.IPStringtoInt('201.2.3.4')])
+        processor = preprocess.Preprocessor(db, sub_id, ds_id, security_rules=False)
+        assert processor.ips_to_nodes(ips) == 1
+    finally:
+        low, high = common.determine_range_string('201')
+        db.delete("s{0}_Nodes".format(sub_id), where="ipstart BETWEEN $low AND $high", vars={'low': low, 'high': high})
+        nodes.NODE_CACHE.clear()
@@ -0,0 +1,98 @@
+import os
+import Queue
+import pytest
+from sam import spill_queue
+from sam.spill_queue import SpillQueue
+
+
+def drain(queue):
+    packages = []
+    while True:
+        try:
+            packages.append(queue.get(timeout=0))
+        except Queue.Empty:
+            return packages
+
+
+def test_memory_only():
+    q = SpillQueue(2)
+    assert q.put('a', 1)
+    assert q.put('b', 2)
+    assert q.put('c', 3)  # drops 'a'
+    assert q.depth() == {'memory': 2, 'disk': 0, 'disk_bytes': 0, 'dropped': 1, 'dropped_lines': 1}
+    assert drain(q) == [('b', 2), ('c', 3)]
+
+    q = SpillQueue(1, policy=spill_queue.DROP_NEWEST)
+    assert q.put('a', 1)
+    assert not q.put('b', 2)
+    assert drain(q) == [('a', 1)]
+    assert q.dropped_lines == 2
+
+    with pytest.raises(ValueError):
+        SpillQueue(1, policy='drop_everything')
+
+
+def test_spill_in_order(tmpdir):
+    directory = str(tmpdir.join('spill'))
+    q = SpillQueue(2, directory, segment_size=20)
+    for i in range(6):
+        assert q.put('data{0}'.format(i), i)
+    depth = q.depth()
+    assert depth['memory'] == 2
+    assert depth['disk'] == 4
+    # 8 header bytes + 5 data bytes per record; a segment is full after 2 records
+    assert depth['disk_bytes'] == 4 * 13
+    assert len(os.listdir(directory)) == 2
+
+    assert q.get(timeout=0) == ('data0', 0)
+    assert q.get(timeout=0) == ('data1', 1)
+    assert q.get(timeout=0) == ('data2', 2)
+    # while anything is on disk, new packages queue behind it
+    assert q.put('data6', 6)
+    assert [package[1] for package in drain(q)] == [3, 4, 5, 6]
+    assert q.depth()['disk_bytes'] == 0
+    assert os.listdir(directory) == []
+    with pytest.raises(Queue.Empty):
+        q.get(timeout=0)
+
+    # back to memory once the disk is empty
+    assert q.put('data7', 7)
+    assert q.depth()['memory'] == 1
+
+
+def test_disk_budget(tmpdir):
+    directory = str(tmpdir)
+    q = SpillQueue(0, directory, segment_size=26, max_disk=52)
+    for i in range(4):
+        assert q.put('data{0}'.format(i), 1)
+    assert q.put('data4', 1)  # drops the segment holding data0 and data1
+    assert q.depth()['dropped'] == 2
+    assert [data for data, _ in drain(q)] == ['data2', 'data3', 'data4']
+
+    q = SpillQueue(0, directory, segment_size=26, max_disk=52, policy=spill_queue.DROP_NEWEST)
+    for i in range(4):
+        assert q.put('data{0}'.format(i), 1)
+    assert not q.put('data4', 1)
+    assert q.depth()['dropped'] == 1
+    assert [data for data, _ in drain(q)] == ['data0', 'data1', 'data2', 'data3']
+
+
+def test_recover(tmpdir):
+    directory = str(tmpdir)
+    q = SpillQueue(1, directory)
+    q.put('first', 1)
+    q.put('second', 2)
+    q.put('third', 3)
+    assert q.get(timeout=0) == ('first', 1)
+    q.unget('first', 1)
+    q.close()
+
+    # a partial record at the end of a segment is cut off
+    segment = os.path.join(directory, sorted(os.listdir(directory))[-1])
+    with open(segment, 'ab') as f:
+        f.write('\x05\x00')
+
+    q = SpillQueue(1, directory)
+    assert len(q) == 3
+    assert drain(q) == [('second', 2), ('third', 3), ('first', 1)]
+    assert os.listdir(directory) == []